@@ -8,17 +8,20 @@ import logging
 import multiprocessing
 from collections import defaultdict, namedtuple
 
+import pysam
 from pbcore.util.Process import backticks
-from pbcore.io import FastaWriter
+from pbcore.io import FastaWriter, ConsensusReadSet
 
 from pbtranscript.PBTranscriptException import PBTranscriptException
 from pbtranscript.io import DOMReader
 from pbtranscript.io.ContigSetReaderWrapper import ContigSetReaderWrapper
-from pbtranscript.io import ReadAnnotation
-from pbtranscript.io.PbiBamIO import CCSInput
+from pbtranscript.io import ReadAnnotation, PrimerReportWriter
+from pbtranscript.io.PbiBamIO import (CCSInput, AnnotatedBamWriter,
+                                      annotation_from_segment, carried_tags,
+                                      cat_bams)
 from pbtranscript.io.Summary import ClassifySummary
 from pbtranscript.Utils import (revcmp, realpath, as_contigset,
-    generateChunkedFN, cat_files, real_upath, ln)
+    generateChunkedFN, cat_files, real_upath, ln, make_pbi)
 
 
 PBMATRIXFN = "PBMATRIX.txt"
@@ -76,6 +79,80 @@ class PBRead(object):
                                  format(r=self.name))
 
 
+class PrimerSeedIndex(object):
+
+    """
+    In-memory index of primer k-mers, used to locate candidate internal
+    primer sites of a read without aligning the whole read.
+
+    Seeds are exact k-mer matches, so an internal primer with an error in
+    every k-mer has no seed and is missed, although phmmer could still
+    align it. Seeding trades this recall for not scoring whole reads;
+    a smaller k recovers more erroneous primers at the cost of more windows.
+
+    Example:
+        idx = PrimerSeedIndex("primers.chimera.fasta", k=10)
+        idx.candidate_windows(seq, min_dist_from_end=100, flank=100)
+        ==> [(1200, 1330)], meaning that only seq[1200:1330] needs
+            to be scored against primers.
+    """
+
+    def __init__(self, primer_fn, k=10):
+        self.k = k
+        self.kmers = set()
+        with ContigSetReaderWrapper(primer_fn) as reader:
+            for r in reader:
+                seq = r.sequence[:].upper()
+                for i in xrange(0, len(seq) - k + 1):
+                    self.kmers.add(seq[i:i + k])
+
+    def seed_hits(self, seq, start, end):
+        """Return sorted positions within [start, end) where a primer
+        k-mer starts, by looking up each k-mer of seq in the index."""
+        k, kmers = self.k, self.kmers
+        return [i for i in xrange(max(0, start), min(end, len(seq) - k + 1))
+                if seq[i:i + k] in kmers]
+
+    def candidate_windows(self, seq, min_dist_from_end, flank):
+        """
+        Return a list of non-overlapping [start, end) windows of seq,
+        each surrounding interior seed hits, extended by 'flank' bases
+        on both sides. Hits closer than min_dist_from_end to either
+        end of seq can not make a read chimeric and are ignored.
+        """
+        seq = seq.upper()
+        start, end = min_dist_from_end, len(seq) - min_dist_from_end - self.k
+        if end <= start:
+            return []
+        windows = []
+        for i in self.seed_hits(seq, start, end):
+            s, e = max(0, i - flank), min(len(seq), i + self.k + flank)
+            if len(windows) > 0 and s <= windows[-1][1]:
+                windows[-1] = (windows[-1][0], max(e, windows[-1][1]))
+            else:
+                windows.append((s, e))
+        return windows
+
+
+def window_name(read_id, start, read_len):
+    """Return name of a chimera candidate window, which encodes the window
+    start and the read length, e.g., movie/zmw/s_e_CCS_win1200_3000"""
+    return "{r}_win{s}_{l}".format(r=read_id, s=start, l=read_len)
+
+
+def window_to_read_coordinate(r):
+    """Given a DOMRecord of a primer hit in a chimera candidate window,
+    convert the hit to read coordinates in place and return it.
+    DOMRecords of reads rather than windows are returned untouched."""
+    m = re.search(r"^(.+)_win(\d+)_(\d+)$", r.sid)
+    if m is not None:
+        offset = int(m.groups()[1])
+        r.sid = m.groups()[0]
+        r.sStart, r.sEnd = r.sStart + offset, r.sEnd + offset
+        r.sLen = int(m.groups()[2])
+    return r
+
+
 class ClassifierException(PBTranscriptException):
 
     """
@@ -119,12 +196,30 @@ class Classifier(object):
         # The output fasta file.
         self.out_all_reads_fn = realpath(out_reads_fn)
 
-        # Intermediate output fasta file before chimera detection.
-        #     trimmed full-length reads: fl.trimmed.fasta
+        # If output full-length non-chimeric reads is a BAM file, ccs BAM
+        # records are trimmed and written to BAM files with annotations
+        # as tags and pbi indices, instead of FASTA files.
+        self.bam_output = out_flnc_fn is not None and \
+            out_flnc_fn.endswith(".bam")
+        ext = ".bam" if self.bam_output else ".fasta"
+
+        # Intermediate output file before chimera detection.
+        #     trimmed full-length reads: fl.trimmed.fasta|bam
         # and
-        #     trimmed non-full-length reads: nfl.trimmed.fasta
-        self._trimmed_fl_reads_fn = op.join(self.out_dir, "fl.trimmed.fasta")
-        self._trimmed_nfl_reads_fn = op.join(self.out_dir, "nfl.trimmed.fasta")
+        #     trimmed non-full-length reads: nfl.trimmed.fasta|bam
+        self._trimmed_fl_reads_fn = op.join(self.out_dir, "fl.trimmed" + ext)
+        self._trimmed_nfl_reads_fn = op.join(self.out_dir, "nfl.trimmed" + ext)
+
+        # Intermediate output fasta files of chimera candidate windows,
+        # which are segments of trimmed reads surrounding internal primer
+        # seeds, collected while trimming primers:
+        #     fl.chimera_windows.fasta and nfl.chimera_windows.fasta
+        self._fl_chimera_windows_fn = op.join(self.out_dir,
+                                              "fl.chimera_windows.fasta")
+        self._nfl_chimera_windows_fn = op.join(self.out_dir,
+                                               "nfl.chimera_windows.fasta")
+        # number of chimera candidate windows written for fl and nfl reads.
+        self._num_chimera_windows = {"fl": 0, "nfl": 0}
 
         self.primer_front_back_fn = op.join(self.out_dir, PRIMERFRONTENDFN)
         self.primer_chimera_fn = op.join(self.out_dir, PRIMERCHIMERAFN)
@@ -133,14 +228,16 @@ class Classifier(object):
         self.primer_report_fn = primer_report_fn \
             if primer_report_fn is not None else \
             ".".join(out_reads_fn.split('.')[:-1]) + "." + PRIMERREPORTFN
-        # primer reports for nfl reads before chimera detection. Note that
-        # chimera detection is not necessary for nfl reads.
+        # Writer of primer_report_fn, which is open while classifying
+        # reads, so that primer info of each read is reported in the same
+        # pass which classifies the read. Primer info of fl reads is
+        # written after chimera detection.
+        self._reporter = None
+        # primer reports of nfl reads, which are written while classifying
+        # reads and appended to primer_report_fn after fl reads.
         self._primer_report_nfl_fn = op.join(self.out_dir,
                                              "primer_report.nfl.csv")
-        # primer reports for fl reads after chimera detection. Note that
-        # chimera detection is required for fl reads.
-        self._primer_report_fl_fn = op.join(self.out_dir,
-                                            "primer_report.fl.csv")
+        self._nfl_reporter = None
 
         # The matrix file: PBMATRIX.txt
         self.pbmatrix_fn = op.join(self.data_dir, PBMATRIXFN)
@@ -165,13 +262,13 @@ class Classifier(object):
             "." + CLASSIFYSUMMARY
 
         self.out_nfl_fn = realpath(out_nfl_fn) if out_nfl_fn is not None \
-            else op.join(self.out_dir, "nfl.fasta")
-        self.out_nflnc_fn = op.join(self.out_dir, "nflnc.fasta")
-        self.out_nflc_fn = op.join(self.out_dir, "nflc.fasta")
+            else op.join(self.out_dir, "nfl" + ext)
+        self.out_nflnc_fn = op.join(self.out_dir, "nflnc" + ext)
+        self.out_nflc_fn = op.join(self.out_dir, "nflc" + ext)
 
         self.out_flnc_fn = realpath(out_flnc_fn) if out_flnc_fn is not None \
-            else op.join(self.out_dir, "flnc.fasta")
-        self.out_flc_fn = op.join(self.out_dir, "flc.fasta")
+            else op.join(self.out_dir, "flnc" + ext)
+        self.out_flc_fn = op.join(self.out_dir, "flc" + ext)
 
         for file_attr in ["out_nfl_fn", "out_nflnc_fn", "out_nflc_fn",
                           "out_flnc_fn", "out_flc_fn", "out_all_reads_fn"]:
@@ -206,6 +303,17 @@ class Classifier(object):
             raise ClassifierException(
                 "Unable to find matrix file for PacBio reads: {fn}".
                 format(fn=pbmatrix_fn))
+        if self.bam_output:
+            with CCSInput(reads_fn) as reader:
+                if not reader.isBam:
+                    raise ClassifierException(
+                        "Unable to write BAM outputs from FASTA reads: {fn}".
+                        format(fn=reads_fn))
+            for fn in [self.out_all_reads_fn, self.out_nfl_fn]:
+                if not fn.endswith(".bam"):
+                    raise ClassifierException(
+                        "Output {fn} must be a BAM file ".format(fn=fn) +
+                        "when full-length non-chimeric reads are in BAM.")
 
     def _checkPhmmer(self):
         """Check phmmer can be called successfully."""
@@ -451,6 +559,8 @@ class Classifier(object):
         suspicous_hits = defaultdict(lambda: [])
         reader = DOMReader(domFN)
         for r in reader:
+            # Hits in chimera candidate windows are mapped back to reads.
+            r = window_to_read_coordinate(r)
             # A hit has to be in the middle of sequence, and with
             # decent score.
             if r.sStart > opts.min_dist_from_end and \
@@ -460,57 +570,98 @@ class Classifier(object):
         return suspicous_hits
 
     def _updateChimeraInfo(self, suspicous_hits, in_read_fn, out_nc_fn,
-                           out_c_fn, primer_report_fn,
-                           write_report_header=True):
+                           out_c_fn, reporter):
         """
         in_read_fn --- a fasta of full-length reads or a fasta of
                        non-full-length reads.
         For each full-length read in in_read_fn FASTA file, detect whether
         it is chimeric or not, and write its annotation to
-        primer_report_fn.
+        reporter, a PrimerReportWriter.
         Return:
             (num_nc, num_c, num_nc_bases, num_c_bases)
         """
         logging.debug("Update chimera info for reads in {f} ".
                       format(f=in_read_fn))
-        logging.debug("Write primer report to {rpt}".
-                      format(rpt=primer_report_fn))
 
         out_nc_fn_fasta, out_c_fn_fasta = out_nc_fn, out_c_fn
         if out_nc_fn.endswith(".xml"):
             out_nc_fn_fasta = out_nc_fn[:-4] + ".fasta"
         if out_c_fn.endswith(".xml"):
             out_c_fn_fasta = out_c_fn[:-4] + ".fasta"
+        header = None
+        if self.bam_output:
+            with pysam.AlignmentFile(in_read_fn, 'rb', check_sq=False) as f:
+                header = f.header
         num_nc, num_c, num_nc_bases, num_c_bases = 0, 0, 0, 0
-        with ContigSetReaderWrapper(in_read_fn) as reader, \
-                FastaWriter(out_nc_fn_fasta) as writer, \
-                FastaWriter(out_c_fn_fasta) as writer_chimera, \
-                open(primer_report_fn, 'w') as reporter:
-            if write_report_header:
-                reporter.write(ReadAnnotation.header(delimiter=",") + "\n")
-            for r in reader:
-                # e.g. r.name="movie/zmw/0_100_CCS fiveend=1;threeend=100;"
-                readid = r.name.split()[0]
-                annotation = ReadAnnotation.fromString(r.name,
-                                                       ignore_polyA=self.ignore_polyA)
-                if readid not in suspicous_hits:  # Non-chimeric reads
+        with self._openWriter(out_nc_fn_fasta, header) as writer, \
+                self._openWriter(out_c_fn_fasta, header) as writer_chimera:
+            for annotation, seq, qualities, tags in \
+                    self._iterTrimmedReads(in_read_fn):
+                if annotation.ID not in suspicous_hits:  # Non-chimeric reads
                     # Primer of a primer-trimmed read can not be None.
                     # assert(annotation.primer is not None)
                     annotation.chimera = 0
                     num_nc += 1
-                    num_nc_bases += len(r.sequence)
-                    writer.writeRecord(annotation.toAnnotation(),
-                                       r.sequence[:])
+                    num_nc_bases += len(seq)
+                    self._writeRead(writer, annotation, seq, qualities, tags)
                 else:  # chimeric reads
                     annotation.chimera = 1
                     num_c += 1
-                    num_c_bases += len(r.sequence)
-                    writer_chimera.writeRecord(annotation.toAnnotation(),
-                                               r.sequence[:])
+                    num_c_bases += len(seq)
+                    self._writeRead(writer_chimera, annotation, seq,
+                                    qualities, tags)
 
-                reporter.write(annotation.toReportRecord(delimitor=",") + "\n")
+                reporter.write(annotation)
         return (num_nc, num_c, num_nc_bases, num_c_bases)
 
+    def _openWriter(self, out_fn, header=None, make_index=True):
+        """Return a FastaWriter of out_fn, or an AnnotatedBamWriter
+        with header if outputs are BAM files."""
+        if self.bam_output:
+            return AnnotatedBamWriter(out_fn, header=header,
+                                      make_index=make_index)
+        return FastaWriter(out_fn)
+
+    def _iterTrimmedReads(self, in_read_fn):
+        """Iterate over (annotation, sequence, qualities, tags) of
+        trimmed reads in a FASTA file or a BAM file written by
+        _trimBarCode. qualities and tags are None for FASTA."""
+        if self.bam_output:
+            with pysam.AlignmentFile(in_read_fn, 'rb', check_sq=False) as reader:
+                for r in reader:
+                    yield (annotation_from_segment(r, ignore_polyA=self.ignore_polyA),
+                           r.query_sequence, r.query_qualities, carried_tags(r))
+        else:
+            with ContigSetReaderWrapper(in_read_fn) as reader:
+                for r in reader:
+                    # e.g. r.name="movie/zmw/0_100_CCS fiveend=1;threeend=100;"
+                    yield (ReadAnnotation.fromString(r.name,
+                                                     ignore_polyA=self.ignore_polyA),
+                           r.sequence[:], None, None)
+
+    @staticmethod
+    def _writeRead(writer, annotation, seq, qualities=None, tags=None):
+        """Write a read with annotation to a FastaWriter, or to an
+        AnnotatedBamWriter together with its qualities and tags."""
+        if isinstance(writer, AnnotatedBamWriter):
+            writer.writeRecord(annotation, seq, qualities,
+                               tags if tags is not None else [])
+        else:
+            writer.writeRecord(annotation.toAnnotation(), seq)
+
+    @staticmethod
+    def _trimmedQualities(read, strand, start, length):
+        """Return qualities of a trimmed read which starts at 'start' of
+        the ccs read in 'strand' with 'length' bases, or None if the ccs
+        read is not a BAM record or has no qualities."""
+        peer = getattr(read, "peer", None)
+        if peer is None or peer.query_qualities is None:
+            return None
+        qualities = peer.query_qualities
+        if strand == "-":
+            qualities = qualities[::-1]
+        return qualities[start:start + length]
+
     def _findPolyA(self, seq, min_a_num=8, three_start=None):
         """
         Find poly A tail, which has at least 'min_a_num' A bases and at most
@@ -585,7 +736,7 @@ class Classifier(object):
                     getDomRecord(dFront, k2, min_score))
 
     def _trimBarCode(self, reads_fn, out_fl_reads_fn, out_nfl_reads_fn,
-                     primer_report_nfl_fn,
+                     reporter,
                      best_of_front, best_of_back, primer_indices,
                      min_seq_len, min_score, change_read_id,
                      ignore_polyA):
@@ -597,31 +748,44 @@ class Classifier(object):
         , save non-full-length reads to 'out_nfl_reads_fn',
         , save full-length reads to 'out_fl_reads_fn', which can later be
         used in chimera detection
-        , write primer info of nfl reads to _primer_report_nfl_fn.
+        , write primer info of nfl reads to reporter, a PrimerReportWriter.
 
         Note that chimera detection is not necessary for nfl reads, but
         is required for fl reads. So we only write primer info for nfl here
-        and will write primer info for fl reads when chimera detection
-        is done.
+        (unless chimera detection on nfl reads is required) and will write
+        primer info for fl reads when chimera detection is done.
 
         best_of_front/Back: {read_id: {primer_name:DOMRecord}}
         min_seq_len: minimum length to output a read.
         min_score: minimum score to output a read.
         change_read_id: if True, change read ids to 'movie/zmw/start_end'.
+
+        Chimera candidate windows of fl reads (and nfl reads if chimera
+        detection on nfl reads is required) are written to
+        _fl_chimera_windows_fn and _nfl_chimera_windows_fn in the same pass.
         """
         logging.info("Trim bar code away from reads.")
         logging.debug("Writing full-length trimmed reads to {f}".
                       format(f=out_fl_reads_fn))
         logging.debug("Writing non-full-length trimmed reads to {f}".
                       format(f=out_nfl_reads_fn))
-        logging.debug("Writing primer reports before chimera detection to {f}".
-                      format(f=primer_report_nfl_fn))
+
+        seed_index = PrimerSeedIndex(self.primer_chimera_fn)
+        header = None
+        if self.bam_output:
+            with CCSInput(reads_fn) as reader:
+                header = reader.header
+        detect_chimera_nfl = self.chimera_detection_opts.detect_chimera_nfl
+        self._num_chimera_windows = {"fl": 0, "nfl": 0}
 
         # these might be XML (ContigSet) filenames
         with CCSInput(reads_fn) as fareader, \
-                FastaWriter(out_nfl_reads_fn) as nfl_fawriter, \
-                FastaWriter(out_fl_reads_fn) as fl_fawriter, \
-                open(primer_report_nfl_fn, 'w') as reporter:
+                self._openWriter(out_nfl_reads_fn, header=header,
+                                 make_index=False) as nfl_fawriter, \
+                self._openWriter(out_fl_reads_fn, header=header,
+                                 make_index=False) as fl_fawriter, \
+                open(self._fl_chimera_windows_fn, 'w') as fl_wwriter, \
+                open(self._nfl_chimera_windows_fn, 'w') as nfl_wwriter:
             for read in fareader:
                 self.summary.num_reads += 1  # number of ROI reads
                 pbread = PBRead(read)
@@ -645,12 +809,20 @@ class Classifier(object):
                                   isccs=("_CCS" if pbread.isCCS else ""))
                     annotation = ReadAnnotation(ID=newName)
                     # Write reports of nfl reads
-                    reporter.write(annotation.toReportRecord(delimitor=",") + "\n")
+                    if not detect_chimera_nfl:
+                        reporter.write(annotation)
                     if len(read.sequence) >= min_seq_len:
                         # output non-full-length reads to nfl.trimmed.fasta
-                        nfl_fawriter.writeRecord(annotation.toAnnotation(),
-                                                 read.sequence[:])
+                        self._writeRead(nfl_fawriter, annotation, read.sequence[:],
+                                        self._trimmedQualities(read, "+", 0,
+                                                               len(read.sequence)),
+                                        carried_tags(read.peer)
+                                        if self.bam_output else None)
                         self.summary.num_nfl += 1
+                        if detect_chimera_nfl:
+                            self._num_chimera_windows["nfl"] += \
+                                self._writeChimeraWindows(nfl_wwriter, seed_index,
+                                                          newName, read.sequence[:])
                     else:
                         self.summary.num_filtered_short_reads += 1
                     continue
@@ -694,21 +866,50 @@ class Classifier(object):
                                             ignore_polyA=ignore_polyA)
 
                 # Write reports for nfl reads
-                if annotation.isFullLength is not True:
-                    reporter.write(annotation.toReportRecord(delimitor=",") + "\n")
+                if annotation.isFullLength is not True and \
+                        not detect_chimera_nfl:
+                    reporter.write(annotation)
 
                 if len(seq) >= min_seq_len:
+                    qualities = self._trimmedQualities(
+                        read, strand, five_end if five_end is not None else 0,
+                        len(seq))
+                    tags = carried_tags(read.peer) if self.bam_output else None
                     if annotation.isFullLength is True:
                         # Write long full-length reads
-                        fl_fawriter.writeRecord(annotation.toAnnotation(), seq[:])
+                        self._writeRead(fl_fawriter, annotation, seq,
+                                        qualities, tags)
                         self.summary.num_fl += 1
+                        self._num_chimera_windows["fl"] += \
+                            self._writeChimeraWindows(fl_wwriter, seed_index,
+                                                      newName, seq)
                     else:
                         # Write long non-full-length reads.
-                        nfl_fawriter.writeRecord(annotation.toAnnotation(), seq[:])
+                        self._writeRead(nfl_fawriter, annotation, seq,
+                                        qualities, tags)
                         self.summary.num_nfl += 1
+                        if detect_chimera_nfl:
+                            self._num_chimera_windows["nfl"] += \
+                                self._writeChimeraWindows(nfl_wwriter, seed_index,
+                                                          newName, seq)
                 else:
                     self.summary.num_filtered_short_reads += 1
 
+    def _writeChimeraWindows(self, writer, seed_index, read_id, seq):
+        """Find chimera candidate windows of a trimmed read using primer
+        seeds, write windows to writer and return the number of windows.
+        Only windows are scored by phmmer later, so a read without any
+        exact internal primer seed is not detected as chimeric, even if
+        phmmer would have found an internal primer with errors in it,
+        see PrimerSeedIndex."""
+        windows = seed_index.candidate_windows(
+            seq=seq, min_dist_from_end=self.chimera_detection_opts.min_dist_from_end,
+            flank=self.chimera_detection_opts.primer_search_window)
+        for s, e in windows:
+            writer.write(">{n}\n{s}\n".format(n=window_name(read_id, s, len(seq)),
+                                              s=seq[s:e]))
+        return len(windows)
+
     def _validate_outputs(self, out_dir, out_all_reads_fn):
         """Validate and create output directory."""
         logging.info("Creating output directory {d}.".format(d=out_dir))
@@ -748,6 +949,14 @@ class Classifier(object):
             primer_out_fn=self.primer_front_back_fn,
             revcmp_primers=False)
 
+        # Create forward/reverse primers for chimera detection, which are
+        # seeded while trimming primers in order to find internal primers.
+        self._processPrimers(
+            primer_fn=self.primer_fn,
+            window_size=self.chimera_detection_opts.primer_search_window,
+            primer_out_fn=self.primer_chimera_fn,
+            revcmp_primers=True)
+
         logging.info("reuse_dom = {0}".format(self.reuse_dom))
         if op.exists(self.out_front_back_dom_fn) and self.reuse_dom:
             logging.warn("Primer detection output already exists. Parsing {0}".
@@ -794,7 +1003,7 @@ class Classifier(object):
         self._trimBarCode(reads_fn=self.reads_fn,
                           out_fl_reads_fn=self._trimmed_fl_reads_fn,
                           out_nfl_reads_fn=self._trimmed_nfl_reads_fn,
-                          primer_report_nfl_fn=self._primer_report_nfl_fn,
+                          reporter=self._nfl_reporter,
                           best_of_front=best_of_front,
                           best_of_back=best_of_back,
                           primer_indices=primer_indices,
@@ -808,18 +1017,22 @@ class Classifier(object):
         self._cleanup(self.chunked_front_back_dom_fns)
         logging.info("Done with finding and trimming primers and polyAs.")
 
-    def _detect_chimera(self, in_fasta, out_nc_fasta, out_c_fasta,
-                        primer_report_fn, out_dom, num_reads, job_name):
-        """Detect chimeric reads from in_fasta, call phmmer to generate a
+    def _detect_chimera(self, in_fasta, in_windows_fasta, out_nc_fasta,
+                        out_c_fasta, reporter, out_dom, num_windows,
+                        job_name):
+        """Detect chimeric reads from in_fasta, call phmmer on chimera
+        candidate windows of these reads in in_windows_fasta to generate a
         dom file (out_dom), save non-chimeric reads to out_nc_fasta and
         chimeric reads to out_c_fasta.
             in_fasta --- either a fasta of trimmed fl reads, or a fasta of
                          trimmed nfl reads.
+            in_windows_fasta --- a fasta of chimera candidate windows
+                         of reads in in_fasta.
             out_nc_fasta --- an output fasta of non-chimeric reads
             out_c_fasta --- an output fasta of chimeric reads
-            primer_report_fn --- an output primer report
+            reporter --- a PrimerReportWriter of primer report
             out_dom --- phmmer output
-            num_reads --- number of reads in in_fasta
+            num_windows --- number of windows in in_windows_fasta
             job_name --- either 'fl' or 'nfl'
         Return:
             (num_nc, num_c, num_nc_bases, num_c_bases)
@@ -827,10 +1040,14 @@ class Classifier(object):
         if op.exists(out_dom) and self.reuse_dom:
             logging.warn("Chimera detection output already exists. Parse {o}.".
                          format(o=out_dom))
+        elif num_windows == 0:
+            logging.info("No internal primer seeds found in {f}.".
+                         format(f=in_fasta))
+            open(out_dom, 'w').close()
         else:
-            num_chunks = max(min(num_reads, self.cpus), 1)
-            reads_per_chunk = int(math.ceil(num_reads / float(num_chunks)))
-            num_chunks = int(math.ceil(num_reads / float(reads_per_chunk)))
+            num_chunks = max(min(num_windows, self.cpus), 1)
+            reads_per_chunk = int(math.ceil(num_windows / float(num_chunks)))
+            num_chunks = int(math.ceil(num_windows / float(reads_per_chunk)))
 
             chunked_reads_fns = generateChunkedFN(self.out_dir,
                                                   "in.{n}.trimmed.fasta_split".format(n=job_name), num_chunks)
@@ -838,7 +1055,7 @@ class Classifier(object):
             chunked_dom_fns = generateChunkedFN(self.out_dir,
                                                 "out.{n}.trimmed.hmmer_split".format(n=job_name), num_chunks)
 
-            self._chunkReads(reads_fn=in_fasta,
+            self._chunkReads(reads_fn=in_windows_fasta,
                              reads_per_chunk=reads_per_chunk,
                              chunked_reads_fns=chunked_reads_fns,
                              extract_front_back_only=False)
@@ -858,32 +1075,27 @@ class Classifier(object):
                                     in_read_fn=in_fasta,
                                     out_nc_fn=out_nc_fasta,
                                     out_c_fn=out_c_fasta,
-                                    primer_report_fn=primer_report_fn,
-                                    write_report_header=True if job_name == "fl" else False)
+                                    reporter=reporter)
 
         return (num_nc, num_c, num_nc_bases, num_c_bases)
 
     def runChimeraDetector(self):
         """Call chimera detection on full-length reads, and non-full-length
-        reads if required."""
-        # Create forward/reverse primers for chimera detection.
-        self._processPrimers(
-            primer_fn=self.primer_fn,
-            window_size=self.chimera_detection_opts.primer_search_window,
-            primer_out_fn=self.primer_chimera_fn,
-            revcmp_primers=True)
-
+        reads if required. Primers for chimera detection have been created
+        and chimera candidate windows have been collected in
+        runPrimerTrimmer."""
         # Detect chimeras among full-length reads, separate flnc reads and
         # flc reads.
         logging.info("Detect chimeric reads from trimmed full-length reads.")
         (self.summary.num_flnc, self.summary.num_flc,
          self.summary.num_flnc_bases, _x) = \
             self._detect_chimera(in_fasta=self._trimmed_fl_reads_fn,
+                                 in_windows_fasta=self._fl_chimera_windows_fn,
                                  out_nc_fasta=self.out_flnc_fn_fasta,
                                  out_c_fasta=self.out_flc_fn,
-                                 primer_report_fn=self._primer_report_fl_fn,
+                                 reporter=self._reporter,
                                  out_dom=self.out_trimmed_fl_dom_fn,
-                                 num_reads=self.summary.num_fl,
+                                 num_windows=self._num_chimera_windows["fl"],
                                  job_name="fl")
         assert(self.summary.num_fl == self.summary.num_flnc +
                self.summary.num_flc)
@@ -891,17 +1103,18 @@ class Classifier(object):
                      "reads.")
 
         # Detect chimeras among non-full-length reads if required, separate
-        # nflnc reads and nflc reads, rewrite self.primer_report_nfl_fn.
+        # nflnc reads and nflc reads, report primer info of nfl reads.
         if self.chimera_detection_opts.detect_chimera_nfl is True:
             logging.info("Detect chimeric reads from trimmed non-full-length " +
                          "reads.")
             (self.summary.num_nflnc, self.summary.num_nflc, _x, _y) = \
                 self._detect_chimera(in_fasta=self._trimmed_nfl_reads_fn,
+                                     in_windows_fasta=self._nfl_chimera_windows_fn,
                                      out_nc_fasta=self.out_nflnc_fn,
                                      out_c_fasta=self.out_nflc_fn,
-                                     primer_report_fn=self._primer_report_nfl_fn,
+                                     reporter=self._nfl_reporter,
                                      out_dom=self.out_trimmed_nfl_dom_fn,
-                                     num_reads=self.summary.num_nfl,
+                                     num_windows=self._num_chimera_windows["nfl"],
                                      job_name="nfl")
             assert(self.summary.num_nfl == self.summary.num_nflnc +
                    self.summary.num_nflc)
@@ -909,28 +1122,31 @@ class Classifier(object):
                          "non-full-length reads.")
 
             # Concatenate out_nflnc_fn and out_nflc_fn as out_nfl_fn
-            cat_files(src=[self.out_nflnc_fn_fasta, self.out_nflc_fn_fasta],
-                      dst=self.out_nfl_fn_fasta)
+            self._catReads(src=[self.out_nflnc_fn_fasta, self.out_nflc_fn_fasta],
+                           dst=self.out_nfl_fn_fasta)
             # Concatenate out_flnc and out_nflnc to make out_all_reads_fn
-            cat_files(src=[self.out_flnc_fn_fasta, self.out_nflnc_fn_fasta],
-                      dst=self.out_all_reads_fn_fasta)
+            self._catReads(src=[self.out_flnc_fn_fasta, self.out_nflnc_fn_fasta],
+                           dst=self.out_all_reads_fn_fasta)
 
         else:
             # Soft link _trimmed_nfl_reads_fn as out_nfl_fn
             ln(self._trimmed_nfl_reads_fn, self.out_nfl_fn_fasta)
+            if self.bam_output:
+                make_pbi(self.out_nfl_fn_fasta)
             # Concatenate out_flnc and out_nfl to make out_all_reads_fn
-            cat_files(src=[self.out_flnc_fn_fasta, self.out_nfl_fn_fasta],
-                      dst=self.out_all_reads_fn_fasta)
-
-        # primer info of fl/nfl reads reported to _primer_report_fl_fn
-        # and _primer_report_nfl_fn, concatenate them in order to make
-        # a full report: primer_report_fn.
-        cat_files(src=[self._primer_report_fl_fn, self._primer_report_nfl_fn],
-                  dst=self.primer_report_fn)
+            self._catReads(src=[self.out_flnc_fn_fasta, self.out_nfl_fn_fasta],
+                           dst=self.out_all_reads_fn_fasta)
 
         # Delete intermediate files.
-        self._cleanup([self._primer_report_nfl_fn,
-                       self._primer_report_fl_fn])
+        self._cleanup([self._fl_chimera_windows_fn,
+                       self._nfl_chimera_windows_fn])
+
+    def _catReads(self, src, dst):
+        """Concatenate FASTA files, or BAM files if outputs are BAM."""
+        if self.bam_output:
+            cat_bams(src=src, dst=dst)
+        else:
+            cat_files(src=src, dst=dst)
 
     def run(self):
         """Classify/annotate reads according to 5' primer seen,
@@ -951,27 +1167,43 @@ class Classifier(object):
         # Sanity check phmmer can be called successfully.
         self._checkPhmmer()
 
-        # Find and trim primers and polyAs.
-        self.runPrimerTrimmer()
-
-        # Check whether no fl reads detected.
+        # Primer info of each read is reported while reads are classified.
+        logging.info("Writing primer report to {f}".
+                     format(f=self.primer_report_fn))
         no_flnc_errMsg = "No full-length non-chimeric reads detected."
-        if self.summary.num_fl == 0:
-            logging.error(no_flnc_errMsg)
-            if not self.ignore_empty_output:
-                raise ClassifierException(no_flnc_errMsg)
-        else:
-            # Detect chimeras and generate primer reports.
-            self.runChimeraDetector()
+        with PrimerReportWriter(self.primer_report_fn) as self._reporter:
+            with PrimerReportWriter(self._primer_report_nfl_fn,
+                                    write_header=False) as self._nfl_reporter:
+                # Find and trim primers and polyAs.
+                self.runPrimerTrimmer()
+
+                # Check whether no fl reads detected.
+                if self.summary.num_fl == 0:
+                    logging.error(no_flnc_errMsg)
+                    if not self.ignore_empty_output:
+                        raise ClassifierException(no_flnc_errMsg)
+                else:
+                    # Detect chimeras and generate primer reports.
+                    self.runChimeraDetector()
+
+            # Report nfl reads after fl reads.
+            self._reporter.append(self._primer_report_nfl_fn)
+        self._cleanup([self._primer_report_nfl_fn])
 
         dataset_uuids = []
         for file_attr in ["out_nfl_fn", "out_nflnc_fn", "out_nflc_fn",
                           "out_flnc_fn", "out_flc_fn", "out_all_reads_fn"]:
             file_name = getattr(self, file_attr)
             fasta_file_name = getattr(self, "%s_fasta" % file_attr)
-            ds = as_contigset(
-                fasta_file=fasta_file_name,
-                xml_file=file_name)
+            if self.bam_output:
+                # BAM outputs are indexed while being written.
+                if not op.exists(file_name):
+                    continue
+                ds = ConsensusReadSet(file_name)
+            else:
+                ds = as_contigset(
+                    fasta_file=fasta_file_name,
+                    xml_file=file_name)
             if file_attr in ["out_all_reads_fn", "out_nfl_fn", "out_flnc_fn"]:
                 dataset_uuids.append(ds.uuid)
 
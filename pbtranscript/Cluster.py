@@ -234,7 +234,8 @@ class Cluster(IceFiles):
                     fa=first_split_fa, ccs=self.ccs_fofn,
                     fq=first_split_fq), level=logging.INFO)
                 ice_fa2fq(in_fa=first_split_fa, ccs_fofn=self.ccs_fofn,
-                          out_fq=first_split_fq)
+                          out_fq=first_split_fq,
+                          num_workers=self.sge_opts.blasr_nproc)
                 # Set probqv from the first splitted FASTQ file.
                 self._probqv, msg = set_probqv_from_fq(fastq_filename=first_split_fq)
             else: # use predefined model
@@ -4,17 +4,24 @@
 Utils for combining output files from cluster bins.
 """
 
+import os
 import os.path as op
 import logging
+import shutil
 import cPickle
+from multiprocessing import Pool
 
 from pbcore.io import FastqReader, FastqWriter, FastaWriter
 
 from pbtranscript.io.ContigSetReaderWrapper import ContigSetReaderWrapper
+from pbtranscript.io.PartialUCIO import load_partial_uc
 from pbtranscript.Utils import mkdir, realpath
 from pbtranscript.ice.IceQuiverPostprocess import IceQuiverPostprocess
 from pbtranscript.ice.IceFiles import write_cluster_summary
 
+# Buffer size of copying per-bin fragments to combined files.
+COMBINE_BUFFER_SIZE = 8 * 1024 * 1024
+
 
 class CombinedFiles(object):
 
@@ -93,10 +100,106 @@ def combined_cid_lq_name(name, cluster_bin_index, sample_name):
                                               sample_name=sample_name), n=name)
 
 
+def fragment_filename(combined_fn, cluster_bin_index):
+    """Return fragment of combined_fn which saves isoforms of a cluster bin."""
+    return "{f}.i{i}.part".format(f=combined_fn, i=cluster_bin_index)
+
+
+COMBINED_CID_NAME_FUNCS = {"HQ": combined_cid_hq_name,
+                            "LQ": combined_cid_lq_name,
+                            "ICE": combined_cid_ice_name}
+
+
+def combine_bin_isoforms(args):
+    """
+    Rename isoforms of a cluster bin and write them to fragments,
+    args = (in_fn, isoform_type, cluster_bin_index, sample_name, out_fa, out_fq).
+      in_fn -- FASTQ if out_fq is not None, else FASTA, FASTQ or ContigSet
+      isoform_type -- HQ, LQ or ICE, see combined_cid_*_name
+      out_fq -- renamed isoforms in FASTQ, or None
+    Return number of isoforms.
+    """
+    in_fn, isoform_type, cluster_bin_index, sample_name, out_fa, out_fq = args
+    name_func = COMBINED_CID_NAME_FUNCS[isoform_type]
+    n = 0
+    fa_writer = FastaWriter(out_fa)
+    fq_writer = None if out_fq is None else FastqWriter(out_fq)
+    try:
+        reader = ContigSetReaderWrapper(in_fn) if out_fq is None else FastqReader(in_fn)
+        with reader:
+            for read in reader:
+                name = name_func(name=read.name, cluster_bin_index=cluster_bin_index,
+                                 sample_name=sample_name)
+                fa_writer.writeRecord(name, read.sequence[:])
+                if fq_writer is not None:
+                    fq_writer.writeRecord(name, read.sequence[:], read.quality)
+                n += 1
+    finally:
+        fa_writer.close()
+        if fq_writer is not None:
+            fq_writer.close()
+    return n
+
+
+def concat_fragments(fragment_fns, combined_fn):
+    """Concatenate fragments in order to combined_fn, and remove them."""
+    with open(combined_fn, 'wb') as writer:
+        for fn in fragment_fns:
+            with open(fn, 'rb') as reader:
+                shutil.copyfileobj(reader, writer, COMBINE_BUFFER_SIZE)
+    for fn in fragment_fns:
+        os.remove(fn)
+
+
+def combine_isoforms_of_bins(jobs, sample_name, nproc=1):
+    """
+    Combine isoforms of cluster bins by nproc worker processes, each of
+    which renames isoforms of one cluster bin and writes them to fragments
+    of combined files. Fragments are then concatenated in order of jobs.
+    Fragments are removed even if combining fails.
+      jobs -- a list of (in_fn, isoform_type, combined_fa, combined_fq, cluster_bin_index),
+              combined_fq may be None.
+    """
+    args = [(in_fn, isoform_type, i, sample_name, fragment_filename(fa, i),
+             None if fq is None else fragment_filename(fq, i))
+            for in_fn, isoform_type, fa, fq, i in jobs]
+
+    fragments = {} # combined file --> fragments in order of jobs
+    combined_fns = []
+    for _in_fn, _isoform_type, fa, fq, i in jobs:
+        for fn in (fa, fq):
+            if fn is not None:
+                if fn not in fragments:
+                    fragments[fn] = []
+                    combined_fns.append(fn)
+                fragments[fn].append(fragment_filename(fn, i))
+
+    try:
+        if nproc > 1 and len(args) > 1:
+            pool = Pool(processes=min(nproc, len(args)))
+            try:
+                pool.map(combine_bin_isoforms, args)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for arg in args:
+                combine_bin_isoforms(arg)
+
+        for fn in combined_fns:
+            concat_fragments(fragments[fn], fn)
+    finally:
+        for fn in combined_fns:
+            for fragment_fn in fragments[fn]:
+                if op.exists(fragment_fn):
+                    os.remove(fragment_fn)
+
+
 def combine_polished_isoforms(split_indices, split_hq_fns, split_lq_fns,
                               combined_hq_fa, combined_hq_fq,
                               combined_lq_fa, combined_lq_fq,
-                              hq_lq_prefix_dict_pickle, sample_name):
+                              hq_lq_prefix_dict_pickle, sample_name,
+                              nproc=1):
     """Combine split hq (lq) files and save to combined_dir.
     Dumping hq|lq prefix dictionary to pickle.
     Return an instance of CombinedFiles.
@@ -104,18 +207,14 @@ def combine_polished_isoforms(split_indices, split_hq_fns, split_lq_fns,
       split_indices -- indices of splitted cluster bins.
       split_hq_fns -- hq files, #['*/all_quivered_hq.100_30_0.99.fastq', ...]
       split_lq_fns -- lq files, #['all_quivered_lq.fastq', ...]
+      nproc -- number of processes to combine cluster bins
     """
     assert len(split_indices) == len(split_hq_fns)
     assert len(split_indices) == len(split_lq_fns)
     assert all([f.endswith(".fastq") for f in split_hq_fns + split_lq_fns])
 
     hq_pre_dict, lq_pre_dict = {}, {}
-
-    hq_fa_writer = FastaWriter(combined_hq_fa)
-    hq_fq_writer = FastqWriter(combined_hq_fq)
-    lq_fa_writer = FastaWriter(combined_lq_fa)
-    lq_fq_writer = FastqWriter(combined_lq_fq)
-
+    jobs = []
     for i, split_hq, split_lq in zip(split_indices, split_hq_fns, split_lq_fns):
         logging.debug("Adding prefix i%s_| to %s, %s", str(i), split_hq, split_lq)
         hq_prefix = combined_prefix(cluster_bin_index=i, isoform_type="HQ",
@@ -126,49 +225,34 @@ def combine_polished_isoforms(split_indices, split_hq_fns, split_lq_fns,
         hq_pre_dict[hq_prefix] = op.dirname(op.abspath(split_hq))
         lq_pre_dict[lq_prefix] = op.dirname(op.abspath(split_lq))
 
-        with FastqReader(split_hq) as reader:
-            for read in reader:
-                name = combined_cid_hq_name(cluster_bin_index=i,
-                                            name=read.name, sample_name=sample_name)
-                hq_fa_writer.writeRecord(name, read.sequence[:])
-                hq_fq_writer.writeRecord(name, read.sequence[:], read.quality)
+        jobs.append((split_hq, "HQ", combined_hq_fa, combined_hq_fq, i))
+        jobs.append((split_lq, "LQ", combined_lq_fa, combined_lq_fq, i))
 
-        with FastqReader(split_lq) as reader:
-            for read in reader:
-                name = combined_cid_lq_name(cluster_bin_index=i,
-                                            name=read.name, sample_name=sample_name)
-                lq_fa_writer.writeRecord(name, read.sequence[:])
-                lq_fq_writer.writeRecord(name, read.sequence[:], read.quality)
-    hq_fa_writer.close()
-    hq_fq_writer.close()
-    lq_fa_writer.close()
-    lq_fq_writer.close()
+    combine_isoforms_of_bins(jobs=jobs, sample_name=sample_name, nproc=nproc)
     logging.info("HQ polished output combined to:%s", combined_hq_fq)
     logging.info("LQ polished output combined to:%s", combined_lq_fq)
 
     logging.info("Dumping hq|lq prefix dictionary to:%s", hq_lq_prefix_dict_pickle)
     with open(hq_lq_prefix_dict_pickle, 'wb') as writer:
-        cPickle.dump({'HQ': hq_pre_dict, 'LQ': lq_pre_dict}, writer)
+        cPickle.dump({'HQ': hq_pre_dict, 'LQ': lq_pre_dict}, writer,
+                     cPickle.HIGHEST_PROTOCOL)
 
 
 def combine_consensus_isoforms(split_indices, split_files,
                                combined_consensus_isoforms_fa,
-                               sample_name):
+                               sample_name, nproc=1):
     """
     Parameters:
       split_indices -- indices of splitted cluster bins.
       split_files -- consensus isoforms in each splitted cluster bin.
+      nproc -- number of processes to combine cluster bins
     """
     assert len(split_indices) == len(split_files)
-    writer = FastaWriter(combined_consensus_isoforms_fa)
+    jobs = []
     for i, split_fn in zip(split_indices, split_files):
         logging.debug("Adding prefix i%s to %s.", str(i), split_fn)
-        with ContigSetReaderWrapper(split_fn) as reader:
-            for read in reader:
-                name = combined_cid_ice_name(name=read.name, cluster_bin_index=i,
-                                             sample_name=sample_name)
-                writer.writeRecord(name, read.sequence[:])
-    writer.close()
+        jobs.append((split_fn, "ICE", combined_consensus_isoforms_fa, None, i))
+    combine_isoforms_of_bins(jobs=jobs, sample_name=sample_name, nproc=nproc)
     logging.info("Consensus isoforms output combined to:%s",
                  combined_consensus_isoforms_fa)
 
@@ -200,14 +284,14 @@ def write_combined_cluster_report(split_indices, split_uc_pickles,
             logging.info("Combining uc pickle %s and partial uc pickle %s",
                          uc_pickle, partial_uc_pickle)
             uc = cPickle.load(open(uc_pickle, 'rb'))['uc']
-            partial_uc = cPickle.load(open(partial_uc_pickle, 'rb'))['partial_uc']
+            partial_uc = load_partial_uc(partial_uc_pickle)['partial_uc']
             for c in uc.keys():
                 for r in uc[c]:
                     cid = combined_cid_ice_name(name="c{c}".format(c=c),
                                                 cluster_bin_index=i,
                                                 sample_name=sample_name)
                     f.write("{cid},{r},FL\n".format(cid=cid, r=r))
-                if partial_uc is not None and c in partial_uc.keys():
+                if partial_uc is not None and c in partial_uc:
                     for r in partial_uc[c]:
                         f.write("{cid},{r},NonFL\n".format(cid=cid, r=r))
 
@@ -222,10 +306,11 @@ class CombineRunner(CombinedFiles):
       i<sid>_HQ_<sample_prefix>|c<cid>/f?p?/len
       i<sid>_LQ_<sample_prefix>|c<cid>/f?p?/len
     """
-    def __init__(self, combined_dir, sample_name, split_dirs, ipq_opts):
+    def __init__(self, combined_dir, sample_name, split_dirs, ipq_opts, nproc=1):
         super(CombineRunner, self).__init__(combined_dir=combined_dir)
 
         self.sample_name = sample_name
+        self.nproc = nproc
         self.split_dirs = split_dirs
         self.split_indices = range(0, len(split_dirs))
 
@@ -258,13 +343,15 @@ class CombineRunner(CombinedFiles):
                                   combined_lq_fa=self.all_lq_fa,
                                   combined_lq_fq=self.all_lq_fq,
                                   hq_lq_prefix_dict_pickle=self.hq_lq_prefix_dict_pickle,
-                                  sample_name=self.sample_name)
+                                  sample_name=self.sample_name,
+                                  nproc=self.nproc)
 
         logging.info("Merging consensus isoforms from all cluster bins.")
         combine_consensus_isoforms(split_indices=self.split_indices,
                                    split_files=self.consensus_isoforms_fns,
                                    combined_consensus_isoforms_fa=self.all_consensus_isoforms_fa,
-                                   sample_name=self.sample_name)
+                                   sample_name=self.sample_name,
+                                   nproc=self.nproc)
 
         logging.info("Writing cluster summary to %s", self.all_cluster_summary_fn)
         write_cluster_summary(summary_fn=self.all_cluster_summary_fn,
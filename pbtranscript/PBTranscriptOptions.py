@@ -73,7 +73,9 @@ def add_classify_arguments(parser):
     tcp = parser.tool_contract_parser
 
     parser = parser.arg_parser.parser
-    helpstr = "Output full-length non-chimeric reads in FASTA or ContigSet"
+    helpstr = "Output full-length non-chimeric reads in FASTA or ContigSet, " + \
+              "or in BAM with annotations as tags if input is BAM. " + \
+              "If BAM, all other outputs must be BAM as well."
     tcp.add_output_file_type(FileTypes.DS_CONTIG, "flnc", # idx 1
         name="Full-length non-chimeric reads",
         description=helpstr,
@@ -84,7 +86,7 @@ def add_classify_arguments(parser):
                         default=None,
                         help=helpstr)
 
-    helpstr = "Output non-full-length reads in FASTA or ContigSet"
+    helpstr = "Output non-full-length reads in FASTA or ContigSet or BAM"
     parser.add_argument("--nfl",
                         dest="nfl_fa",
                         type=str,
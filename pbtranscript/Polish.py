@@ -160,7 +160,8 @@ class Polish(IceFiles):
         self.icepq = IceQuiverPostprocess(root_dir=self.root_dir,
                                           use_sge=self.sge_opts.use_sge,
                                           quit_if_not_done=False,
-                                          ipq_opts=self.ipq_opts)
+                                          ipq_opts=self.ipq_opts,
+                                          nproc=self.sge_opts.quiver_nproc)
         self.add_log("IceQuiverPostprocess log: {f}.".
                      format(f=self.icepq.log_fn), level=logging.INFO)
         self.icepq.run()
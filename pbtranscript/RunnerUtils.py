@@ -7,6 +7,10 @@ import subprocess
 import logging
 import time
 import os
+import os.path as op
+import select
+import ctypes
+import ctypes.util
 from multiprocessing.pool import ThreadPool
 from pbcore.util.Process import backticks
 from pbtranscript.ClusterOptions import SgeOptions
@@ -74,6 +78,123 @@ def local_job_runner(cmds_list, num_threads, throw_error=True):
         return failed_cmds
 
 
+def backoff_intervals(initial=0.5, maximum=600, factor=2):
+    """Yield exponentially increasing intervals in seconds, starting
+    from initial and capped by maximum."""
+    interval = initial
+    while True:
+        yield interval
+        interval = min(maximum, interval * factor)
+
+
+# inotify events of a file being created, moved in, written or touched.
+IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE = 0x4, 0x8, 0x80, 0x100
+IN_NONBLOCK, IN_CLOEXEC = 0o4000, 0o2000000
+
+
+def _load_inotify():
+    """Return libc if it supports inotify, otherwise None."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None
+    if hasattr(libc, 'inotify_init1') and hasattr(libc, 'inotify_add_watch'):
+        return libc
+    return None
+
+
+class DirectoryWatcher(object):
+
+    """
+    Watch directories for files being created, moved in, written or
+    touched, by inotify where available (Linux).
+
+    Note that inotify does not see files written by other hosts on
+    network file systems, so callers should always wait with a timeout
+    and check files again, e.g., by wait_for_files. Without inotify,
+    wait(timeout) simply sleeps for timeout.
+
+    Example:
+        with DirectoryWatcher(['output/map_noFL']) as watcher:
+            while not op.exists('output/map_noFL/a.DONE'):
+                watcher.wait(timeout=10)
+    """
+
+    _libc = _load_inotify()
+
+    def __init__(self, dirs):
+        self.fd = None
+        if self._libc is None:
+            return
+        fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            logging.debug("Unable to init inotify, errno %s.", ctypes.get_errno())
+            return
+        mask = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        for d in set(dirs):
+            if self._libc.inotify_add_watch(fd, op.abspath(d), mask) < 0:
+                logging.debug("Unable to watch %s by inotify, errno %s.",
+                              d, ctypes.get_errno())
+        self.fd = fd
+
+    def wait(self, timeout):
+        """Wait for at most timeout seconds, return True if any file in
+        watched directories has changed, otherwise False."""
+        if self.fd is None:
+            time.sleep(timeout)
+            return False
+        readable, _w, _x = select.select([self.fd], [], [], timeout)
+        if len(readable) == 0:
+            return False
+        try: # drain events, which will be checked by callers.
+            while len(os.read(self.fd, 65536)) > 0:
+                pass
+        except OSError:
+            pass
+        return True
+
+    def close(self):
+        """Stop watching."""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def wait_for_files(filenames, timeout=None, max_interval=60):
+    """
+    Wait for all files in filenames to exist.
+    Return True if all files exist, or False if timeout seconds have
+    passed. If timeout is None, wait forever.
+
+    Directories of files are watched by inotify, so that a wait returns
+    as soon as the last file is created on a local file system; files
+    are also checked in exponentially increasing intervals of at most
+    max_interval seconds, in case files are created by other hosts on
+    network file systems, which inotify can not see.
+    """
+    filenames = list(filenames)
+    start = time.time()
+    intervals = backoff_intervals(initial=0.1, maximum=max_interval)
+    with DirectoryWatcher([op.dirname(op.abspath(fn)) for fn in filenames]) as watcher:
+        while True:
+            filenames = [fn for fn in filenames if not op.exists(fn)]
+            if len(filenames) == 0:
+                return True
+            interval = next(intervals)
+            if timeout is not None:
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    return False
+                interval = min(interval, remaining)
+            watcher.wait(interval)
+
+
 def get_active_sge_jobs():
     """Return a dict of active sge job ids and their status by
     calling qstat.
@@ -178,7 +299,9 @@ def wait_for_sge_jobs(jids, wait_timeout=None, run_timeout=None):
                    If is None, no cap.
     """
     count = 0
-    check_sge_every_n_seconds = 10 # check sge every n seconds.
+    # check sge in exponentially increasing intervals, at most every n seconds.
+    check_sge_every_n_seconds = 30
+    intervals = backoff_intervals(initial=1, maximum=check_sge_every_n_seconds)
     time_passed = 0
     runtime_passed = dict({jid: 0 for jid in jids})
     killed_jobs = [] # jobs that have been killed.
@@ -188,8 +311,9 @@ def wait_for_sge_jobs(jids, wait_timeout=None, run_timeout=None):
         not_done_jids = list(set(jids).intersection(set(active_d.keys())))
         if len(not_done_jids) != 0:
             # some sge jobs are still running or qw, or held
-            time.sleep(check_sge_every_n_seconds)
-            time_passed += check_sge_every_n_seconds
+            interval = next(intervals)
+            time.sleep(interval)
+            time_passed += interval
             count += 1
             if count % 100 == 0:
                 logging.debug("Waiting for sge job to complete: %s.",
@@ -204,7 +328,7 @@ def wait_for_sge_jobs(jids, wait_timeout=None, run_timeout=None):
                 # update runtime_passed
                 for jid in not_done_jids:
                     if active_d[jid].startswith('r'):
-                        runtime_passed[jid] += check_sge_every_n_seconds
+                        runtime_passed[jid] += interval
 
                 to_kill_jids = [jid for jid in not_done_jids
                                 if runtime_passed[jid] >= run_timeout]
@@ -16,16 +16,24 @@ Note that Branch input GMAP SAM file must be sorted by
     (2) reference coordinates.
 
 Note that Branch does not merge fuzzy junctions
+
+Branch collapses groups of overlapping records (loci) independently, so
+with nproc > 1, batches of loci are collapsed by a pool of processes while
+the SAM file is read, and collapsed transcripts are written in order of
+loci, identical to output of a single process.
 """
 import logging
 import os.path as op
+from collections import deque
+from multiprocessing import Pool
 
 from pbtranscript.Utils import ln, realpath
 from pbtranscript.io import iter_gmap_sam, ContigSetReaderWrapper, \
         CollapseGffWriter, GroupWriter, parse_ds_filename
 from pbtranscript.collapsing.common import CollapsedFiles
 from pbtranscript.collapsing.CollapsingUtils import collapse_sam_records, \
-        collapse_fuzzy_junctions, pick_rep
+        collapse_fuzzy_junctions, pick_rep, compact_sam_records, collapse_loci, \
+        write_collapsed_locus
 
 
 __all__ = ["Branch",
@@ -36,6 +44,13 @@ __author__ = 'etseng@pacificbiosciences.com'
 
 log = logging.getLogger(__name__)
 
+# Number of loci collapsed by a worker process at a time.
+LOCI_PER_BATCH = 100
+
+# Max number of batches of loci pending per worker process, which bounds
+# memory used by records read ahead of writing collapsed transcripts.
+BATCHES_PER_PROC = 4
+
 
 class Branch(object):
     """
@@ -70,47 +85,91 @@ class Branch(object):
         self.min_aln_coverage = min_aln_coverage
         self.min_aln_identity = min_aln_identity
 
+    def iter_loci(self, ignored_ids_writer=None):
+        """Yield groups of overlapping SAM records of the same strand (loci)
+        in order of the SORTED SAM file."""
+        for recs in iter_gmap_sam(sam_filename=self.sam_filename,
+                                  query_len_dict=self.isoform_len_dict,
+                                  min_aln_coverage=self.min_aln_coverage,
+                                  min_aln_identity=self.min_aln_identity,
+                                  ignored_ids_writer=ignored_ids_writer):
+            # Iterate over groups of overlapping SAM records
+            for records in recs.itervalues():
+                if len(records) > 0:
+                    yield records
+
     def run(self, allow_extra_5exon, skip_5_exon_alt,
             ignored_ids_fn, good_gff_fn, bad_gff_fn, group_fn,
-            tolerate_end=100):
+            tolerate_end=100, nproc=1):
         """
         Process the whole SAM file:
           (1) Group SAM records based on where they mapped to and strands
           (2) Collapse records, write collapsed isoforms to *_gff_writer,
               write supportive records associated with each collapsed isoforms
               to group_writer.
+        If nproc > 1, collapse loci using nproc processes.
         """
         ignored_ids_writer = open(ignored_ids_fn, 'w') if ignored_ids_fn else None
         good_gff_writer = CollapseGffWriter(good_gff_fn) if good_gff_fn else None
         bad_gff_writer = CollapseGffWriter(bad_gff_fn) if bad_gff_fn else None
         group_writer = GroupWriter(group_fn) if group_fn else None
 
-        cuff_index = 1
-        for recs in iter_gmap_sam(sam_filename=self.sam_filename,
-                                  query_len_dict=self.isoform_len_dict,
-                                  min_aln_coverage=self.min_aln_coverage,
-                                  min_aln_identity=self.min_aln_identity,
-                                  ignored_ids_writer=ignored_ids_writer):
-            # Iterate over groups of overlapping SAM records
-            for records in recs.itervalues():
-                if len(records) > 0:
-                    # records: a list of overlapping SAM records, same strands
-                    collapse_sam_records(records=records, cuff_index=cuff_index,
-                                         cov_threshold=self.cov_threshold,
-                                         allow_extra_5exon=allow_extra_5exon,
-                                         skip_5_exon_alt=skip_5_exon_alt,
-                                         good_gff_writer=good_gff_writer,
-                                         bad_gff_writer=bad_gff_writer,
-                                         group_writer=group_writer,
-                                         tolerate_end=tolerate_end)
-                    cuff_index += 1
+        loci = self.iter_loci(ignored_ids_writer=ignored_ids_writer)
+        if nproc <= 1:
+            for cuff_index, records in enumerate(loci, start=1):
+                # records: a list of overlapping SAM records, same strands
+                collapse_sam_records(records=records, cuff_index=cuff_index,
+                                     cov_threshold=self.cov_threshold,
+                                     allow_extra_5exon=allow_extra_5exon,
+                                     skip_5_exon_alt=skip_5_exon_alt,
+                                     good_gff_writer=good_gff_writer,
+                                     bad_gff_writer=bad_gff_writer,
+                                     group_writer=group_writer,
+                                     tolerate_end=tolerate_end)
+        else:
+            params = (self.cov_threshold, allow_extra_5exon, skip_5_exon_alt, tolerate_end)
+            writers = dict(good_gff_writer=good_gff_writer, bad_gff_writer=bad_gff_writer,
+                           group_writer=group_writer)
+            pool = Pool(processes=nproc)
+            try:
+                pending = deque()
+                for batch in _batches_of_loci(loci, LOCI_PER_BATCH):
+                    pending.append(pool.apply_async(collapse_loci, ((batch, ) + params, )))
+                    if len(pending) >= nproc * BATCHES_PER_PROC:
+                        _write_collapsed_loci(pending.popleft().get(), **writers)
+                while len(pending) > 0:
+                    _write_collapsed_loci(pending.popleft().get(), **writers)
+            finally:
+                pool.close()
+                pool.join()
 
         # close writers.
-        for writer in (ignored_ids_writer, good_gff_writer, bad_gff_writer, bad_gff_writer):
+        for writer in (ignored_ids_writer, good_gff_writer, bad_gff_writer, group_writer):
             if writer:
                 writer.close()
 
 
+def _batches_of_loci(loci, batch_size):
+    """Yield lists of (cuff_index, compact records) of at most batch_size loci,
+    cuff_index of loci starts from 1 in order of loci."""
+    batch = []
+    for cuff_index, records in enumerate(loci, start=1):
+        batch.append((cuff_index, compact_sam_records(records)))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def _write_collapsed_loci(collapsed_loci, good_gff_writer, bad_gff_writer, group_writer):
+    """Write [(cuff_index, chrom, strand, transcripts)] returned by collapse_loci."""
+    for cuff_index, chrom, strand, transcripts in collapsed_loci:
+        write_collapsed_locus(chrom=chrom, strand=strand, transcripts=transcripts,
+                              cuff_index=cuff_index, good_gff_writer=good_gff_writer,
+                              bad_gff_writer=bad_gff_writer, group_writer=group_writer)
+
+
 class CollapseIsoformsRunner(CollapsedFiles):
     """
     Collapse isoforms into gene families, requiring
@@ -127,7 +186,7 @@ class CollapseIsoformsRunner(CollapsedFiles):
     """
     def __init__(self, isoform_filename, sam_filename, output_prefix,
                  min_aln_coverage, min_aln_identity, min_flnc_coverage,
-                 max_fuzzy_junction, allow_extra_5exon, skip_5_exon_alt):
+                 max_fuzzy_junction, allow_extra_5exon, skip_5_exon_alt, nproc=1):
         """
         Parameters:
           isoform_filename -- input file containing isoforms, as fastq|fasta|contigset
@@ -139,6 +198,7 @@ class CollapseIsoformsRunner(CollapsedFiles):
           max_fuzzy_junction -- max edit distance between fuzzy-matching exons
           allow_extra_5exon -- whether or not to allow shorter 5' exons
           skip_5_exon_alt -- whether or not to skip alternative 5' exons
+          nproc -- number of processes to collapse isoforms
         """
         self.suffix = parse_ds_filename(isoform_filename)[1]
         super(CollapseIsoformsRunner, self).__init__(prefix=output_prefix,
@@ -154,6 +214,7 @@ class CollapseIsoformsRunner(CollapsedFiles):
         self.max_fuzzy_junction = int(max_fuzzy_junction)
         self.allow_extra_5exon = bool(allow_extra_5exon)
         self.skip_5_exon_alt = bool(skip_5_exon_alt)
+        self.nproc = int(nproc)
 
     @property
     def shall_collapse_fuzzy_junctions(self):
@@ -205,7 +266,8 @@ class CollapseIsoformsRunner(CollapsedFiles):
               ignored_ids_fn=self.ignored_ids_txt_fn,
               good_gff_fn=self.good_unfuzzy_gff_fn,
               bad_gff_fn=self.bad_unfuzzy_gff_fn,
-              group_fn=self.unfuzzy_group_fn)
+              group_fn=self.unfuzzy_group_fn,
+              nproc=self.nproc)
 
         logging.info("Good unfuzzy isoforms written to: %s", realpath(self.good_unfuzzy_gff_fn))
         logging.info("Bad unfuzzy isoforms written to: %s", realpath(self.bad_unfuzzy_gff_fn))
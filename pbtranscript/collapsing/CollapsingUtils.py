@@ -10,13 +10,14 @@ convert np.array to exons.
 
 import os.path as op
 import logging
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 import numpy as np
-from pbcore.io import FastaWriter, FastqWriter, ContigSet
+from pbcore.io import FastaWriter, FastqWriter
 from pbtranscript.Utils import execute, rmpath, as_contigset
 from pbtranscript.io import ContigSetReaderWrapper, FastaRandomReader, FastqRandomReader, \
     CollapseGffRecord, CollapseGffReader, CollapseGffWriter, \
-    GroupRecord, GroupReader, GroupWriter, parse_ds_filename
+    GroupRecord, GroupReader, GroupWriter, parse_ds_filename, \
+    contigset_external_files, sam_header_lines, merge_sam_files
 from pbtranscript.collapsing import c_branch, IntervalTree
 
 __all__ = ["ContiVec",
@@ -30,12 +31,23 @@ __all__ = ["ContiVec",
            "get_fl_from_id",
            "can_merge",
            "collapse_sam_records",
+           "compact_sam_records",
+           "collapse_locus",
+           "collapse_loci",
+           "write_collapsed_locus",
            "compare_fuzzy_junctions",
            "collapse_fuzzy_junctions",
            "pick_rep"]
 
 logger = logging.getLogger(op.basename(__file__))
 
+# Fields of a GMAP SAM record which are required to collapse it with
+# overlapping records in worker processes, see compact_sam_records.
+CompactSAMRecord = namedtuple('CompactSAMRecord', ['qID', 'sID', 'sStart', 'sEnd',
+                                                   'flag', 'segments'])
+CompactSAMFlag = namedtuple('CompactSAMFlag', ['strand'])
+CompactSegment = namedtuple('CompactSegment', ['start', 'end'])
+
 
 def copy_sam_header(in_sam, out_sam):
     """Copy headers of input sam to output sam."""
@@ -98,36 +110,30 @@ def map_isoforms_and_sort(input_filename, sam_filename,
 
 
 def concatenate_sam(in_sam_files, sam_out):
-    """Concatenate input sam files to sam_out."""
+    """Concatenate input sam files to sam_out.
+    Header of sam_out contains @HD of the first input sam file and all
+    other distinct header lines of input sam files, records are streamed
+    (k-way merged if all input sam files are sorted), see merge_sam_files.
+    """
     if sam_out in in_sam_files:
         raise IOError("Can not overwrite input sam file %s as output file." % sam_out)
 
     # First save sam headers in c_header
     c_header = []
+    c_header_seen = set()
     has_hd = False
     for in_sam in in_sam_files:
-        with open(in_sam, 'r') as reader:
-            for r in reader:
-                r = r.strip()
-                if r.startswith("@"):
-                    if r.startswith("@HD") and not has_hd:
-                        has_hd = True
-                        c_header.append(r)
-                    else:
-                        if r not in c_header:
-                            c_header.append(r)
-                else:
-                    break
+        for r in sam_header_lines(in_sam):
+            r = r.strip()
+            if r.startswith("@HD") and not has_hd:
+                has_hd = True
+                c_header.append(r)
+            else:
+                if r not in c_header_seen:
+                    c_header.append(r)
+            c_header_seen.add(r)
 
-    # Start to write
-    with open(sam_out, 'w') as writer:
-        writer.write("\n".join(c_header) + "\n")
-        for in_sam in in_sam_files:
-            with open(in_sam, 'r') as reader:
-                for r in reader:
-                    r = r.strip()
-                    if not r.startswith("@"):
-                        writer.write("%s\n" % r)
+    merge_sam_files(in_sam_files, sam_out, header=c_header)
 
 
 INTINF = 999999
@@ -351,22 +357,15 @@ class ContiVec(object):
                                      threshSplit=2, threshBase=0, offset=offset)
 
 
-def collapse_sam_records(records, cuff_index, cov_threshold,
-                         allow_extra_5exon, skip_5_exon_alt,
-                         good_gff_writer, bad_gff_writer, group_writer,
-                         tolerate_end=100, starting_isoform_index=0, gene_prefix='PB'):
+def _merge_sam_records(records, allow_extra_5exon, skip_5_exon_alt, tolerate_end=100):
     """
     Given a set of gmap sam records
     (1) parse them by running through transfrag_to_contig, and return contiVec
     (2) find exons based on contiVec
     (3) go through each record, get the list of "nodes" they corresspond to
     (4) collapse identical records (53mergeing)
-
-    Write collapsed isoforms out to GTF format. Collapsed isoforms with
-    coverage > cov_threshold go to good_gff_writer, otherwise, go to bad_gff_writer.
-    Write supportive records of collapsed isoforms to group_writer.
-
-    Returns result and merged_result, where
+    Returns (chrom, strand, node_d, result, result_merged), where
+    node_d: exon value --> exon interval
     result: [ (r.qID, r.strand, nparray representing r) for r in records]
     result_merge: merged result
     """
@@ -392,48 +391,142 @@ def collapse_sam_records(records, cuff_index, cov_threshold,
     if len(result) > 0 and len(result_merged) > 0:
         logging.debug("merged %s (%s, ...) down to %s transcripts",
                       len(result), result[0][0], len(result_merged))
+    return chrom, strand, node_d, result, result_merged
+
+
+def _exon_chain(segments):
+    """Join adjacent exon segments, return exons as [(start, end)], where
+    start is 1-based and end is inclusive."""
+    exons = []
+    i = 0
+    for j in xrange(1, len(segments)):
+        if segments[j].start != segments[j-1].end:
+            exons.append((segments[i].start+1, segments[j-1].end))
+            i = j
+    exons.append((segments[i].start+1, segments[-1].end))
+    return exons
 
-    isoform_index = starting_isoform_index
-    # make the exon value --> interval dictionary
 
+def _collapsed_transcripts(strand, node_d, result_merged, cov_threshold):
+    """Return [(ids, is_good, exons)] of merged results, see collapse_locus."""
+    transcripts = []
     for ids, _strand, m in result_merged:
         assert strand == _strand
-        if ids.count(',')+1 < cov_threshold:
-            f_out = bad_gff_writer
-        else:
-            f_out = good_gff_writer
-        isoform_index += 1
         segments = [node_d[x] for x in m.nonzero()[1]]
+        transcripts.append((ids, ids.count(',')+1 >= cov_threshold, _exon_chain(segments)))
+    return transcripts
+
+
+def collapse_locus(records, cov_threshold, allow_extra_5exon, skip_5_exon_alt,
+                   tolerate_end=100):
+    """
+    Collapse a set of overlapping gmap sam records of the same strand
+    into transcripts without writing them, see collapse_sam_records.
+    Returns (chrom, strand, transcripts), where transcripts is a list of
+    (ids, is_good, exons) of collapsed transcripts,
+      ids -- ids of supportive records, separated by ','
+      is_good -- True if having >= cov_threshold supportive records
+      exons -- exon chain [(start, end)], start is 1-based
+    Results are compact, so that loci can be collapsed by worker processes.
+    """
+    chrom, strand, node_d, _result, result_merged = \
+        _merge_sam_records(records=records, allow_extra_5exon=allow_extra_5exon,
+                           skip_5_exon_alt=skip_5_exon_alt, tolerate_end=tolerate_end)
+    return chrom, strand, _collapsed_transcripts(strand, node_d, result_merged, cov_threshold)
+
+
+def compact_sam_records(records):
+    """
+    Return compact copies of GMAP SAM records as plain tuples
+    (qID, sID, sStart, sEnd, strand, [(start, end) of segments]), which keep
+    only fields required by collapse_locus and, unlike GMAPSAMRecord bound
+    to pysam alignments, can be sent to worker processes cheaply.
+    """
+    return [(r.qID, r.sID, r.sStart, r.sEnd, r.flag.strand,
+             [(e.start, e.end) for e in r.segments])
+            for r in records]
+
 
-        gene_id = "{p}.{i}".format(p=gene_prefix, i=cuff_index)
+def _records_of_compact(compact_records):
+    """Return CompactSAMRecord of compact records, see compact_sam_records."""
+    return [CompactSAMRecord(qID=qID, sID=sID, sStart=sStart, sEnd=sEnd,
+                             flag=CompactSAMFlag(strand=strand),
+                             segments=[CompactSegment(start, end) for start, end in segments])
+            for qID, sID, sStart, sEnd, strand, segments in compact_records]
+
+
+def collapse_loci(args):
+    """
+    Collapse a batch of loci, and return [(cuff_index, chrom, strand, transcripts)],
+    see collapse_locus. Called by worker processes of Branch.run.
+        args --- (loci, cov_threshold, allow_extra_5exon, skip_5_exon_alt, tolerate_end),
+                 where loci is a list of (cuff_index, compact records of a locus).
+    """
+    loci, cov_threshold, allow_extra_5exon, skip_5_exon_alt, tolerate_end = args
+    return [(cuff_index, ) +
+            collapse_locus(records=_records_of_compact(records),
+                           cov_threshold=cov_threshold,
+                           allow_extra_5exon=allow_extra_5exon,
+                           skip_5_exon_alt=skip_5_exon_alt, tolerate_end=tolerate_end)
+            for cuff_index, records in loci]
+
+
+def write_collapsed_locus(chrom, strand, transcripts, cuff_index,
+                          good_gff_writer, bad_gff_writer, group_writer,
+                          starting_isoform_index=0, gene_prefix='PB'):
+    """
+    Write collapsed transcripts of a locus returned by collapse_locus,
+    as gene {gene_prefix}.{cuff_index}, to GTF format. Good transcripts go
+    to good_gff_writer, otherwise, go to bad_gff_writer.
+    Write supportive records of collapsed transcripts to group_writer.
+    """
+    isoform_index = starting_isoform_index
+    gene_id = "{p}.{i}".format(p=gene_prefix, i=cuff_index)
+    for ids, is_good, exons in transcripts:
+        f_out = good_gff_writer if is_good else bad_gff_writer
+        isoform_index += 1
         transcript_id = "{g}.{j}".format(g=gene_id, j=isoform_index)
         group_writer.writeRecord(GroupRecord(name=transcript_id, members=ids.split(',')))
 
         gff_record = CollapseGffRecord(seqid=chrom, feature='transcript',
-                                       start=segments[0].start+1, end=segments[-1].end,
+                                       start=exons[0][0], end=exons[-1][1],
                                        strand=strand, gene_id=gene_id, transcript_id=transcript_id)
         f_out.writeRecord(gff_record)
+        for start, end in exons:
+            gff_record = CollapseGffRecord(seqid=chrom, feature='exon',
+                                           start=start, end=end,
+                                           strand=strand, gene_id=gene_id, transcript_id=transcript_id)
+            f_out.writeRecord(gff_record)
 
-        i = 0
-        j = 0
-        for j in xrange(1, len(segments)):
-            if segments[j].start != segments[j-1].end:
-                gene_id = "{p}.{i}".format(p=gene_prefix, i=cuff_index)
-                transcript_id = "{g}.{j}".format(g=gene_id, j=isoform_index)
-                gff_record = CollapseGffRecord(seqid=chrom, feature='exon',
-                                               start=segments[i].start+1, end=segments[j-1].end,
-                                               strand=strand, gene_id=gene_id, transcript_id=transcript_id)
-                f_out.writeRecord(gff_record)
-                i = j
-
-        # write the last one
-        gene_id = "{p}.{i}".format(p=gene_prefix, i=cuff_index)
-        transcript_id = "{g}.{j}".format(g=gene_id, j=isoform_index)
-        gff_record = CollapseGffRecord(seqid=chrom, feature='exon',
-                                       start=segments[i].start+1, end=segments[j].end,
-                                       strand=strand, gene_id=gene_id, transcript_id=transcript_id)
-        f_out.writeRecord(gff_record)
 
+def collapse_sam_records(records, cuff_index, cov_threshold,
+                         allow_extra_5exon, skip_5_exon_alt,
+                         good_gff_writer, bad_gff_writer, group_writer,
+                         tolerate_end=100, starting_isoform_index=0, gene_prefix='PB'):
+    """
+    Given a set of gmap sam records
+    (1) parse them by running through transfrag_to_contig, and return contiVec
+    (2) find exons based on contiVec
+    (3) go through each record, get the list of "nodes" they corresspond to
+    (4) collapse identical records (53mergeing)
+
+    Write collapsed isoforms out to GTF format. Collapsed isoforms with
+    coverage > cov_threshold go to good_gff_writer, otherwise, go to bad_gff_writer.
+    Write supportive records of collapsed isoforms to group_writer.
+
+    Returns result and merged_result, where
+    result: [ (r.qID, r.strand, nparray representing r) for r in records]
+    result_merge: merged result
+    """
+    chrom, strand, node_d, result, result_merged = \
+        _merge_sam_records(records=records, allow_extra_5exon=allow_extra_5exon,
+                           skip_5_exon_alt=skip_5_exon_alt, tolerate_end=tolerate_end)
+    transcripts = _collapsed_transcripts(strand, node_d, result_merged, cov_threshold)
+    write_collapsed_locus(chrom=chrom, strand=strand, transcripts=transcripts,
+                          cuff_index=cuff_index, good_gff_writer=good_gff_writer,
+                          bad_gff_writer=bad_gff_writer, group_writer=group_writer,
+                          starting_isoform_index=starting_isoform_index,
+                          gene_prefix=gene_prefix)
     return result, result_merged
 
 
@@ -664,16 +757,13 @@ def pick_rep(isoform_filename, gff_filename,
         fd = FastqRandomReader(isoform_filename)
         is_fq = True
     elif _suffix == "contigset.xml":
-        fd = ContigSet(isoform_filename)
-        _fns = fd.toExternalFiles()
+        _fns = contigset_external_files(isoform_filename)
         if len(_fns) == 1 and _fns[0].endswith(".fq") or _fns[0].endswith(".fastq"):
             fd = FastqRandomReader(_fns[0])
             is_fq = True
         else:
-            if not fd.isIndexed:
-                # Must be indexed FASTA, or exactly contains one FASTQ file
-                raise IOError("%s must contain either indexed FASTA files or " % isoform_filename +
-                              "contain exactly one FASTQ file!")
+            # FASTA files are indexed by FastaRandomReader
+            fd = FastaRandomReader(isoform_filename)
     else:
         raise IOError("Unable to recognize file type of %s." % isoform_filename)
 
@@ -721,9 +811,11 @@ def pick_rep(isoform_filename, gff_filename,
         err = 9999999
         max_len = 0
 
-        for x in members:
+        if is_fq and pick_least_err_instead:
+            errs = fd.expected_errors(members)
+        for i, x in enumerate(members):
             if is_fq and pick_least_err_instead:
-                err = sum(i**-(i/10.) for i in fd[x].quality)
+                err = errs[i]
             if (is_fq and pick_least_err_instead and err < best_err) or \
                ((not is_fq or not pick_least_err_instead) and len(fd[x].sequence) >= max_len):
                 best_id = x
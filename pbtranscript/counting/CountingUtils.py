@@ -9,7 +9,8 @@ from collections import defaultdict
 from cPickle import load
 #from csv import DictReader
 from pbtranscript.io import GroupReader, MapStatus, ReadStatRecord, \
-        ReadStatReader, ReadStatWriter, AbundanceRecord, AbundanceWriter
+        ReadStatReader, ReadStatWriter, AbundanceRecord, AbundanceWriter, \
+        iter_partial_uc
 
 
 __author__ = 'etseng@pacificbiosciences.com'
@@ -217,18 +218,16 @@ def output_read_count_nFL(cid_info, prefix_pickle_filename_tuples, output_filena
     for sample_prefix, pickle_filename in prefix_pickle_filename_tuples:
         if not op.exists(pickle_filename):
             raise IOError("%s does not exist." % pickle_filename)
-        with open(pickle_filename) as h:
-            result = load(h)
-            uc = result['partial_uc']
-            if restricted_movies is None:
-                unmapped_holder.update(result['nohit'])
-            else:
-                #unmapped_holder.update(filter(lambda x: x.split('/')[0] in restricted_movies,
-                #                              result['nohit']))
-                unmapped_holder.update([x for x in result['nohit']
-                                        if x.split('/')[0] in restricted_movies])
+        # Stream nFL reads cluster by cluster, nohit reads come last.
+        for cid_no_prefix, members in iter_partial_uc(pickle_filename):
+            if cid_no_prefix is None: # nohit
+                if restricted_movies is None:
+                    unmapped_holder.update(members)
+                else:
+                    unmapped_holder.update([x for x in members
+                                            if x.split('/')[0] in restricted_movies])
+                continue
 
-        for cid_no_prefix, members in uc.iteritems():
             cid = 'c' + str(cid_no_prefix)
             if cid in cid_info[sample_prefix]: # is at least mapped
                 pbid = cid_info[sample_prefix][cid]
@@ -15,10 +15,10 @@ IceAllPartials procedures:
 
 import os.path as op
 import logging
-import time
 from pbtranscript.PBTranscriptOptions import \
     add_sge_arguments, add_fofn_arguments, add_tmp_dir_argument
 from pbtranscript.Utils import realpath, mkdir, real_upath, ln
+from pbtranscript.RunnerUtils import wait_for_files
 from pbtranscript.ice.IceFiles import IceFiles
 from pbtranscript.ice.IceUtils import combine_nfl_pickles
 from pbtranscript.ice.__init__ import ICE_PARTIAL_PY
@@ -200,16 +200,11 @@ class IceAllPartials(IceFiles):
         self.add_log("Waiting for pickles {ps} to be created.".
                      format(ps=", ".join(pickle_filenames)),
                      level=logging.INFO)
-        stop = False
-        sleep_time = 10
-        while stop is not True:
-            stop = all(op.exists(p) for p in pickle_filenames) and \
-                all(op.exists(d) for d in done_filenames)
-            sleep_time = min(600, sleep_time * 2)
-            time.sleep(sleep_time)
-            self.add_log("Waiting for pickles to be created: {ps}".
-                         format(ps=", ".join([p for p in pickle_filenames
-                                              if op.exists(p)])))
+        # Return as soon as the last pickle is done if pickles are created
+        # locally, or are seen by inotify, otherwise check pickles in
+        # exponentially increasing intervals.
+        wait_for_files(pickle_filenames + done_filenames, max_interval=600)
+        self.add_log("Pickles are created: {ps}".format(ps=", ".join(pickle_filenames)))
 
     def combinePickles(self, pickle_filenames, out_pickle):
         """Combine all *.pickle files to one and dump to self.out_pickle."""
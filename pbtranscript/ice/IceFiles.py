@@ -3,16 +3,30 @@
 Define files which are used or created in the ICE algorithm,
 including temporary results, output files, scripts and logs.
 """
+import os
 import os.path as op
+import errno
+import time
 import logging
+import cPickle
+import json
+from collections import defaultdict
 
 from pbcore.util.Process import backticks
 
 from pbtranscript.Utils import real_ppath, now_str, mkdir
+from pbtranscript.RunnerUtils import DirectoryWatcher, backoff_intervals
 from pbtranscript.ice.IceUtils import write_cluster_report
+from pbtranscript.io import ClusterState, write_cluster_state, \
+    is_cluster_state_valid, load_partial_uc
 from pbtranscript.io.Summary import write_cluster_summary
 
 
+# A cluster state lock older than this many seconds is left by a builder
+# which has died, and will be removed by the next caller.
+CLUSTER_STATE_LOCK_TIMEOUT = 3600
+
+
 class IceFiles(object):
 
     """Define directories and files used by the ICE algorithm."""
@@ -295,6 +309,108 @@ class IceFiles(object):
                             f=report_fn), level=logging.INFO)
         write_cluster_report(report_fn=report_fn, uc=uc, partial_uc=partial_uc)
 
+    def load_pickles(self):
+        """Load uc and refs from final_pickle_fn, load partial uc from
+        nfl_all_pickle_fn, return (uc, partial_uc. refs).
+        """
+        def _load_pickle(fn):
+            """Load *.json or *.pickle file."""
+            with open(fn) as f:
+                if fn.endswith(".json"):
+                    return json.loads(f.read())
+                else:
+                    return cPickle.load(f)
+        self.add_log("Loading uc from {f}.".format(f=self.final_pickle_fn))
+        a = _load_pickle(self.final_pickle_fn)
+        uc = a['uc']
+        refs = a['refs']
+
+        self.add_log("Loading partial uc from {f}.".
+                     format(f=self.nfl_all_pickle_fn))
+        partial_uc = load_partial_uc(self.nfl_all_pickle_fn)['partial_uc']
+        partial_uc2 = defaultdict(lambda: [])
+        partial_uc2.update(partial_uc)
+        return (uc, partial_uc2, refs)
+
+    @property
+    def cluster_state_prefix(self):
+        """Return $root_dir/output/cluster_state, prefix of ClusterState
+        store built from final_pickle_fn, nfl_all_pickle_fn and
+        final_consensus_fa."""
+        return op.join(self.out_dir, "cluster_state")
+
+    @property
+    def cluster_state_lock_fn(self):
+        """Lock file held by the caller which is building cluster state."""
+        return self.cluster_state_prefix + ".lock"
+
+    def load_cluster_state(self, build=True):
+        """
+        Return a memory mapped ClusterState, which provides uc, partial_uc
+        and refs per cluster, see ClusterStateIO. The store is built from
+        pickles once, and shared by all later callers, e.g.,
+        IceQuiver.process_chunk_i of other chunks, until pickles change.
+        Building is serialized by an exclusive lock file, so that
+        concurrent chunks wait for the store instead of each loading
+        pickles and building it again.
+        If build is False and no valid store exists, return None.
+        """
+        sources = [self.final_pickle_fn, self.nfl_all_pickle_fn,
+                   self.final_consensus_fa]
+        if not is_cluster_state_valid(self.cluster_state_prefix, sources):
+            if not build:
+                return None
+            with DirectoryWatcher([self.out_dir]) as watcher:
+                intervals = backoff_intervals(initial=0.1, maximum=60)
+                while not self._try_build_cluster_state(sources):
+                    # Another chunk is building cluster state, wait for it.
+                    watcher.wait(next(intervals))
+        self.add_log("Loading cluster state from {f}.".
+                     format(f=self.cluster_state_prefix))
+        return ClusterState(self.cluster_state_prefix)
+
+    def _try_build_cluster_state(self, sources):
+        """
+        Build cluster state from pickles unless it is valid or being built
+        by another caller. Return True if cluster state is valid on return,
+        False if another caller holds the lock.
+        """
+        lock_fn = self.cluster_state_lock_fn
+        try:
+            fd = os.open(lock_fn, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            if is_cluster_state_valid(self.cluster_state_prefix, sources):
+                return True
+            try:
+                age = time.time() - op.getmtime(lock_fn)
+            except OSError: # lock has just been released, try again.
+                return False
+            if age > CLUSTER_STATE_LOCK_TIMEOUT:
+                self.add_log("Removing stale lock {f}.".format(f=lock_fn),
+                             level=logging.WARNING)
+                try:
+                    os.remove(lock_fn)
+                except OSError:
+                    pass
+            return False
+
+        try:
+            os.close(fd)
+            # Cluster state may be written while waiting for the lock.
+            if not is_cluster_state_valid(self.cluster_state_prefix, sources):
+                uc, partial_uc, refs = self.load_pickles()
+                self.add_log("Writing cluster state to {f}.".
+                             format(f=self.cluster_state_prefix))
+                write_cluster_state(out_prefix=self.cluster_state_prefix,
+                                    uc=uc, partial_uc=partial_uc, refs=refs,
+                                    consensus_fa=self.final_consensus_fa,
+                                    sources=sources)
+        finally:
+            os.remove(lock_fn)
+        return True
+
     def write_summary(self, summary_fn, isoforms_fa, hq_fa=None, lq_fa=None):
         """Extract number of consensus isoforms predicted, and total
         number of bases in all consensuus isoforms from isoforms_fa and write
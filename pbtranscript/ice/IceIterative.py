@@ -170,7 +170,8 @@ class IceIterative(IceFiles):
                 self.add_log("Converting input {fa} + {ccs} --> {fq}.",
                              level=logging.INFO)
                 ice_fa2fq(in_fa=self.fasta_filename, ccs_fofn=ccs_fofn,
-                          out_fq=self.fastq_filename)
+                          out_fq=self.fastq_filename,
+                          num_workers=self.blasr_nproc)
 
         if probQV is not None:
             self.add_log("Loading probabilities and QVs from given probQV.",
@@ -1179,7 +1180,7 @@ class IceIterative(IceFiles):
             # convert fasta + ccs --> fastq
             batch_fqfn = fafn2fqfn(batch_filename)
             ice_fa2fq(in_fa=batch_filename, ccs_fofn=self.ccs_fofn,
-                      out_fq=batch_fqfn)
+                      out_fq=batch_fqfn, num_workers=self.blasr_nproc)
             self.probQV.add_seqs_from_fastq(fastq_filename=batch_fqfn,
                                             smooth=True)
         # only ids from new batch are not already in probQV
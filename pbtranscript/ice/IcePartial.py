@@ -54,7 +54,7 @@ from cPickle import dump
 import json
 
 from pbcommand.models import FileTypes
-from pbcore.io import ContigSet
+from pbtranscript.io.ContigSetCache import contigset_external_files
 
 from pbtranscript.ClusterOptions import IceOptions
 from pbtranscript.Utils import realpath, touch, real_upath, execute
@@ -127,7 +127,7 @@ def build_uc_from_partial_daligner(input_fasta, ref_fasta, out_pickle,
                 input_fastq = input_fasta[:input_fasta.rfind('.')] + '.fastq'
                 logging.info("Converting %s + %s --> %s",
                              input_fasta, ccs_fofn, input_fastq)
-                ice_fa2fq(input_fasta, ccs_fofn, input_fastq)
+                ice_fa2fq(input_fasta, ccs_fofn, input_fastq, num_workers=cpus)
                 probqv = ProbFromFastq(input_fastq)
                 logging.info("Loading QVs from %s took %s secs",
                              input_fastq, time.time()-start_t)
@@ -189,8 +189,7 @@ def build_uc_from_partial_daligner(input_fasta, ref_fasta, out_pickle,
 
 def _get_fasta_path(file_name):
     if file_name.endswith(".contigset.xml"):
-        ds = ContigSet(file_name)
-        fasta_files = ds.toExternalFiles()
+        fasta_files = contigset_external_files(file_name)
         assert len(fasta_files) == 1
         return fasta_files[0]
     return file_name
@@ -5,10 +5,9 @@
 import os.path as op
 import logging
 import shutil
-import cPickle
-import json
 from math import ceil
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from pbtranscript.ClusterOptions import IceQuiverOptions
 from pbtranscript.PBTranscriptOptions import  add_fofn_arguments, \
@@ -16,12 +15,17 @@ from pbtranscript.PBTranscriptOptions import  add_fofn_arguments, \
 from pbtranscript.Utils import mkdir, real_upath, nfs_exists, \
     get_files_from_file_or_fofn, guess_file_format, FILE_FORMATS
 from pbtranscript.ice.IceUtils import get_the_only_fasta_record, \
-    is_blank_sam, concat_sam, blasr_for_quiver, trim_subreads_and_write, \
-    is_blank_bam, concat_bam
+    is_blank_sam, concat_sam, blasr_for_quiver, trim_subreads_and_write_in_batch, \
+    is_blank_bam, concat_bam, zmws_of_seqids, write_sorted_bam_of_targets, \
+    concat_subreads_of_unique_zmws
 from pbtranscript.ice.IceFiles import IceFiles
+from pbtranscript.ice.QuiverScheduler import consensus_lengths, \
+    cluster_polish_cost, cluster_polish_costs, pack_by_cost, local_job_slots
+from pbtranscript.ice.PolishCache import PolishCache, polish_cache_key, \
+    file_signatures
 from pbtranscript.io import MetaSubreadFastaReader, BamCollection, \
-    FastaRandomReader
-from pbcore.io import FastaWriter
+    FastaRandomReader, ClusterMembers, sequence_hash
+from pbcore.io import FastaWriter, openDataFile
 
 
 class IceQuiver(IceFiles):
@@ -32,14 +36,28 @@ class IceQuiver(IceFiles):
            "consensus isoforms created by ICE, call quiver to polish " + \
            "these isoforms."
 
+    # Number of clusters in a quiver bin on average.
+    clusters_per_bin = 100
+
+    # Polish cache is pruned to at most this many bytes, least recently
+    # used entries first, after quiver bins are created.
+    polish_cache_max_size = 100 * 1024 ** 3
+
     def __init__(self, root_dir, bas_fofn, fasta_fofn, sge_opts,
-                 tmp_dir=None, prog_name=None):
+                 tmp_dir=None, prog_name=None, local_cpus=None):
+        """
+        local_cpus --- number of CPUs available to quiver jobs running
+                       on the local machine, default all CPUs.
+        """
         # Initialize super class IceFiles.
         prog_name = "IceQuiver" if prog_name is None else prog_name
         super(IceQuiver, self).__init__(prog_name=prog_name,
                                         root_dir=root_dir, bas_fofn=bas_fofn,
                                         fasta_fofn=fasta_fofn, tmp_dir=tmp_dir)
         self.sge_opts = sge_opts
+        self.local_cpus = local_cpus
+        self.polish_cache = PolishCache(self.polish_cache_dir)
+        self._subreads_signature = None
 
     def validate_inputs(self):
         """Validate input fofns, and root_dir, log_dir, tmp_dir,
@@ -94,6 +112,36 @@ class IceQuiver(IceFiles):
             self.add_log(errMsg, level=logging.ERROR)
             raise IOError(errMsg)
 
+    @property
+    def polish_cache_dir(self):
+        """Return $root_dir/polish_cache, where polishing inputs of
+        clusters are cached and reused by reruns, see PolishCache."""
+        return op.join(self.root_dir, "polish_cache")
+
+    @property
+    def polish_cache_hits_fn(self):
+        """Return $root_dir/log/polish_cache_hits.txt, which records
+        number of clusters reused from polish cache of each bin."""
+        return op.join(self.log_dir, "polish_cache_hits.txt")
+
+    @property
+    def subreads_signature(self):
+        """Return real paths, sizes and mtimes of subreads files in
+        bas_fofn and fasta_fofn (bam files of dataset xml files), so that
+        polish cache keys change if input subreads are modified."""
+        if self._subreads_signature is None:
+            fns = []
+            for fofn in (self.bas_fofn, self.fasta_fofn):
+                if fofn is None:
+                    continue
+                for fn in get_files_from_file_or_fofn(fofn):
+                    if fn.endswith(".xml"):
+                        fns.extend(openDataFile(fn).toExternalFiles())
+                    else:
+                        fns.append(fn)
+            self._subreads_signature = file_signatures(fns)
+        return self._subreads_signature
+
     def _quivered_bin_prefix(self, first, last):
         """Return $quivered_dir/c{first}to{last}"""
         return self.quivered_dir + "/c{first}to{last}".format(
@@ -113,6 +161,25 @@ class IceQuiver(IceFiles):
         else:
             return self._quivered_bin_prefix(first, last) + ".bam"
 
+    def raw_bam_of_quivered_bin(self, first, last):
+        """Return $_quivered_bin_prefix.raw.bam
+        this contains subreads of zmws of all clusters in the bin.
+        """
+        return self._quivered_bin_prefix(first, last) + ".raw.bam"
+
+    def blasr_bam_of_quivered_bin(self, first, last):
+        """Return $_quivered_bin_prefix.blasr.bam
+        this aligns raw_bam_of_quivered_bin to consensus sequences of
+        all clusters in the bin, before alignments are filtered.
+        """
+        return self._quivered_bin_prefix(first, last) + ".blasr.bam"
+
+    def all_ref_fa_of_quivered_bin(self, first, last):
+        """Return $_quivered_bin_prefix.all_ref.fasta
+        this contains unique consensus sequences of all clusters in the bin.
+        """
+        return self._quivered_bin_prefix(first, last) + ".all_ref.fasta"
+
     def ref_fa_of_quivered_bin(self, first, last):
         """Return $_quivered_bin_prefix.ref.fasta
         this is reference fasta for quiver to use as input.
@@ -134,7 +201,49 @@ class IceQuiver(IceFiles):
         """Return $_quivered_bin_prefix.sh"""
         return self._quivered_bin_prefix(first, last) + ".sh"
 
-    def reconstruct_ref_fa_for_clusters_in_bin(self, cids, refs):
+    def _consensus_from_final_consensus_fa(self, cids):
+        """Return {cid: (name, sequence)} of consensus isoforms of clusters
+        in cids, read from final_consensus_fa by its index in order of
+        file offsets."""
+        # Check existence when first time it is read.
+        if not nfs_exists(self.final_consensus_fa):
+            raise IOError("Final consensus FASTA file {f}".format(
+                f=self.final_consensus_fa) + "does not exist.")
+
+        cids = set(cids)
+        final_consensus_d = FastaRandomReader(self.final_consensus_fa)
+        # e.g., ref_id = c103/1/3708, cid = 103
+        ref_ids = [ref_id for ref_id in final_consensus_d.keys()
+                   if int(ref_id.split('/')[0].replace('c', '')) in cids]
+        ref_ids.sort(key=lambda ref_id: final_consensus_d.d[ref_id])
+        ret = dict((int(ref_id.split('/')[0].replace('c', '')),
+                    (ref_id, final_consensus_d[ref_id].sequence[:]))
+                   for ref_id in ref_ids)
+        final_consensus_d.close()
+        return ret
+
+    def consensus_of_clusters(self, cids, uc=None, refs=None):
+        """
+        Return {cid: (name, sequence, hash of sequence)} of consensus
+        isoforms of clusters in cids.
+        If uc is a view of ClusterState, consensus sequences are read from
+        final consensus isoforms in one pass in order of file offsets by
+        the index of the state, and their hashes are precomputed;
+        otherwise, consensus sequences are read from refs[cid].
+        """
+        if isinstance(uc, ClusterMembers):
+            state = uc.state
+            return dict((cid, (name, seq, state.consensus_hash(cid)))
+                        for cid, (name, seq) in
+                        state.consensus_of_clusters(cids).iteritems())
+        ret = {}
+        for cid in cids:
+            ref_rec = get_the_only_fasta_record(refs[cid])
+            seq = ref_rec.sequence.strip()
+            ret[cid] = (ref_rec.name.strip(), seq, sequence_hash(seq))
+        return ret
+
+    def reconstruct_ref_fa_for_clusters_in_bin(self, cids, refs, uc=None):
         """
         Reconstruct ref_fa of the cluster in the new tmp_dir
         e.g.,
@@ -142,30 +251,28 @@ class IceQuiver(IceFiles):
 
         cids --- list[int(cid)], e.g., [10, 11, 12, ..., 20]
         refs --- dict{int(cid): ref_fa of cluster(cid)}
+        uc --- if uc is a view of ClusterState, consensus sequences are
+               read by the index of the state, see consensus_of_clusters.
         """
-        # Check existence when first time it is read.
-        if not nfs_exists(self.final_consensus_fa):
-            raise IOError("Final consensus FASTA file {f}".format(
-                f=self.final_consensus_fa) + "does not exist.")
-
         self.add_log("Reconstructing g consensus files for clusters "
                      "[%d, %d] in %s" % (cids[0], cids[-1], self.tmp_dir),
                      level=logging.INFO)
 
-        final_consensus_d = FastaRandomReader(self.final_consensus_fa)
-        for ref_id in final_consensus_d.d.keys():
-            cid = int(ref_id.split('/')[0].replace('c', ''))
+        if isinstance(uc, ClusterMembers):
+            consensus = uc.state.consensus_of_clusters(cids)
+        else:
+            consensus = self._consensus_from_final_consensus_fa(cids)
+
+        for cid in sorted(consensus):
             # e.g., ref_id = c103/1/3708, cid = 103,
             #       refs[cid] = ...tmp/0/c103/g_consensus_ref.fasta
-            if cid in cids:
-                mkdir(self.cluster_dir(cid))
-                ref_fa = op.join(self.cluster_dir(cid),
-                                 op.basename(refs[cid]))
-                refs[cid] = ref_fa
-                with FastaWriter(ref_fa) as writer:
-                    self.add_log("Writing ref_fa %s" % refs[cid])
-                    writer.writeRecord(ref_id,
-                                       final_consensus_d[ref_id].sequence[:])
+            ref_id, seq = consensus[cid]
+            mkdir(self.cluster_dir(cid))
+            ref_fa = op.join(self.cluster_dir(cid), op.basename(refs[cid]))
+            refs[cid] = ref_fa
+            with FastaWriter(ref_fa) as writer:
+                self.add_log("Writing ref_fa %s" % refs[cid])
+                writer.writeRecord(ref_id, seq)
 
         self.add_log("Reconstruct of g consensus files completed.",
                      level=logging.INFO)
@@ -187,16 +294,17 @@ class IceQuiver(IceFiles):
         file_func = self.raw_bam_of_cluster if bam \
                     else self.raw_fa_of_cluster
 
-        for k in cids:  # for each cluster k
-            # write cluster k's associated raw subreads to raw_fa
-            # Trim both ends of subreads (which contain primers and polyAs)
-            trim_subreads_and_write(reader=d,
-                                    in_seqids=uc[k] + partial_uc[k],
-                                    out_file=file_func(k),
-                                    trim_len=IceQuiverOptions.trim_subread_flank_len,
-                                    min_len=IceQuiverOptions.min_trimmed_subread_len,
-                                    ignore_keyerror=True,
-                                    bam=bam)
+        # write each cluster k's associated raw subreads to raw_fa
+        # Trim both ends of subreads (which contain primers and polyAs)
+        # Subreads of all clusters are read in batch in order of file offsets.
+        out_file_to_seqids = OrderedDict((file_func(k), uc[k] + partial_uc[k])
+                                         for k in cids)
+        trim_subreads_and_write_in_batch(reader=d,
+                                         out_file_to_seqids=out_file_to_seqids,
+                                         trim_len=IceQuiverOptions.trim_subread_flank_len,
+                                         min_len=IceQuiverOptions.min_trimmed_subread_len,
+                                         ignore_keyerror=True,
+                                         bam=bam)
 
     def create_sams_for_clusters_in_bin(self, cids, refs, bam=False):
         """
@@ -235,14 +343,17 @@ class IceQuiver(IceFiles):
                 blasr_nproc=self.sge_opts.blasr_nproc)
 
 
-    def concat_valid_sams_and_refs_for_bin(self, cids, refs, bam=False):
+    def concat_valid_sams_and_refs_for_bin(self, cids, refs, bam=False,
+                                           consensus=None):
         """
         Concat sam files and reference sequences of all valid clusters
         in bin to create a big sam and a big ref.
         A cluser is not valid if (1) or (2)
             (1) identical sequences already exists in another cluster
-                (rare, but happens)
+                (rare, but happens), found by hashes of sequences
             (2) the alignment is empty (also rare, but happens)
+        consensus --- {cid: (name, sequence, hash)}, see consensus_of_clusters,
+                      by default read from refs.
         Return valid_cids, a list of valid cluster ids
         """
         first, last = cids[0], cids[-1]
@@ -257,24 +368,25 @@ class IceQuiver(IceFiles):
             bin_sam_file = self.bam_of_quivered_bin(first, last)
             file_func  = self.bam_of_cluster
             is_blank_file = is_blank_bam
-            concat_sambam = concat_bam
+            concat_sambam = lambda in_fns, out_fn: \
+                concat_bam(in_fns, out_fn, threads=self.sge_opts.blasr_nproc)
 
         self.add_log("Concatenating reference files between " +
                      "{first} and {last}.".format(first=first, last=last))
+        if consensus is None:
+            consensus = self.consensus_of_clusters(cids, refs=refs)
         valid_sam_files = []
         valid_cids = []
-        seqs_seen = {}
+        seqs_seen = defaultdict(list) # hash --> sequences
         with open(bin_ref_fa, 'w') as bin_ref_fa_writer:
             for cid in cids:
                 fname = file_func(cid)
                 if not is_blank_file(fname):
-                    ref_rec = get_the_only_fasta_record(refs[cid])
-                    name = ref_rec.name.strip()
-                    seq = ref_rec.sequence.strip()
-                    if seq not in seqs_seen:
+                    name, seq, seq_hash = consensus[cid]
+                    if seq not in seqs_seen[seq_hash]:
                         valid_sam_files.append(fname)
                         valid_cids.append(cid)
-                        seqs_seen[seq] = cid
+                        seqs_seen[seq_hash].append(seq)
                         # concate valid ref files, avoid 'cat ...' hundreds
                         # or even thousands of files due to linux cmd line
                         # length limits
@@ -301,12 +413,98 @@ class IceQuiver(IceFiles):
 
         return valid_cids
 
-    def quiver_cmds_for_bin(self, cids, quiver_nproc=2, bam=False):
+    def align_clusters_in_bin(self, cids, d, uc, partial_uc, refs, consensus=None,
+                              cids_with_raw=()):
+        """
+        Align subreads of all clusters in cids to their consensus sequences
+        by a single blasr call, instead of one blasr call per cluster.
+        (1) Write subreads of zmws of each cluster to raw_bam_of_cluster,
+            except clusters in cids_with_raw of which raw_bam_of_cluster
+            already exists (e.g., restored from polish cache), then concat
+            them to raw_bam_of_quivered_bin, each zmw only once.
+        (2) Write unique consensus sequences of all clusters to
+            all_ref_fa_of_quivered_bin.
+        (3) Align (1) to (2) to create blasr_bam_of_quivered_bin.
+        (4) Keep alignments of subreads to consensus sequences of clusters
+            which their zmws are assigned to, write them to sorted
+            bam_of_quivered_bin, and write consensus sequences with kept
+            alignments to ref_fa_of_quivered_bin.
+
+        d --- BamCollection
+        consensus --- {cid: (name, sequence, hash)}, see consensus_of_clusters
+        Return valid_cids, a list of cluster ids with alignments, see
+        concat_valid_sams_and_refs_for_bin.
+        """
+        first, last = cids[0], cids[-1]
+        raw_bam = self.raw_bam_of_quivered_bin(first, last)
+        all_ref_fa = self.all_ref_fa_of_quivered_bin(first, last)
+        blasr_bam = self.blasr_bam_of_quivered_bin(first, last)
+
+        zmw_to_cids = defaultdict(set)
+        for cid in cids:
+            for zmw in zmws_of_seqids(uc[cid] + partial_uc[cid]):
+                zmw_to_cids[zmw].add(cid)
+
+        self.add_log("Writing subreads of clusters between " +
+                     "{first} and {last} to {f}.".format(first=first, last=last, f=raw_bam))
+        cids_with_raw = set(cids_with_raw)
+        todo = [cid for cid in cids if cid not in cids_with_raw]
+        if len(todo) > 0:
+            self.create_raw_files_for_clusters_in_bin(cids=todo, d=d, uc=uc,
+                                                      partial_uc=partial_uc,
+                                                      bam=True)
+        concat_subreads_of_unique_zmws(in_bams=[self.raw_bam_of_cluster(cid) for cid in cids],
+                                       out_bam=raw_bam)
+
+        if consensus is None:
+            consensus = self.consensus_of_clusters(cids, uc=uc, refs=refs)
+        ref_name_to_cid, name_to_seq = {}, {}
+        seqs_seen = defaultdict(list) # hash --> sequences
+        with open(all_ref_fa, 'w') as writer:
+            for cid in cids:
+                name, seq, seq_hash = consensus[cid]
+                if seq not in seqs_seen[seq_hash]:
+                    seqs_seen[seq_hash].append(seq)
+                    ref_name_to_cid[name] = cid
+                    ref_name_to_cid[name.split()[0]] = cid
+                    name_to_seq[name.split()[0]] = (name, seq)
+                    writer.write(">{0}\n{1}\n".format(name, seq))
+                else:
+                    self.add_log("ignoring {0} because identical sequence!".format(cid))
+
+        # Each read may align to consensus of similar clusters in bin,
+        # report enough alignments to reach clusters which it belongs to.
+        n_refs = sum(len(seqs) for seqs in seqs_seen.itervalues())
+        blasr_for_quiver(query_fn=raw_bam, ref_fasta=all_ref_fa, out_fn=blasr_bam,
+                         bam=True, run_cmd=True,
+                         blasr_nproc=self.sge_opts.blasr_nproc,
+                         bestn=max(5, n_refs), nCandidates=max(10, n_refs))
+
+        valid_names = write_sorted_bam_of_targets(
+            in_bam=blasr_bam, out_bam=self.bam_of_quivered_bin(first, last, is_sorted=True),
+            zmw_to_cids=zmw_to_cids, ref_name_to_cid=ref_name_to_cid)
+
+        with open(self.ref_fa_of_quivered_bin(first, last), 'w') as writer:
+            for name in valid_names:
+                writer.write(">{0}\n{1}\n".format(*name_to_seq[name.split()[0]]))
+
+        valid_cids = [ref_name_to_cid[name] for name in valid_names]
+        for cid in set(ref_name_to_cid.values()).difference(valid_cids):
+            self.add_log("ignoring {0} because no alignments!".format(cid))
+        if len(valid_cids) == 0:
+            self.add_log("No alignments were found for clusters between " +
+                         "{first} and {last}.".format(first=first, last=last),
+                         level=logging.WARNING)
+        return valid_cids
+
+    def quiver_cmds_for_bin(self, cids, quiver_nproc=2, bam=False, is_sorted=False):
         """
         Return a list of quiver related cmds. Input format can be FASTA or BAM.
         If inputs are in FASTA format, call samtoh5, loadPulses, comph5tools.py,
         samtools, loadChemistry, quiver...
         If inputs are in BAM format, call quiver directly.
+        If is_sorted, bam_of_quivered_bin(is_sorted=True) has been created
+        and does not need to be sorted.
         """
         first, last = cids[0], cids[-1]
         self.add_log("Creating quiver cmds for c{first} to c{last}".
@@ -343,9 +541,10 @@ class IceQuiver(IceFiles):
                         format(bas_fofn=real_upath(self.bas_fofn),
                                cmph5=real_upath(bin_cmph5)))
         else:
-            cmds.append("samtools sort {f} {d}".format(
-                f=real_upath(bin_unsorted_bam_file),
-                d=real_upath(bin_bam_prefix)))
+            if not is_sorted:
+                cmds.append("samtools sort {f} {d}".format(
+                    f=real_upath(bin_unsorted_bam_file),
+                    d=real_upath(bin_bam_prefix)))
             cmds.append("samtools index {f}".format(f=real_upath(bin_bam_file)))
 
         cmds.append("samtools faidx {ref}".format(ref=real_upath(bin_ref_fa)))
@@ -385,7 +584,8 @@ class IceQuiver(IceFiles):
         self.add_log("Submitting todo quiver jobs.")
         if sge_opts.use_sge is not True or \
            sge_opts.max_sge_jobs == 0:  # don't use SGE
-            for job in todo:
+            def _run_local_job(job):
+                """Run a quiver job locally."""
                 elog = op.join(self.quivered_log_dir,
                                op.basename(job) + ".elog")
                 olog = op.join(self.quivered_log_dir,
@@ -394,7 +594,20 @@ class IceQuiver(IceFiles):
                       format(olog=real_upath(olog), elog=real_upath(elog))
                 self.run_cmd_and_log(cmd, olog=olog, elog=elog,
                                      description="Failed to run Quiver")
-                submitted.append(("local", job))
+
+            # Run jobs in a pool limited by local CPUs and memory.
+            n_slots = min(max(1, len(todo)),
+                          local_job_slots(nproc_per_job=sge_opts.quiver_nproc,
+                                          cpus=self.local_cpus))
+            self.add_log("Running {n} quiver jobs locally, at most {s} at a time.".
+                         format(n=len(todo), s=n_slots))
+            pool = ThreadPool(processes=n_slots)
+            try:
+                pool.map(_run_local_job, todo)
+            finally:
+                pool.close()
+                pool.join()
+            submitted.extend([("local", job) for job in todo])
             todo = []
         else:
             while len(todo) > 0:
@@ -429,18 +642,26 @@ class IceQuiver(IceFiles):
         consensus of clusters in the bin, prepare inputs and create a quiver
         bash script to run later.
 
+        (0) Compute polish cache keys of clusters in cids, see PolishCache.
+            Outputs of (1) and (2) of a cluster, or of (1)-(3) of a bin
+            if input subreads are in BAM, are reused from polish cache if
+            their keys are found. If input subreads are in BAM and outputs
+            of the bin are not found (e.g., clusters are packed into bins
+            differently), outputs of (1) are still reused per cluster.
         (1) For each cluster k in cids, obtain subreads of all zmws
             belonging to this cluster, and save in raw_fa_of_cluster(k)
         (2) For each cluster k in cids, call blasr to align raw_fa_of_cluster to
             its consensus sequence and create sam_of_cluster(k).
         (3) Concat all sam files of `valid` clusters to sam_of_quivered_bin, and
             concat ref seqs of all `valid` clusters to ref_fa_of_quivered_bin
+            If input subreads are in BAM, (1)-(3) are done by a single blasr
+            call per bin, see align_clusters_in_bin.
         (4) Make commands including
                 samtoh5, loadPulses, cmph5tools.py, loadChemistry, ..., quiver
             in order to convert sam_of_quivered_bin to cmph5_of_quivered_bin.
             Write these commands to script_of_quivered_bin
               * qsub all jobs later when scripts of all quivered bins are done.
-              * or execute scripts sequentially on local machine
+              * or execute scripts in a pool on local machine
         """
         if not isinstance(d, BamCollection) and \
            not isinstance(d, MetaSubreadFastaReader):
@@ -452,54 +673,183 @@ class IceQuiver(IceFiles):
 
         bam = True if isinstance(d, BamCollection) else False
 
-        # For each cluster in bin, create its raw subreads fasta file.
-        self.create_raw_files_for_clusters_in_bin(cids=cids, d=d, uc=uc,
-                                                  partial_uc=partial_uc,
-                                                  bam=bam)
-
-        # For each cluster in bin, align its raw subreads to ref to build a sam
-        self.create_sams_for_clusters_in_bin(cids=cids, refs=refs, bam=bam)
-
-        # Concatenate sam | ref files of 'valid' clusters in this bin to create
-        # a big sam | ref file.
-        valid_cids = self.concat_valid_sams_and_refs_for_bin(cids=cids,
-                                                             refs=refs,
-                                                             bam=bam)
+        # Polishing inputs are reused from polish cache if clusters,
+        # consensus sequences and parameters are unchanged since last run.
+        consensus = self.consensus_of_clusters(cids=cids, uc=uc, refs=refs)
+        keys = self.polish_cache_keys(cids=cids, uc=uc, partial_uc=partial_uc,
+                                      refs=refs, bam=bam, consensus=consensus)
+        if bam:
+            # Align subreads of all clusters in bin by a single blasr call
+            # and create a sorted bam | ref file of 'valid' clusters.
+            first, last = cids[0], cids[-1]
+            bin_key = polish_cache_key([keys[cid] for cid in cids])
+            bin_files = {"bam": self.bam_of_quivered_bin(first, last, is_sorted=True),
+                         "ref": self.ref_fa_of_quivered_bin(first, last)}
+            data = self.polish_cache.restore(bin_key, bin_files)
+            if data is not None:
+                valid_cids = data["valid_cids"]
+                self.record_polish_cache_hits(cids, len(cids))
+            else:
+                # Alignments depend on all consensus sequences in bin, while
+                # raw subreads of a cluster do not, so reuse them per cluster.
+                self.polish_cache.discard(bin_files)
+                raw_keys = self.raw_subreads_cache_keys(cids=cids, uc=uc,
+                                                        partial_uc=partial_uc)
+                raw_files = dict((cid, {"raw": self.raw_bam_of_cluster(cid)})
+                                 for cid in cids)
+                cids_with_raw = [cid for cid in cids if self.polish_cache.restore(
+                    raw_keys[cid], raw_files[cid]) is not None]
+                self.record_polish_cache_hits(cids, 0)
+                self.add_log("Reused raw subreads of {h}/{n} clusters from polish cache.".
+                             format(h=len(cids_with_raw), n=len(cids)), level=logging.INFO)
+                for cid in cids:
+                    if cid not in cids_with_raw:
+                        self.polish_cache.discard(raw_files[cid])
+
+                valid_cids = self.align_clusters_in_bin(cids=cids, d=d, uc=uc,
+                                                        partial_uc=partial_uc,
+                                                        refs=refs,
+                                                        consensus=consensus,
+                                                        cids_with_raw=cids_with_raw)
+                for cid in cids:
+                    self.polish_cache.save(raw_keys[cid], raw_files[cid])
+                self.polish_cache.save(bin_key, bin_files,
+                                       data={"valid_cids": valid_cids})
+        else:
+            files = dict((cid, {"raw": self.raw_fa_of_cluster(cid),
+                                "aln": self.sam_of_cluster(cid)}) for cid in cids)
+            todo = [cid for cid in cids
+                    if self.polish_cache.restore(keys[cid], files[cid]) is None]
+            self.record_polish_cache_hits(cids, len(cids) - len(todo))
+
+            if len(todo) > 0:
+                for cid in todo:
+                    self.polish_cache.discard(files[cid])
+
+                # For each cluster in bin, create its raw subreads fasta file.
+                self.create_raw_files_for_clusters_in_bin(cids=todo, d=d, uc=uc,
+                                                          partial_uc=partial_uc,
+                                                          bam=bam)
+
+                # For each cluster in bin, align its raw subreads to ref to build a sam
+                self.create_sams_for_clusters_in_bin(cids=todo, refs=refs, bam=bam)
+
+                for cid in todo:
+                    self.polish_cache.save(keys[cid], files[cid])
+
+            # Concatenate sam | ref files of 'valid' clusters in this bin to create
+            # a big sam | ref file.
+            valid_cids = self.concat_valid_sams_and_refs_for_bin(cids=cids,
+                                                                 refs=refs,
+                                                                 bam=bam,
+                                                                 consensus=consensus)
 
         # quiver cmds for this bin
         cmds = []
         if len(valid_cids) != 0:
             cmds = self.quiver_cmds_for_bin(cids=cids,
                                             quiver_nproc=sge_opts.quiver_nproc,
-                                            bam=bam)
+                                            bam=bam, is_sorted=bam)
         else:
             cmds = ["echo no valid clusters in this bin, skip..."]
 
         # Write quiver cmds for this bin to $root_dir/quivered/c{}_{}.sh
         return self.create_quiver_sh_for_bin(cids=cids, cmds=cmds)
 
+    def polish_cache_keys(self, cids, uc, partial_uc, refs, bam=False,
+                          consensus=None):
+        """
+        Return {cid: key} of clusters in cids, where key is a hash of
+        cluster members, consensus sequence, input subreads and parameters
+        to trim and align subreads, see PolishCache.
+        consensus --- {cid: (name, sequence, hash)}, see consensus_of_clusters
+        """
+        if consensus is None:
+            consensus = self.consensus_of_clusters(cids, uc=uc, refs=refs)
+        params = self.polish_cache_params(bam=bam)
+        keys = {}
+        for cid in cids:
+            name, seq, _seq_hash = consensus[cid]
+            keys[cid] = polish_cache_key(params, cid, list(uc[cid]), list(partial_uc[cid]),
+                                         name, seq)
+        return keys
+
+    def raw_subreads_cache_keys(self, cids, uc, partial_uc):
+        """
+        Return {cid: key} of raw subreads bam files of clusters in cids,
+        where key is a hash of cluster members, input subreads and parameters
+        to trim subreads, but not consensus sequences, see PolishCache.
+        """
+        params = self.polish_cache_params(bam=True)
+        return dict((cid, polish_cache_key("raw", params, list(uc[cid]),
+                                           list(partial_uc[cid])))
+                    for cid in cids)
+
+    def polish_cache_params(self, bam):
+        """Return input subreads and parameters to trim subreads, which
+        polish cache keys are computed from."""
+        return {"bam": bam,
+                "subreads": self.subreads_signature,
+                "trim_len": IceQuiverOptions.trim_subread_flank_len,
+                "min_len": IceQuiverOptions.min_trimmed_subread_len}
+
+    def record_polish_cache_hits(self, cids, n_hits):
+        """Log and record number of clusters in bin of which polishing
+        inputs are reused from polish cache."""
+        first, last = cids[0], cids[-1]
+        self.add_log("Reused polishing inputs of {h}/{n} clusters in bin [{first}, {last}] ".
+                     format(h=n_hits, n=len(cids), first=first, last=last) +
+                     "from polish cache.", level=logging.INFO)
+        with open(self.polish_cache_hits_fn, 'a') as writer:
+            writer.write("c{first}to{last}\t{h}\t{n}\n".
+                         format(first=first, last=last, h=n_hits, n=len(cids)))
+
+    def polish_costs(self, cids, uc, partial_uc):
+        """Return {cid: estimated cost of polishing cluster cid} of
+        clusters in cids, see QuiverScheduler.cluster_polish_cost."""
+        if isinstance(uc, ClusterMembers):
+            # Read sizes of clusters from index of ClusterState only.
+            return dict((cid, cluster_polish_cost(sum(uc.state.num_reads(cid)),
+                                                  uc.state.consensus_len(cid)))
+                        for cid in cids)
+        if not hasattr(self, "_consensus_lens"):
+            self._consensus_lens = consensus_lengths(self.final_consensus_fa)
+        return cluster_polish_costs(cids=cids, uc=uc, partial_uc=partial_uc,
+                                    consensus_lens=self._consensus_lens)
+
+    def pack_quiver_bins(self, cids, uc, partial_uc):
+        """Pack clusters in cids into bins of roughly equal polishing cost,
+        with clusters_per_bin clusters per bin on average.
+        Return a list of bins, each containing sorted cluster ids."""
+        num_bins = int(ceil(len(cids) / float(self.clusters_per_bin)))
+        costs = self.polish_costs(cids=cids, uc=uc, partial_uc=partial_uc)
+        bins = [b for b in pack_by_cost(cids, costs, num_bins) if len(b) > 0]
+        return sorted(bins)
+
     def create_quiver_bins(self, d, uc, partial_uc, refs, keys, start, end,
                            sge_opts):
         """
-        Create quiver bins by putting every 100 clusters into a bin.
+        Create quiver bins by packing clusters into bins of roughly equal
+        polishing cost, see pack_quiver_bins.
         For each bin, create a bash script (e.g., script_of_quivered_bin).
         Return a list of scripts to run.
         """
         bin_scripts = []
-        for i in xrange(start, end, 100):  # Put every 100 clusters to a bin
-            cids = keys[i:min(end, i + 100)]
+        for cids in self.pack_quiver_bins(keys[start:end], uc, partial_uc):
             bin_sh = self.create_a_quiver_bin(cids=cids, d=d, uc=uc,
                                               partial_uc=partial_uc,
                                               refs=refs, sge_opts=sge_opts)
-            bin_scripts += bin_sh
+            bin_scripts.append(bin_sh)
+        self.polish_cache.prune(max_size=self.polish_cache_max_size)
         return bin_scripts
 
     def create_quiver_bins_and_submit_jobs(self, d, uc, partial_uc, refs, keys,
                                            start, end, submitted, sge_opts):
         """
-        Put every 100 clusters together and create bins. Create a bash script
-        (e.g., script_of_quivered_bin), for each bin, and submit the script
-        either using qsub or running it locally.
+        Pack clusters into bins of roughly equal polishing cost. Create a
+        bash script (e.g., script_of_quivered_bin), for each bin, and submit
+        the script using qsub once it is created, or run all scripts locally
+        in a pool after all of them are created.
         return all bash scripts in a list.
         """
         if start >= end or start < 0 or start > len(keys) or end > len(keys):
@@ -509,23 +859,32 @@ class IceQuiver(IceFiles):
         new_refs = {cid: op.join(self.cluster_dir(cid), op.basename(refs[cid])) for cid in keys[start:end]}
         refs = new_refs
 
-        # Reconstruct refs if not exist.
-        if not nfs_exists(refs[keys[start]]):
+        # Reconstruct refs if not exist. Subreads in BAM are aligned to
+        # consensus sequences read by the index of ClusterState, which
+        # do not need refs, see consensus_of_clusters.
+        bam = isinstance(d, BamCollection)
+        if not (bam and isinstance(uc, ClusterMembers)) and \
+                not nfs_exists(refs[keys[start]]):
             self.reconstruct_ref_fa_for_clusters_in_bin(cids=keys[start:end],
-                                                        refs=refs)
+                                                        refs=refs, uc=uc)
 
+        use_sge = sge_opts.use_sge is True and sge_opts.max_sge_jobs != 0
         all_todo = []
-        for i in xrange(start, end, 100):  # Put every 100 clusters to a bin
-            cids = keys[i:min(end, i + 100)]
+        for cids in self.pack_quiver_bins(keys[start:end], uc, partial_uc):
             bin_sh = self.create_a_quiver_bin(cids=cids, d=d, uc=uc,
                                               partial_uc=partial_uc,
                                               refs=refs, sge_opts=sge_opts)
             all_todo.append(bin_sh)
             # assert bin_sh == self.script_of_quivered_bin(first, last)
             # submit the created script of this quiver bin
-            self.submit_todo_quiver_jobs(todo=[bin_sh], submitted=submitted,
+            if use_sge:
+                self.submit_todo_quiver_jobs(todo=[bin_sh], submitted=submitted,
+                                             sge_opts=sge_opts)
+        # end of for cids in bins
+
+        if not use_sge:
+            self.submit_todo_quiver_jobs(todo=list(all_todo), submitted=submitted,
                                          sge_opts=sge_opts)
-        # end of for i in xrange(start, end, 100):
         return all_todo
 
     @property
@@ -533,29 +892,6 @@ class IceQuiver(IceFiles):
         """Return a csv report with cluster_id, read_id, read_type."""
         return op.join(self.out_dir, "cluster_report.FL_nonFL.csv")
 
-    def load_pickles(self):
-        """Load uc and refs from final_pickle_fn, load partial uc from
-        nfl_all_pickle_fn, return (uc, partial_uc. refs).
-        """
-        def _load_pickle(fn):
-            """Load *.json or *.pickle file."""
-            with open(fn) as f:
-                if fn.endswith(".json"):
-                    return json.loads(f.read())
-                else:
-                    return cPickle.load(f)
-        self.add_log("Loading uc from {f}.".format(f=self.final_pickle_fn))
-        a = _load_pickle(self.final_pickle_fn)
-        uc = a['uc']
-        refs = a['refs']
-
-        self.add_log("Loading partial uc from {f}.".
-                     format(f=self.nfl_all_pickle_fn))
-        partial_uc = _load_pickle(self.nfl_all_pickle_fn)['partial_uc']
-        partial_uc2 = defaultdict(lambda: [])
-        partial_uc2.update(partial_uc)
-        return (uc, partial_uc2, refs)
-
     def index_input_subreads(self):
         """Index input subreads in self.fasta_fofn or self.bas_fofn.
         """
@@ -594,18 +930,20 @@ class IceQuiver(IceFiles):
         number of nodes, we divide quiver jobs into num_chunks workloads
         of roughly the same size, and are processing the i-th workload
         now.
-        (1) load uc, partial_uc and refs from pickles and index subreads
-            in fasta and save to d
+        (1) load uc, partial_uc and refs from a shared ClusterState store,
+            which only reads clusters touched by this chunk, and index
+            subreads in fasta and save to d
         (2) write report if this is the first chunk (e.g, i==0)
-        (3) Assume clusters are divided into num_chunks parts, process
-            the i-th part.
+        (3) Assume clusters are packed into num_chunks parts of roughly
+            equal polishing cost, process the i-th part.
         """
         if (i >= num_chunks):
             raise ValueError("Chunk index {i} should be less than {N}.".
                              format(i=i, N=num_chunks))
 
-        # load uc, partial_uc and refs from pickles,
-        uc, partial_uc, refs = self.load_pickles()
+        # load uc, partial_uc and refs from cluster state,
+        state = self.load_cluster_state()
+        uc, partial_uc, refs = state.uc, state.partial_uc, state.refs
 
         # Write report to quivered/cluster_report.FL_nonFL.csv
         if i == 0:
@@ -619,12 +957,11 @@ class IceQuiver(IceFiles):
         # bug 24984, call quiver on everything, no selection is needed.
         keys = sorted([x for x in uc])  # sort cluster ids
 
-        # Compute number of clusters in i-th chunk
-        num_clusters_per_chunk = int(ceil(len(keys) / float(num_chunks)))
-        num_clusters_in_chunk_i = max(0, min(len(keys) - i * num_clusters_per_chunk,
-                                             num_clusters_per_chunk))
-        start = i * num_clusters_per_chunk
-        end = start + num_clusters_in_chunk_i
+        # Pack clusters into num_chunks chunks of roughly equal cost,
+        # all chunks are packed the same way, take the i-th chunk.
+        costs = self.polish_costs(cids=keys, uc=uc, partial_uc=partial_uc)
+        keys = pack_by_cost(keys, costs, num_chunks)[i]
+        start, end = 0, len(keys)
 
         submitted = []
         # Create quiver bins and submit jobs
@@ -647,6 +984,7 @@ class IceQuiver(IceFiles):
         with open(sh_name, 'w') as f:
             assert isinstance(all_todo, list)
             f.write("\n".join(["bash " + str(x) for x in all_todo]))
+        state.close()
 
     def run(self):
         """Run quiver to polish all consensus isoforms predicted by ICE."""
@@ -148,7 +148,8 @@ class IceQuiverAll(object):
         icepq = IceQuiverPostprocess(root_dir=self.root_dir,
                                      use_sge=self.sge_opts.use_sge,
                                      quit_if_not_done=False,
-                                     ipq_opts=self.ipq_opts)
+                                     ipq_opts=self.ipq_opts,
+                                     nproc=self.sge_opts.quiver_nproc)
         icepq.run()
         return 0
 
@@ -119,24 +119,55 @@ import os
 import re
 import logging
 import os.path as op
-from collections import defaultdict
-from cPickle import load
-from time import sleep
+from multiprocessing import Pool
 
-from pbcore.io import FastaWriter, FastqReader, FastqWriter
+from pbcore.io import FastaWriter, FastqWriter
 
 from pbtranscript.ClusterOptions import IceQuiverHQLQOptions
 from pbtranscript.PBTranscriptOptions import \
     add_cluster_root_dir_as_positional_argument, \
     add_ice_post_quiver_hq_lq_arguments, \
     add_cluster_summary_report_arguments, _wrap_parser # FIXME
-from pbtranscript.Utils import phred_to_qv, as_contigset, \
+from pbtranscript.Utils import as_contigset, \
     get_all_files_in_dir, ln, nfs_exists
+from pbtranscript.RunnerUtils import DirectoryWatcher, backoff_intervals
+from pbtranscript.io import FastqRandomReader
+from pbtranscript.io.FastqRandomReader import load_or_build_fastq_fai
 from pbtranscript.ice.IceFiles import IceFiles
 from pbtranscript.ice.IceUtils import cid_with_annotation
 from pbtranscript.ice.__init__ import ICE_QUIVER_PY
 
 
+def cid_of_quivered_name(name):
+    """Return cluster id of a quivered consensus isoform,
+    e.g., c0/0_1611|quiver --> 0, c3_ref|quiver --> 3"""
+    cid = name.split('|')[0]
+    if cid.endswith('_ref'):
+        cid = cid[:-4]
+    i = cid.find('/')
+    if i > 0:
+        cid = cid[:i]
+    return int(cid[1:])
+
+
+def quivered_fq_stats(args):
+    """
+    Given args = (fq, qv_trim_5, qv_trim_3), return a list of
+        (cid, read_id, err_sum, qv_len)
+    of records in a quivered fq in file order, where qv_len is the number
+    of bases ignoring the first qv_trim_5 and the last qv_trim_3 bases,
+    and err_sum is expected number of errors of these bases.
+    QVs are decoded and summed in numpy arrays.
+    """
+    fq, qv_trim_5, qv_trim_3 = args
+    ids = [e[0] for e in load_or_build_fastq_fai(fq)]
+    reader = FastqRandomReader(fq)
+    err_sums, qv_lens = reader.trimmed_expected_errors(ids, qv_trim_5, qv_trim_3)
+    reader.close()
+    return [(cid_of_quivered_name(read_id), read_id, float(err_sum), int(qv_len))
+            for read_id, err_sum, qv_len in zip(ids, err_sums, qv_lens)]
+
+
 class IceQuiverPostprocess(IceFiles):
 
     """check if quiver jobs are finished and quiver results are compeleted.
@@ -153,11 +184,15 @@ class IceQuiverPostprocess(IceFiles):
     def __init__(self, root_dir, ipq_opts,
                  use_sge=False, quit_if_not_done=True,
                  summary_fn=None, report_fn=None,
-                 no_log_f=False, make_dirs=True):
+                 no_log_f=False, make_dirs=True, nproc=1):
+        """
+        nproc --- number of worker processes to read quivered fastq files.
+        """
         super(IceQuiverPostprocess, self).__init__(
                 prog_name="ice_quiver_postprocess",
                 root_dir=root_dir, no_log_f=no_log_f, make_dirs=make_dirs)
         self.use_sge = use_sge
+        self.nproc = nproc
         self.quit_if_not_done = quit_if_not_done
 
         assert(type(ipq_opts) is IceQuiverHQLQOptions)
@@ -315,59 +350,68 @@ class IceQuiverPostprocess(IceFiles):
         return op.join(self.root_dir, "all_quivered_lq.fastq")
 
     def pickup_best_clusters(self, fq_filenames):
-        """Pick up hiqh QV clusters."""
+        """Pick up hiqh QV clusters.
+        QV statistics of quivered fq files are computed in parallel by
+        nproc workers, which only return statistics. If a cluster appears
+        in multiple fq files, the last one wins. Records are then read
+        from fq files by index one at a time and streamed to HQ|LQ
+        fasta|fastq in order of cluster ids.
+        """
         self.add_log("Picking up the best clusters according to QVs from {fs}.".
                      format(fs=", ".join(fq_filenames)))
-        a = load(open(self.final_pickle_fn))
-        uc = a['uc']
-        quivered = {}
-
-        for fq in fq_filenames:
-            self.add_log("Looking at quivered fq {f}".format(f=fq))
-            for r in FastqReader(fq):
-                # possible ID: c0/0_1611|quiver
-                cid = r.name.split('|')[0]
-                if cid.endswith('_ref'):
-                    cid = cid[:-4]
-                i = cid.find('/')
-                if i > 0:
-                    cid = cid[:i]
-                cid = int(cid[1:])
-                quivered[cid] = r
-
-        good = []
-
-        for cid, r in quivered.iteritems():
-            qv_len = max(0, len(r.quality) - self.qv_trim_5 - self.qv_trim_3)
-            if qv_len != 0:
-                q = [phred_to_qv(x) for x in r.quality]
-                err_sum = sum(q[self.qv_trim_5: -self.qv_trim_3])
-                if 1.0 - (err_sum / float(qv_len)) >= self.hq_quiver_min_accuracy and \
-                    len(uc[cid]) >= self.hq_min_full_length_reads :
-                    good.append(cid)
-
-        partial_uc = load(open(self.nfl_all_pickle_fn))['partial_uc']
-        partial_uc2 = defaultdict(lambda: [])
-        partial_uc2.update(partial_uc)
+        # Read uc and partial_uc from cluster state if IceQuiver has built
+        # it, which only reads clusters being looked up, else from pickles.
+        state = self.load_cluster_state(build=False)
+        if state is not None:
+            uc, partial_uc = state.uc, state.partial_uc
+        else:
+            uc, partial_uc, _refs = self.load_pickles()
+
+        args = [(fq, self.qv_trim_5, self.qv_trim_3) for fq in fq_filenames]
+        if self.nproc > 1 and len(args) > 1:
+            pool = Pool(processes=min(self.nproc, len(args)))
+            try:
+                all_stats = pool.map(quivered_fq_stats, args)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            all_stats = [quivered_fq_stats(arg) for arg in args]
+
+        quivered = {} # cid --> (index of fq, read_id)
+        good = set()
+        for index, stats in enumerate(all_stats):
+            self.add_log("Looking at quivered fq {f}".format(f=fq_filenames[index]))
+            for cid, read_id, err_sum, qv_len in stats:
+                quivered[cid] = (index, read_id)
+                good.discard(cid)
+                if qv_len != 0 and \
+                   1.0 - (err_sum / float(qv_len)) >= self.hq_quiver_min_accuracy and \
+                   len(uc[cid]) >= self.hq_min_full_length_reads:
+                    good.add(cid)
 
         if self.report_fn is not None:
             self.write_report(report_fn=self.report_fn,
-                              uc=uc, partial_uc=partial_uc2)
+                              uc=uc, partial_uc=partial_uc)
 
         self.add_log("Writing hiqh-quality isoforms to {f}|fq".
                      format(f=self.quivered_good_fa))
         self.add_log("Writing low-quality isoforms to {f}|fq".
                      format(f=self.quivered_bad_fa))
+        readers = {}
         with FastaWriter(self.quivered_good_fa) as good_fa_writer, \
                 FastaWriter(self.quivered_bad_fa) as bad_fa_writer, \
                 FastqWriter(self.quivered_good_fq) as good_fq_writer, \
                 FastqWriter(self.quivered_bad_fq) as bad_fq_writer:
-            for cid in quivered:
-                r = quivered[cid]
+            for cid in sorted(quivered):
+                index, read_id = quivered[cid]
+                if index not in readers:
+                    readers[index] = FastqRandomReader(fq_filenames[index])
+                r = readers[index][read_id]
                 newname = "c{cid}/f{flnc_num}p{nfl_num}/{read_len}".\
                     format(cid=cid,
                            flnc_num=len(uc[cid]),
-                           nfl_num=len(partial_uc2[cid]),
+                           nfl_num=len(partial_uc[cid]),
                            read_len=len(r.sequence))
                 newname = cid_with_annotation(newname)
 
@@ -381,6 +425,10 @@ class IceQuiverPostprocess(IceFiles):
                                  format(c=cid))
                     bad_fa_writer.writeRecord(newname, r.sequence[:])
                     bad_fq_writer.writeRecord(newname, r.sequence[:], r.quality)
+        for reader in readers.values():
+            reader.close()
+        if state is not None:
+            state.close()
 
         self.add_log("-" * 60, level=logging.INFO)
         self.add_log("High-quality Quivered consensus written " +
@@ -431,25 +479,30 @@ class IceQuiverPostprocess(IceFiles):
                          level=logging.ERROR)
             return -1
         elif self.use_sge is True:
-            while job_stats != "DONE":
-                self.add_log("Sleeping for 180 seconds.")
-                sleep(180)
-                job_stats = self.check_quiver_jobs_completion()
-                if job_stats == "DONE":
-                    break
-                elif job_stats == "FAILED":
-                    self.add_log("There are some failed jobs. Please check.",
-                                 level=logging.ERROR)
-                    return 1
-                elif job_stats == "RUNNING":
-                    self.add_log("There are jobs still running, waiting...",
-                                 level=logging.INFO)
-                    if self.quit_if_not_done is True:
-                        return 0
-                else:
-                    msg = "Unable to recognize job_stats {s}".format(job_stats)
-                    self.add_log(msg, logging.ERROR)
-                    raise ValueError(msg)
+            # Check jobs again as soon as a quivered file is written, or
+            # in exponentially increasing intervals of at most 180 seconds.
+            intervals = backoff_intervals(initial=5, maximum=180)
+            with DirectoryWatcher([self.quivered_dir]) as watcher:
+                while job_stats != "DONE":
+                    interval = next(intervals)
+                    self.add_log("Waiting for at most {n} seconds.".format(n=interval))
+                    watcher.wait(interval)
+                    job_stats = self.check_quiver_jobs_completion()
+                    if job_stats == "DONE":
+                        break
+                    elif job_stats == "FAILED":
+                        self.add_log("There are some failed jobs. Please check.",
+                                     level=logging.ERROR)
+                        return 1
+                    elif job_stats == "RUNNING":
+                        self.add_log("There are jobs still running, waiting...",
+                                     level=logging.INFO)
+                        if self.quit_if_not_done is True:
+                            return 0
+                    else:
+                        msg = "Unable to recognize job_stats {s}".format(job_stats)
+                        self.add_log(msg, logging.ERROR)
+                        raise ValueError(msg)
 
         self.pickup_best_clusters(self.fq_filenames)
 
@@ -6,13 +6,15 @@ import shutil
 import filecmp
 import random
 import time
-from cPickle import dump, load
+import itertools
+import hashlib
+from multiprocessing import Pool
 from collections import defaultdict
 import numpy as np
 import pysam
 from pbcore.util.Process import backticks
 from pbcore.io import FastaReader, FastaWriter, FastqWriter, \
-        BasH5Reader
+        BasH5Reader, openDataFile
 from pbtranscript.Utils import realpath, mkdir, execute, \
         write_files_to_fofn, real_upath, \
         get_files_from_file_or_fofn, \
@@ -21,7 +23,9 @@ from pbtranscript.RunnerUtils import write_cmd_to_script
 from pbtranscript.findECE import findECE
 from pbtranscript.io.BasQV import basQVcacher
 from pbtranscript.io import BLASRM5Reader, MetaSubreadFastaReader, \
-        BamCollection, BamWriter, LA4IceReader
+        BamCollection, BamWriter, LA4IceReader, FastqRandomReader, \
+        merge_sam_files, merge_sam_header_lines, sam_header_lines, \
+        merge_partial_uc_pickles
 from pbtranscript.io.ContigSetReaderWrapper import ContigSetReaderWrapper
 from pbtranscript.ice_daligner import DalignerRunner
 from pbtranscript.ice.ProbModel import ProbFromQV, \
@@ -564,74 +568,16 @@ def concat_sam(samfiles, outsam_filename):
     @RG     ID:2caa54eef6   PU:in.raw_with_partial.fasta       SM:NO_CHIP_ID
     @PG     ID:BLASR        VN:1.3.1.126469 CL:blasr in.raw_with_partial.fasta g_consensus.fasta -nproc 12 -bestn 5 -nCandidates 10 -sam -out out.sam
 
+    Records of samfiles are streamed to outsam_filename, headers are
+    merged, see merge_sam_header_lines, keeping @RG and @PG of the first
+    sam file only.
     NOTE: check for M5 conflicts; manipulate them if it conflicts
     """
-    f_sq = open(outsam_filename + '.sq', 'w')
-    f_bd = open(outsam_filename + '.bd', 'w')
-
-    rg_line = None
-    pg_line = None
-
-    md5_seen = set()
-
     if len(samfiles) == 0:
         raise ValueError("No sam input files to concatenate.")
-
-    h = open(samfiles[0])
-    line = h.readline()
-    assert line.startswith('@HD')
-    f_sq.write(line)
-    line = h.readline()
-    assert line.startswith('@SQ')
-    line = h.readline()
-    assert line.startswith('@RG')
-    rg_line = line  # write at the end
-    line = h.readline()
-    assert line.startswith('@PG')
-    pg_line = line  # write at the end
-    h.close()
-
-    for f in samfiles:
-        with open(f) as h:
-            assert h.readline().startswith('@HD')
-            line = h.readline()
-            assert line.startswith('@SQ')
-            # ------- check for MD5 conflicts ----------- #
-            m5 = line.strip().split()[-1]
-            assert m5.startswith("M5:")
-            if m5 not in md5_seen:
-                f_sq.write(line)
-                md5_seen.add(m5)
-            else:
-                s = list(m5[3:])
-                while True:
-                    # create a random m5 string.
-                    random.shuffle(s)
-                    s = "".join(s)
-                    if s not in md5_seen:
-                        break
-                line = line[:line.find('M5:')] + 'M5:' + s + '\n'
-                logging.debug("MD5 conflict: change to {0}".format(s))
-                md5_seen.add(s)
-                f_sq.write(line)
-            # ----- end MD5 checking and writing --------- #
-            assert h.readline().startswith('@RG')
-            assert h.readline().startswith('@PG')
-            for line in h:
-                f_bd.write(line)
-
-    f_bd.close()
-    f_sq.write(rg_line)
-    f_sq.write(pg_line)
-    f_sq.close()
-
-    cmd = "cat {0}.sq {0}.bd > {0}".format(real_upath(outsam_filename))
-    execute(cmd=cmd,
-            errmsg="Failed to concat sam files! Abort.",
-            errcls=IOError)
-
-    os.remove(f_sq.name)
-    os.remove(f_bd.name)
+    header = merge_sam_header_lines([sam_header_lines(fn) for fn in samfiles],
+                                    unique_m5=True, first_rg_pg=True)
+    merge_sam_files(samfiles, outsam_filename, header=header)
 
 
 def concat_bam_header(in_fns, out_fn=None):
@@ -649,20 +595,14 @@ def concat_bam_header(in_fns, out_fn=None):
     return h
 
 
-def concat_bam(in_fns, out_fn):
-    """Concat input bam files to an output bam file.
-    Note that each input bam has ONLY one reference sequence.
+def concat_bam(in_fns, out_fn, threads=1):
+    """Concat input bam files to an output bam file, compressed by threads.
+    Records are streamed from input bam files, and k-way merged if input
+    bam files are all sorted, see merge_sam_files.
     """
     # construct sam header
     h = concat_bam_header(in_fns)
-    o = BamWriter(out_fn, header=h)
-    for index, in_fn in enumerate(in_fns):
-        s = pysam.Samfile(in_fn, 'rb')
-        for r in s:
-            r.tid = index # Overwrite tid !!!
-            o.write(r)
-        s.close()
-    o.close()
+    merge_sam_files(in_fns, out_fn, header=h, threads=threads)
 
 
 def convert_fofn_to_fasta(fofn_filename, out_filename, fasta_out_dir,
@@ -716,75 +656,124 @@ def build_sa(input_fasta, out_sa):
         raise IOError("Unable to find fasta file {f}.".format(f=input_fasta))
 
 
-def trim_subreads_and_write(reader, in_seqids, out_file, trim_len, min_len,
-                            ignore_keyerror=False, bam=False):
-    """ Extract (dump) raw subreads of every zmws from in_seqeids from reader
-    to out_file.
+def zmws_of_seqids(seqids):
+    """Return a list of unique zmws <movie>/<holeNumber> of read ids
+    in seqids, in order of their first occurrence."""
+    zmws, zmw_seen = [], set()
+    for seqid in seqids:
+        zmw = '/'.join(seqid.split('/')[0:2])
+        if zmw not in zmw_seen:
+            zmw_seen.add(zmw)
+            zmws.append(zmw)
+    return zmws
+
+
+def write_trimmed_subreads(f, zmw_records, trim_len, min_len, bam):
+    """Trim the first and last trim_len bases of subreads of a zmw
+    and write subreads longer than min_len to f.
+        zmw_records --- a BamZmw if bam, otherwise a list of FastaRecords.
+    """
+    if bam:
+        for rec in zmw_records.subreads:
+            if len(rec) >= 2*trim_len + min_len:
+                f.write(rec.Clip(rec.readStart+trim_len,
+                                 rec.readEnd-trim_len))
+    else:
+        for rec in zmw_records:
+            if len(rec) >= 2*trim_len + min_len:
+                try:
+                    m, hn, s_e = rec.name.split('/')
+                    s, e = [int(x) for x in s_e.split('_')]
+                    new_id = "%s/%s/%d_%d" % (m, hn, s+trim_len, e-trim_len)
+                    f.writeRecord(new_id, rec.sequence[trim_len:-trim_len])
+                except ValueError:
+                    raise ValueError("%s is not a valid pacbio subread." % rec.name)
+
+
+def trim_subreads_and_write_in_batch(reader, out_file_to_seqids, trim_len, min_len,
+                                     ignore_keyerror=False, bam=False,
+                                     max_files_per_batch=100):
+    """ Extract (dump) raw subreads of every zmws of in_seqids to out_file
+    for every (out_file, in_seqids) in out_file_to_seqids.
         reader --- provides random access to raw subreads in input file.
                    type = MetaSubreadFastaReader, when input files are in FASTA,
                    and reads are in format <movie>/<holeNumber>/<subread or CCS>.
                    type = BamCollection, when input files are in BAM.
-        trim_len --- trim the first and last n bases when input is BAM
-        min_len --- minimum read length to write a subread when input is BAM
-        in_seqids --- zmw ids to dump
-        out_file --- a FASTA file when input files are in FASTA; a BAM file when
-                     input files are in BAM.
+        out_file_to_seqids --- an OrderedDict {out_file: in_seqids}, where
+                   out_file is a FASTA file when input files are in FASTA;
+                   a BAM file when input files are in BAM, and
+                   in_seqids are zmw ids to dump.
+        trim_len --- trim the first and last n bases of subreads
+        min_len --- minimum read length to write a subread
+        max_files_per_batch --- zmws of at most this many out_files are
+                   collected and read in one sweep, in order of input files
+                   and file offsets. Subreads are then routed to out_files,
+                   which are written one at a time.
         return movies seen
     """
-    movies = set()
-    zmw_seen = set()
-    f = None # output open file handler
-
     if bam:
         assert isinstance(reader, BamCollection)
-        f = BamWriter(out_file, reader.header)
     else:
         assert isinstance(reader, MetaSubreadFastaReader)
-        f = FastaWriter(out_file)
-
-    for seqid in in_seqids:
-        zmw = seqid
-        try:
-            zmw = '/'.join(seqid.split('/')[0:2])
-        except ValueError:
-            raise ValueError("%s does not contain a valid pacbio zmw id." % seqid)
 
-        if zmw not in zmw_seen:
-            movies.add(zmw.split('/')[0])
-            zmw_seen.add(zmw)
-            try:
-                if bam:
-                    for rec in reader[zmw].subreads:
-                        if len(rec) >= 2*trim_len + min_len:
-                            f.write(rec.Clip(rec.readStart+trim_len,
-                                             rec.readEnd-trim_len))
-                else:
-                    for rec in reader[zmw]:
-                        if len(rec) >= 2*trim_len + min_len:
-                            try:
-                                m, hn, s_e = rec.name.split('/')
-                                s, e = [int(x) for x in s_e.split('_')]
-                                new_id = "%s/%s/%d_%d" % (m, hn, s+trim_len, e-trim_len)
-                                f.writeRecord(new_id, rec.sequence[trim_len:-trim_len])
-                            except ValueError:
-                                raise ValueError("%s is not a valid pacbio subread." % rec.name)
-            except KeyError:
-                if ignore_keyerror:
+    movies = set()
+    items = list(out_file_to_seqids.iteritems())
+    for i in xrange(0, len(items), max(1, max_files_per_batch)):
+        batch = [(out_file, zmws_of_seqids(in_seqids))
+                 for out_file, in_seqids in items[i:i+max_files_per_batch]]
+        batch_zmws = []
+        for _out_file, zmws in batch:
+            batch_zmws.extend(zmws)
+            movies.update([zmw.split('/')[0] for zmw in zmws])
+
+        zmw_to_records = reader.fetch_zmws(batch_zmws, ignore_missing=True)
+
+        for out_file, zmws in batch:
+            f = BamWriter(out_file, reader.header) if bam else FastaWriter(out_file)
+            for zmw in zmws:
+                if zmw in zmw_to_records:
+                    write_trimmed_subreads(f, zmw_to_records[zmw],
+                                            trim_len, min_len, bam)
+                elif ignore_keyerror:
                     logging.warning("Ignoring {zmw} because the input FASTA/BAM ".
                                     format(zmw=zmw) + " does not contain it.")
                 else:
+                    f.close()
                     raise ValueError("{0} doesn't exist. Abort!".format(zmw))
-    f.close()
+            f.close()
 
     return movies
 
 
+def trim_subreads_and_write(reader, in_seqids, out_file, trim_len, min_len,
+                            ignore_keyerror=False, bam=False):
+    """ Extract (dump) raw subreads of every zmws from in_seqeids from reader
+    to out_file.
+        reader --- provides random access to raw subreads in input file.
+                   type = MetaSubreadFastaReader, when input files are in FASTA,
+                   and reads are in format <movie>/<holeNumber>/<subread or CCS>.
+                   type = BamCollection, when input files are in BAM.
+        trim_len --- trim the first and last n bases when input is BAM
+        min_len --- minimum read length to write a subread when input is BAM
+        in_seqids --- zmw ids to dump
+        out_file --- a FASTA file when input files are in FASTA; a BAM file when
+                     input files are in BAM.
+        return movies seen
+    """
+    return trim_subreads_and_write_in_batch(
+        reader=reader, out_file_to_seqids={out_file: in_seqids},
+        trim_len=trim_len, min_len=min_len,
+        ignore_keyerror=ignore_keyerror, bam=bam)
+
+
 def blasr_for_quiver(query_fn, ref_fasta, out_fn, bam=False,
-                     run_cmd=True, blasr_nproc=12):
+                     run_cmd=True, blasr_nproc=12, bestn=5, nCandidates=10):
     """
     query_fn  --- should be in.raw.fasta|bam
     ref_fasta --- reference fasta (ex: g_consensus.fasta) to align to
     out_fn    --- sam|bam output aligning query_fn to ref_fasta
+    bestn, nCandidates --- report at most bestn alignments of each read
+                  among nCandidates candidates
 
     blasr query_fn ref_fasta -out out_fn -sam -clipping soft
     blasr query_fn ref_fasta -out out_fn -bam
@@ -792,7 +781,7 @@ def blasr_for_quiver(query_fn, ref_fasta, out_fn, bam=False,
     cmd = "blasr {i} ".format(i=real_upath(query_fn)) + \
           "{r} ".format(r=real_upath(ref_fasta)) + \
           "--nproc {n} ".format(n=blasr_nproc) + \
-          "--bestn 5 --nCandidates 10 " + \
+          "--bestn {b} --nCandidates {c} ".format(b=bestn, c=nCandidates) + \
           ("--sam --clipping soft " if not bam else "--bam ") + \
           "--out {o} ".format(o=real_upath(out_fn)) + \
           "1>/dev/null 2>/dev/null"
@@ -803,6 +792,65 @@ def blasr_for_quiver(query_fn, ref_fasta, out_fn, bam=False,
     return cmd
 
 
+def concat_subreads_of_unique_zmws(in_bams, out_bam):
+    """
+    Concat unaligned subreads in in_bams to out_bam, keeping subreads of a
+    zmw only from the first file which contains this zmw, e.g., concat raw
+    subreads of clusters which may share zmws.
+    Header of out_bam is copied from the first file.
+    """
+    with pysam.Samfile(in_bams[0], 'rb', check_sq=False) as reader:
+        header = reader.header.to_dict() if hasattr(reader.header, "to_dict") \
+                 else dict(reader.header)
+    zmws_seen = set()
+    with BamWriter(out_bam, header) as writer:
+        for in_bam in in_bams:
+            zmws = set()
+            with pysam.Samfile(in_bam, 'rb', check_sq=False) as reader:
+                for r in reader:
+                    zmw = '/'.join(r.qname.split('/')[0:2])
+                    if zmw not in zmws_seen:
+                        zmws.add(zmw)
+                        writer.write(r)
+            zmws_seen.update(zmws)
+
+
+def write_sorted_bam_of_targets(in_bam, out_bam, zmw_to_cids, ref_name_to_cid):
+    """
+    Filter alignments in in_bam, which aligns subreads of zmws of multiple
+    clusters to consensus sequences of these clusters, keep an alignment
+    only if its subread belongs to a zmw assigned to the cluster of its
+    reference, and write kept alignments sorted by reference and position
+    to out_bam, of which the header only contains references with kept
+    alignments.
+        zmw_to_cids --- {movie/holeNumber: set of cluster ids}
+        ref_name_to_cid --- {reference name: cluster id}
+    Return names of references with kept alignments, in order of in_bam header.
+    """
+    with pysam.Samfile(in_bam, 'rb', check_sq=False) as reader:
+        header = reader.header.to_dict() if hasattr(reader.header, "to_dict") \
+                 else dict(reader.header)
+        ref_names = [sq['SN'] for sq in header.get('SQ', [])]
+        records = defaultdict(list) # reference name --> kept alignments
+        for r in reader:
+            if r.is_unmapped:
+                continue
+            ref_name = ref_names[r.tid]
+            zmw = '/'.join(r.qname.split('/')[0:2])
+            if ref_name_to_cid.get(ref_name) in zmw_to_cids.get(zmw, ()):
+                records[ref_name].append(r)
+
+    valid_sqs = [sq for sq in header.get('SQ', []) if sq['SN'] in records]
+    header['SQ'] = valid_sqs
+    header.setdefault('HD', {'VN': '1.5'})['SO'] = 'coordinate'
+    with BamWriter(out_bam, header) as writer:
+        for tid, sq in enumerate(valid_sqs):
+            for r in sorted(records[sq['SN']], key=lambda r: r.pos):
+                r.tid = tid # Overwrite tid !!!
+                writer.write(r)
+    return [sq['SN'] for sq in valid_sqs]
+
+
 def num_reads_in_fasta(in_fa):
     """Return the number of reads in the in_fa fasta file."""
     if not op.exists(in_fa):
@@ -817,34 +865,15 @@ def num_reads_in_fasta(in_fa):
 
 
 def combine_nfl_pickles(splitted_pickles, out_pickle):
-    """Combine splitted nfl pickles to a big pickle."""
+    """Combine splitted nfl pickles to a big nfl pickle, and save its
+    partial_uc in the sorted text format next to it, which is read by
+    load_partial_uc or iter_partial_uc (see io.PartialUCIO)."""
     logging.debug("Cominbing {N} nfl pickles: {ps} ".
                   format(N=len(splitted_pickles),
                          ps=",".join(splitted_pickles)) +
                   " into a big pickle {p}.".format(p=out_pickle))
-
-    if len(splitted_pickles) == 1:
-        logging.debug("Copying the only given pickle to out_pickle.")
-        if realpath(splitted_pickles[0]) != realpath(out_pickle):
-            shutil.copyfile(splitted_pickles[0], out_pickle)
-    else:
-        # Combine all partial outputs
-        logging.debug("Merging all pickles.")
-        partial_uc = defaultdict(lambda: [])
-        nohit = set()
-        for pf in splitted_pickles:
-            logging.debug("Merging {pf}.".format(pf=pf))
-            a = load(open(pf))
-            nohit.update(a['nohit'])
-            for k, v in a['partial_uc'].iteritems():
-                partial_uc[k] += v
-
-        logging.debug("Dumping all to {f}".format(f=out_pickle))
-        # Dump to one file
-        partial_uc = dict(partial_uc)
-        with open(out_pickle, 'w') as f:
-            dump({'nohit': nohit, 'partial_uc': partial_uc}, f)
-        logging.debug("{f} created.".format(f=out_pickle))
+    merge_partial_uc_pickles(splitted_pickles, out_pickle)
+    logging.debug("{f} created.".format(f=out_pickle))
 
 
 def cid_with_annotation(cid):
@@ -930,41 +959,6 @@ class _Parsed_Read_Name(object):
                    "%s/%s" % (self.zmwName, s_e)
 
 
-def get_qvs_from_bam(reader, parsed_read_name, qv_name):
-    """Get qvs from a bam file."""
-    if not parsed_read_name.is_CCS:
-        raise IOError("get_qvs_from_bam does not support non-ccs bam.")
-
-    zmw = reader[parsed_read_name.zmwName]
-    if zmw.ccsRead is None:
-        raise IOError("Could not find ccs of zmw %s" % zmw.zmwName)
-    qvs = zmw.ccsRead.qv(qv_name)
-
-    if not parsed_read_name.get_all:
-        qvs = qvs[parsed_read_name.s:parsed_read_name.e]
-    if parsed_read_name.strand == "-":
-        qvs = qvs[::-1]
-    return qvs
-
-
-def get_qv_from_bas_handler(bas_handler, parsed_read_name, qv_name):
-    """Read QV of type qv_name for movie/hn/s_e from bas_h5 file handler."""
-    zmw = bas_handler[parsed_read_name.hn]
-    if parsed_read_name.is_CCS:
-        if zmw.ccsRead is not None:
-            qvs = zmw.ccsRead.qv(qv_name)
-        else:  # this is for CCS w/ 0-passed
-            qvs = zmw.read().qv(qv_name)
-    else:  # subread
-        qvs = zmw.read().qv(qv_name)
-
-    if not parsed_read_name.get_all:
-        qvs = qvs[parsed_read_name.s:parsed_read_name.e]
-    if parsed_read_name.strand == '-':
-        qvs = qvs[::-1]
-    return qvs
-
-
 def fafn2fqfn(fafn):
     """return a FASTQ file name which corresponds to a FASTA file."""
     if fafn.find('.') != -1:
@@ -973,59 +967,219 @@ def fafn2fqfn(fafn):
         return fafn + ".fastq"
 
 
-def ice_fa2fq(in_fa, ccs_fofn, out_fq):
-    """Convert an input FASTA file to an output FASTQ file,
-       reading QVs from the input ccs.h5, ccs.bam or ccs FOFN.
-    """
-    ccs_fns = get_files_from_file_or_fofn(ccs_fofn)
-    fmt = guess_file_format(ccs_fns)
-
+def _qv_reader(ccs_fns, fmt):
+    """Return a reader of QVs in ccs files, a basQVcacher mapping
+    reads to bas files if ccs files are in H5, or a BamCollection."""
     if fmt == FILE_FORMATS.H5:
         qver = basQVcacher()
         for ccs_fn in ccs_fns:
             qver.add_bash5(ccs_fn)
-        bas_handlers = {}
+        return qver
     elif fmt == FILE_FORMATS.BAM:
-        qver = BamCollection(*ccs_fns)
-    else:
-        raise IOError("ice_fa2fq does not support input %s." %
-                      ccs_fofn)
+        return BamCollection(*ccs_fns)
+    raise IOError("ice_fa2fq does not support input %s." % ccs_fns)
 
-    with ContigSetReaderWrapper(in_fa) as reader, \
-            FastqWriter(out_fq) as writer:
-        for r in reader:
-            logging.debug("Getting QVs for {name} ...".format(name=r.name))
-            seqid = r.name.split(' ')[0]
-            parsed_read_name = _Parsed_Read_Name(seqid)
-            if fmt == FILE_FORMATS.H5:
+
+def qv_source_files(ccs_fns):
+    """Return files which QVs are read from, i.e., ccs files, and
+    bam files of ccs dataset xml files."""
+    ret = []
+    for fn in ccs_fns:
+        if fn.endswith(".xml"):
+            ret.extend(openDataFile(fn).toExternalFiles())
+        else:
+            ret.append(fn)
+    return ret
+
+
+def qv_cache_key(ccs_fns):
+    """Return a key of QV source files of ccs_fns by their real paths,
+    sizes and mtimes, so that QVs cached from other files or from earlier
+    versions of these files have different keys."""
+    h = hashlib.md5()
+    for fn in sorted(set(op.realpath(fn) for fn in qv_source_files(ccs_fns))):
+        h.update("%s\t%d\t%r\n" % (fn, op.getsize(fn), op.getmtime(fn)))
+    return h.hexdigest()[:16]
+
+
+def zmw_qv_name(parsed_read_name):
+    """Return name of the full zmw read whose QVs are used for a read,
+    <zmw>/ccs for ccs reads and <zmw>/raw for subreads. Note that the
+    <zmw>/ccs read of a zmw without ccs (0-passed) is its raw read."""
+    return parsed_read_name.zmwName + \
+           ("/ccs" if parsed_read_name.is_CCS else "/raw")
+
+
+def extract_zmw_qvs(reader, fmt, parsed_read_names, qv_name="QualityValue"):
+    """
+    Extract sequence and QVs of full zmw reads of parsed_read_names,
+    all reads must come from the same movie. Zmws are read in order of
+    files and file offsets (bam) or hole numbers (h5).
+        reader --- returned by _qv_reader
+    Return {zmw_qv_name: (sequence, qvs)}.
+    """
+    ret = {}
+    if fmt == FILE_FORMATS.BAM:
+        for p in parsed_read_names:
+            if not p.is_CCS:
+                raise IOError("get_qvs_from_bam does not support non-ccs bam.")
+        zmws = reader.fetch_zmws(sorted(set([p.zmwName for p in parsed_read_names])))
+        for zmw_name, zmw in zmws.iteritems():
+            if zmw.ccsRead is None:
+                raise IOError("Could not find ccs of zmw %s" % zmw_name)
+            ret[zmw_name + "/ccs"] = (zmw.ccsRead.basecalls(),
+                                      zmw.ccsRead.qv(qv_name))
+    elif fmt == FILE_FORMATS.H5:
+        bas_handlers = {}
+        try:
+            items = []
+            for p in parsed_read_names:
                 try:
-                    bas_file = qver.bas_files[parsed_read_name.movie][seqid]
-                    if bas_file not in bas_handlers:
-                        bas_handlers[bas_file] = BasH5Reader(bas_file)
+                    bas_file = reader.bas_files[p.movie][p.zmwName]
                 except KeyError:
-                    raise IOError("Could not read {s} from {f}.".
-                                  format(s=seqid, f=ccs_fofn))
-                qvs = get_qv_from_bas_handler(bas_handler=bas_handlers[bas_file],
-                                              parsed_read_name=parsed_read_name,
-                                              qv_name="QualityValue")
-            elif fmt == FILE_FORMATS.BAM:
-                qvs = get_qvs_from_bam(reader=qver,
-                                       parsed_read_name=parsed_read_name,
-                                       qv_name="QualityValue")
-            else:
-                assert False
+                    raise IOError("Could not read {s} from ccs files.".format(s=p))
+                items.append((bas_file, p.hn, p))
+            for bas_file, hn, p in sorted(items, key=lambda x: x[0:2]):
+                if bas_file not in bas_handlers:
+                    bas_handlers[bas_file] = BasH5Reader(bas_file)
+                zmw = bas_handlers[bas_file][hn]
+                if p.is_CCS and zmw.ccsRead is not None:
+                    read = zmw.ccsRead
+                else: # subreads or ccs w/ 0-passed
+                    read = zmw.read()
+                ret[zmw_qv_name(p)] = (read.basecalls(), read.qv(qv_name))
+        finally:
+            for bas_handler in bas_handlers.itervalues():
+                bas_handler.close()
+    return ret
 
-            if len(r.sequence) != len(qvs):
-                raise ValueError("Sequence and QVs of {r} should be the same!".
-                                 format(r=r.name))
-            writer.writeRecord(r.name, r.sequence[:], qvs)
 
-    if fmt == FILE_FORMATS.H5:
-        for bas_file, bas_handler in bas_handlers.iteritems():
-            logging.debug("Closing {bas_file} ...".format(bas_file=bas_file))
-            bas_handler.close()
-    elif fmt == FILE_FORMATS.BAM:
-        qver.close()
+# QV reader of a worker process, see _init_qv_worker.
+_QV_WORKER_READER = None
+
+
+def _init_qv_worker(ccs_fns, fmt):
+    """Open a QV reader in a worker process."""
+    global _QV_WORKER_READER
+    _QV_WORKER_READER = _qv_reader(ccs_fns, fmt)
+
+
+def _extract_zmw_qvs_in_worker(args):
+    """Call extract_zmw_qvs with args=(fmt, parsed_read_names) in a worker process."""
+    fmt, parsed_read_names = args
+    return extract_zmw_qvs(_QV_WORKER_READER, fmt, parsed_read_names)
+
+
+def _write_qv_cache(records, qv_cache):
+    """Append (name, sequence, qvs) records to FASTQ file qv_cache."""
+    with open(qv_cache, 'a') as f:
+        for name, seq, qvs in records:
+            q = (np.asarray(qvs, dtype=np.int64) + 33).astype(np.uint8).tostring()
+            f.write("@{n}\n{s}\n+\n{q}\n".format(n=name, s=seq, q=q))
+
+
+def ice_fa2fq(in_fa, ccs_fofn, out_fq, num_workers=1, qv_cache=None,
+              chunk_size=10000):
+    """Convert an input FASTA file to an output FASTQ file,
+       reading QVs from the input ccs.h5, ccs.bam or ccs FOFN.
+
+       Reads are processed in chunks of chunk_size reads. Reads in a chunk
+       are grouped by movie, QVs of each movie are extracted by one of
+       num_workers processes in order of file offsets, and reads are
+       written back in input order.
+
+       If qv_cache is not None, QVs of full zmw reads are looked up in and
+       appended to FASTQ file qv_cache, so that zmws seen before are not
+       read from ccs files again. Cached reads are named
+       <qv_cache_key>/<zmw_qv_name>, so QVs cached from other ccs files,
+       or from ccs files which have been modified since, are never used.
+       qv_cache must not be written by multiple processes at the same time.
+    """
+    ccs_fns = get_files_from_file_or_fofn(ccs_fofn)
+    fmt = guess_file_format(ccs_fns)
+    if fmt not in [FILE_FORMATS.H5, FILE_FORMATS.BAM]:
+        raise IOError("ice_fa2fq does not support input %s." %
+                      ccs_fofn)
+
+    cache, cache_key = None, None
+    if qv_cache is not None:
+        cache_key = qv_cache_key(ccs_fns)
+        if op.exists(qv_cache) and op.getsize(qv_cache) > 0:
+            cache = FastqRandomReader(qv_cache)
+    appended = set() # names appended to qv_cache in this run
+
+    # QVs of each movie are extracted by one worker, so there is no
+    # use of more workers than QV source files.
+    if num_workers > 1:
+        num_workers = min(num_workers, len(qv_source_files(ccs_fns)))
+    pool, qver = None, None
+    if num_workers > 1:
+        pool = Pool(processes=num_workers, initializer=_init_qv_worker,
+                    initargs=(ccs_fns, fmt))
+    else:
+        qver = _qv_reader(ccs_fns, fmt)
+
+    try:
+        with ContigSetReaderWrapper(in_fa) as reader, \
+                FastqWriter(out_fq) as writer:
+            it = iter(reader)
+            while True:
+                # a bounded buffer of reads to reorder
+                chunk = list(itertools.islice(it, chunk_size))
+                if len(chunk) == 0:
+                    break
+                parsed = [_Parsed_Read_Name(r.name.split(' ')[0]) for r in chunk]
+
+                # group reads whose QVs are not cached by movie
+                zmw_qvs = {} # zmw_qv_name --> (sequence, qvs)
+                movie_to_reads = defaultdict(list)
+                for p in parsed:
+                    name = zmw_qv_name(p)
+                    cache_name = "%s/%s" % (cache_key, name)
+                    if cache is not None and cache_name in cache:
+                        zmw_qvs[name] = (None, cache[cache_name].quality)
+                    else:
+                        movie_to_reads[p.movie].append(p)
+
+                tasks = [(fmt, movie_to_reads[m]) for m in sorted(movie_to_reads)]
+                results = pool.map(_extract_zmw_qvs_in_worker, tasks) \
+                          if pool is not None else \
+                          [extract_zmw_qvs(qver, fmt, ps) for _fmt, ps in tasks]
+                new_records = []
+                for result in results:
+                    for name, (seq, qvs) in result.iteritems():
+                        zmw_qvs[name] = (seq, qvs)
+                        if qv_cache is not None and name not in appended:
+                            appended.add(name)
+                            new_records.append(("%s/%s" % (cache_key, name), seq, qvs))
+
+                for r, p in zip(chunk, parsed):
+                    logging.debug("Getting QVs for {name} ...".format(name=r.name))
+                    try:
+                        qvs = zmw_qvs[zmw_qv_name(p)][1]
+                    except KeyError:
+                        raise IOError("Could not read {s} from {f}.".
+                                      format(s=r.name, f=ccs_fofn))
+                    if not p.get_all:
+                        qvs = qvs[p.s:p.e]
+                    if p.strand == '-':
+                        qvs = qvs[::-1]
+
+                    if len(r.sequence) != len(qvs):
+                        raise ValueError("Sequence and QVs of {r} should be the same!".
+                                         format(r=r.name))
+                    writer.writeRecord(r.name, r.sequence[:], qvs)
+
+                if len(new_records) > 0:
+                    _write_qv_cache(new_records, qv_cache)
+    finally:
+        if cache is not None:
+            cache.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if fmt == FILE_FORMATS.BAM and qver is not None:
+            qver.close()
 
 
 def set_probqv_from_ccs(ccs_fofn, fasta_filename):
@@ -1070,7 +1224,7 @@ def write_cluster_report(report_fn, uc, partial_uc):
         for c in uc.keys():
             for r in uc[c]:
                 f.write("c{c},{r},FL\n".format(r=r, c=c))
-            if partial_uc is not None and c in partial_uc.keys():
+            if partial_uc is not None and c in partial_uc:
                 for r in partial_uc[c]:
                     f.write("c{c},{r},NonFL\n".format(r=r, c=c))
 
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+"""
+Content-addressed cache of inputs of polishing (quiver|arrow), e.g.,
+raw subreads and alignments of clusters, which are reused when polishing
+is restarted after a failure or rerun with different quiver parameters.
+
+An entry is addressed by a key, which is a hash of everything its files
+are created from, e.g., cluster members, consensus sequence and aligner
+parameters, and is saved as
+    <cache_dir>/<key[0:2]>/<key>/<name>  --- files of the entry
+    <cache_dir>/<key[0:2]>/<key>/data.json  --- data of the entry
+Files are hard linked (copied if not possible) to and from their working
+paths. An entry directory is renamed into place only after all its files
+are saved, so an entry in the cache is always complete.
+
+Input files, e.g., subreads, are identified by their real paths, sizes
+and mtimes (see file_signatures) instead of their contents, which are too
+large to hash.
+
+The cache does not limit its size by itself, call prune(max_size) to
+remove least recently used entries, e.g., after polishing inputs of all
+bins are created.
+"""
+
+import os
+import os.path as op
+import json
+import shutil
+import hashlib
+import logging
+
+from pbtranscript.Utils import mkdir
+
+# Change this to invalidate all existing entries.
+POLISH_CACHE_VERSION = 1
+
+
+def polish_cache_key(*parts):
+    """Return a hex key of parts, which are json serializable."""
+    h = hashlib.sha1()
+    h.update(json.dumps([POLISH_CACHE_VERSION] + list(parts), sort_keys=True))
+    return h.hexdigest()
+
+
+def file_signatures(fns):
+    """Return sorted [real path, size, mtime] of files in fns, which
+    changes if any file is replaced or modified."""
+    return sorted([op.realpath(fn), op.getsize(fn), op.getmtime(fn)]
+                  for fn in set(fns))
+
+
+def _entry_size(entry_dir):
+    """Return total size of files of an entry."""
+    return sum(op.getsize(op.join(entry_dir, fn)) for fn in os.listdir(entry_dir))
+
+
+def _link_or_copy(src, dst):
+    """Hard link src to dst, or copy src to dst if hard link fails.
+    dst is removed first, so that a file linked to dst is never modified."""
+    if op.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class PolishCache(object):
+
+    """
+    Content-addressed cache of polishing inputs.
+
+    Example:
+        cache = PolishCache('polish_cache')
+        key = polish_cache_key(cid, members, consensus_seq, params)
+        if cache.restore(key, {'raw': raw_fa, 'aln': sam}) is None:
+            ... create raw_fa and sam ...
+            cache.save(key, {'raw': raw_fa, 'aln': sam})
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def entry_dir(self, key):
+        """Return directory of entry key."""
+        return op.join(self.cache_dir, key[0:2], key)
+
+    def __contains__(self, key):
+        return op.exists(op.join(self.entry_dir(key), "data.json"))
+
+    def restore(self, key, files):
+        """
+        Restore files of entry key to their working paths, and return data
+        of the entry, or None if the entry is not in cache.
+            files --- {name: working path}
+        """
+        if key not in self:
+            return None
+        entry_dir = self.entry_dir(key)
+        try:
+            with open(op.join(entry_dir, "data.json"), 'r') as reader:
+                data = json.load(reader)
+            for name, fn in files.iteritems():
+                mkdir(op.dirname(fn))
+                _link_or_copy(op.join(entry_dir, name), fn)
+            # mtime of an entry directory is when it was last used, see prune.
+            os.utime(entry_dir, None)
+        except (IOError, OSError, ValueError):
+            logging.warning("Could not restore %s from polish cache.", entry_dir)
+            return None
+        return data
+
+    def save(self, key, files, data=None):
+        """
+        Save files and data of entry key, unless it is already in cache.
+            files --- {name: working path}
+            data --- json serializable data of the entry, e.g., valid cids
+        """
+        if key in self:
+            return
+        entry_dir = self.entry_dir(key)
+        tmp_dir = entry_dir + ".%d.tmp" % os.getpid()
+        try:
+            mkdir(tmp_dir)
+            for name, fn in files.iteritems():
+                _link_or_copy(fn, op.join(tmp_dir, name))
+            with open(op.join(tmp_dir, "data.json"), 'w') as writer:
+                json.dump({} if data is None else data, writer)
+            os.rename(tmp_dir, entry_dir)
+        except (IOError, OSError):
+            # Saved by another process, or files could not be saved.
+            logging.debug("Could not save %s to polish cache.", entry_dir)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def entries(self):
+        """Return (mtime, key) of all entries, least recently used first."""
+        ret = []
+        if not op.isdir(self.cache_dir):
+            return ret
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = op.join(self.cache_dir, prefix)
+            if not op.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                if key.endswith(".tmp"):
+                    continue
+                try:
+                    ret.append((op.getmtime(op.join(prefix_dir, key)), key))
+                except OSError: # removed by another process
+                    pass
+        return sorted(ret)
+
+    def prune(self, max_size):
+        """
+        Remove least recently used entries until files of all entries
+        take at most max_size bytes. Note that space of a removed file
+        is not freed while it is still hard linked to a working path.
+        Return number of removed entries.
+        """
+        sizes = []
+        for _mtime, key in self.entries():
+            try:
+                sizes.append((key, _entry_size(self.entry_dir(key))))
+            except OSError:
+                pass
+        total_size = sum(size for _key, size in sizes)
+        n_removed = 0
+        for key, size in sizes:
+            if total_size <= max_size:
+                break
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+            total_size -= size
+            n_removed += 1
+        if n_removed > 0:
+            logging.info("Removed %d least recently used entries from polish cache %s.",
+                         n_removed, self.cache_dir)
+        return n_removed
+
+    @staticmethod
+    def discard(files):
+        """Remove working paths of files before they are created again,
+        so that files of cached entries linked to them are not modified."""
+        for fn in files.itervalues():
+            if op.lexists(fn):
+                os.remove(fn)
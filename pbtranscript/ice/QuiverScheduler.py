@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+"""
+Schedule polishing (quiver|arrow) of consensus isoforms.
+
+Cost of polishing a cluster is estimated from the number of reads
+assigned to the cluster and the length of its consensus sequence.
+Clusters are packed into chunks and bins of roughly equal cost, and
+bins are run locally at most as many at a time as CPUs and memory
+of the local machine allow.
+"""
+
+import os
+import heapq
+import logging
+from multiprocessing import cpu_count
+from pbtranscript.io import ContigSetReaderWrapper
+
+# Estimated memory used by a polishing job, in bytes.
+MEM_PER_POLISH_JOB = 2 * 1024 * 1024 * 1024
+
+
+def cluster_polish_cost(n_reads, consensus_len):
+    """
+    Return estimated cost of polishing a cluster, which has n_reads
+    reads and a consensus sequence of consensus_len bases.
+    Every subread of the n_reads zmws is aligned and scored against the
+    consensus, and the consensus itself is refined, so cost grows with
+    (n_reads + 1) * consensus_len.
+    """
+    return (n_reads + 1) * max(1, consensus_len)
+
+
+def consensus_lengths(consensus_fa):
+    """Return {cid: length of consensus sequence} of consensus isoforms
+    in consensus_fa (FASTA or ContigSet), e.g., c103/1/3708 of 3708 bases
+    --> {103: 3708}."""
+    return dict((int(name.split('/')[0].replace('c', '')), seqlen) for name, seqlen
+                in ContigSetReaderWrapper.name_to_len_dict(consensus_fa).iteritems())
+
+
+def cluster_polish_costs(cids, uc, partial_uc, consensus_lens):
+    """
+    Return {cid: estimated cost} of clusters in cids.
+        uc --- uc[k] returns fl ccs reads associated with cluster k
+        partial_uc --- partial_uc[k] returns nfl ccs reads associated with cluster k
+        consensus_lens --- {cid: length of consensus sequence}
+    """
+    return dict((cid, cluster_polish_cost(len(uc[cid]) + len(partial_uc[cid]),
+                                          consensus_lens.get(cid, 0)))
+                for cid in cids)
+
+
+def pack_by_cost(cids, costs, num_packs):
+    """
+    Pack cids into num_packs packs of roughly equal total cost, by
+    assigning clusters in decreasing order of cost to the pack with the
+    lowest total cost so far. The packing is deterministic.
+    Return a list of num_packs lists of sorted cids, some of which may
+    be empty if there are fewer cids than packs.
+        costs --- {cid: estimated cost}
+    """
+    num_packs = max(1, int(num_packs))
+    packs = [[] for _i in xrange(num_packs)]
+    heap = [(0, i) for i in xrange(num_packs)]
+    for cid in sorted(cids, key=lambda cid: (-costs[cid], cid)):
+        load, i = heapq.heappop(heap)
+        packs[i].append(cid)
+        heapq.heappush(heap, (load + costs[cid], i))
+    return [sorted(pack) for pack in packs]
+
+
+def local_job_slots(nproc_per_job, cpus=None, mem_per_job=MEM_PER_POLISH_JOB):
+    """
+    Return number of jobs, each using nproc_per_job CPUs and mem_per_job
+    bytes of memory, which can run on the local machine at the same time.
+        cpus --- number of CPUs available to jobs, default all CPUs.
+    """
+    cpus = cpu_count() if cpus is None else cpus
+    slots = max(1, int(cpus) / max(1, int(nproc_per_job)))
+    try:
+        mem = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        slots = min(slots, max(1, mem / mem_per_job))
+    except (ValueError, OSError, AttributeError):
+        logging.debug("Could not get size of physical memory.")
+    return slots
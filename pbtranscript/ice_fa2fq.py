@@ -49,6 +49,12 @@ def add_ice_fa2fq_arguments(parser):
     parser.add_argument("out_fq", type=str, default=None,
                         help="An output FASTQ file containing ice ccs reads " +
                              "with Quality Values.")
+    parser.add_argument("--cpus", dest="cpus", type=int, default=1,
+                        help="Number of processes to extract QVs of " +
+                             "different movies in parallel (default: 1).")
+    parser.add_argument("--qv_cache", dest="qv_cache", type=str, default=None,
+                        help="A FASTQ file caching QVs of zmws, which is " +
+                             "read and extended by each run (default: None).")
     return parser
 
 
@@ -75,10 +81,13 @@ class IceFAToFQRunner(PBToolRunner):
             raise IOError("Input ccs_fofn {f} does not exist.".
                           format(f=ccs_fofn))
 
-    def cmd_str(self, in_fa, ccs_fofn, out_fq):
+    def cmd_str(self, in_fa, ccs_fofn, out_fq, cpus=1, qv_cache=None):
         """Return a cmd string."""
         cmd = "ice_fa2fq.py {in_fa} {ccs_fofn} {out_fq} ".\
               format(in_fa=in_fa, ccs_fofn=ccs_fofn, out_fq=out_fq)
+        cmd += "--cpus={cpus} ".format(cpus=cpus)
+        if qv_cache is not None:
+            cmd += "--qv_cache={f} ".format(f=qv_cache)
         return cmd
 
     def run(self):
@@ -95,9 +104,11 @@ class IceFAToFQRunner(PBToolRunner):
                                  ccs_fofn=ccs_fofn)
 
             cmd_str = self.cmd_str(in_fa=in_fa, ccs_fofn=ccs_fofn,
-                                   out_fq=out_fq)
+                                   out_fq=out_fq, cpus=args.cpus,
+                                   qv_cache=args.qv_cache)
 
-            ice_fa2fq(in_fa=in_fa, ccs_fofn=ccs_fofn, out_fq=out_fq)
+            ice_fa2fq(in_fa=in_fa, ccs_fofn=ccs_fofn, out_fq=out_fq,
+                      num_workers=args.cpus, qv_cache=args.qv_cache)
 
         except:
             logging.exception("Exiting {cmd} with return code 1.".
@@ -0,0 +1,489 @@
+"""
+Define readers and writers of BGZF (blocked gzip, as produced by bgzip)
+compressed files.
+
+A BGZF file is a series of gzip members, each of which compresses at most
+64 KB of data and records its compressed size in a 'BC' extra subfield,
+so blocks can be located without decompression. BgzfReader reads data
+randomly by uncompressed offsets, through a block index persisted as
+a bgzip compatible .gzi file. BgzfTextReader reads data sequentially,
+decompressing blocks by multiple threads.
+"""
+
+from collections import OrderedDict, deque
+from multiprocessing.pool import ThreadPool
+import os.path as op
+import logging
+import mmap
+import struct
+import zlib
+import numpy as np
+
+__all__ = ["BgzfReader",
+           "BgzfTextReader",
+           "BgzfWriter",
+           "is_bgzf",
+           "is_gzip",
+           "open_text",
+           "open_random_access"]
+
+
+GZIP_MAGIC = "\x1f\x8b\x08\x04" # gzip, deflate, FEXTRA
+# ID1 ID2 CM FLG MTIME XFL OS XLEN SI1 SI2 SLEN BSIZE
+BGZF_HEADER = struct.Struct("<4BIBBHBBHH")
+BGZF_EOF = ("\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43"
+            "\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00")
+# bgzip never puts more than 0xff00 bytes of data in a block.
+BGZF_MAX_BLOCK_DATA = 0xff00
+BGZF_MAX_BLOCK_SIZE = 0x10000
+# Number of blocks decompressed by a thread in a task.
+BGZF_BLOCKS_PER_TASK = 16
+
+
+def _block_size(header, filename):
+    """Return total size of a BGZF block given its first 12 bytes and
+    the extra field, raise IOError if it is not a BGZF block."""
+    if len(header) < 12 or header[0:4] != GZIP_MAGIC:
+        raise IOError("%s is not a BGZF file." % filename)
+    xlen, = struct.unpack("<H", header[10:12])
+    extra, i = header[12:12+xlen], 0
+    while i + 4 <= len(extra):
+        slen, = struct.unpack("<H", extra[i+2:i+4])
+        if extra[i:i+2] == "BC" and slen == 2:
+            bsize, = struct.unpack("<H", extra[i+4:i+6])
+            return bsize + 1
+        i += 4 + slen
+    raise IOError("%s is not a BGZF file." % filename)
+
+
+def is_bgzf(filename):
+    """Return True if filename is a BGZF compressed file."""
+    try:
+        with open(filename, 'rb') as f:
+            header = f.read(12)
+            if len(header) < 12 or header[0:4] != GZIP_MAGIC:
+                return False
+            xlen, = struct.unpack("<H", header[10:12])
+            _block_size(header + f.read(xlen), filename)
+        return True
+    except (IOError, struct.error):
+        return False
+
+
+def is_gzip(filename):
+    """Return True if filename is gzip (including BGZF) compressed."""
+    with open(filename, 'rb') as f:
+        return f.read(2) == "\x1f\x8b"
+
+
+def iter_raw_blocks(f, filename):
+    """Yield (compressed offset, block) of each BGZF block in file handle f."""
+    coffset = f.tell()
+    while True:
+        header = f.read(12)
+        if len(header) == 0:
+            break
+        if len(header) < 12:
+            raise IOError("%s is truncated at %d." % (filename, coffset))
+        xlen, = struct.unpack("<H", header[10:12])
+        header += f.read(xlen)
+        bsize = _block_size(header, filename)
+        block = header + f.read(bsize - len(header))
+        if len(block) != bsize:
+            raise IOError("%s is truncated at %d." % (filename, coffset))
+        yield coffset, block
+        coffset += bsize
+
+
+def inflate_block(block):
+    """Return data of a BGZF block."""
+    xlen, = struct.unpack("<H", block[10:12])
+    data = zlib.decompress(block[12+xlen:-8], -15)
+    crc, isize = struct.unpack("<iI", block[-8:])
+    if isize != len(data) or zlib.crc32(data) != crc:
+        raise IOError("BGZF block is corrupted.")
+    return data
+
+
+def _inflate_blocks(blocks):
+    """Return data of BGZF blocks concatenated."""
+    return "".join([inflate_block(block) for block in blocks])
+
+
+def deflate_block(data, level=6):
+    """Return a BGZF block of data, which is at most BGZF_MAX_BLOCK_DATA bytes."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    if len(cdata) + BGZF_HEADER.size + 8 > BGZF_MAX_BLOCK_SIZE:
+        # incompressible data, store it.
+        compressor = zlib.compressobj(0, zlib.DEFLATED, -15)
+        cdata = compressor.compress(data) + compressor.flush()
+    header = BGZF_HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'),
+                              2, BGZF_HEADER.size + len(cdata) + 8 - 1)
+    return header + cdata + struct.pack("<iI", zlib.crc32(data), len(data))
+
+
+def iter_bgzf(filename, threads=1):
+    """
+    Yield decompressed data of a BGZF file in order, a number of blocks
+    at a time. If threads > 1, blocks are decompressed by a pool of threads
+    (zlib releases the GIL), while at most 2 * threads tasks are in flight.
+    """
+    with open(filename, 'rb') as f:
+        batches = _iter_batches(iter_raw_blocks(f, filename), BGZF_BLOCKS_PER_TASK)
+        if threads <= 1:
+            for blocks in batches:
+                yield _inflate_blocks(blocks)
+            return
+        pool = ThreadPool(threads)
+        try:
+            pending = deque()
+            for blocks in batches:
+                pending.append(pool.apply_async(_inflate_blocks, (blocks, )))
+                if len(pending) >= 2 * threads:
+                    yield pending.popleft().get()
+            while len(pending) > 0:
+                yield pending.popleft().get()
+        finally:
+            pool.terminate()
+
+
+def _iter_batches(raw_blocks, n):
+    """Yield lists of at most n blocks in raw_blocks."""
+    batch = []
+    for _coffset, block in raw_blocks:
+        batch.append(block)
+        if len(batch) == n:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def gzi_filename(filename):
+    """Return .gzi block index file name of a BGZF file."""
+    return filename + ".gzi"
+
+
+def build_gzi(filename):
+    """
+    Scan block headers of a BGZF file and return (coffsets, uoffsets, size),
+    where coffsets and uoffsets are compressed and uncompressed offsets of
+    blocks in numpy arrays, and size is total uncompressed size.
+    """
+    coffsets, uoffsets, size = [], [], 0
+    with open(filename, 'rb') as f:
+        for coffset, block in iter_raw_blocks(f, filename):
+            coffsets.append(coffset)
+            uoffsets.append(size)
+            size += struct.unpack("<I", block[-4:])[0]
+    return (np.array(coffsets, dtype=np.uint64),
+            np.array(uoffsets, dtype=np.uint64), size)
+
+
+def write_gzi(coffsets, uoffsets, out_gzi):
+    """Write block index to a bgzip compatible .gzi file, which lists
+    (compressed, uncompressed) offsets of all blocks but the first."""
+    with open(out_gzi, 'wb') as writer:
+        n = max(0, len(coffsets) - 1)
+        writer.write(struct.pack("<Q", n))
+        pairs = np.zeros((n, 2), dtype='<u8')
+        pairs[:, 0], pairs[:, 1] = coffsets[1:], uoffsets[1:]
+        writer.write(pairs.tostring())
+
+
+def _isize_of_block(f, coffset, filename):
+    """Return uncompressed size of the block at coffset of file handle f."""
+    f.seek(coffset)
+    header = f.read(12)
+    if len(header) < 12:
+        raise IOError("%s is truncated at %d." % (filename, coffset))
+    bsize = _block_size(header + f.read(struct.unpack("<H", header[10:12])[0]),
+                        filename)
+    f.seek(coffset + bsize - 4)
+    return struct.unpack("<I", f.read(4))[0]
+
+
+def read_gzi(filename):
+    """
+    Return (coffsets, uoffsets, size) of filename in its .gzi file, if the
+    .gzi file exists and is not older than filename; otherwise return None.
+    """
+    gzi_fn = gzi_filename(filename)
+    if not op.exists(gzi_fn) or op.getmtime(gzi_fn) < op.getmtime(filename):
+        return None
+    try:
+        with open(gzi_fn, 'rb') as reader:
+            n, = struct.unpack("<Q", reader.read(8))
+            pairs = np.fromstring(reader.read(16 * n), dtype='<u8')
+        if len(pairs) != 2 * n:
+            return None
+        coffsets = np.concatenate(([0], pairs[0::2])).astype(np.uint64)
+        uoffsets = np.concatenate(([0], pairs[1::2])).astype(np.uint64)
+        with open(filename, 'rb') as f:
+            size = int(uoffsets[-1]) + _isize_of_block(f, int(coffsets[-1]), filename)
+        return coffsets, uoffsets, size
+    except (IOError, struct.error):
+        return None
+
+
+def load_or_build_gzi(filename, persist_index=True):
+    """
+    Return (coffsets, uoffsets, size) of a BGZF file. Read them from
+    a valid .gzi file if persist_index is True, otherwise build them by
+    scanning block headers, and if possible, save them to .gzi.
+    """
+    if persist_index:
+        ret = read_gzi(filename)
+        if ret is not None:
+            return ret
+
+    coffsets, uoffsets, size = build_gzi(filename)
+    if persist_index:
+        try:
+            write_gzi(coffsets, uoffsets, gzi_filename(filename))
+        except (IOError, OSError):
+            logging.debug("Could not save %s.", gzi_filename(filename))
+    return coffsets, uoffsets, size
+
+
+class BgzfReader(object):
+
+    """
+    Random access reader of a BGZF file by uncompressed offsets.
+
+    Each uncompressed offset u maps to a virtual offset
+        coffset << 16 | (u - uoffset),
+    where coffset and uoffset are compressed and uncompressed offsets of
+    the block containing u. Recently decompressed blocks are cached.
+
+    Example:
+        r = BgzfReader("reads.fasta.gz")
+        r[100:200] ==> uncompressed bytes [100, 200)
+    """
+
+    def __init__(self, filename, persist_index=True, cache_size=64):
+        self.filename = filename
+        self.coffsets, self.uoffsets, self.size = \
+            load_or_build_gzi(filename, persist_index=persist_index)
+        self.f = open(filename, 'rb')
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.cache_size = cache_size
+        self.cache = OrderedDict() # block index --> data
+
+    def __len__(self):
+        """Return uncompressed size."""
+        return self.size
+
+    def virtual_offset(self, uoffset):
+        """Return virtual offset of an uncompressed offset."""
+        i = self._block_index(uoffset)
+        return (int(self.coffsets[i]) << 16) | (uoffset - int(self.uoffsets[i]))
+
+    def _block_index(self, uoffset):
+        """Return index of the block containing uncompressed offset."""
+        return int(np.searchsorted(self.uoffsets, uoffset, side='right')) - 1
+
+    def _block(self, i):
+        """Return data of the i-th block."""
+        if i in self.cache:
+            data = self.cache.pop(i)
+        else:
+            coffset = int(self.coffsets[i])
+            end = int(self.coffsets[i+1]) if i + 1 < len(self.coffsets) else len(self.mm)
+            data = inflate_block(self.mm[coffset:end])
+            if len(self.cache) >= self.cache_size:
+                self.cache.popitem(last=False)
+        self.cache[i] = data
+        return data
+
+    def read(self, start, end):
+        """Return uncompressed data in [start, end)."""
+        start, end = max(0, int(start)), min(int(end), self.size)
+        if start >= end:
+            return ''
+        ret = []
+        i = self._block_index(start)
+        while start < end:
+            ustart = int(self.uoffsets[i])
+            data = self._block(i)
+            ret.append(data[start-ustart:end-ustart])
+            start = ustart + len(data)
+            i += 1
+        return "".join(ret)
+
+    def __getitem__(self, k):
+        if not isinstance(k, slice) or k.step not in (None, 1):
+            raise TypeError("%s only supports slices." % self.__class__.__name__)
+        start = 0 if k.start is None else k.start
+        end = self.size if k.stop is None else k.stop
+        return self.read(start, end)
+
+    def close(self):
+        """Close file handles."""
+        self.cache = OrderedDict()
+        self.mm.close()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class BgzfTextReader(object):
+
+    """
+    File-like sequential reader of a BGZF file, supporting read(),
+    readline() and iteration over lines, with blocks decompressed
+    by a pool of threads if threads > 1.
+
+    Example:
+        with BgzfTextReader("reads.fastq.gz", threads=4) as f:
+            for line in f:
+                ...
+    """
+
+    def __init__(self, filename, threads=1):
+        self.name = filename
+        self.chunks = iter_bgzf(filename, threads=threads)
+        self.buf, self.pos = '', 0
+
+    def _fill(self):
+        """Append the next chunk of data to buffer, return False at EOF."""
+        for chunk in self.chunks:
+            self.buf = self.buf[self.pos:] + chunk
+            self.pos = 0
+            return True
+        return False
+
+    def read(self, size=-1):
+        """Read at most size bytes, or all bytes if size < 0."""
+        while size < 0 or len(self.buf) - self.pos < size:
+            if not self._fill():
+                break
+        end = len(self.buf) if size < 0 else min(len(self.buf), self.pos + size)
+        ret = self.buf[self.pos:end]
+        self.pos = end
+        return ret
+
+    def readline(self):
+        """Read a line including '\\n'."""
+        i = self.buf.find('\n', self.pos)
+        while i < 0:
+            n = len(self.buf) - self.pos
+            if not self._fill():
+                break
+            i = self.buf.find('\n', self.pos + n)
+        end = len(self.buf) if i < 0 else i + 1
+        ret = self.buf[self.pos:end]
+        self.pos = end
+        return ret
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """Return the next line."""
+        line = self.readline()
+        if len(line) == 0:
+            raise StopIteration
+        return line
+
+    def write(self, data):
+        """Not supported, defined so that pbcore recognizes a file-like object."""
+        raise IOError("%s is opened for reading." % self.name)
+
+    def close(self):
+        """Stop decompressing."""
+        self.chunks.close()
+        self.buf, self.pos = '', 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class BgzfWriter(object):
+
+    """
+    Write data to a BGZF file, compatible with bgzip.
+
+    Example:
+        with BgzfWriter("reads.fasta.gz") as writer:
+            writer.write(">r\\nACGT\\n")
+    """
+
+    def __init__(self, filename, level=6):
+        self.filename = filename
+        self.level = level
+        self.f = open(filename, 'wb')
+        self.buf = []
+        self.buf_size = 0
+
+    def write(self, data):
+        """Write data."""
+        self.buf.append(data)
+        self.buf_size += len(data)
+        if self.buf_size >= BGZF_MAX_BLOCK_DATA:
+            self._flush_blocks(final=False)
+
+    def _flush_blocks(self, final):
+        """Compress buffered data into full blocks, and the remainder too
+        if final is True."""
+        data = "".join(self.buf)
+        n = len(data) if final else \
+            len(data) - len(data) % BGZF_MAX_BLOCK_DATA
+        for i in xrange(0, n, BGZF_MAX_BLOCK_DATA):
+            self.f.write(deflate_block(data[i:min(n, i+BGZF_MAX_BLOCK_DATA)],
+                                       self.level))
+        self.buf = [data[n:]] if n < len(data) else []
+        self.buf_size = len(data) - n
+
+    def close(self):
+        """Flush data, write the EOF block and close."""
+        self._flush_blocks(final=True)
+        self.f.write(BGZF_EOF)
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_text(filename, threads=1):
+    """Open filename for reading lines, which may be BGZF compressed."""
+    return BgzfTextReader(filename, threads=threads) if is_bgzf(filename) \
+           else open(filename, 'rb')
+
+
+def uncompressed_size(filename):
+    """Return uncompressed size of a plain or BGZF compressed file."""
+    return load_or_build_gzi(filename)[2] if is_bgzf(filename) \
+           else op.getsize(filename)
+
+
+def open_random_access(filename, persist_index=True):
+    """
+    Return an object which slices uncompressed data of filename by offsets,
+    a memory map of a plain file or a BgzfReader of a BGZF file, or None if
+    filename is empty. Gzip files not compressed by bgzip are not supported.
+    """
+    if is_bgzf(filename):
+        reader = BgzfReader(filename, persist_index=persist_index)
+        if len(reader) == 0:
+            reader.close()
+            return None
+        return reader
+    if is_gzip(filename):
+        raise IOError("%s is gzip compressed, random access requires "
+                      "bgzip compressed files." % filename)
+    if op.getsize(filename) == 0:
+        return None
+    with open(filename, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
@@ -0,0 +1,323 @@
+"""
+Define ClusterState, a cluster-addressable store of ICE clustering
+results, which saves per cluster id its full-length (FL) reads,
+non-full-length (nFL) reads, reference fasta and location of its
+consensus sequence.
+
+A store of prefix consists of
+    <prefix>.idx.npy --- a sorted numpy array of CLUSTER_STATE_DTYPE,
+                         one row per cluster
+    <prefix>.dat     --- one text line per cluster, located by offset and
+                         length in .idx.npy:
+                         consensus_name \t ref_fa \t fl reads \t nfl reads
+                         where reads are separated by ' '
+    <prefix>.json    --- consensus files and modification time of the
+                         source files the store was built from
+
+.idx.npy and .dat are memory mapped, so that looking up a cluster only
+reads pages of this cluster, instead of loading all clusters.
+.idx.npy also saves location of consensus sequence of each cluster in
+consensus files and a hash of the sequence, so that consensus sequences
+of a batch of clusters are read in one pass in order of file offsets,
+and identical sequences are found without reading sequences.
+"""
+
+import os
+import os.path as op
+import json
+import mmap
+import hashlib
+import numpy as np
+
+from pbtranscript.io.ContigSetCache import contigset_external_files
+from pbtranscript.io.FastaRandomReader import load_or_build_fai
+from pbtranscript.io.BgzfIO import open_random_access
+
+__all__ = ["ClusterState",
+           "ClusterMembers",
+           "write_cluster_state",
+           "is_cluster_state_valid",
+           "sequence_hash"]
+
+CLUSTER_STATE_VERSION = 2
+
+CLUSTER_STATE_DTYPE = np.dtype([('cid', '<i8'),
+                                ('n_fl', '<i8'), ('n_nfl', '<i8'),
+                                ('offset', '<i8'), ('length', '<i8'),
+                                ('cons_file', '<i8'), ('cons_offset', '<i8'),
+                                ('cons_end', '<i8'), ('cons_len', '<i8'),
+                                ('cons_hash', '<u8')])
+
+
+def cluster_state_files(prefix):
+    """Return (index file, data file, meta file) of a store of prefix."""
+    return (prefix + ".idx.npy", prefix + ".dat", prefix + ".json")
+
+
+def _cid_of_consensus(name):
+    """Return cluster id of a consensus isoform, e.g., c103/1/3708 --> 103."""
+    return int(name.split('/')[0].replace('c', ''))
+
+
+def sequence_hash(seq):
+    """Return a 64-bit hash of a sequence."""
+    return int(hashlib.md5(seq).hexdigest()[0:16], 16)
+
+
+def _read_sequence(m, offset, end):
+    """Read sequence in [offset, end) of a memory map or BgzfReader."""
+    return m[offset:end].translate(None, '\r\n')
+
+
+def _mtimes(sources):
+    """Return {realpath: mtime} of source files."""
+    return dict((op.realpath(fn), op.getmtime(fn)) for fn in sources)
+
+
+def write_cluster_state(out_prefix, uc, partial_uc, refs, consensus_fa,
+                        sources=()):
+    """
+    Write a ClusterState store of out_prefix.
+        uc --- uc[k] returns fl reads of cluster k
+        partial_uc --- partial_uc[k] returns nfl reads of cluster k
+        refs --- refs[k] returns ref fasta of cluster k
+        consensus_fa --- FASTA or ContigSet of consensus isoforms c{k}/...
+        sources --- files the store is built from, the store becomes
+                    invalid once any of them is modified.
+    Files are written to temporary files first and then renamed, the
+    meta file is renamed last, so a partially written store is never valid.
+    """
+    cons_files = contigset_external_files(consensus_fa)
+    cons = {} # cid --> (file index, offset, end, seqlen, name, hash)
+    for index, fn in enumerate(cons_files):
+        m = open_random_access(fn) or ''
+        for e in load_or_build_fai(fn):
+            cons[_cid_of_consensus(e[0])] = (index, e[2], e[3], e[1], e[0],
+                                             sequence_hash(_read_sequence(m, e[2], e[3])))
+        if len(m) > 0:
+            m.close()
+
+    cids = sorted(int(cid) for cid in uc)
+    idx = np.zeros(len(cids), dtype=CLUSTER_STATE_DTYPE)
+    idx_fn, dat_fn, meta_fn = cluster_state_files(out_prefix)
+    tmp = ".%d.tmp" % os.getpid()
+
+    with open(dat_fn + tmp, 'wb') as writer:
+        offset = 0
+        for i, cid in enumerate(cids):
+            fl = uc[cid] if cid in uc else uc[str(cid)]
+            nfl = partial_uc[cid] if cid in partial_uc else \
+                  partial_uc.get(str(cid), [])
+            index, cons_offset, cons_end, cons_len, name, cons_hash = \
+                cons.get(cid, (-1, 0, 0, 0, "", 0))
+            ref = refs[cid] if cid in refs else refs.get(str(cid), "")
+            line = "\t".join([name, ref, " ".join(fl), " ".join(nfl)]) + "\n"
+            writer.write(line)
+            idx[i] = (cid, len(fl), len(nfl), offset, len(line) - 1,
+                      index, cons_offset, cons_end, cons_len, cons_hash)
+            offset += len(line)
+
+    with open(idx_fn + tmp, 'wb') as writer:
+        np.save(writer, idx)
+    with open(meta_fn + tmp, 'w') as writer:
+        json.dump({"version": CLUSTER_STATE_VERSION,
+                   "consensus_files": [op.realpath(fn) for fn in cons_files],
+                   "sources": _mtimes(sources)}, writer)
+
+    for fn in (idx_fn, dat_fn, meta_fn):
+        os.rename(fn + tmp, fn)
+
+
+def is_cluster_state_valid(prefix, sources=()):
+    """Return True if a complete ClusterState store of prefix exists and
+    was built from sources, none of which has been modified since."""
+    if not all(op.exists(fn) for fn in cluster_state_files(prefix)):
+        return False
+    try:
+        with open(cluster_state_files(prefix)[2], 'r') as reader:
+            meta = json.load(reader)
+        return meta["version"] == CLUSTER_STATE_VERSION and \
+               meta["sources"] == _mtimes(sources)
+    except (ValueError, KeyError, OSError):
+        return False
+
+
+class ClusterMembers(object):
+
+    """
+    A read-only dict-like view {cid: reads} of FL (uc) or nFL (partial_uc)
+    reads of clusters in a ClusterState. Like partial_uc returned by
+    IceQuiver.load_pickles, the nFL view returns [] for unknown clusters.
+    """
+
+    def __init__(self, state, is_fl):
+        self.state = state
+        self.is_fl = is_fl
+
+    def __getitem__(self, cid):
+        if not self.is_fl and cid not in self.state:
+            return []
+        return self.state.fl_reads(cid) if self.is_fl else \
+               self.state.nfl_reads(cid)
+
+    def __contains__(self, cid):
+        if self.is_fl:
+            return cid in self.state
+        return cid in self.state and self.state.num_reads(cid)[1] > 0
+
+    def keys(self):
+        """Return cluster ids in a list, for nFL, only clusters with nFL reads."""
+        if self.is_fl:
+            return self.state.cids
+        return [int(cid) for cid in self.state.idx['cid'][self.state.idx['n_nfl'] > 0]]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def iteritems(self):
+        """Iterate over (cid, reads)."""
+        for cid in self.keys():
+            yield cid, self[cid]
+
+
+class _ClusterRefs(object):
+
+    """A read-only dict-like view {cid: ref fasta} of a ClusterState."""
+
+    def __init__(self, state):
+        self.state = state
+
+    def __getitem__(self, cid):
+        return self.state.ref_fa(cid)
+
+    def __contains__(self, cid):
+        return cid in self.state
+
+
+class ClusterState(object):
+
+    """
+    Read a ClusterState store of prefix, see write_cluster_state.
+
+    Example:
+        s = ClusterState('output/cluster_state')
+        s.fl_reads(103) ==> FL reads of cluster 103
+        s.consensus(103) ==> (c103/1/3708, consensus sequence)
+        s.consensus_of_clusters([103, 7]) ==> {103: (c103/1/3708, ...), 7: ...}
+        s.uc[103], s.partial_uc[103] ==> FL and nFL reads, like uc and partial_uc
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        idx_fn, dat_fn, meta_fn = cluster_state_files(prefix)
+        with open(meta_fn, 'r') as reader:
+            self.consensus_files = json.load(reader)["consensus_files"]
+        self.idx = np.load(idx_fn, mmap_mode='r')
+        self._dat_f = open(dat_fn, 'rb')
+        self.dat = mmap.mmap(self._dat_f.fileno(), 0, access=mmap.ACCESS_READ) \
+                   if op.getsize(dat_fn) > 0 else ''
+        self._cons_handlers = {} # consensus file index --> mmap or BgzfReader
+        self.uc = ClusterMembers(self, is_fl=True)
+        self.partial_uc = ClusterMembers(self, is_fl=False)
+
+    @property
+    def cids(self):
+        """Return all cluster ids in a sorted list."""
+        return [int(cid) for cid in self.idx['cid']]
+
+    def _row(self, cid):
+        """Return index row of cluster cid."""
+        i = int(np.searchsorted(self.idx['cid'], int(cid)))
+        if i >= len(self.idx) or self.idx['cid'][i] != int(cid):
+            raise KeyError("Cluster {c} not in {p}!".format(c=cid, p=self.prefix))
+        return self.idx[i]
+
+    def _fields(self, cid):
+        """Return fields of data line of cluster cid."""
+        row = self._row(cid)
+        return self.dat[row['offset']:row['offset'] + row['length']].split('\t')
+
+    def __contains__(self, cid):
+        try:
+            self._row(cid)
+            return True
+        except (KeyError, ValueError, TypeError):
+            return False
+
+    def __len__(self):
+        return len(self.idx)
+
+    def num_reads(self, cid):
+        """Return (number of FL reads, number of nFL reads) of cluster cid."""
+        row = self._row(cid)
+        return (int(row['n_fl']), int(row['n_nfl']))
+
+    def consensus_len(self, cid):
+        """Return length of consensus sequence of cluster cid."""
+        return int(self._row(cid)['cons_len'])
+
+    def fl_reads(self, cid):
+        """Return FL reads of cluster cid in a list."""
+        return self._fields(cid)[2].split()
+
+    def nfl_reads(self, cid):
+        """Return nFL reads of cluster cid in a list."""
+        return self._fields(cid)[3].split()
+
+    def ref_fa(self, cid):
+        """Return ref fasta of cluster cid."""
+        return self._fields(cid)[1]
+
+    def consensus_hash(self, cid):
+        """Return hash of consensus sequence of cluster cid, clusters of
+        identical consensus sequences have the same hash."""
+        return int(self._row(cid)['cons_hash'])
+
+    def _consensus_of_row(self, cid, row):
+        """Return (name, sequence) of consensus isoform of cluster cid,
+        of which index row is row."""
+        index = int(row['cons_file'])
+        if index < 0:
+            raise KeyError("Consensus of cluster {c} not in {p}!".
+                           format(c=cid, p=self.prefix))
+        if index not in self._cons_handlers:
+            self._cons_handlers[index] = \
+                open_random_access(self.consensus_files[index]) or ''
+        seq = _read_sequence(self._cons_handlers[index],
+                             int(row['cons_offset']), int(row['cons_end']))
+        return (self._fields(cid)[0], seq)
+
+    def consensus(self, cid):
+        """Return (name, sequence) of consensus isoform of cluster cid."""
+        return self._consensus_of_row(cid, self._row(cid))
+
+    def consensus_of_clusters(self, cids):
+        """Return {cid: (name, sequence)} of consensus isoforms of clusters
+        in cids, which are read in one pass in order of file offsets."""
+        rows = [(cid, self._row(cid)) for cid in cids]
+        rows.sort(key=lambda x: (int(x[1]['cons_file']), int(x[1]['cons_offset'])))
+        return dict((cid, self._consensus_of_row(cid, row)) for cid, row in rows)
+
+    @property
+    def refs(self):
+        """Return a read-only dict-like view {cid: ref fasta}."""
+        return _ClusterRefs(self)
+
+    def close(self):
+        """Close memory maps."""
+        for m in self._cons_handlers.values():
+            if len(m) > 0:
+                m.close()
+        self._cons_handlers = {}
+        if len(self.dat) > 0:
+            self.dat.close()
+        self._dat_f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,60 @@
+"""
+Cache parsed ContigSet dataset xml files.
+
+Parsing a dataset xml by pbcore is slow, while pipelines look up external
+resources of the same xml many times. Information of each xml file is
+parsed once and cached by path and modification time.
+"""
+
+from collections import namedtuple
+import os.path as op
+import xml.etree.ElementTree as ET
+from pbcore.io import ContigSet
+
+__all__ = ["ContigSetInfo",
+           "get_contigset_info",
+           "contigset_external_files",
+           "clear_contigset_cache"]
+
+
+ContigSetInfo = namedtuple("ContigSetInfo", ["external_files", "has_filters"])
+
+_CONTIGSET_CACHE = {} # realpath --> (mtime, ContigSetInfo)
+
+
+def _has_filters(xml_filename):
+    """Return True if a dataset xml file has any non-empty Filters element."""
+    for elem in ET.parse(xml_filename).iter():
+        if elem.tag.split('}')[-1] == "Filters" and len(elem) > 0:
+            return True
+    return False
+
+
+def get_contigset_info(xml_filename):
+    """Return ContigSetInfo of a ContigSet xml file, which is parsed only
+    if it has not been parsed or has been modified since parsed."""
+    path = op.realpath(xml_filename)
+    mtime = op.getmtime(path)
+    if path in _CONTIGSET_CACHE and _CONTIGSET_CACHE[path][0] == mtime:
+        return _CONTIGSET_CACHE[path][1]
+    try:
+        external_files = ContigSet(xml_filename).toExternalFiles()
+    except IOError:
+        raise IOError("Could not open %s as ContigSet." % xml_filename)
+    info = ContigSetInfo(external_files=tuple(external_files),
+                         has_filters=_has_filters(xml_filename))
+    _CONTIGSET_CACHE[path] = (mtime, info)
+    return info
+
+
+def contigset_external_files(filename):
+    """Return external files of filename in a list if it is a ContigSet
+    xml file, otherwise, return [filename]."""
+    if filename.upper().endswith(".XML"):
+        return list(get_contigset_info(filename).external_files)
+    return [filename]
+
+
+def clear_contigset_cache():
+    """Clear cached ContigSet information."""
+    _CONTIGSET_CACHE.clear()
@@ -13,6 +13,15 @@ See difference between:
       [r for r in ContigSet("*.fasta")]
 and
       [r for r in ContigSetWrapper("*.fasta")]
+
+FASTA and FASTQ files may be gzip or bgzip compressed,
+blocks of bgzip compressed files are decompressed by
+multiple threads.
+
+Parsed ContigSet xml files are cached by path and mtime.
+External files of a ContigSet xml without filters are read
+directly, and names, lengths of reads are read from persisted
+.fai indices of FASTA/FASTQ files where possible.
 """
 
 import logging
@@ -21,6 +30,10 @@ from pbcore.io import (FastaReader, FastqReader, ContigSet,
                        FastaRecord, FastqRecord,
                        FastaWriter, FastqWriter)
 from pbcore.io.FastaIO import IndexedFastaRecord
+from pbtranscript.io.BgzfIO import BgzfTextReader, is_bgzf, is_gzip, open_text
+from pbtranscript.io.ContigSetCache import get_contigset_info
+from pbtranscript.io.FastaRandomReader import load_or_build_fai
+from pbtranscript.io.FastqRandomReader import load_or_build_fastq_fai
 
 __author__ = 'yli@pacificbiosciences.com'
 
@@ -28,25 +41,33 @@ log = logging.getLogger(__name__)
 
 __all__ = ["ContigSetReaderWrapper"]
 
+# Size of buffer to copy files in consolidate.
+CONSOLIDATE_BUFFER_SIZE = 8 * 1024 * 1024
+
 
 class ContigSetReaderWrapper(object):
 
     """
     Wraps readers for input FASTA, FASTQ, ContigSet xml,
 
-    <input>.fasta|fastq|xml accepted.
+    <input>.fasta|fastq|xml accepted, as well as <input>.fasta|fastq.gz.
 
     e.g.:
         [r for r in ContigSetReaderWrapper(input_fn)]
+        [r for r in ContigSetReaderWrapper(input_fn, threads=4)]
     """
     FILE_TYPE = {"FA": "FASTA", "FASTA": "FASTA",
                  "FQ": "FASTQ", "FASTQ": "FASTQ",
                  "XML": "CONTIGSET"}
-    def __init__(self, *input_filenames):
+    def __init__(self, *input_filenames, **kwargs):
         """
         *input_filenames - input FASTA/FASTQ/ContigSet files
+        threads - number of threads to decompress bgzip compressed files
         """
+        self.threads = kwargs.get("threads", 1)
+        self.input_filenames = input_filenames
         self.readers = self._open_files(*input_filenames)
+        self.started = False # whether next() has been called
         self.reader_index = 0
         self.it = self.readers[self.reader_index].__iter__()
 
@@ -56,19 +77,34 @@ class ContigSetReaderWrapper(object):
         if not input_filename.rfind('.') >= 0:
             raise IOError("Could not recoginize file type of %s" % input_filename)
         else:
-            suffix = input_filename[input_filename.rfind('.') + 1:].upper()
+            fn = input_filename
+            for ext in (".gz", ".bgz"):
+                if fn.endswith(ext):
+                    fn = fn[:-len(ext)]
+            suffix = fn[fn.rfind('.') + 1:].upper()
             return ContigSetReaderWrapper.FILE_TYPE[suffix]
 
+    def _open_fastx(self, reader_class, fn):
+        """Return reader_class reading fn, decompressing bgzip blocks by
+        threads; pbcore reads plain and gzip compressed files."""
+        if self.threads > 1 and is_bgzf(fn):
+            return reader_class(BgzfTextReader(fn, threads=self.threads))
+        return reader_class(fn)
+
     def _open_files(self, *input_filenames):
         """Open file handers and return."""
         readers = []
         for fn in input_filenames:
             if ContigSetReaderWrapper.get_file_type(fn) == "FASTA":
-                readers.append(FastaReader(fn))
+                readers.append(self._open_fastx(FastaReader, fn))
             elif ContigSetReaderWrapper.get_file_type(fn) == "FASTQ":
-                readers.append(FastqReader(fn))
+                readers.append(self._open_fastx(FastqReader, fn))
             elif ContigSetReaderWrapper.get_file_type(fn) == "CONTIGSET":
-                readers.append(ContigSet(fn))
+                info = get_contigset_info(fn)
+                if info.has_filters:
+                    readers.append(ContigSet(fn))
+                else:
+                    readers.extend(self._open_files(*info.external_files))
             else:
                 raise IOError("Could not read %s as FASTA/FASTQ/CONTIGSET file." % fn)
         return readers
@@ -100,8 +136,41 @@ class ContigSetReaderWrapper(object):
         for reader in self.readers:
             reader.close()
 
+    @classmethod
+    def indexable_files(cls, *input_filenames):
+        """Return FASTA/FASTQ files of input_filenames in a list, if
+        reads in them can be accessed through .fai indices, otherwise
+        (e.g., ContigSet with filters, gzip compressed files), return None."""
+        fns = []
+        try:
+            for fn in input_filenames:
+                if cls.get_file_type(fn) == "CONTIGSET":
+                    info = get_contigset_info(fn)
+                    if info.has_filters:
+                        return None
+                    fns.extend(info.external_files)
+                else:
+                    fns.append(fn)
+            for fn in fns:
+                if cls.get_file_type(fn) not in ["FASTA", "FASTQ"] or \
+                   (is_gzip(fn) and not is_bgzf(fn)):
+                    return None
+        except KeyError:
+            return None
+        return fns
+
+    @classmethod
+    def index_entries(cls, fn):
+        """Return [(name, length)] of reads in a FASTA/FASTQ file, read
+        from its .fai index, which is built and saved if necessary."""
+        if cls.get_file_type(fn) == "FASTA":
+            return [(e[0], e[1]) for e in load_or_build_fai(fn)]
+        else:
+            return [(e[0], e[1]) for e in load_or_build_fastq_fai(fn)]
+
     def next(self):
         """Return the next FastaRecord or FastqRecord."""
+        self.started = True
         try:
             return self.it.next()
         except StopIteration:
@@ -111,8 +180,30 @@ class ContigSetReaderWrapper(object):
             else:
                 raise StopIteration
 
+    def _consolidate_by_copy(self, fns, out_prefix):
+        """Consolidate FASTA/FASTQ files fns by copying, return path to output file."""
+        file_types = set([self.get_file_type(fn) for fn in fns])
+        if sum([len(self.index_entries(fn)) for fn in fns]) == 0:
+            raise ValueError("No records to consolidate")
+        if len(file_types) != 1:
+            raise ValueError("Not able to consolidate records of mixed types.")
+        out_fn = out_prefix + (".fasta" if file_types.pop() == "FASTA" else ".fastq")
+        with open(out_fn, 'wb') as writer:
+            for fn in fns:
+                last = ''
+                with open_text(fn, threads=self.threads) as reader:
+                    for data in iter(lambda: reader.read(CONSOLIDATE_BUFFER_SIZE), ''):
+                        writer.write(data)
+                        last = data[-1]
+                if last not in ['', '\n']:
+                    writer.write('\n')
+        return out_fn
+
     def consolidate(self, out_prefix):
         """Consolidate ContigSet to FASTA/FASTQ file, return path to output file."""
+        fns = self.indexable_files(*self.input_filenames) if not self.started else None
+        if fns is not None:
+            return self._consolidate_by_copy(fns, out_prefix)
         try:
             r0 = self.next()
         except StopIteration:
@@ -149,6 +240,12 @@ class ContigSetReaderWrapper(object):
     @staticmethod
     def name_to_len_dict(args):
         """Return dict {read_name: read_length}."""
+        fns = ContigSetReaderWrapper.indexable_files(args)
+        if fns is not None:
+            d = {}
+            for fn in fns:
+                d.update(ContigSetReaderWrapper.index_entries(fn))
+            return d
         with ContigSetReaderWrapper(args) as reader:
             return dict({r.name.split()[0]: len(r.sequence[:]) for r in reader})
 
@@ -161,6 +258,15 @@ class ContigSetReaderWrapper(object):
         Parameters:
           input_filename - an input FASTA/FASTQ or contigset dataset xml
         """
+        fns = ContigSetReaderWrapper.indexable_files(input_filename)
+        if fns is not None:
+            seen = set()
+            for fn in fns:
+                for name, _len in ContigSetReaderWrapper.index_entries(fn):
+                    if name in seen:
+                        raise ValueError("Duplicate id {0} detected. Abort!".format(name))
+                    seen.add(name)
+            return
         reader = ContigSetReaderWrapper(input_filename)
         seen = set()
         for r in reader:
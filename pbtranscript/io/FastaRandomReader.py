@@ -5,14 +5,24 @@ or ContigSet files randomly.
 Note that a ContigSet can contain multiple FASTA files,
 but can only contain FASTA files and filters in the
 ContigSet will not be respected.
+
+Index of FASTA files are persisted as samtools compatible .fai files,
+and zmw index of subreads FASTA files are persisted as binary .zmwi files.
+FASTA files may be compressed by bgzip, in which case offsets in indices
+are uncompressed offsets, as in samtools.
 """
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+import os
 import os.path as op
 import logging
+import struct
+import numpy as np
 
 from pbcore.io.FastaIO import FastaRecord
-from pbcore.io import ContigSet
+from pbtranscript.io.ContigSetCache import contigset_external_files
+from pbtranscript.io.BgzfIO import open_text, open_random_access, \
+        uncompressed_size
 
 __all__ = ["FastaRandomReader",
            "MetaSubreadFastaReader",
@@ -21,6 +31,148 @@ __all__ = ["FastaRandomReader",
 Interval = namedtuple('Interval', ['start', 'end'])
 
 
+def strip_gz(filename):
+    """Return filename without a trailing .gz or .bgz extension."""
+    for ext in (".gz", ".bgz"):
+        if filename.endswith(ext):
+            return filename[:-len(ext)]
+    return filename
+
+
+def fai_filename(fasta_filename):
+    """Return .fai index file name of a FASTA file."""
+    return fasta_filename + ".fai"
+
+
+def _fai_end(offset, seqlen, linebases, linewidth):
+    """Return offset right after the last base of a record in fai."""
+    if seqlen == 0:
+        return offset
+    return offset + seqlen + ((seqlen - 1) / linebases) * (linewidth - linebases)
+
+
+def build_fai(fasta_filename):
+    """
+    Scan a FASTA file and return a list of index entries
+        (sid, seqlen, offset, end, linebases, linewidth),
+    where sid is the first word of the header, offset is the position of
+    the first base, end is the position right after the last base,
+    linebases and linewidth are number of bases and bytes of each line
+    as defined in samtools .fai, or both 0 if sequence lines of the
+    record are not of equal width.
+    """
+    entries = []
+    sid, offset, seqlen, linebases, linewidth = None, 0, 0, 0, 0
+    nlines, last_line_seen, regular, pos = 0, False, True, 0
+
+    def _entry(end):
+        """Return an index entry of the current record."""
+        if regular and seqlen > 0:
+            return (sid, seqlen, offset,
+                    _fai_end(offset, seqlen, linebases, linewidth),
+                    linebases, linewidth)
+        return (sid, seqlen, offset, end if seqlen > 0 else offset, 0, 0)
+
+    with open_text(fasta_filename) as reader:
+        for line in reader:
+            if line.startswith('>'):
+                if sid is not None:
+                    entries.append(_entry(pos))
+                # the header MUST be just 1 line
+                sid = line.strip()[1:].split(None, 1)[0]
+                offset = pos + len(line)
+                seqlen, linebases, linewidth, nlines = 0, 0, 0, 0
+                last_line_seen, regular = False, True
+            elif sid is not None:
+                nbases = len(line.rstrip('\r\n'))
+                if nlines == 0:
+                    linebases, linewidth = nbases, len(line)
+                elif last_line_seen or nbases > linebases or \
+                     (line.endswith('\n') and len(line) - nbases != linewidth - linebases):
+                    regular = False
+                if nbases < linebases or nbases == 0:
+                    last_line_seen = True
+                seqlen += nbases
+                nlines += 1
+            pos += len(line)
+        if sid is not None:
+            entries.append(_entry(pos))
+    return entries
+
+
+def write_fai(entries, out_fai):
+    """Write index entries to a samtools compatible .fai file."""
+    # write to a temporary file then rename, so that concurrent readers
+    # never see a partial index.
+    tmp_fn = "%s.%d.tmp" % (out_fai, os.getpid())
+    try:
+        with open(tmp_fn, 'w') as writer:
+            for sid, seqlen, offset, _end, linebases, linewidth in entries:
+                writer.write("{0}\t{1}\t{2}\t{3}\t{4}\n".format(
+                    sid, seqlen, offset, linebases, linewidth))
+        os.rename(tmp_fn, out_fai)
+    finally:
+        if op.exists(tmp_fn):
+            os.remove(tmp_fn)
+
+
+def read_fai(fasta_filename):
+    """
+    Return index entries of fasta_filename in its .fai file, if the .fai
+    file exists, is not older than the FASTA file and describes
+    a file of the same size; otherwise return None.
+    """
+    fai_fn = fai_filename(fasta_filename)
+    if not op.exists(fai_fn) or \
+       op.getmtime(fai_fn) < op.getmtime(fasta_filename):
+        return None
+    entries = []
+    try:
+        with open(fai_fn, 'r') as reader:
+            for line in reader:
+                fields = line.rstrip('\n').split('\t')
+                seqlen, offset, linebases, linewidth = [int(x) for x in fields[1:5]]
+                if linebases == 0 and seqlen > 0:
+                    return None
+                end = _fai_end(offset, seqlen, linebases, linewidth)
+                entries.append((fields[0], seqlen, offset, end, linebases, linewidth))
+    except (IOError, ValueError, IndexError):
+        return None
+
+    size = uncompressed_size(fasta_filename)
+    if len(entries) == 0 and size != 0:
+        return None
+    # the last record may or may not end with '\n' or '\r\n'.
+    if len(entries) > 0 and not (entries[-1][3] <= size <= entries[-1][3] + 2):
+        return None
+    return entries
+
+
+def load_or_build_fai(fasta_filename, persist_index=True):
+    """
+    Return index entries of fasta_filename. Read them from a valid .fai
+    file if persist_index is True, otherwise build them by scanning
+    fasta_filename, and if possible, save them to .fai. If .fai can not
+    be saved, e.g., in a read-only directory, entries are only kept in memory.
+    """
+    if persist_index:
+        entries = read_fai(fasta_filename)
+        if entries is not None:
+            return entries
+
+    entries = build_fai(fasta_filename)
+    if persist_index:
+        if any([e[4] == 0 and e[1] > 0 for e in entries]):
+            logging.debug("Could not save .fai of %s with unequal line widths.",
+                          fasta_filename)
+        else:
+            try:
+                write_fai(entries, fai_filename(fasta_filename))
+            except (IOError, OSError):
+                logging.debug("Could not save %s.", fai_filename(fasta_filename))
+    return entries
+
+
 class FastaRandomReader(object):
 
     """
@@ -35,6 +187,11 @@ class FastaRandomReader(object):
 
         The only requirement is that every id line begins with the symbol >.
 
+        Index of each FASTA file is saved to a samtools compatible
+        <fasta>.fai and reused next time if the .fai file is still valid,
+        unless persist_index=False. Sequences are sliced from memory
+        mapped FASTA files.
+
         Example:
             r = FastaRandomReader('output/test.fna')
             r['6C_49273_NC_008578/2259031-2259297'] ==> this shows a FastaRecord
@@ -43,10 +200,11 @@ class FastaRandomReader(object):
             r['m/zmw/s_e'] ==> this shows a FastaRecord
     """
 
-    def __init__(self, *args):
+    def __init__(self, *args, **kwargs):
+        self.persist_index = kwargs.get("persist_index", True)
         self.fasta_filenames = self.get_fasta_filenames(*args)
         self.fhandlers = self._open_files()
-        self.d = {}
+        self.d = {} # sid --> (file index, offset, end)
         self._init_index()
 
     def get_fasta_filenames(self, *args):
@@ -55,52 +213,41 @@ class FastaRandomReader(object):
         for fn in args:
             ext = op.splitext(fn)[1].upper()
             if ext in [".XML"]:
-                try:
-                    fns = ContigSet(fn).toExternalFiles()
-                    ret.extend(fns)
-                except IOError:
-                    raise IOError("Could not open %s as ContigSet." % fn)
+                ret.extend(contigset_external_files(fn))
             else:
                 ret.append(fn)
         for fn in ret:
-            if op.splitext(fn)[1].upper() not in [".FA", ".FASTA"]:
+            if op.splitext(strip_gz(fn))[1].upper() not in [".FA", ".FASTA"]:
                 raise IOError("%s input must be FASTA or ContigSet."
                               % self.__class__.__name__)
         return ret
 
     def _open_files(self):
-        return [open(fn) for fn in self.fasta_filenames]
+        """Return memory maps or BgzfReaders of fasta_filenames,
+        or None for empty files."""
+        return [open_random_access(fn, persist_index=self.persist_index)
+                for fn in self.fasta_filenames]
 
     def _init_index(self):
         """Indexing reads in fasta_filenames"""
-        for index, f in enumerate(self.fhandlers):
-            while 1:
-                line = f.readline()
-                if len(line) == 0:
-                    break
-                if line.startswith('>'):
-                    sid = line.strip()[1:].split(None, 1)[0]
-                    # the header MUST be just 1 line
-                    # if id in self.d:
-                    #    print "duplicate id {0}!!".format(id)
-                    self.d[sid] = (index, f.tell())
+        for index, fn in enumerate(self.fasta_filenames):
+            for e in load_or_build_fai(fn, persist_index=self.persist_index):
+                # sid --> (file index, offset, end)
+                self.d[e[0]] = (index, e[2], e[3])
 
     def __getitem__(self, k):
         if k not in self.d:
             errMsg = "key {k} not in {f}!".format(k=k, f=",".join(self.fasta_filenames))
-            logging.error(self.d.keys())
             raise ValueError(errMsg)
         return self._get_record(k)
 
+    def __contains__(self, k):
+        return k in self.d
+
     def _get_record(self, k):
-        index, tell = self.d[k]
-        f = self.fhandlers[index]
-        f.seek(tell)
-        content = ''
-        for line in f:
-            if line.startswith('>'):
-                break
-            content += line.strip()
+        index, offset, end = self.d[k]
+        m = self.fhandlers[index]
+        content = m[offset:end].translate(None, '\r\n') if m is not None else ''
         return FastaRecord(header=k, sequence=content)
 
     def __len__(self):
@@ -118,20 +265,165 @@ class FastaRandomReader(object):
         """Return d.keys."""
         return self.d.keys()
 
+    def close(self):
+        """Close memory maps and BgzfReaders."""
+        for m in self.fhandlers:
+            if m is not None:
+                m.close()
+        self.fhandlers = []
+
+
+def zmw_index_filename(fasta_filename):
+    """Return binary ZMW index file name of a subreads FASTA file."""
+    return fasta_filename + ".zmwi"
+
+
+# A ZMW index file contains a header
+#     (magic, FASTA file size, FASTA mtime, number of subreads,
+#      number of bytes of movie names),
+# followed by '\n' joined movie names, zero padded to 8 bytes, and
+# subread records of ZMW_INDEX_DTYPE sorted by zmw, where
+# zmw = movie index << 32 | hole number.
+ZMW_INDEX_MAGIC = "PBZMWI01"
+ZMW_INDEX_HEADER = struct.Struct("<8sqdqq")
+ZMW_INDEX_DTYPE = np.dtype([('zmw', '<i8'), ('qstart', '<i4'), ('qend', '<i4'),
+                            ('offset', '<i8'), ('end', '<i8')])
+
+
+def build_zmw_index(fasta_filename, persist_index=True):
+    """
+    Scan a subreads FASTA file, where reads are named as
+    <movie>/<holeNumber>/<qStart>_<qEnd>, and return (movies, records),
+    where records is a numpy array of ZMW_INDEX_DTYPE sorted by zmw,
+    subreads of a zmw are kept in file order.
+    Raise ValueError if any read is not named as a subread.
+    """
+    movies, movie_index, rows = [], {}, []
+    entries = load_or_build_fai(fasta_filename, persist_index=persist_index)
+    for sid, _seqlen, offset, end, _linebases, _linewidth in entries:
+        try:
+            movie, hole, s_e = sid.split('/')
+            qstart, qend = [int(x) for x in s_e.split('_')]
+            hole = int(hole)
+        except ValueError:
+            raise ValueError("%s is not a valid pacbio subread." % sid)
+        if movie not in movie_index:
+            movie_index[movie] = len(movies)
+            movies.append(movie)
+        rows.append(((movie_index[movie] << 32) | hole, qstart, qend, offset, end))
+    records = np.array(rows, dtype=ZMW_INDEX_DTYPE)
+    return movies, records[np.argsort(records['zmw'], kind='mergesort')]
+
+
+def build_zmw_index_by_names(fasta_filename, persist_index=True):
+    """
+    Index reads of a FASTA file which are not all named as subreads,
+    e.g., CCS reads, by read names, where the zmw of a read is its name
+    up to the last '/'. Return (names, zmw_keys, records), where
+    zmw_keys is {zmw: key}, keys number zmws in file order, records is
+    a numpy array of ZMW_INDEX_DTYPE sorted by zmw key and names are
+    read names of records.
+    """
+    names, zmw_keys, rows = [], {}, []
+    entries = load_or_build_fai(fasta_filename, persist_index=persist_index)
+    for sid, _seqlen, offset, end, _linebases, _linewidth in entries:
+        zmw = sid[:sid.rfind('/')]
+        key = zmw_keys.setdefault(zmw, len(zmw_keys))
+        names.append(sid)
+        rows.append((key, 0, 0, offset, end))
+    records = np.array(rows, dtype=ZMW_INDEX_DTYPE)
+    order = np.argsort(records['zmw'], kind='mergesort')
+    return [names[i] for i in order], zmw_keys, records[order]
+
+
+def write_zmw_index(fasta_filename, movies, records, out_fn):
+    """Write movies and records of fasta_filename to a ZMW index file."""
+    movies_str = "\n".join(movies)
+    header = ZMW_INDEX_HEADER.pack(ZMW_INDEX_MAGIC, op.getsize(fasta_filename),
+                                   op.getmtime(fasta_filename), len(records),
+                                   len(movies_str))
+    padding = -(len(header) + len(movies_str)) % 8
+    # write to a temporary file then rename, so that concurrent readers
+    # never see a partial index.
+    tmp_fn = "%s.%d.tmp" % (out_fn, os.getpid())
+    with open(tmp_fn, 'wb') as writer:
+        writer.write(header)
+        writer.write(movies_str)
+        writer.write('\0' * padding)
+        writer.write(records.tostring())
+    os.rename(tmp_fn, out_fn)
+
+
+def read_zmw_index(fasta_filename):
+    """
+    Return (movies, records) in ZMW index file of fasta_filename, where
+    records are memory mapped, if the index file exists and matches size
+    and mtime of fasta_filename; otherwise, return None.
+    """
+    fn = zmw_index_filename(fasta_filename)
+    if not op.exists(fn):
+        return None
+    with open(fn, 'rb') as reader:
+        buf = reader.read(ZMW_INDEX_HEADER.size)
+        if len(buf) != ZMW_INDEX_HEADER.size:
+            return None
+        magic, size, mtime, num_records, nbytes = ZMW_INDEX_HEADER.unpack(buf)
+        if magic != ZMW_INDEX_MAGIC or size != op.getsize(fasta_filename) or \
+           mtime != op.getmtime(fasta_filename):
+            return None
+        movies_str = reader.read(nbytes)
+
+    offset = ZMW_INDEX_HEADER.size + nbytes
+    offset += -offset % 8
+    if op.getsize(fn) != offset + num_records * ZMW_INDEX_DTYPE.itemsize:
+        return None
+    movies = movies_str.split("\n") if nbytes > 0 else []
+    if num_records == 0:
+        return movies, np.zeros(0, dtype=ZMW_INDEX_DTYPE)
+    return movies, np.memmap(fn, dtype=ZMW_INDEX_DTYPE, mode='r',
+                             offset=offset, shape=(num_records,))
+
+
+def load_or_build_zmw_index(fasta_filename, persist_index=True):
+    """
+    Return (movies, records) of a subreads FASTA file. Read them from a
+    valid ZMW index file if persist_index is True, otherwise build them
+    by scanning fasta_filename, and if possible, save them to the index file.
+    """
+    if persist_index:
+        ret = read_zmw_index(fasta_filename)
+        if ret is not None:
+            return ret
+
+    movies, records = build_zmw_index(fasta_filename, persist_index=persist_index)
+    if persist_index:
+        try:
+            write_zmw_index(fasta_filename, movies, records,
+                            zmw_index_filename(fasta_filename))
+        except (IOError, OSError):
+            logging.debug("Could not save %s.", zmw_index_filename(fasta_filename))
+    return movies, records
+
 
 class MetaSubreadFastaReader(object):
 
     """Reader for reading PabBio subreads in a list of fasta files."""
 
-    def __init__(self, fasta_filenames):
+    def __init__(self, fasta_filenames, persist_index=True):
         self.meta_f = {}
-        self.meta_zmw_d = {}
-        # record just the zmw and let the subread reader handle it
+        self.movie_to_readers = {} # movie --> SubreadFastaReaders
+        # record just the movies and let the subread reader handle zmws
         for fn in fasta_filenames:
-            self.meta_f[fn] = SubreadFastaReader(fn)
-            # combine all the keys
-            for k in self.meta_f[fn].zmw_d.keys():
-                self.meta_zmw_d[k] = fn
+            self.meta_f[fn] = SubreadFastaReader(fn, persist_index=persist_index)
+            for movie in self.meta_f[fn].movies:
+                self.movie_to_readers.setdefault(movie, []).append(self.meta_f[fn])
+
+    def _reader_of_zmw(self, zmw):
+        """Return the SubreadFastaReader which contains zmw."""
+        for reader in self.movie_to_readers.get(zmw.split('/')[0], []):
+            if zmw in reader:
+                return reader
+        raise KeyError("key {0} not in dictionary!".format(zmw))
 
     def __getitem__(self, k):
         """
@@ -141,10 +433,38 @@ class MetaSubreadFastaReader(object):
             zmw = k[:k.rfind('/')]
         else:
             zmw = k
-        return self.meta_f[self.meta_zmw_d[zmw]][k]
+        return self._reader_of_zmw(zmw)[k]
+
+    def __contains__(self, k):
+        try:
+            self._reader_of_zmw(k[:k.rfind('/')] if k.count('/') == 2 else k)
+            return True
+        except KeyError:
+            return False
+
+    def fetch_zmws(self, zmws, ignore_missing=False):
+        """
+        Return an OrderedDict {zmw: [FastaRecord of subreads]} of zmws,
+        in order of zmws. Subreads are read in order of files and
+        offsets in files.
+        """
+        reader_to_zmws = {}
+        for zmw in zmws:
+            try:
+                reader = self._reader_of_zmw(zmw)
+                reader_to_zmws.setdefault(reader.fasta_filename, []).append(zmw)
+            except KeyError:
+                if not ignore_missing:
+                    raise
+
+        d = {}
+        for fn in sorted(reader_to_zmws.keys()):
+            d.update(self.meta_f[fn].fetch_zmws(reader_to_zmws[fn]))
+        return OrderedDict((zmw, d[zmw]) for zmw in zmws if zmw in d)
 
     def __len__(self):
-        return len(sum([len(d) for d in self.meta_zmw_d]))
+        """Return number of zmws."""
+        return sum([r.num_zmws for r in self.meta_f.itervalues()])
 
     def __delitem__(self, key):
         errMsg = "%s.__delitem__ not defined." % self.__class__.__name__
@@ -157,25 +477,73 @@ class MetaSubreadFastaReader(object):
 
 class SubreadFastaReader(object):
 
-    """Reader for reading PabBio subreads in a fasta file."""
+    """
+    Reader for reading PabBio subreads in a fasta file.
+
+    Subreads are indexed by zmw in a binary <fasta>.zmwi file, which is
+    built once, memory mapped and shared by readers of the same file,
+    unless persist_index=False. Reads which are not all named as
+    <movie>/<holeNumber>/<qStart>_<qEnd>, e.g., CCS reads, are indexed
+    by names in memory instead.
+    """
 
-    def __init__(self, fasta_filename):
-        self.f = open(fasta_filename)
-        self.d = {}
-        self.zmw_d = {}
-        while 1:
-            line = self.f.readline()
-            if len(line) == 0:
-                break
-            if line.startswith('>'):
-                # ex: m140..._s1_p0/155/0_1673 RQ=0.845
-                rid = line.strip()[1:].split(None, 1)[0]
-                # the header MUST be just 1 line
-                zmw = rid[:rid.rfind('/')]
-                self.d[rid] = (rid, self.f.tell())
-                if zmw not in self.zmw_d:
-                    self.zmw_d[zmw] = []
-                self.zmw_d[zmw].append((rid, self.f.tell()))
+    def __init__(self, fasta_filename, persist_index=True):
+        self.fasta_filename = fasta_filename
+        # names and zmw keys of reads, if reads are indexed by names.
+        self.names, self.zmw_keys = None, None
+        try:
+            self.movies, self.records = load_or_build_zmw_index(
+                fasta_filename, persist_index=persist_index)
+        except ValueError as e:
+            logging.debug("%s Index reads in %s by names.", e, fasta_filename)
+            self.names, self.zmw_keys, self.records = build_zmw_index_by_names(
+                fasta_filename, persist_index=persist_index)
+            self.movies = sorted(set(zmw.split('/')[0] for zmw in self.zmw_keys))
+        self.movie_index = dict((m, i) for i, m in enumerate(self.movies))
+        self.f = open_random_access(fasta_filename, persist_index=persist_index)
+        self._num_zmws = None
+
+    def _zmw_range(self, zmw):
+        """Return (start, end) indices of records of zmw <movie>/<holeNumber>."""
+        try:
+            if self.zmw_keys is not None:
+                key = self.zmw_keys[zmw]
+            else:
+                movie, hole = zmw.split('/')
+                key = (self.movie_index[movie] << 32) | int(hole)
+        except (ValueError, KeyError):
+            return (0, 0)
+        zmw_keys = self.records['zmw']
+        return (int(np.searchsorted(zmw_keys, key, side='left')),
+                int(np.searchsorted(zmw_keys, key, side='right')))
+
+    def _subread_index(self, k):
+        """Return index of record of subread k, or None."""
+        zmw, s_e = k[:k.rfind('/')], k[k.rfind('/')+1:]
+        start, end = self._zmw_range(zmw)
+        for i in xrange(start, end):
+            if self.names is not None:
+                if self.names[i] == k:
+                    return i
+            elif "%d_%d" % (self.records[i]['qstart'], self.records[i]['qend']) == s_e:
+                return i
+        return None
+
+    def _name(self, i):
+        """Return subread name of the i-th index record."""
+        if self.names is not None:
+            return self.names[i]
+        rec = self.records[i]
+        return "%s/%d/%d_%d" % (self.movies[int(rec['zmw']) >> 32],
+                                int(rec['zmw']) & 0xffffffff,
+                                rec['qstart'], rec['qend'])
+
+    def _record(self, i):
+        """Return i-th subread as a FastaRecord."""
+        rec = self.records[i]
+        content = self.f[rec['offset']:rec['end']].translate(None, '\r\n') \
+                  if self.f is not None else ''
+        return FastaRecord(header=self._name(i), sequence=content)
 
     def __getitem__(self, k):
         """
@@ -184,30 +552,65 @@ class SubreadFastaReader(object):
         If latter, return just that record but still in a list
         """
         if k.count('/') == 2:  # is a subread
-            if k not in self.d:
+            i = self._subread_index(k)
+            if i is None:
                 raise ValueError("key {0} not in dictionary!".format(k))
-            locations = [self.d[k]]
+            return [self._record(i)]
         else:  # is a ZMW
-            if k not in self.zmw_d:
+            start, end = self._zmw_range(k)
+            if start == end:
                 raise ValueError("key {0} not in dictionary!".format(k))
-            locations = self.zmw_d[k]
-        output = []
-        for seqid, loc in locations:
-            self.f.seek(loc)
-            content = ''
-            for line in self.f:
-                if line.startswith('>'):
-                    break
-                content += line.strip()
-            output.append(FastaRecord(header=seqid, sequence=content))
-        return output
+            return [self._record(i) for i in xrange(start, end)]
+
+    def __contains__(self, k):
+        if k.count('/') == 2:
+            return self._subread_index(k) is not None
+        start, end = self._zmw_range(k)
+        return start < end
+
+    def fetch_zmws(self, zmws, ignore_missing=False):
+        """
+        Return an OrderedDict {zmw: [FastaRecord of subreads]} of zmws,
+        in order of zmws. Subreads are read in order of file offsets.
+        """
+        ret = OrderedDict()
+        indices = []
+        for zmw in zmws:
+            if zmw in ret:
+                continue
+            start, end = self._zmw_range(zmw)
+            if start == end:
+                if ignore_missing:
+                    continue
+                raise KeyError("key {0} not in dictionary!".format(zmw))
+            ret[zmw] = []
+            indices.extend(xrange(start, end))
+
+        indices = np.array(indices, dtype=np.int64)
+        records = {}
+        for i in indices[np.argsort(self.records['offset'][indices], kind='mergesort')]:
+            records[i] = self._record(i)
+        for zmw in ret:
+            start, end = self._zmw_range(zmw)
+            ret[zmw] = [records[i] for i in xrange(start, end)]
+        return ret
+
+    @property
+    def num_zmws(self):
+        """Return number of zmws, which is counted once since records
+        are sorted by zmw."""
+        if self._num_zmws is None:
+            zmws = self.records['zmw']
+            self._num_zmws = 0 if len(zmws) == 0 else \
+                int(np.count_nonzero(zmws[1:] != zmws[:-1])) + 1
+        return self._num_zmws
 
     def keys(self):
         """return keys (subreads)."""
-        return self.d.keys()
+        return [self._name(i) for i in xrange(len(self.records))]
 
     def __len__(self):
-        return len(self.d)
+        return len(self.records)
 
     def __delitem__(self, key):
         errMsg = "%s.__delitem__ not defined." % self.__class__.__name__
@@ -1,29 +1,86 @@
 #!/usr/bin/env python
 """Define Class `FastaSplitter` which splits a fasta file into
-smaller files each containing `reads_per_split` reads."""
+smaller files each containing `reads_per_split` reads.
+
+A plain FASTA file is split by copying byte ranges, which start and end
+at record starts found in the .fai index of the file, to splitted files
+in parallel, without parsing records. Other inputs (e.g., ContigSet xml,
+bgzip compressed FASTA) are split by reading and writing records."""
 
 import os
 import os.path as op
 import sys
+from multiprocessing.pool import ThreadPool
+import numpy as np
 
 from pbcore.io import FastaWriter
 
 from pbtranscript.Utils import mkdir
 from pbtranscript.io.ContigSetReaderWrapper import ContigSetReaderWrapper
+from pbtranscript.io.FastaRandomReader import load_or_build_fai
+from pbtranscript.io.BgzfIO import is_bgzf
 
 __all__ = ["FastaSplitter"]
 
+# Size of buffer to copy byte ranges.
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
+
+
+def split_points(seqlens, reads_per_split, reads_in_first_split=None,
+                 balance_by_bases=False):
+    """
+    Return indices of the first record of each split, given lengths of
+    records in a numpy array.
+    By default, the first split contains reads_in_first_split reads, then
+    a new split starts at every multiple of reads_per_split. If
+    balance_by_bases is True, the same number of splits is made, but
+    records (after the first split if reads_in_first_split is given) are
+    distributed so that splits have about the same number of bases.
+    """
+    n = len(seqlens)
+    first = reads_per_split if reads_in_first_split is None else reads_in_first_split
+    points = [0] + ([first] if first < n else []) + \
+             [x for x in range(reads_per_split, n, reads_per_split) if x > first]
+    if balance_by_bases and len(points) > 1:
+        first = 0 if reads_in_first_split is None else reads_in_first_split
+        num_splits = len(points) - (1 if first > 0 else 0)
+        cum_bases = np.cumsum(seqlens[first:], dtype=np.int64)
+        targets = cum_bases[-1] * np.arange(1, num_splits, dtype=np.float64) / num_splits
+        # a split ends right after the record reaching a target
+        ends = first + 1 + np.searchsorted(cum_bases, targets, side='left')
+        points = sorted(set([0, first] + [int(x) for x in ends if x < n]))
+    return points
+
+
+def copy_byte_range(args):
+    """Copy bytes [start, end) of src to dst, args=(src, dst, start, end)."""
+    src, dst, start, end = args
+    with open(src, 'rb') as reader, open(dst, 'wb') as writer:
+        reader.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            data = reader.read(min(COPY_BUFFER_SIZE, remaining))
+            if len(data) == 0:
+                raise IOError("{f} is truncated at {p}.".format(f=src, p=end-remaining))
+            writer.write(data)
+            remaining -= len(data)
+    return dst
+
 class FastaSplitter(object):
 
     """An object of `FastaSplitter` splits a fasta file into
     smaller chunks with a given prefix."""
 
-    def __init__(self, input_fasta, reads_per_split, out_dir, out_prefix):
+    def __init__(self, input_fasta, reads_per_split, out_dir, out_prefix,
+                 threads=1):
         self.input_fasta = input_fasta
+        self.threads = threads # threads to copy or decompress input
         self.out_dir = out_dir
         self.reads_per_split = reads_per_split  # Number of reads per split
         self.out_prefix = out_prefix
         self.out_fns = None
+        self.num_reads = None # number of reads in each splitted file
+        self.num_bases = None # number of bases in each splitted file
         mkdir(self.out_dir)
 
     def __str__(self):
@@ -47,46 +104,134 @@ class FastaSplitter(object):
                                                  idx=split_index)
         return op.join(self.out_dir, name)
 
-    def split(self, reads_in_first_split=None):
+    @property
+    def manifest_fn(self):
+        """Return manifest of splitted files."""
+        return op.join(self.out_dir, "{prefix}.manifest.csv".
+                       format(prefix=self.out_prefix))
+
+    def write_manifest(self):
+        """Write number of reads and bases of each splitted file to
+        manifest_fn, e.g.,
+            file,num_reads,num_bases
+            <out_dir>/<out_prefix>_000.fasta,100,72345
+        """
+        with open(self.manifest_fn, 'w') as writer:
+            writer.write("file,num_reads,num_bases\n")
+            for fn, r, b in zip(self.out_fns, self.num_reads, self.num_bases):
+                writer.write("{f},{r},{b}\n".format(f=fn, r=r, b=b))
+
+    def split(self, reads_in_first_split=None, balance_by_bases=False):
         """Split `input_fasta` into smaller files each containing
-        `reads_per_split` reads. Return splitted fasta."""
+        `reads_per_split` reads, or, if balance_by_bases is True, the same
+        number of files each containing about the same number of bases.
+        Write a manifest of splitted files. Return splitted fasta."""
+        if op.splitext(self.input_fasta)[1].upper() in [".FA", ".FASTA"] and \
+           not is_bgzf(self.input_fasta):
+            self._split_by_offsets(reads_in_first_split, balance_by_bases)
+        else:
+            self._split_by_records(reads_in_first_split, balance_by_bases)
+        self.write_manifest()
+        return list(self.out_fns)
+
+    def _split_by_offsets(self, reads_in_first_split, balance_by_bases):
+        """Split a plain FASTA file by copying byte ranges in parallel."""
+        entries = load_or_build_fai(self.input_fasta)
+        seqlens = np.array([e[1] for e in entries], dtype=np.int64)
+        points = split_points(seqlens, self.reads_per_split,
+                              reads_in_first_split, balance_by_bases)
+        self.out_fns = [self._out_fn(i) for i in range(len(points))]
+
+        # A record starts at '>' of its header, right before its first base.
+        size = op.getsize(self.input_fasta)
+        starts = [0]
+        with open(self.input_fasta, 'rb') as reader:
+            for point in points[1:]:
+                offset = entries[point][2]
+                reader.seek(max(0, offset - COPY_BUFFER_SIZE))
+                buf = reader.read(offset - max(0, offset - COPY_BUFFER_SIZE))
+                i = buf.rfind('\n>')
+                if i < 0:
+                    raise ValueError("Could not find header of {r} in {f}.".
+                                     format(r=entries[point][0], f=self.input_fasta))
+                starts.append(offset - len(buf) + i + 1)
+        ends = starts[1:] + [size]
+
+        pool = ThreadPool(max(1, self.threads))
+        try:
+            pool.map(copy_byte_range, [(self.input_fasta, fn, start, end) for
+                                       fn, start, end in zip(self.out_fns, starts, ends)])
+        finally:
+            pool.close()
+            pool.join()
+
+        bounds = points + [len(seqlens)]
+        self.num_reads = [bounds[i+1] - bounds[i] for i in range(len(points))]
+        self.num_bases = [int(seqlens[bounds[i]:bounds[i+1]].sum())
+                          for i in range(len(points))]
+
+    def _split_by_records(self, reads_in_first_split, balance_by_bases):
+        """Split input by reading and writing records."""
+        if balance_by_bases:
+            with ContigSetReaderWrapper(self.input_fasta, threads=self.threads) as reader:
+                seqlens = np.array([len(r.sequence) for r in reader], dtype=np.int64)
+            points = split_points(seqlens, self.reads_per_split,
+                                  reads_in_first_split, balance_by_bases)
+        else:
+            points = None
         split_index = 0
         self.out_fns = []
+        self.num_reads, self.num_bases = [0], [0]
         writer = FastaWriter(self._out_fn(split_index))
         self.out_fns.append(self._out_fn(split_index))
         if reads_in_first_split is None:
             reads_in_first_split = self.reads_per_split
-        with ContigSetReaderWrapper(self.input_fasta) as reader:
+        with ContigSetReaderWrapper(self.input_fasta, threads=self.threads) as reader:
             for ridx, r in enumerate(reader):
-                if ((split_index == 0 and ridx == reads_in_first_split) or
-                        (split_index > 0 and ridx % self.reads_per_split == 0)) \
-                    and ridx != 0:
+                if points is not None:
+                    new_split = split_index + 1 < len(points) and \
+                                ridx == points[split_index + 1]
+                else:
+                    new_split = ((split_index == 0 and ridx == reads_in_first_split) or
+                                 (split_index > 0 and ridx % self.reads_per_split == 0)) \
+                                and ridx != 0
+                if new_split:
                     split_index += 1
                     writer.close()
                     writer = FastaWriter(self._out_fn(split_index))
                     self.out_fns.append(self._out_fn(split_index))
-                writer.writeRecord(r.name, r.sequence[:])
+                    self.num_reads.append(0)
+                    self.num_bases.append(0)
+                seq = r.sequence[:]
+                writer.writeRecord(r.name, seq)
+                self.num_reads[-1] += 1
+                self.num_bases[-1] += len(seq)
 
         writer.close()
-        return list(self.out_fns)
 
     def rmOutFNs(self):
-        """Remove splitted files."""
+        """Remove splitted files and their manifest."""
         for f in self.out_fns:
             os.remove(f)
         self.out_fns = []
+        if op.exists(self.manifest_fn):
+            os.remove(self.manifest_fn)
 
 
-def splitFasta(input_fasta, reads_per_split, out_dir, out_prefix, reads_in_first_split=None):
+def splitFasta(input_fasta, reads_per_split, out_dir, out_prefix, reads_in_first_split=None,
+               threads=1, balance_by_bases=False):
     """
     Split input_fasta into small fasta files each containing at most
-    reads_per_split reads. All splitted fasta files will be placed under
+    reads_per_split reads, or if balance_by_bases is True, the same number
+    of files balanced by bases. All splitted fasta files will be placed under
     out_dir with out_prefix. Return paths to splitted files in a list.
     """
     obj = FastaSplitter(input_fasta=input_fasta,
                         reads_per_split=reads_per_split,
-                        out_dir=out_dir, out_prefix=out_prefix)
-    return obj.split(reads_in_first_split=reads_in_first_split)
+                        out_dir=out_dir, out_prefix=out_prefix,
+                        threads=threads)
+    return obj.split(reads_in_first_split=reads_in_first_split,
+                     balance_by_bases=balance_by_bases)
 
 
 def get_args():
@@ -106,6 +251,12 @@ def get_args():
     parser.add_argument("out_prefix",
                         type=str,
                         help="Output files prefix.")
+    parser.add_argument("--threads",
+                        type=int, default=1,
+                        help="Number of threads to copy splitted files.")
+    parser.add_argument("--balance_by_bases",
+                        default=False, action="store_true",
+                        help="Balance splitted files by bases instead of reads.")
     this_args = parser.parse_args()
     return this_args
 
@@ -124,7 +275,9 @@ def main():
     splitFasta(input_fasta=args.input_fasta,
                reads_per_split=args.reads_per_split,
                out_dir=args.out_dir,
-               out_prefix=args.out_prefix)
+               out_prefix=args.out_prefix,
+               threads=args.threads,
+               balance_by_bases=args.balance_by_bases)
 
 if __name__ == "__main__":
     sys.exit(main())
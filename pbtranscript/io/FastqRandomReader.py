@@ -1,65 +1,223 @@
 """
 Define miscBio.FastqRandomReader.
 It will be repaced by pbcore.io.FastqIO.FastqRandomReader.
+
+Index of FASTQ files are persisted as samtools compatible .fai files.
+FASTQ files may be compressed by bgzip.
 """
+import os.path as op
+import logging
+import numpy as np
 from pbcore.io.FastqIO import FastqRecord
+from pbtranscript.io.BgzfIO import open_text, open_random_access, \
+        uncompressed_size
 
 __all__ = ["FastqRandomReader"]
 
-class FastqRandomReader:
+
+# Probability of a base being wrong, indexed by its phred quality value.
+ERROR_PROB_OF_QV = 10 ** -(np.arange(256, dtype=np.float64) / 10.0)
+
+
+def sum_error_probs(qvs, lens):
+    """Given QVs of reads concatenated in a numpy uint8 array and number of
+    QVs of each read, return sum of error probabilities of each read."""
+    ret = np.zeros(len(lens), dtype=np.float64)
+    nonempty = lens > 0
+    if nonempty.any():
+        starts = np.concatenate(([0], np.cumsum(lens)[:-1]))
+        ret[nonempty] = np.add.reduceat(ERROR_PROB_OF_QV[qvs], starts[nonempty])
+    return ret
+
+
+def fastq_fai_filename(fastq_filename):
+    """Return .fai index file name of a FASTQ file."""
+    return fastq_filename + ".fai"
+
+
+def build_fastq_fai(fastq_filename):
+    """
+    Scan a FASTQ file of 4-line records and return a list of index entries
+        (sid, seqlen, offset, qualoffset),
+    where sid is the first word of the header, offset and qualoffset are
+    positions of the first base and the first quality value.
+    """
+    entries, sids = [], set()
+    with open_text(fastq_filename) as reader:
+        pos = 0
+        while True:
+            header = reader.readline()
+            if len(header) == 0:
+                break
+            if not header.startswith('@'):
+                raise ValueError("Bad fastq format: {h} does not start with '@'".
+                                 format(h=header.strip()))
+            # the header MUST be just 1 line
+            sid = header.strip()[1:].split(None, 1)[0]
+            if sid in sids:
+                raise ValueError("Bad fastq format: redundant record {sid}".
+                                 format(sid=sid))
+            sids.add(sid)
+            seq, plus, qual = reader.readline(), reader.readline(), reader.readline()
+            if plus.strip() != '+':
+                raise ValueError("Bad fastq format: line 3 of {name}".
+                                 format(name=sid) + " is not '+'")
+            seqlen = len(seq.rstrip('\r\n'))
+            offset = pos + len(header)
+            qualoffset = offset + len(seq) + len(plus)
+            entries.append((sid, seqlen, offset, qualoffset))
+            pos = qualoffset + len(qual)
+    return entries
+
+
+def write_fastq_fai(entries, out_fai):
+    """Write index entries to a samtools compatible FASTQ .fai file."""
+    with open(out_fai, 'w') as writer:
+        for sid, seqlen, offset, qualoffset in entries:
+            # each record has a single sequence line and a single qual line.
+            writer.write("{0}\t{1}\t{2}\t{1}\t{3}\t{4}\n".format(
+                sid, seqlen, offset, seqlen + 1, qualoffset))
+
+
+def read_fastq_fai(fastq_filename):
+    """
+    Return index entries of fastq_filename in its .fai file, if the .fai
+    file exists, is not older than the FASTQ file and describes
+    a file of the same size; otherwise return None.
+    """
+    fai_fn = fastq_fai_filename(fastq_filename)
+    if not op.exists(fai_fn) or \
+       op.getmtime(fai_fn) < op.getmtime(fastq_filename):
+        return None
+    entries = []
+    try:
+        with open(fai_fn, 'r') as reader:
+            for line in reader:
+                fields = line.rstrip('\n').split('\t')
+                seqlen, offset, qualoffset = [int(fields[i]) for i in (1, 2, 5)]
+                entries.append((fields[0], seqlen, offset, qualoffset))
+    except (ValueError, IndexError):
+        return None
+
+    size = uncompressed_size(fastq_filename)
+    if len(entries) == 0 and size != 0:
+        return None
+    # the last record may or may not end with '\n' or '\r\n'.
+    if len(entries) > 0 and \
+       not (entries[-1][3] + entries[-1][1] <= size <= entries[-1][3] + entries[-1][1] + 2):
+        return None
+    return entries
+
+
+def load_or_build_fastq_fai(fastq_filename, persist_index=True):
+    """
+    Return index entries of fastq_filename. Read them from a valid .fai
+    file if persist_index is True, otherwise build them by scanning
+    fastq_filename, and if possible, save them to .fai.
+    """
+    if persist_index:
+        entries = read_fastq_fai(fastq_filename)
+        if entries is not None:
+            return entries
+
+    entries = build_fastq_fai(fastq_filename)
+    if persist_index:
+        try:
+            write_fastq_fai(entries, fastq_fai_filename(fastq_filename))
+        except (IOError, OSError):
+            logging.debug("Could not save %s.", fastq_fai_filename(fastq_filename))
+    return entries
+
+
+class FastqRandomReader(object):
 
     """
         Like FastaRandomReader except works with fastq.
 
         This is meant to substitute for the Bio.SeqIO.to_dict method since some fastq files
         are too big to fit entirely to memory. The only requirement is that every id line
-        begins with the symbol >. It is ok for the sequences to stretch multiple lines.
-        The sequences, when read, are returned as Bio.SeqRecord objects.
+        begins with the symbol @, and that every record has exactly 4 lines.
+        The sequences, when read, are returned as FastqRecord objects.
+
+        Index of the FASTQ file is saved to a samtools compatible
+        <fastq>.fai and reused next time if the .fai file is still valid,
+        unless persist_index=False. Quality values can be read as numpy
+        uint8 arrays without constructing FastqRecord objects.
 
         Example:
             r = FastqRandomReader('test.fastq')
             r['m131018_081703_42161_c100585152550000001823088404281404_s1_p0/61232/4045_63_CCS'] ==> this shows a FastqRecord
+            r.quality('m.../61232/4045_63_CCS') ==> QVs in a numpy array
+            r.expected_errors(['m.../61232/4045_63_CCS']) ==> expected number of errors
     """
 
-    def __init__(self, fastq_filename):
-        self.f = open(fastq_filename)
-        self.d = {}
-        self.locations = []
-        self.locations_d_key_map = {}
+    def __init__(self, fastq_filename, persist_index=True):
+        self.filename = fastq_filename
+        # a memory map or BgzfReader, or '' if fastq_filename is empty
+        self.mm = open_random_access(fastq_filename, persist_index=persist_index) or ''
+        self.d = {} # sid --> (offset, seqlen, qualoffset)
+        for sid, seqlen, offset, qualoffset in \
+                load_or_build_fastq_fai(fastq_filename, persist_index=persist_index):
+            self.d[sid] = (offset, seqlen, qualoffset)
 
-        idx = -1
-        while 1:
-            line = self.f.readline()
-            if len(line) == 0:
-                break
-            idx += 1
-            if idx % 4 == 0:
-                assert line.startswith('@')
-                sid = line.strip()[1:].split(None, 1)[0]
-                # the header MUST be just 1 line
-                if sid in self.d:
-                    raise ValueError("Bad fastq format: redundant record {sid}".
-                                     format(sid=sid))
-                self.d[sid] = self.f.tell()
+    def _location(self, k):
+        """Return (offset, seqlen, qualoffset) of k."""
+        try:
+            return self.d[k]
+        except KeyError:
+            errMsg = "key {k} not in {f}!".format(k=k, f=self.filename)
+            raise ValueError(errMsg)
 
     def __getitem__(self, k):
-        if k not in self.d:
-            errMsg = "key {k} not in {f}!".format(k=k, f=self.f.name)
-            raise ValueError(errMsg)
-        self.f.seek(self.d[k])
-        name, seq, plus, qv = k, "", "", ""
+        offset, seqlen, qualoffset = self._location(k)
+        seq = self.mm[offset:offset+seqlen]
+        qv = self.mm[qualoffset:qualoffset+seqlen]
+        return FastqRecord(header=k, sequence=seq, qualityString=qv)
+
+    def quality(self, k):
+        """Return phred quality values of k as a numpy uint8 array."""
+        _offset, seqlen, qualoffset = self._location(k)
+        return np.frombuffer(self.mm[qualoffset:qualoffset+seqlen],
+                             dtype=np.uint8) - np.uint8(33)
+
+    def _qualities(self, ids):
+        """Return (QVs of all ids concatenated in a numpy uint8 array,
+        number of QVs of each id in a numpy array)."""
+        locations = [self._location(k) for k in ids]
+        qvs = np.frombuffer("".join([self.mm[qualoffset:qualoffset+seqlen]
+                                     for _offset, seqlen, qualoffset in locations]),
+                            dtype=np.uint8) - np.uint8(33)
+        return qvs, np.array([seqlen for _offset, seqlen, _q in locations],
+                             dtype=np.int64)
 
-        seq  = self.f.readline().strip()
-        plus = self.f.readline().strip()
-        qv = self.f.readline().strip()
-        if plus != '+':
-            raise ValueError("Bad fastq format: line 3 of {name}".
-                             format(name=name) + " is not '+'")
-        return FastqRecord(header=name, sequence=seq, qualityString=qv)
+    def expected_errors(self, ids):
+        """Return expected number of base errors, i.e., sum of error
+        probabilities of all bases, of each of ids in a numpy array."""
+        return sum_error_probs(*self._qualities(ids))
+
+    def trimmed_expected_errors(self, ids, trim_5=0, trim_3=0):
+        """Ignoring the first trim_5 and the last trim_3 bases of each of ids,
+        return (expected number of errors of the remaining bases,
+        number of the remaining bases) of each of ids in numpy arrays."""
+        qvs, lens = self._qualities(ids)
+        cum_errs = np.concatenate(([0.0], np.cumsum(ERROR_PROB_OF_QV[qvs])))
+        n = np.maximum(0, lens - trim_5 - trim_3)
+        begins = np.cumsum(lens) - lens + np.minimum(trim_5, lens)
+        return cum_errs[begins + n] - cum_errs[begins], n
+
+    def mean_error(self, ids):
+        """Return mean error probability of bases of each of ids in a
+        numpy array, nan for empty reads."""
+        qvs, lens = self._qualities(ids)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return sum_error_probs(qvs, lens) / lens
 
     def __len__(self):
         return len(self.d)
 
+    def __contains__(self, k):
+        return k in self.d
+
     def __delitem__(self, key):
         errMsg = "FastqRandomReader.__delitem__ not defined."
         raise NotImplementedError(errMsg)
@@ -71,3 +229,8 @@ class FastqRandomReader:
     def keys(self):
         """Return d.keys."""
         return self.d.keys()
+
+    def close(self):
+        """Close the underlying memory map or BgzfReader."""
+        if len(self.mm) > 0:
+            self.mm.close()
@@ -0,0 +1,234 @@
+"""
+Read and write partial_uc, assignments of non-full-length (nFL) reads to
+clusters made by ice_partial, in a compact sorted text format:
+
+    #partial_uc	v1
+    <cid>	<read_id>   --- one line per assignment, sorted by (cid, read_id)
+    *	<read_id>       --- one line per read which hits no cluster (nohit),
+                            after all assignments, sorted by read_id
+
+Files of this format are k-way merged line by line, so that merging
+results of ice_partial chunks only keeps one line per chunk in memory,
+instead of unioning all chunks in dicts and sets. Consumers either stream
+reads cluster by cluster (iter_partial_uc), or load them to a dict
+{'partial_uc': {cid: reads}, 'nohit': set(reads)} (load_partial_uc),
+like a partial_uc pickle. Both also read partial_uc pickle and json files
+written by ice_partial chunks, and read exactly the file they are given,
+of which the format is told by its header.
+
+A merged partial_uc pickle, e.g., nfl.all.partial_uc.pickle, is still
+written as a pickle (merge_partial_uc_pickles), since other tools load it
+with cPickle. The pickle is streamed from its sorted text form, which is
+saved next to it (partial_uc_text_file, e.g., nfl.all.partial_uc.txt),
+one cluster at a time.
+"""
+
+import os
+import os.path as op
+import heapq
+import json
+import pickle
+import cPickle
+import logging
+from itertools import groupby, islice
+
+__all__ = ["write_partial_uc",
+           "merge_partial_uc",
+           "merge_partial_uc_pickles",
+           "partial_uc_text_file",
+           "iter_partial_uc",
+           "load_partial_uc",
+           "is_partial_uc_file"]
+
+PARTIAL_UC_HEADER = "#partial_uc\tv1"
+
+# cid of reads which hit no cluster.
+NOHIT = "*"
+
+
+def is_partial_uc_file(filename):
+    """Return True if filename is a partial_uc file of the sorted text format."""
+    with open(filename, 'rb') as reader:
+        return reader.read(len(PARTIAL_UC_HEADER) + 1) == PARTIAL_UC_HEADER + "\n"
+
+
+def partial_uc_text_file(pickle_filename):
+    """Return the sorted text file saved next to a merged partial_uc pickle,
+    e.g., nfl.all.partial_uc.pickle --> nfl.all.partial_uc.txt"""
+    prefix = op.splitext(pickle_filename)[0]
+    if not prefix.endswith(".partial_uc"):
+        prefix += ".partial_uc"
+    return prefix + ".txt"
+
+
+def _key(cid, read_id):
+    """Return sort key of an assignment, nohit reads (cid is NOHIT or
+    None) are sorted after all assignments."""
+    if cid is None or cid == NOHIT:
+        return (1, 0, read_id)
+    return (0, int(cid), read_id)
+
+
+def _load_pickle_or_json(filename):
+    """Load a partial_uc pickle or json file written by ice_partial."""
+    with open(filename, 'rb') as reader:
+        if filename.endswith(".json"):
+            return json.loads(reader.read())
+        return cPickle.load(reader)
+
+
+def write_partial_uc(partial_uc, nohit, out_fn):
+    """
+    Write partial_uc and nohit to out_fn of the sorted text format.
+        partial_uc --- {cid: nfl reads}
+        nohit --- nfl reads which hit no cluster
+    """
+    records = [_key(cid, r) for cid, reads in partial_uc.iteritems() for r in reads]
+    records.extend(_key(None, r) for r in nohit)
+    records.sort()
+    with open(out_fn, 'wb') as writer:
+        writer.write(PARTIAL_UC_HEADER + "\n")
+        for is_nohit, cid, read_id in records:
+            writer.write("{c}\t{r}\n".format(c=NOHIT if is_nohit else cid, r=read_id))
+
+
+def _iter_records(filename):
+    """Yield (key, line) of assignments in a partial_uc file of the
+    sorted text format."""
+    with open(filename, 'rb') as reader:
+        reader.readline() # header
+        for line in reader:
+            cid, read_id = line.rstrip('\r\n').split('\t')
+            yield _key(cid, read_id), line
+
+
+def merge_partial_uc(in_fns, out_fn):
+    """
+    Merge partial_uc files, pickles or json files in in_fns to out_fn of
+    the sorted text format. Inputs not of the sorted text format are
+    converted to temporary files one at a time, then all inputs are k-way
+    merged, and duplicated assignments are written once.
+    """
+    if in_fns is None or len(in_fns) == 0:
+        raise ValueError("No partial_uc files to merge.")
+    tmp = "{f}.{p}.tmp".format(f=out_fn, p=os.getpid())
+    sorted_fns, tmp_fns = [], []
+    for i, fn in enumerate(in_fns):
+        if is_partial_uc_file(fn):
+            sorted_fns.append(fn)
+        else:
+            logging.debug("Sorting partial_uc of %s.", fn)
+            a = _load_pickle_or_json(fn)
+            tmp_fn = "{t}.{i}".format(t=tmp, i=i)
+            write_partial_uc(a['partial_uc'], a['nohit'], tmp_fn)
+            del a
+            sorted_fns.append(tmp_fn)
+            tmp_fns.append(tmp_fn)
+
+    try:
+        with open(tmp, 'wb') as writer:
+            writer.write(PARTIAL_UC_HEADER + "\n")
+            last_key = None
+            for key, line in heapq.merge(*[_iter_records(fn) for fn in sorted_fns]):
+                if key != last_key:
+                    writer.write(line)
+                    last_key = key
+        os.rename(tmp, out_fn)
+    finally:
+        for fn in tmp_fns:
+            os.remove(fn)
+
+
+def _pickled(obj):
+    """Return obj pickled by protocol 2 without PROTO and STOP opcodes,
+    to be embedded in a pickle stream."""
+    return cPickle.dumps(obj, 2)[2:-1]
+
+
+def _write_partial_uc_pickle(text_fn, out_pickle, batch_size=10000):
+    """
+    Write partial_uc in text_fn of the sorted text format to out_pickle,
+    which cPickle loads as {'partial_uc': {cid: reads}, 'nohit': set(reads)}.
+    Pickle opcodes are streamed while text_fn is read, so that only reads
+    of one cluster, or batch_size nohit reads, are in memory at a time.
+    """
+    with open(text_fn, 'rb') as reader, open(out_pickle, 'wb') as writer:
+        reader.readline() # header
+        records = (line.rstrip('\r\n').split('\t') for line in reader)
+        writer.write(pickle.PROTO + chr(2) + pickle.EMPTY_DICT)
+        writer.write(_pickled('partial_uc') + pickle.EMPTY_DICT)
+        nohit = iter([])
+        for cid, group in groupby(records, key=lambda x: x[0]):
+            if cid == NOHIT:
+                nohit = (r for _c, r in group)
+                break
+            writer.write(_pickled(int(cid)) + _pickled([r for _c, r in group]) +
+                         pickle.SETITEM)
+        writer.write(pickle.SETITEM)
+        # 'nohit': set(reads) is pickled as set([reads]), see set.__reduce__.
+        writer.write(_pickled('nohit') + pickle.GLOBAL + "__builtin__\nset\n" +
+                     pickle.EMPTY_LIST)
+        while True:
+            batch = list(islice(nohit, batch_size))
+            if len(batch) == 0:
+                break
+            writer.write(pickle.MARK + "".join(_pickled(r) for r in batch) +
+                         pickle.APPENDS)
+        writer.write(pickle.TUPLE1 + pickle.REDUCE + pickle.SETITEM + pickle.STOP)
+
+
+def merge_partial_uc_pickles(in_fns, out_pickle):
+    """
+    Merge partial_uc files, pickles or json files in in_fns to sorted text
+    file partial_uc_text_file(out_pickle), and to a partial_uc pickle
+    out_pickle, which is loaded by cPickle like pickles written by
+    ice_partial. The pickle is streamed from the text file instead of
+    loading the merged partial_uc to memory.
+    Return the sorted text file, which may be read by iter_partial_uc
+    to stream reads cluster by cluster.
+    """
+    text_fn = partial_uc_text_file(out_pickle)
+    merge_partial_uc(in_fns, text_fn)
+    tmp = "{f}.{p}.tmp".format(f=out_pickle, p=os.getpid())
+    try:
+        _write_partial_uc_pickle(text_fn, tmp)
+        os.rename(tmp, out_pickle)
+    finally:
+        if op.exists(tmp):
+            os.remove(tmp)
+    return text_fn
+
+
+def iter_partial_uc(filename):
+    """
+    Yield (cid, reads) of clusters and (None, nohit reads) in a partial_uc
+    file, in which clusters are in order of cids followed by nohit reads.
+    Pickle and json files of partial_uc are loaded first, and nohit reads
+    are yielded before clusters in the order they are saved.
+    """
+    if not is_partial_uc_file(filename):
+        a = _load_pickle_or_json(filename)
+        yield None, list(a['nohit'])
+        for cid, reads in a['partial_uc'].iteritems():
+            yield cid, reads
+        return
+
+    with open(filename, 'rb') as reader:
+        reader.readline() # header
+        records = (line.rstrip('\r\n').split('\t') for line in reader)
+        for cid, group in groupby(records, key=lambda x: x[0]):
+            yield (None if cid == NOHIT else int(cid)), [r for _c, r in group]
+
+
+def load_partial_uc(filename):
+    """Load a partial_uc file, pickle or json file, and return
+    {'partial_uc': {cid: reads}, 'nohit': set(reads)}."""
+    if not is_partial_uc_file(filename):
+        return _load_pickle_or_json(filename)
+    partial_uc, nohit = {}, set()
+    for cid, reads in iter_partial_uc(filename):
+        if cid is None:
+            nohit = set(reads)
+        else:
+            partial_uc[cid] = reads
+    return {'partial_uc': partial_uc, 'nohit': nohit}
@@ -5,6 +5,9 @@ files, and for writing bam files.
 """
 
 import os.path as op
+import Queue
+import threading
+from collections import OrderedDict
 import numpy as np
 import pysam
 
@@ -12,12 +15,31 @@ from pbcore.io import (SubreadSet, ConsensusReadSet,
                        ContigSet, FastaReader, openDataFile, openDataSet, IndexedBamReader)
 from pbcore.io import BamAlignment
 
-from pbtranscript.Utils import get_files_from_file_or_fofn
+from pbtranscript.Utils import get_files_from_file_or_fofn, make_pbi
+from pbtranscript.io.ReadAnnotation import ReadAnnotation
 
 
 __all__ = ["BamCollection",
            "BamHeader",
-           "BamWriter"]
+           "BamWriter",
+           "AnnotatedBamWriter",
+           "annotation_from_segment",
+           "carried_tags",
+           "cat_bams"]
+
+
+# Tags of per-base QVs, which must be clipped together with sequences.
+PER_BASE_TAGS = ["iq", "dq", "dt", "st", "sq", "mq", "ip", "pw"]
+
+# Optional (lower case) tags which save classify annotations of
+# trimmed reads, see ReadAnnotation. Annotations which are None
+# are not saved.
+ANNOTATION_TAGS = OrderedDict([("strand", "ts"),
+                               ("fiveend", "fe"),
+                               ("polyAend", "pe"),
+                               ("threeend", "te"),
+                               ("primer", "pi"),
+                               ("chimera", "ch")])
 
 
 class BamZmw(object):
@@ -251,7 +273,6 @@ class BamZmwRead(object):
                              (new_query_name, self.readName))
 
         s, e = readStart - self.readStart, readEnd - self.readStart
-        QV_TAGS = ["iq", "dq", "dt", "st", "sq", "mq", "ip", "pw"]
 
         # Create an unaligned pysam.AlignedSegment object.
         ret = pysam.AlignedSegment()
@@ -283,7 +304,7 @@ class BamZmwRead(object):
 
         tags = peer.tags[::]
         for index, (tag_name, tag_val) in enumerate(tags):
-            if tag_name in QV_TAGS:
+            if tag_name in PER_BASE_TAGS:
                 if self.__len__() != len(tag_val):
                     raise ValueError("%s's %s length %d ! = sequence length %d" %
                                      (peer.query_name, tag_name, len(tag_val), self.__len__()))
@@ -317,6 +338,57 @@ class BamCCSZmwRead(BamZmwRead):
         return "%s/ccs" % self.zmw.zmwName
 
 
+def zmw_keys(movie_ids, hole_numbers):
+    """Return int64 zmw keys of movie ids (qId in pbi) and hole numbers."""
+    return (np.asarray(movie_ids, dtype=np.int64) << 32) | \
+           (np.asarray(hole_numbers, dtype=np.int64) & 0xffffffff)
+
+
+class ZmwRowIndex(object):
+    """
+    Index of rows in pbi arrays by zmw, where a zmw is keyed by
+    (movie id, holeNumber). Rows are argsorted by zmw key once, and rows
+    of a zmw are found by binary search.
+
+    Rows of a zmw are kept in increasing order, which is in order of
+    bam files and file offsets within bam files.
+    """
+    def __init__(self, movie_ids, hole_numbers):
+        keys = zmw_keys(movie_ids, hole_numbers)
+        self.order = np.argsort(keys, kind='mergesort')
+        self.keys = keys[self.order]
+
+    def __len__(self):
+        """Return number of rows."""
+        return len(self.keys)
+
+    def rows(self, movie_id, hole_number):
+        """Return rows of a zmw as a numpy array."""
+        key = zmw_keys([movie_id], [hole_number])[0]
+        start = np.searchsorted(self.keys, key, side='left')
+        end = np.searchsorted(self.keys, key, side='right')
+        return self.order[start:end]
+
+    def _group_starts(self):
+        """Return indices in sorted keys where rows of a zmw start."""
+        if len(self.keys) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(([0], np.flatnonzero(self.keys[1:] != self.keys[:-1]) + 1))
+
+    @property
+    def num_zmws(self):
+        """Return number of zmws."""
+        return len(self._group_starts())
+
+    def groups(self):
+        """Yield rows of each zmw as a numpy array, in order of zmw keys,
+        i.e., sorted by (movie id, holeNumber, row)."""
+        starts = self._group_starts()
+        ends = np.append(starts[1:], len(self.keys))
+        for start, end in zip(starts, ends):
+            yield self.order[start:end]
+
+
 class BamCollection(object):
     """
     Class wraps PacBio bam fofn or datasets.
@@ -348,6 +420,9 @@ class BamCollection(object):
             for rg in bam.readGroupTable:
                 assert rg.ReadType in ["CCS", "SUBREAD"]
 
+        # zmw --> rows in dataset index, built when first used.
+        self._zmw_index = None
+
     @property
     def movieNames(self):
         """Return movie names as a list of string."""
@@ -360,6 +435,31 @@ class BamCollection(object):
         """
         return self._header
 
+    @property
+    def zmwIndex(self):
+        """Return a ZmwRowIndex of all reads in dataset."""
+        if self._zmw_index is None:
+            index = self._dataset.index
+            self._zmw_index = ZmwRowIndex(index.qId, index.holeNumber)
+        return self._zmw_index
+
+    def _zmw_rows(self, zmw):
+        """Return rows of zmw <movie>/<holeNumber> in dataset index."""
+        try:
+            _movie, _hn = zmw.rstrip("/").split("/")[0:2]
+            return self.zmwIndex.rows(self._dataset.movieIds[_movie], int(_hn))
+        except (ValueError, KeyError):
+            return self.zmwIndex.order[0:0]
+
+    def _records_of_rows(self, rows):
+        """Return bam records of rows in dataset index, as a dict
+        {row: record}. Records are read in order of rows, which
+        is order of files and file offsets."""
+        rows = np.unique(rows)
+        if len(rows) == 0:
+            return {}
+        return dict((row, self._dataset[int(row)]) for row in rows)
+
     @property
     def isCCS(self):
         """Is CCS read set?"""
@@ -394,12 +494,11 @@ class BamCollection(object):
             ds2.filters.addRequirement(movie=[('==', _movie)])
             return ds2
 
-        _hn = int(indices[1])
-        # for efficiency: first select on hn, then movie name.
-        _reads = self._dataset[self._dataset.index.holeNumber == _hn]
-        _reads = [_read for _read in _reads if _read.movieName == _movie]
-        if len(_reads) == 0:
+        _rows = self._zmw_rows(key)
+        if len(_rows) == 0:
             raise KeyError("Could not find %s in %s" % (key, str(self._dataset)))
+        _records = self._records_of_rows(_rows)
+        _reads = [_records[_row] for _row in _rows]
 
         _zmw = BamZmw(bamRecords=_reads, isCCS=self.isCCS)
         if len(indices) == 2:
@@ -414,20 +513,91 @@ class BamCollection(object):
 
         raise KeyError("%s invalid slice: %s" % (self.__class__.__name__, key))
 
+    def fetch_zmws(self, zmws, ignore_missing=False):
+        """
+        Return an OrderedDict {zmw: BamZmw} of zmws <movie>/<holeNumber>,
+        in order of zmws. Records of all zmws are read in order of files
+        and file offsets.
+        """
+        zmw_to_rows = OrderedDict()
+        for zmw in zmws:
+            if zmw not in zmw_to_rows:
+                _rows = self._zmw_rows(zmw)
+                if len(_rows) == 0:
+                    if ignore_missing:
+                        continue
+                    raise KeyError("Could not find %s in %s" % (zmw, str(self._dataset)))
+                zmw_to_rows[zmw] = _rows
+
+        _records = self._records_of_rows(np.concatenate(zmw_to_rows.values())) \
+                   if len(zmw_to_rows) > 0 else {}
+        return OrderedDict((zmw, BamZmw(bamRecords=[_records[_row] for _row in _rows],
+                                        isCCS=self.isCCS))
+                           for zmw, _rows in zmw_to_rows.iteritems())
+
+    def _zmw_of_rows(self, rows):
+        """Return a BamZmw of records of rows in dataset index."""
+        return BamZmw(bamRecords=[self._dataset[int(row)] for row in rows],
+                      isCCS=self.isCCS)
+
+    def iterZmws(self, prefetch=False, prefetch_size=100):
+        """
+        Iterate over zmws as BamZmw objects, in order of (movie id, holeNumber).
+        Each zmw is visited once from one pass over the sorted zmw index.
+
+        If prefetch is True, records of up to prefetch_size next zmws are
+        read in a background thread while the current zmw is processed.
+        Do not randomly access this object while iterating with prefetch,
+        since bam readers are not thread safe.
+        """
+        if not prefetch:
+            for rows in self.zmwIndex.groups():
+                yield self._zmw_of_rows(rows)
+            return
+
+        queue = Queue.Queue(maxsize=max(1, prefetch_size))
+        stop = threading.Event()
+
+        def _put(item):
+            """Put an item to queue unless iteration stopped."""
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def _produce():
+            """Read zmws and put (zmw, None), then put (None, None) when
+            done, or (None, error) if an error occurs."""
+            try:
+                for rows in self.zmwIndex.groups():
+                    if not _put((self._zmw_of_rows(rows), None)):
+                        return
+                _put((None, None))
+            except Exception as e:
+                _put((None, e))
+
+        thread = threading.Thread(target=_produce)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                zmw, error = queue.get()
+                if error is not None:
+                    raise error
+                if zmw is None:
+                    break
+                yield zmw
+        finally:
+            stop.set()
+            thread.join()
+
     def __iter__(self):
         """Iterators over Zmw, ZmwRead objects.
         """
-        _qid_hns = np.unique(self._dataset.index[['qId', 'holeNumber']])
-        for _movie in self.movieNames:
-            ds2 = self._dataset.copy()
-            ds2.filters.addRequirement(movie=[('==', _movie)])
-            _movie_id = self._dataset.movieIds[_movie]
-            for (__movie_id, _hn) in _qid_hns:
-                if __movie_id == _movie_id:
-                    _reads = ds2[ds2.index.holeNumber == _hn]
-                    assert all([_read.movieName == _movie for _read in _reads])
-                    if len(_reads) > 0:
-                        yield BamZmw(bamRecords=_reads, isCCS=self.isCCS)
+        return self.iterZmws()
 
     def reads(self):
         """Iterate over all reads"""
@@ -460,7 +630,7 @@ class BamCollection(object):
 
     def __len__(self):
         """Return total number of zmws in all movies."""
-        return len(np.unique(self._dataset.index[['qId', 'holeNumber']]))
+        return self.zmwIndex.num_zmws
 
     def close(self):
         """Close all readers."""
@@ -653,6 +823,83 @@ class BamWriter(object):
         self.close()
 
 
+class AnnotatedBamWriter(BamWriter):
+    """
+    Write trimmed, unaligned ccs reads together with their classify
+    annotations as tags (see ANNOTATION_TAGS) to a bam file, and make
+    its pbi index when the bam file is closed.
+    """
+
+    def __init__(self, fname, header, make_index=True):
+        super(AnnotatedBamWriter, self).__init__(fname, header)
+        self.make_index = make_index
+
+    def writeRecord(self, annotation, sequence, qualities=None, tags=()):
+        """Write a read named after annotation.ID, with sequence,
+        qualities (e.g., an array of phred values) and tags, plus
+        tags of annotation."""
+        ret = pysam.AlignedSegment()
+        ret.query_name = annotation.ID
+        ret.query_sequence = sequence
+        ret.flag = 4
+        ret.reference_id = -1
+        ret.reference_start = -1
+        ret.mapping_quality = 255
+        if qualities is not None:
+            ret.query_qualities = qualities
+        ret.tags = list(tags) + \
+            [(tag, getattr(annotation, attr))
+             for attr, tag in ANNOTATION_TAGS.iteritems()
+             if getattr(annotation, attr) is not None]
+        self.peer.write(ret)
+
+    def close(self):
+        """Close bam file and make pbi index."""
+        super(AnnotatedBamWriter, self).close()
+        if self.make_index:
+            make_pbi(self.filename)
+
+
+def annotation_from_segment(segment, ignore_polyA=False):
+    """Return a ReadAnnotation saved in tags of a pysam.AlignedSegment
+    object written by AnnotatedBamWriter."""
+    tags = dict(segment.tags)
+    kwargs = dict({attr: tags[tag] for attr, tag in ANNOTATION_TAGS.iteritems()
+                   if tag in tags})
+    return ReadAnnotation(ID=segment.query_name, ignore_polyA=ignore_polyA,
+                          **kwargs)
+
+
+def carried_tags(segment):
+    """Return tags of a pysam.AlignedSegment object which are still valid
+    after its sequence has been trimmed, that is, all tags except per-base
+    QVs and classify annotations, e.g., RG, zm, np, rq."""
+    return [(tag, val) for (tag, val) in segment.tags
+            if tag not in PER_BASE_TAGS and
+            tag not in ANNOTATION_TAGS.values() and
+            tag not in ("qs", "qe")]
+
+
+def cat_bams(src, dst, make_index=True):
+    """Concatenate unaligned bam files in src and save to dst, headers of
+    all bam files are merged, finally make pbi index of dst."""
+    if src is None or len(src) == 0:
+        raise ValueError("src should contain at least one file.")
+    if dst in src:
+        raise IOError("Unable to cat a file and save to itself.")
+    readers = [pysam.AlignmentFile(fn, 'rb', check_sq=False) for fn in src]
+    header = BamHeader(ignore_pg=True)
+    for reader in readers:
+        header.add(reader.header)
+    with BamWriter(dst, header=header) as writer:
+        for reader in readers:
+            for record in reader:
+                writer.write(record)
+            reader.close()
+    if make_index:
+        make_pbi(dst)
+
+
 class CCSBamSequence(object):
     """
     Wrapper for a BAM record, used to substitute for a Fasta record.
@@ -660,6 +907,7 @@ class CCSBamSequence(object):
     def __init__(self, bam):
         self.name = bam.qname
         self.sequence = bam.seq
+        self.peer = bam
 
 
 class CCSInput(object):
@@ -690,6 +938,23 @@ class CCSInput(object):
                 rec = CCSBamSequence(rec.peer)
             yield rec
 
+    @property
+    def isBam(self):
+        """True if input ccs reads are in BAM files."""
+        return not self._is_fasta
+
+    @property
+    def header(self):
+        """Return a BamHeader object which combines headers of all input
+        BAM files."""
+        if self._is_fasta:
+            raise ValueError("%s is not a BAM or ConsensusReadSet file." %
+                             self.file_name)
+        header = BamHeader(ignore_pg=True)
+        for reader in self._dataset.resourceReaders():
+            header.add(reader.peer.header)
+        return header
+
     def close(self):
         """Close all datasets."""
         self._dataset.close()
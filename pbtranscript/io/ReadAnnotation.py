@@ -1,6 +1,9 @@
-"""Define Read Annotation class."""
+"""Define Read Annotation class and primer report writer."""
 
-__all__ = ["ReadAnnotation"]
+import gzip
+import shutil
+
+__all__ = ["ReadAnnotation", "PrimerReportWriter"]
 
 def xorNA(x):
     """Return x if x is not None, or return 'NA'."""
@@ -126,3 +129,64 @@ class ReadAnnotation(object):
         return str(self.ID) + " " + ";".join(
             [x + "=" + xorNA(y) for x, y in
              zip(self.fieldsNames(), self.fields())[1:]])
+
+
+class PrimerReportWriter(object):
+
+    """
+    Buffered writer of primer reports, e.g., *.primer_info.csv, which
+    keeps fields of read annotations column by column in memory and writes
+    every 'buffer_size' rows in one call. Output is gzip compressed if
+    file name ends with '.gz'.
+
+    Example:
+        with PrimerReportWriter("primer_info.csv") as writer:
+            writer.write(annotation)
+    """
+
+    def __init__(self, filename, delimiter=",", buffer_size=10000,
+                 write_header=True):
+        self.filename = filename
+        self.delimiter = delimiter
+        self.buffer_size = buffer_size
+        self.writer = gzip.open(filename, 'wb') if filename.endswith(".gz") \
+            else open(filename, 'w')
+        self.columns = [[] for _x in ReadAnnotation.fieldsNames()]
+        if write_header:
+            self.writer.write(ReadAnnotation.header(delimiter=delimiter) + "\n")
+
+    def __len__(self):
+        """Return number of buffered rows."""
+        return len(self.columns[0])
+
+    def write(self, annotation):
+        """Buffer a ReadAnnotation, flush if buffer is full."""
+        for column, field in zip(self.columns, annotation.fields()):
+            column.append(xorNA(field))
+        if len(self) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Write buffered rows."""
+        if len(self) > 0:
+            self.writer.write("".join([self.delimiter.join(row) + "\n"
+                                       for row in zip(*self.columns)]))
+            self.columns = [[] for _x in self.columns]
+
+    def append(self, filename):
+        """Flush, then copy rows of a primer report without header,
+        e.g., written by PrimerReportWriter(write_header=False), in blocks."""
+        self.flush()
+        with open(filename, 'r') as reader:
+            shutil.copyfileobj(reader, self.writer)
+
+    def close(self):
+        """Flush and close."""
+        self.flush()
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
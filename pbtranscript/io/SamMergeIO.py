@@ -0,0 +1,316 @@
+"""
+Merge SAM/BAM files by streaming records of all input files to one output.
+
+Headers of input files are reconciled into one header, see
+merge_sam_header_lines. If all input files are sorted by coordinate,
+records are k-way merged by (reference index in the merged header,
+position), so that the output is sorted as well; otherwise records are
+written file after file. At most max_open_files input files are open at
+the same time; sorted inputs beyond that are merged in batches to
+temporary files, which are then merged.
+
+Records of SAM files written to a SAM file are streamed as text lines,
+because SAM records refer to reference sequences by names. Otherwise
+records are read and written by pysam, while reference ids are mapped to
+the merged header. BAM output is compressed by multiple threads, and a
+sorted BAM output is indexed (.bai) as soon as it is written.
+"""
+
+import os
+import os.path as op
+import sys
+import heapq
+import logging
+import random
+from itertools import chain
+import pysam
+
+from pbtranscript.io.PbiBamIO import BamHeader
+
+__all__ = ["sam_header_lines",
+           "sam_header_dict",
+           "merge_sam_header_lines",
+           "merge_sam_files"]
+
+
+# Key of unmapped records, which are placed after mapped records.
+UNMAPPED = sys.maxint
+
+# Maximum number of input files which are open at the same time.
+MAX_OPEN_FILES = 256
+
+
+def is_bam_filename(filename):
+    """Return True if filename is a BAM file."""
+    return filename.lower().endswith(".bam")
+
+
+def sam_header_lines(filename):
+    """Return header lines of a SAM or BAM file in a list, without
+    line endings."""
+    if is_bam_filename(filename):
+        reader = pysam.AlignmentFile(filename, 'rb', check_sq=False)
+        text = reader.text
+        reader.close()
+        return [line for line in text.splitlines() if line.startswith('@')]
+    lines = []
+    with open(filename, 'r') as reader:
+        for line in reader:
+            if not line.startswith('@'):
+                break
+            lines.append(line.rstrip('\r\n'))
+    return lines
+
+
+def _tag(line, key):
+    """Return value of tag key of a header line, e.g., SN of a @SQ line,
+    or None if key does not exist."""
+    for field in line.split('\t')[1:]:
+        if field.startswith(key + ':'):
+            return field[len(key)+1:]
+    return None
+
+
+def _unique_m5(line, m5s_seen):
+    """Return a @SQ line, of which M5 checksum is replaced by a random
+    string if it has been seen."""
+    m5 = _tag(line, 'M5')
+    if m5 is None:
+        return line
+    if m5 in m5s_seen:
+        chars = list(m5)
+        while m5 in m5s_seen:
+            # create a random m5 string.
+            random.shuffle(chars)
+            m5 = "".join(chars)
+        logging.debug("MD5 conflict: change to {0}".format(m5))
+        line = "\t".join([field if not field.startswith('M5:') else 'M5:' + m5
+                          for field in line.split('\t')])
+    m5s_seen.add(m5)
+    return line
+
+
+def merge_sam_header_lines(headers, unique_m5=False, first_rg_pg=False):
+    """
+    Reconcile headers, each of which is a list of header lines, into one
+    and return its lines in a list. The merged header contains
+        @HD of the first header,
+        @SQ unique by SN, @RG and @PG unique by ID, unique @CO,
+    each type in the order lines are first seen.
+        unique_m5 --- if True, replace M5 checksum of a @SQ line which
+                      conflicts with M5 of another @SQ line by a random string
+        first_rg_pg --- if True, keep @RG and @PG lines of the first
+                        header only
+    Raise ValueError if a reference sequence appears with different lengths.
+    """
+    hd_line = None
+    types = ["@SQ", "@RG", "@PG", "@CO"]
+    groups = dict((t, []) for t in types)
+    ref_lens = {} # SN --> LN
+    keys_seen = set()
+    m5s_seen = set()
+    for k, lines in enumerate(headers):
+        for line in lines:
+            t = line[0:3]
+            if first_rg_pg and k > 0 and t in ("@RG", "@PG"):
+                continue
+            if t == "@HD":
+                hd_line = line if hd_line is None else hd_line
+            elif t == "@SQ":
+                name, length = _tag(line, 'SN'), _tag(line, 'LN')
+                if name in ref_lens:
+                    if ref_lens[name] != length:
+                        raise ValueError("Reference sequence %s has different lengths %s and %s." %
+                                         (name, ref_lens[name], length))
+                    continue
+                ref_lens[name] = length
+                groups[t].append(_unique_m5(line, m5s_seen) if unique_m5 else line)
+            else:
+                key = (t, _tag(line, 'ID')) if t in ("@RG", "@PG") else (t, line)
+                if key not in keys_seen:
+                    keys_seen.add(key)
+                    if t not in groups:
+                        groups[t] = []
+                        types.append(t)
+                    groups[t].append(line)
+    return ([] if hd_line is None else [hd_line]) + \
+           [line for t in types for line in groups[t]]
+
+
+def sam_header_dict(lines):
+    """Convert header lines to a header dict, which pysam accepts."""
+    header = {}
+    for line in lines:
+        t = line[1:3]
+        if t == "CO":
+            header.setdefault(t, []).append(line[4:])
+            continue
+        fields = dict(field.split(':', 1) for field in line.split('\t')[1:])
+        if 'LN' in fields:
+            fields['LN'] = int(fields['LN'])
+        if t == "HD":
+            header[t] = fields
+        else:
+            header.setdefault(t, []).append(fields)
+    return header
+
+
+def _is_coordinate_sorted(lines):
+    """Return True if header lines declare records sorted by coordinate."""
+    return any(line.startswith("@HD") and _tag(line, 'SO') == "coordinate"
+               for line in lines)
+
+
+def _ref_names(lines):
+    """Return names of reference sequences in header lines."""
+    return [_tag(line, 'SN') for line in lines if line.startswith("@SQ")]
+
+
+def _ref_index(header_lines, header_dict):
+    """Return {reference name: index} of the merged header."""
+    names = _ref_names(header_lines) if header_dict is None else \
+            [sq['SN'] for sq in header_dict.get('SQ', [])]
+    return dict((name, index) for index, name in enumerate(names))
+
+
+def _text_records(filename, ref_index, i):
+    """Yield (key, line) of records of a SAM file."""
+    with open(filename, 'r') as reader:
+        for n, line in enumerate(reader):
+            if line.startswith('@') or len(line.strip()) == 0:
+                continue
+            fields = line.split('\t', 4)
+            if not line.endswith('\n'):
+                line += '\n'
+            yield (ref_index.get(fields[2], UNMAPPED), int(fields[3]), i, n), line
+
+
+def _pysam_records(filename, tid_map, i):
+    """Yield (key, record) of records of a SAM or BAM file read by pysam,
+    of which reference ids are mapped by tid_map to the merged header.
+    The file is opened when the first record is requested."""
+    reader = pysam.AlignmentFile(filename, 'rb' if is_bam_filename(filename) else 'r',
+                                 check_sq=False)
+    try:
+        for n, r in enumerate(reader):
+            if r.tid >= 0:
+                r.tid = tid_map[r.tid]
+            if r.next_reference_id >= 0:
+                r.next_reference_id = tid_map[r.next_reference_id]
+            yield (r.tid if r.tid >= 0 else UNMAPPED, r.pos, i, n), r
+    finally:
+        reader.close()
+
+
+def _open_alignment_writer(filename, mode, header, threads):
+    """Open a pysam.AlignmentFile to write, compressing by threads."""
+    if threads > 1 and 'b' in mode:
+        try:
+            return pysam.AlignmentFile(filename, mode, header=header, threads=threads)
+        except TypeError: # pysam < 0.10 does not support threads
+            logging.debug("pysam does not support threads, compress %s by one thread.",
+                          filename)
+    return pysam.AlignmentFile(filename, mode, header=header)
+
+
+def _write_records(in_fns, tid_maps, ref_index, out_fn, header_lines,
+                   header_dict, is_sorted, threads, mode=None):
+    """Write records of in_fns to out_fn with a merged header, k-way merged
+    if is_sorted, otherwise file after file, which keeps one input open."""
+    merge = heapq.merge if is_sorted else chain
+    if header_dict is None and not is_bam_filename(out_fn) and \
+            not any(is_bam_filename(fn) for fn in in_fns):
+        with open(out_fn, 'w') as writer:
+            for line in header_lines:
+                writer.write(line + '\n')
+            for _key, line in merge(*[_text_records(fn, ref_index, i)
+                                      for i, fn in enumerate(in_fns)]):
+                writer.write(line)
+        return
+
+    if header_dict is None:
+        header_dict = sam_header_dict(header_lines)
+    if mode is None:
+        mode = 'wb' if is_bam_filename(out_fn) else 'wh'
+    writer = _open_alignment_writer(out_fn, mode, header_dict, threads)
+    try:
+        for _key, r in merge(*[_pysam_records(fn, tid_map, i)
+                               for i, (fn, tid_map) in enumerate(zip(in_fns, tid_maps))]):
+            writer.write(r)
+    finally:
+        writer.close()
+
+
+def merge_sam_files(in_fns, out_fn, header=None, unique_m5=False,
+                    threads=1, make_index=True, max_open_files=MAX_OPEN_FILES):
+    """
+    Merge SAM or BAM files in in_fns to out_fn, which is a BAM file if it
+    ends with .bam, otherwise a SAM file.
+        header --- header of out_fn, a list of header lines, a dict or a
+                   BamHeader, by default, headers of in_fns are reconciled
+                   by merge_sam_header_lines
+        unique_m5 --- see merge_sam_header_lines
+        threads --- number of threads to compress BAM output
+        make_index --- if True, index BAM output if it is sorted
+        max_open_files --- maximum number of input files open at the same time
+    Return True if records in out_fn are sorted by coordinate, otherwise False.
+    """
+    if in_fns is None or len(in_fns) == 0:
+        raise ValueError("No sam|bam input files to merge.")
+    if out_fn in in_fns:
+        raise IOError("Unable to merge a file and save to itself.")
+
+    in_headers = [sam_header_lines(fn) for fn in in_fns]
+    header_lines, header_dict = None, None
+    if header is None:
+        header_lines = merge_sam_header_lines(in_headers, unique_m5=unique_m5)
+    elif isinstance(header, BamHeader):
+        header_dict = header.header
+    elif isinstance(header, dict):
+        header_dict = header
+    else:
+        header_lines = list(header)
+
+    # Records are k-way merged only if all inputs are sorted and refer to
+    # reference sequences in the order of the merged header.
+    ref_index = _ref_index(header_lines, header_dict)
+    try:
+        tid_maps = [[ref_index[name] for name in _ref_names(lines)]
+                    for lines in in_headers]
+    except KeyError as e:
+        raise ValueError("Reference sequence %s is not in header of %s." % (e, out_fn))
+    is_sorted = all(_is_coordinate_sorted(lines) for lines in in_headers) and \
+                all(tid_map == sorted(tid_map) for tid_map in tid_maps)
+
+    # A k-way merge keeps all inputs open, so sorted inputs are merged in
+    # batches of max_open_files files to temporary files with the merged
+    # header, which are then merged.
+    max_open_files = max(2, max_open_files)
+    tmp_fns = []
+    try:
+        while is_sorted and len(in_fns) > max_open_files:
+            text = header_dict is None and not is_bam_filename(out_fn) and \
+                   not any(is_bam_filename(fn) for fn in in_fns)
+            identity = range(len(ref_index))
+            batch_fns = []
+            for k in xrange(0, len(in_fns), max_open_files):
+                batch_fn = "%s.%d.%d.tmp.%s" % (out_fn, os.getpid(), len(tmp_fns),
+                                               "sam" if text else "bam")
+                tmp_fns.append(batch_fn)
+                batch_fns.append(batch_fn)
+                # temporary BAM files are not compressed.
+                _write_records(in_fns[k:k+max_open_files], tid_maps[k:k+max_open_files],
+                               ref_index, batch_fn, header_lines, header_dict,
+                               is_sorted=True, threads=1, mode=None if text else 'wbu')
+            in_fns, tid_maps = batch_fns, [identity for _fn in batch_fns]
+
+        _write_records(in_fns, tid_maps, ref_index, out_fn, header_lines,
+                       header_dict, is_sorted, threads)
+    finally:
+        for fn in tmp_fns:
+            if op.exists(fn):
+                os.remove(fn)
+
+    if make_index and is_sorted and is_bam_filename(out_fn):
+        pysam.index(out_fn)
+    return is_sorted
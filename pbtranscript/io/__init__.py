@@ -2,11 +2,16 @@
 
 from .FastaRandomReader import *
 from .FastqRandomReader import *
+from .BgzfIO import *
+from .ContigSetCache import *
 from .FastaSplitter import *
+from .ClusterStateIO import *
+from .PartialUCIO import *
 from .DOMIO import *
 from .BLASRRecord import *
 from .ReadAnnotation import *
 from .PbiBamIO import *
+from .SamMergeIO import *
 from .LA4IceReader import *
 from .DazzIDHandler import DazzIDHandler
 from .ContigSetReaderWrapper import ContigSetReaderWrapper
@@ -8,8 +8,9 @@ import logging
 import os
 import os.path as op
 import sys
+from multiprocessing import Pool
 from cPickle import dump, load
-from collections import defaultdict
+from pbtranscript.io.ContigSetCache import contigset_external_files
 from pbtranscript.Utils import realpath, mkdir, as_contigset
 from pbtranscript.io.ContigSetReaderWrapper import ContigSetReaderWrapper
 
@@ -19,11 +20,156 @@ __author__ = "etseng@pacificbiosciences.com"
 __all__ = ["SeparateFLNCRunner"]
 
 
+# buffer size in bytes of each per-bin output fasta file handler
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+def primer_id_from_name(name):
+    """Return primer id in read name 'primer=<id>' as an int, or None."""
+    for x in name.split(';'):
+        if x.startswith('primer='):
+            return int(x.split('=')[1])
+    return None
+
+
+class ReadLengthHistogram(object):
+    """
+    Number of reads and bases of reads in each 1 kb read length bin and
+    of reads with each primer id, plus min and max read length.
+    """
+    def __init__(self):
+        self.kb_reads = {} # read length in kb --> number of reads
+        self.kb_bases = {} # read length in kb --> number of bases
+        self.primer_reads = {} # primer id --> number of reads
+        self.min_len = sys.maxint + 1
+        self.max_len = 0
+
+    def __len__(self):
+        """Return total number of reads."""
+        return sum(self.kb_reads.values())
+
+    def add(self, name, seqlen):
+        """Add a read of name and length seqlen."""
+        kb = seqlen/1000
+        self.kb_reads[kb] = self.kb_reads.get(kb, 0) + 1
+        self.kb_bases[kb] = self.kb_bases.get(kb, 0) + seqlen
+        p = primer_id_from_name(name)
+        self.primer_reads[p] = self.primer_reads.get(p, 0) + 1
+        self.min_len = min(self.min_len, seqlen)
+        self.max_len = max(self.max_len, seqlen)
+
+    def merge(self, other):
+        """Merge another histogram into this one, return self."""
+        for src, dst in [(other.kb_reads, self.kb_reads),
+                         (other.kb_bases, self.kb_bases),
+                         (other.primer_reads, self.primer_reads)]:
+            for k, v in src.iteritems():
+                dst[k] = dst.get(k, 0) + v
+        self.min_len = min(self.min_len, other.min_len)
+        self.max_len = max(self.max_len, other.max_len)
+        return self
+
+
+def fasta_chunk_offsets(fasta_fn, num_chunks):
+    """
+    Split fasta_fn into at most num_chunks byte ranges of similar size,
+    return a list of (start, end) byte offsets, each range starts at
+    a fasta record header.
+    """
+    size = op.getsize(fasta_fn)
+    offsets = [0]
+    with open(fasta_fn, 'r') as reader:
+        for i in range(1, max(1, num_chunks)):
+            pos = max(size * i / num_chunks, offsets[-1] + 1)
+            if pos >= size:
+                break
+            # move to the first line starting at or after pos
+            reader.seek(pos - 1)
+            reader.readline()
+            while True:
+                line_start = reader.tell()
+                line = reader.readline()
+                if not line:
+                    line_start = size
+                    break
+                if line.startswith('>'):
+                    break
+            if line_start >= size:
+                break
+            offsets.append(line_start)
+    offsets.append(size)
+    return [(offsets[i], offsets[i+1]) for i in range(0, len(offsets)-1)
+            if offsets[i] < offsets[i+1]]
+
+
+def scan_fasta_chunk(args):
+    """
+    args - (fasta_fn, start, end)
+    Scan fasta records within byte range [start, end) of fasta_fn,
+    and return a ReadLengthHistogram.
+    """
+    fasta_fn, start, end = args
+    hist = ReadLengthHistogram()
+    with open(fasta_fn, 'r') as reader:
+        reader.seek(start)
+        pos, name, seqlen = start, None, 0
+        while pos < end:
+            line = reader.readline()
+            if not line:
+                break
+            pos += len(line)
+            if line.startswith('>'):
+                if name is not None:
+                    hist.add(name, seqlen)
+                name, seqlen = line[1:].rstrip(), 0
+            else:
+                seqlen += len(line.strip())
+        if name is not None:
+            hist.add(name, seqlen)
+    return hist
+
+
+def scan_read_lengths(flnc_filename, cpus=1):
+    """
+    Return a ReadLengthHistogram of reads in flnc_filename.
+    If all reads are in FASTA files, each file is split into byte
+    range chunks which are scanned by cpus processes, otherwise,
+    reads are scanned one by one.
+    """
+    fasta_fns = contigset_external_files(flnc_filename)
+
+    if not all([ContigSetReaderWrapper.get_file_type(fn) == "FASTA"
+                for fn in fasta_fns]):
+        hist = ReadLengthHistogram()
+        for r in ContigSetReaderWrapper(flnc_filename):
+            hist.add(r.name, len(r.sequence))
+        return hist
+
+    tasks = []
+    for fn in fasta_fns:
+        tasks.extend([(fn, start, end) for start, end in
+                      fasta_chunk_offsets(fn, max(1, cpus) * 4)])
+    logging.info("Scanning %s reads in %s chunks using %s cpus.",
+                 flnc_filename, len(tasks), cpus)
+
+    if cpus > 1 and len(tasks) > 1:
+        pool = Pool(processes=min(cpus, len(tasks)))
+        try:
+            hists = pool.map(scan_fasta_chunk, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        hists = [scan_fasta_chunk(task) for task in tasks]
+    return reduce(lambda x, y: x.merge(y), hists, ReadLengthHistogram())
+
+
 class SeparateFLNCBase(object):
     """
     Base class to separate FLNC reads.
     """
-    def __init__(self, flnc_filename, root_dir, out_pickle, output_basename):
+    def __init__(self, flnc_filename, root_dir, out_pickle, output_basename,
+                 cpus=1):
         """
         Reads in input flnc file will be separated into multiple categories
         according to separation criterion, and reads in each category will
@@ -37,6 +183,10 @@ class SeparateFLNCBase(object):
           flnc_filename - input full length non-chimeric reads in FASTA or CONTIGSET
           root_dir - output root directory
           output_basename - output file basename
+          cpus - number of processes to scan input read lengths
+
+        Number of reads and bases written to each category are saved
+        to a manifest csv file next to out_pickle.
         """
         self.flnc_filename = flnc_filename
         self.root_dir = realpath(root_dir)
@@ -46,6 +196,12 @@ class SeparateFLNCBase(object):
         self.handles = {} # key --> fasta file handler
         self.out_pickle = out_pickle if out_pickle is not None \
                           else op.join(self.root_dir, "separate_flnc.pickle")
+        self.out_manifest = op.splitext(self.out_pickle)[0] + ".manifest.csv"
+        self.cpus = cpus
+        self.num_reads = {} # key --> number of reads written
+        self.num_bases = {} # key --> number of bases written
+        # read length histogram of input, scanned once in parallel
+        self.histogram = scan_read_lengths(flnc_filename, cpus=cpus)
 
     def __enter__(self):
         # make a sub dir for each separation criteria
@@ -54,7 +210,10 @@ class SeparateFLNCBase(object):
 
         # open all fasta file handlers
         for index, key in enumerate(self.sorted_keys):
-            self.handles[key] = open(self.out_fasta_files[index], 'w')
+            self.handles[key] = open(self.out_fasta_files[index], 'w',
+                                     WRITE_BUFFER_SIZE)
+            self.num_reads[key] = 0
+            self.num_bases[key] = 0
 
         return self
 
@@ -71,8 +230,9 @@ class SeparateFLNCBase(object):
             for fasta_fn, xml_fn in zip(self.out_fasta_files, self.out_contigset_files):
                 as_contigset(fasta_fn, xml_fn)
 
-        # write out_pickle
+        # write out_pickle and out_manifest
         self.write_pickle()
+        self.write_manifest()
 
     def __len__(self):
         """Return total number of separation criterion."""
@@ -126,6 +286,13 @@ class SeparateFLNCBase(object):
         """Separate reads and write to out_fasta_files."""
         raise NotImplementedError("%s.run" % self.__class__.__name__)
 
+    def write_read(self, key, r):
+        """Write read r to output fasta of key."""
+        seq = r.sequence[:]
+        self.handles[key].write(">{0}\n{1}\n".format(r.name, seq))
+        self.num_reads[key] += 1
+        self.num_bases[key] += len(seq)
+
     def write_pickle(self):
         """Write output pickle with {sorted_key: out_contigset|fasta_files}
         """
@@ -138,9 +305,37 @@ class SeparateFLNCBase(object):
                     d['key_to_file'][key] = self.out_fasta_files[index]
                 else:
                     d['key_to_file'][key] = self.out_contigset_files[index]
+        d['manifest'] = self.out_manifest
         with open(self.out_pickle, 'wb') as writer:
             dump(d, writer)
 
+    def write_manifest(self):
+        """Write number of reads and bases of each separation criteria
+        to out_manifest, e.g.,
+            criteria,num_reads,num_bases,file
+            0to1kb_part0,100,72345,<root_dir>/0to1kb_part0/isoseq_flnc.fasta
+        """
+        out_files = self.out_contigset_files if self.create_contigset \
+                    else self.out_fasta_files
+        with open(self.out_manifest, 'w') as writer:
+            writer.write("criteria,num_reads,num_bases,file\n")
+            for index, key in enumerate(self.sorted_keys):
+                writer.write("{c},{r},{b},{f}\n".format(
+                    c=self.separation_criteria(key),
+                    r=self.num_reads.get(key, 0), b=self.num_bases.get(key, 0),
+                    f=out_files[index]))
+
+    @staticmethod
+    def read_manifest(in_manifest):
+        """Return a list of (criteria, num_reads, num_bases, file) tuples
+        read from a manifest csv file."""
+        ret = []
+        with open(in_manifest, 'r') as reader:
+            for line in reader.readlines()[1:]:
+                c, r, b, f = line.rstrip('\n').split(',', 3)
+                ret.append((c, int(r), int(b), f))
+        return ret
+
     @staticmethod
     def convert_pickle_to_sorted_flnc_files(in_pickle):
         """Read from in_pickle and convert to sorted flnc files.
@@ -165,19 +360,20 @@ class SeparateFLNCByPrimer(SeparateFLNCBase):
     ex: make <root_dir>/primer0/isoseq_flnc.fasta|contigset.xml
     """
     def __init__(self, flnc_filename, root_dir, out_pickle=None,
-                 output_basename="isoseq_flnc"):
+                 output_basename="isoseq_flnc", cpus=1):
         super(SeparateFLNCByPrimer, self).__init__(flnc_filename=flnc_filename,
                                                    root_dir=root_dir,
                                                    out_pickle=out_pickle,
-                                                   output_basename=output_basename)
+                                                   output_basename=output_basename,
+                                                   cpus=cpus)
 
         self.primer_ids = self.get_primer_ids()
 
     def _get_primer_id(self, r):
         """Given a read, return its primer id as an int."""
-        for x in r.name.split(';'):
-            if x.startswith('primer='):
-                return int(x.split('=')[1])
+        p = primer_id_from_name(r.name)
+        if p is not None:
+            return p
 
         raise ValueError("Unable to find primer information " +
                          "from sequence ID for {n} in {f}! Abort!"
@@ -185,12 +381,12 @@ class SeparateFLNCByPrimer(SeparateFLNCBase):
 
     def get_primer_ids(self):
         """Return primer ids seen in input FLNC file."""
-        primer_ids = set()
-        for r in ContigSetReaderWrapper(self.flnc_filename):
-            primer_ids.add(self._get_primer_id(r))
-
-        primer_ids = sorted(list(primer_ids))
-        return primer_ids
+        if None in self.histogram.primer_reads:
+            raise ValueError("Unable to find primer information " +
+                             "from sequence IDs of {n} reads in {f}! Abort!"
+                             .format(n=self.histogram.primer_reads[None],
+                                     f=self.flnc_filename))
+        return sorted(self.histogram.primer_reads.keys())
 
     @property
     def sorted_keys(self):
@@ -205,8 +401,7 @@ class SeparateFLNCByPrimer(SeparateFLNCBase):
         """Run"""
         # separate reads and write
         for r in ContigSetReaderWrapper(self.flnc_filename):
-            p = self._get_primer_id(r)
-            self.handles[p].write(">{0}\n{1}\n".format(r.name, r.sequence[:]))
+            self.write_read(self._get_primer_id(r), r)
 
         assert all([os.stat(x).st_size > 0 for x in self.out_dirs])
 
@@ -310,12 +505,13 @@ class SeparateFLNCBySize(SeparateFLNCBase):
     """
     def __init__(self, flnc_filename, root_dir, out_pickle=None,
                  output_basename="isoseq_flnc", bin_size_kb=1,
-                 bin_manual=None, max_base_limit_MB=600):
+                 bin_manual=None, max_base_limit_MB=600, cpus=1):
         """
         Parameters:
           bin_size_kb - size bins are "0to1K", "1to2K", ..., "{n}to{n+1}K"
           bin_manual - manually sepcificied size bin
           max_base_limit_MB - maximum number of bases in Mb in each bin.
+          cpus - number of processes to scan input read lengths
 
           If <bin_manual> (ex: (0, 2, 4, 12)) is given, <bin_size_kb> is ignored.
 
@@ -325,7 +521,8 @@ class SeparateFLNCBySize(SeparateFLNCBase):
         super(SeparateFLNCBySize, self).__init__(flnc_filename=flnc_filename,
                                                  root_dir=root_dir,
                                                  out_pickle=out_pickle,
-                                                 output_basename=output_basename)
+                                                 output_basename=output_basename,
+                                                 cpus=cpus)
         # a dictionary mapping a SizeBin to number of parts in the SizeBin
         # {SizeBin(lb, ub): num_parts in SizeBin(lb, ub)}
         self.size_bins_parts = self.get_size_bins_parts(bin_size_kb=bin_size_kb,
@@ -336,16 +533,12 @@ class SeparateFLNCBySize(SeparateFLNCBase):
         """
         return a dict {SizeBin: number of parts in this SizeBin}
         """
-        # first check min - max size range
-        min_size = sys.maxint + 1
-        max_size = 0
-        base_in_each_size = defaultdict(lambda: 0) # SizeBin --> number of bases
-        for r in ContigSetReaderWrapper(self.flnc_filename):
-            seqlen = len(r.sequence)
-            min_size = min(min_size, seqlen)
-            max_size = max(max_size, seqlen)
-            b = SizeBin(seqlen/1000, seqlen/1000+1)
-            base_in_each_size[b] += len(r.sequence)
+        # first check min - max size range from read length histogram
+        min_size = self.histogram.min_len
+        max_size = self.histogram.max_len
+        # SizeBin --> number of bases
+        base_in_each_size = [(SizeBin(kb, kb+1), num_bases) for kb, num_bases
+                             in self.histogram.kb_bases.iteritems()]
 
         min_size_kb = min_size/1000
         max_size_kb = max_size/1000 + (1 if max_size%1000 != 0 else 0)
@@ -369,7 +562,7 @@ class SeparateFLNCBySize(SeparateFLNCBase):
         size_bins_bases = dict({b:0 for b in size_bins}) # SizeBin -> total n of bases in it
         size_bins_parts = dict({b:0 for b in size_bins}) # SizeBin -> total n of partitions in it
         if max_base_limit_MB is not None:
-            for _b, num_bases in base_in_each_size.iteritems():
+            for _b, num_bases in base_in_each_size:
                 b = size_bins.which_bin_contains(_b)
                 size_bins_bases[b] += num_bases
 
@@ -408,19 +601,25 @@ class SeparateFLNCBySize(SeparateFLNCBase):
 
     def run(self):
         """Run"""
-        read_counter_in_each_bin = dict({b:0 for b in self.size_bins})
+        size_bins = self.size_bins
+        read_counter_in_each_bin = dict({b:0 for b in size_bins})
+        kb_to_bin = dict() # read length in kb --> SizeBin
 
         for r in ContigSetReaderWrapper(self.flnc_filename):
-            b = self.size_bins.which_bin_contains(len(r.sequence))
+            kb = len(r.sequence)/1000
+            if kb not in kb_to_bin:
+                kb_to_bin[kb] = size_bins.which_bin_contains(len(r.sequence))
+            b = kb_to_bin[kb]
             p = read_counter_in_each_bin[b] % self.size_bins_parts[b]
             read_counter_in_each_bin[b] += 1
-            self.handles[(b, p)].write(">{0}\n{1}\n".format(r.name, r.sequence[:]))
+            self.write_read((b, p), r)
 
 
 class SeparateFLNCRunner(object):
     """Runner to either bin by primer, by manual or by size kb."""
     def __init__(self, flnc_fa, root_dir, out_pickle,
-                 bin_size_kb, bin_by_primer, bin_manual, max_base_limit_MB):
+                 bin_size_kb, bin_by_primer, bin_manual, max_base_limit_MB,
+                 cpus=1):
         self.flnc_fa = flnc_fa
         self.root_dir = root_dir
         self.out_pickle = out_pickle
@@ -428,6 +627,7 @@ class SeparateFLNCRunner(object):
         self.bin_by_primer = bool(bin_by_primer)
         self.bin_manual = bin_manual
         self.max_base_limit_MB = int(max_base_limit_MB)
+        self.cpus = int(cpus)
 
     def run(self):
         """Run"""
@@ -435,7 +635,8 @@ class SeparateFLNCRunner(object):
             logging.warning("Separate FLNC reads by primers, overwrite bin_manual and bin_size_kb.")
             with SeparateFLNCByPrimer(flnc_filename=self.flnc_fa,
                                       root_dir=self.root_dir,
-                                      out_pickle=self.out_pickle) as obj:
+                                      out_pickle=self.out_pickle,
+                                      cpus=self.cpus) as obj:
                 obj.run()
         else:
             bin_manual = None
@@ -449,6 +650,7 @@ class SeparateFLNCRunner(object):
                                     bin_size_kb=self.bin_size_kb,
                                     bin_manual=bin_manual,
                                     max_base_limit_MB=self.max_base_limit_MB,
-                                    out_pickle=self.out_pickle) as obj:
+                                    out_pickle=self.out_pickle,
+                                    cpus=self.cpus) as obj:
                 obj.run()
         return 0
@@ -153,7 +153,8 @@ def resolved_tool_contract_runner(rtc):
                               combined_lq_fa=combined_files.all_lq_fa,
                               combined_lq_fq=combined_files.all_lq_fq,
                               hq_lq_prefix_dict_pickle=combined_files.hq_lq_prefix_dict_pickle,
-                              sample_name=sample_name)
+                              sample_name=sample_name,
+                              nproc=rtc.task.nproc)
 
     ln(combined_files.all_hq_fa, out_hq_fa) #'HQ isoforms'
     ln(combined_files.all_hq_fq, out_hq_fq) #'HQ isoforms'
@@ -168,7 +169,8 @@ def resolved_tool_contract_runner(rtc):
     combine_consensus_isoforms(split_indices=cluster_bin_indices,
                                split_files=split_consensus_isoforms,
                                combined_consensus_isoforms_fa=combined_files.all_consensus_isoforms_fa,
-                               sample_name=sample_name)
+                               sample_name=sample_name,
+                               nproc=rtc.task.nproc)
     ln(combined_files.all_consensus_isoforms_fa, out_consensus_isoforms_fa)
     #consensus isoforms
     as_contigset(out_consensus_isoforms_fa, out_consensus_isoforms_cs)
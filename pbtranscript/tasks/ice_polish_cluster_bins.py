@@ -67,7 +67,8 @@ class IceQuiverRTC(IceQuiver):
                 max_sge_jobs=0,
                 blasr_nproc=nproc,
                 quiver_nproc=nproc),
-            prog_name="IceQuiver")
+            prog_name="IceQuiver",
+            local_cpus=nproc)
 
     def cluster_dir(self, cid):
         """"overwrite IceQuiver.cluster_dir"""
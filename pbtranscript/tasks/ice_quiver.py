@@ -48,7 +48,8 @@ class IceQuiverRTC(IceQuiver):
                 max_sge_jobs=0,
                 blasr_nproc=nproc,
                 quiver_nproc=nproc),
-            prog_name="IceQuiver")
+            prog_name="IceQuiver",
+            local_cpus=nproc)
 
     def cluster_dir(self, cid):
         dir_name = IceQuiver.cluster_dir(self, cid)
@@ -79,6 +79,10 @@ def add_separate_flnc_arguments(arg_parser):
 
     sepa_group.add_argument("--max_base_limit_MB", default=Constants.MAX_BASE_LIMIT_MB_DEFAULT,
                             type=int, help=Constants.MAX_BASE_LIMIT_MB_DESC)
+
+    sepa_group.add_argument("--cpus", default=1, type=int,
+                            help="Number of processes to scan input read lengths " +
+                                 "(default: 1)")
     return arg_parser
 
 
@@ -100,7 +104,8 @@ def args_runner(args):
     """Run given input args"""
     s = SeparateFLNCRunner(flnc_fa=args.flnc_fa, root_dir=args.root_dir, out_pickle=args.out_pickle,
                            bin_size_kb=args.bin_size_kb, bin_by_primer=args.bin_by_primer,
-                           bin_manual=args.bin_manual, max_base_limit_MB=args.max_base_limit_MB)
+                           bin_manual=args.bin_manual, max_base_limit_MB=args.max_base_limit_MB,
+                           cpus=args.cpus)
     s.run()
 
 
@@ -151,7 +156,8 @@ def resolved_tool_contract_runner(rtc):
     s = SeparateFLNCRunner(flnc_fa=flnc_fa, root_dir=root_dir, out_pickle=out_pickle,
                            bin_size_kb=bin_size_kb, bin_by_primer=bin_by_primer,
                            bin_manual=bin_manual,
-                           max_base_limit_MB=Constants.MAX_BASE_LIMIT_MB_DEFAULT)
+                           max_base_limit_MB=Constants.MAX_BASE_LIMIT_MB_DEFAULT,
+                           cpus=rtc.task.nproc)
     s.run()
     return 0
 
@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+"""
+Benchmark alternative implementations of pbtranscript steps on the same
+input, reporting wall time and bytes written of each implementation.
+
+e.g.,
+    python -m pbtranscript.testkit.benchmark classify ccs.bam out_dir
+"""
+
+import argparse
+import logging
+import os
+import os.path as op
+import random
+import sys
+import time
+
+from pbtranscript.Utils import mknewdir
+
+
+def timed(func, *args, **kwargs):
+    """Call func(*args, **kwargs), return (wall time in seconds, result)."""
+    start = time.time()
+    ret = func(*args, **kwargs)
+    return (time.time() - start, ret)
+
+
+def dir_size(path):
+    """Return total number of bytes of files under path, symbolic links
+    are not followed."""
+    n = 0
+    for root, _dirs, files in os.walk(path):
+        for fn in files:
+            if not op.islink(op.join(root, fn)):
+                n += op.getsize(op.join(root, fn))
+    return n
+
+
+def report(name, seconds, nbytes=None, writer=sys.stdout):
+    """Write a line of benchmark result."""
+    writer.write("{n}\t{s:.3f}s\t{b}\n".format(
+        n=name, s=seconds, b="NA" if nbytes is None else "%d bytes" % nbytes))
+
+
+def bench_classify(args):
+    """Classify ccs reads to FASTA outputs (current route) and to BAM
+    outputs (BAM-native route), compare wall time and bytes written."""
+    from pbtranscript.Classifier import Classifier
+    for route, ext in [("fasta", ".fasta"), ("bam", ".bam")]:
+        out_dir = op.join(args.out_dir, "classify_" + route)
+        mknewdir(out_dir)
+        obj = Classifier(reads_fn=args.ccs, out_dir=out_dir,
+                         out_reads_fn=op.join(out_dir, "isoseq_draft" + ext),
+                         out_flnc_fn=op.join(out_dir, "isoseq_flnc" + ext),
+                         out_nfl_fn=op.join(out_dir, "isoseq_nfl" + ext),
+                         cpus=args.cpus, ignore_empty_output=True)
+        seconds, _ret = timed(obj.run)
+        report("classify_" + route, seconds, dir_size(out_dir))
+
+
+def bench_fasta_random_reader(args):
+    """Index a FASTA file with FastaRandomReader without .fai, with a newly
+    built .fai and with an existing .fai, then fetch random reads, report
+    wall time of indexing and average latency of 1000 fetches."""
+    from pbtranscript.io.FastaRandomReader import FastaRandomReader
+    seconds, reader = timed(FastaRandomReader, args.fasta, persist_index=False)
+    report("index_in_memory", seconds)
+    seconds, reader = timed(FastaRandomReader, args.fasta)
+    report("index_load_or_save_fai", seconds)
+    seconds, reader = timed(FastaRandomReader, args.fasta)
+    report("index_load_fai", seconds)
+
+    random.seed(args.seed)
+    keys = reader.keys()
+    keys = [random.choice(keys) for _i in xrange(args.num_fetches)]
+    seconds, _ret = timed(lambda: [reader[k] for k in keys])
+    report("random_fetch_per_1000_reads", seconds * 1000 / max(1, len(keys)))
+
+
+def drop_page_cache():
+    """Write dirty pages and drop the page cache of Linux, so that files
+    are read from disk again. Return False if not permitted."""
+    try:
+        os.system("sync")
+        with open("/proc/sys/vm/drop_caches", 'w') as writer:
+            writer.write("3\n")
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def bench_trim_subreads(args):
+    """Extract subreads of random zmws into cluster files one zmw at a time
+    (previous route) and in batch sorted by file offsets (current route),
+    report wall time of reading subreads from the device where the input
+    files are, e.g., a local spinning disk or NFS.
+    With --drop_caches, the page cache is dropped before each route (needs
+    root), otherwise subreads read by one route may be cached for the next."""
+    import itertools
+    from collections import OrderedDict
+    from pbcore.io import FastaWriter
+    from pbtranscript.Utils import guess_file_format, FILE_FORMATS, \
+        get_files_from_file_or_fofn
+    from pbtranscript.io import BamCollection, BamWriter, MetaSubreadFastaReader
+    from pbtranscript.ice.IceUtils import trim_subreads_and_write_in_batch, \
+        write_trimmed_subreads, zmws_of_seqids
+
+    bam = guess_file_format(args.subreads) == FILE_FORMATS.BAM
+    def _reader():
+        """Return a new reader of subreads."""
+        return BamCollection(args.subreads) if bam else \
+               MetaSubreadFastaReader(get_files_from_file_or_fofn(args.subreads))
+
+    reader = _reader()
+    if bam:
+        zmws = [zmw.zmwName for zmw in itertools.islice(reader, args.num_zmws * 10)]
+    else:
+        zmws = zmws_of_seqids(sorted(itertools.chain(*[r.keys() for r in reader.meta_f.values()])))
+    random.seed(args.seed)
+    zmws = random.sample(zmws, min(args.num_zmws, len(zmws)))
+
+    mknewdir(args.out_dir)
+    ext = ".bam" if bam else ".fasta"
+    out_file_to_seqids = OrderedDict(
+        (op.join(args.out_dir, "c%d%s" % (i, ext)), zmws[i:i+args.zmws_per_cluster])
+        for i in xrange(0, len(zmws), args.zmws_per_cluster))
+
+    def _one_by_one(reader):
+        """Previous route, fetch and write subreads zmw by zmw."""
+        for out_file, seqids in out_file_to_seqids.iteritems():
+            f = BamWriter(out_file, reader.header) if bam else FastaWriter(out_file)
+            for zmw in zmws_of_seqids(seqids):
+                write_trimmed_subreads(f, reader[zmw], args.trim_len, 0, bam)
+            f.close()
+
+    def _batch(reader):
+        """Current route, fetch subreads of all zmws in file offset order."""
+        trim_subreads_and_write_in_batch(reader=reader,
+                                         out_file_to_seqids=out_file_to_seqids,
+                                         trim_len=args.trim_len, min_len=0, bam=bam)
+
+    for repeat in xrange(args.repeats):
+        for name, func in [("one_by_one", _one_by_one), ("batch", _batch)]:
+            if args.drop_caches and not drop_page_cache():
+                logging.warning("Could not drop page cache, files may be cached.")
+            reader = _reader()
+            seconds, _ret = timed(func, reader)
+            report("%s_repeat_%d" % (name, repeat), seconds, dir_size(args.out_dir))
+
+
+def bench_bgzf(args):
+    """Compress a FASTA/FASTQ file with bgzip, then compare disk usage,
+    sequential scan time (by 1 and --threads threads) and average latency
+    of 1000 random fetches of the plain and the bgzip compressed file."""
+    import shutil
+    from pbtranscript.io import BgzfWriter, ContigSetReaderWrapper, \
+        FastaRandomReader, FastqRandomReader
+    mknewdir(args.out_dir)
+    plain_fn = op.join(args.out_dir, op.basename(args.fastx))
+    bgzf_fn = plain_fn + ".gz"
+    shutil.copy(args.fastx, plain_fn)
+
+    def _compress():
+        """Compress plain_fn to bgzf_fn."""
+        with open(plain_fn, 'rb') as reader, BgzfWriter(bgzf_fn) as writer:
+            for data in iter(lambda: reader.read(1 << 20), ''):
+                writer.write(data)
+    seconds, _ret = timed(_compress)
+    report("bgzip_compress", seconds, op.getsize(bgzf_fn))
+    report("plain_size", 0, op.getsize(plain_fn))
+
+    def _scan(fn, threads):
+        """Read all records of fn, return number of records."""
+        with ContigSetReaderWrapper(fn, threads=threads) as reader:
+            return sum(1 for _r in reader)
+    for name, fn, threads in [("plain", plain_fn, 1), ("bgzf", bgzf_fn, 1),
+                              ("bgzf", bgzf_fn, args.threads)]:
+        seconds, _ret = timed(_scan, fn, threads)
+        report("scan_%s_%d_threads" % (name, threads), seconds, op.getsize(fn))
+
+    is_fq = ContigSetReaderWrapper.get_file_type(plain_fn) == "FASTQ"
+    random.seed(args.seed)
+    for name, fn in [("plain", plain_fn), ("bgzf", bgzf_fn)]:
+        seconds, reader = timed(FastqRandomReader if is_fq else FastaRandomReader, fn)
+        report("index_%s" % name, seconds)
+        keys = reader.keys()
+        keys = [random.choice(keys) for _i in xrange(args.num_fetches)]
+        seconds, _ret = timed(lambda: [reader[k] for k in keys])
+        report("random_fetch_%s_per_1000_reads" % name,
+               seconds * 1000 / max(1, len(keys)))
+        reader.close()
+
+
+def bench_contigset(args):
+    """Split a FASTA file into --num_files files and a ContigSet xml, then
+    compare wall time of reading read names and lengths, checking ids and
+    consolidating the xml by iterating over records (old route) and by
+    .fai indices and copying files (new route)."""
+    from pbcore.io import ContigSet, FastaReader, FastaWriter
+    from pbtranscript.io import ContigSetReaderWrapper, clear_contigset_cache
+    mknewdir(args.out_dir)
+    fns = [op.join(args.out_dir, "part%d.fasta" % i) for i in xrange(args.num_files)]
+    writers = [FastaWriter(fn) for fn in fns]
+    for i, r in enumerate(FastaReader(args.fasta)):
+        writers[i % len(writers)].writeRecord(r)
+    for writer in writers:
+        writer.close()
+    xml_fn = op.join(args.out_dir, "contigset.xml")
+    ContigSet(*fns).write(xml_fn)
+
+    def _old_name_to_len_dict():
+        """Read names and lengths by iterating over records."""
+        with ContigSetReaderWrapper(xml_fn) as reader:
+            return dict({r.name.split()[0]: len(r.sequence[:]) for r in reader})
+
+    def _old_consolidate():
+        """Consolidate after reading the first record, which iterates over records."""
+        with ContigSetReaderWrapper(xml_fn) as reader:
+            reader.next()
+            return reader.consolidate(op.join(args.out_dir, "old_consolidated"))
+
+    def _new_consolidate():
+        """Consolidate by copying files."""
+        with ContigSetReaderWrapper(xml_fn) as reader:
+            return reader.consolidate(op.join(args.out_dir, "new_consolidated"))
+
+    for repeat in xrange(args.repeats):
+        clear_contigset_cache()
+        for name, func in [("old_name_to_len_dict", _old_name_to_len_dict),
+                           ("new_name_to_len_dict",
+                            lambda: ContigSetReaderWrapper.name_to_len_dict(xml_fn)),
+                           ("new_check_ids_unique",
+                            lambda: ContigSetReaderWrapper.check_ids_unique(xml_fn)),
+                           ("old_consolidate", _old_consolidate),
+                           ("new_consolidate", _new_consolidate)]:
+            seconds, _ret = timed(func)
+            report("%s_repeat_%d" % (name, repeat), seconds)
+
+
+def bench_quiver_bin(args):
+    """Align subreads of the first --num_clusters clusters of a finished
+    ICE run to their consensus sequences in bins of --bin_size clusters,
+    by one blasr call per cluster (previous route) and by one blasr call
+    per bin (current route), report wall time and clusters per minute.
+    Outputs are written to out_dir, not to the cluster root dir."""
+    from pbtranscript.ClusterOptions import SgeOptions
+    from pbtranscript.io import BamCollection
+    from pbtranscript.ice.IceQuiver import IceQuiver
+
+    class _IceQuiver(IceQuiver):
+        """IceQuiver writing quivered files to out_dir."""
+        @property
+        def quivered_dir(self):
+            """Return $out_dir/quivered"""
+            return op.join(args.out_dir, "quivered")
+
+    mknewdir(args.out_dir)
+    sge_opts = SgeOptions(unique_id=0, blasr_nproc=args.blasr_nproc)
+    obj = _IceQuiver(root_dir=args.root_dir, bas_fofn=args.subreads,
+                     fasta_fofn=None, sge_opts=sge_opts,
+                     tmp_dir=op.join(args.out_dir, "tmp"))
+    mknewdir(obj.quivered_dir)
+    uc, partial_uc, refs = obj.load_pickles()
+    d = BamCollection(args.subreads)
+    keys = sorted(uc)[:args.num_clusters]
+    refs = {cid: op.join(obj.cluster_dir(cid), op.basename(refs[cid])) for cid in keys}
+    obj.reconstruct_ref_fa_for_clusters_in_bin(cids=keys, refs=refs)
+    bins = [keys[i:i+args.bin_size] for i in xrange(0, len(keys), args.bin_size)]
+
+    def _per_cluster():
+        """Previous route, one blasr call per cluster."""
+        for cids in bins:
+            obj.create_raw_files_for_clusters_in_bin(cids=cids, d=d, uc=uc,
+                                                     partial_uc=partial_uc, bam=True)
+            obj.create_sams_for_clusters_in_bin(cids=cids, refs=refs, bam=True)
+            obj.concat_valid_sams_and_refs_for_bin(cids=cids, refs=refs, bam=True)
+
+    def _per_bin():
+        """Current route, one blasr call per bin."""
+        for cids in bins:
+            obj.align_clusters_in_bin(cids=cids, d=d, uc=uc,
+                                      partial_uc=partial_uc, refs=refs)
+
+    for name, func in [("blasr_per_cluster", _per_cluster),
+                       ("blasr_per_bin", _per_bin)]:
+        seconds, _ret = timed(func)
+        report(name, seconds, dir_size(obj.quivered_dir))
+        sys.stdout.write("{n}\t{c:.1f} clusters/min\n".format(
+            n=name, c=len(keys) * 60.0 / max(seconds, 1e-6)))
+
+
+def _write_synthetic_loci(args, isoform_fn, sam_fn):
+    """Write isoforms of --num_loci synthetic loci to isoform_fn, and their
+    alignments to a synthetic genome to a SORTED GMAP SAM file sam_fn.
+    Isoforms of a locus skip random inner exons and start from random exons."""
+    random.seed(args.seed)
+    num_chroms = max(1, args.num_loci / args.loci_per_chrom)
+    chrom_len = args.loci_per_chrom * args.locus_span
+    with open(isoform_fn, 'w') as fa_writer, open(sam_fn, 'w') as sam_writer:
+        sam_writer.write("@HD\tVN:1.5\tSO:coordinate\n")
+        for c in xrange(num_chroms):
+            sam_writer.write("@SQ\tSN:chr%d\tLN:%d\n" % (c, chrom_len))
+        for locus in xrange(args.num_loci):
+            chrom = "chr%d" % (locus / args.loci_per_chrom)
+            start = (locus % args.loci_per_chrom) * args.locus_span + 1
+            exons, pos = [], start
+            for _i in xrange(random.randint(2, 8)):
+                length = random.randint(100, 300)
+                exons.append((pos, pos + length))
+                pos += length + random.randint(200, 1500)
+            strand = random.choice('+-')
+            records = []
+            for k in xrange(args.isoforms_per_locus):
+                chain = [e for i, e in enumerate(exons)
+                         if i in (0, len(exons) - 1) or random.random() > 0.2]
+                chain = chain[random.randint(0, len(chain) - 2):]
+                cigar = "".join("%dM%dN" % (e[1] - e[0], chain[i+1][0] - e[1])
+                                for i, e in enumerate(chain[:-1]))
+                cigar += "%dM" % (chain[-1][1] - chain[-1][0])
+                seqlen = sum(e[1] - e[0] for e in chain)
+                name = "i%d_%d/f%dp0/%d" % (locus, k, random.randint(1, 10), seqlen)
+                fa_writer.write(">%s\n%s\n" % (name, "A" * seqlen))
+                records.append((chain[0][0], "\t".join([
+                    name, "0" if strand == '+' else "16", chrom, str(chain[0][0]),
+                    "60", cigar, "*", "0", "0", "A" * seqlen, "*",
+                    "XS:A:" + strand, "NM:i:0"]) + "\n"))
+            for _pos, line in sorted(records):
+                sam_writer.write(line)
+
+
+def bench_collapse(args):
+    """Collapse isoforms of --num_loci synthetic loci with Branch using each
+    of --nproc processes, report wall time, loci per second, and whether
+    outputs are identical to outputs of a single process."""
+    import filecmp
+    from pbtranscript.collapsing.CollapseIsoforms import Branch
+    mknewdir(args.out_dir)
+    isoform_fn = op.join(args.out_dir, "isoforms.fasta")
+    sam_fn = op.join(args.out_dir, "isoforms.sorted.sam")
+    seconds, _ret = timed(_write_synthetic_loci, args, isoform_fn, sam_fn)
+    report("write_synthetic_loci", seconds, op.getsize(sam_fn))
+
+    first_out_fns = None
+    for nproc in args.nproc:
+        out_dir = op.join(args.out_dir, "collapse_nproc_%d" % nproc)
+        mknewdir(out_dir)
+        out_fns = [op.join(out_dir, fn) for fn in
+                   ("ignored_ids.txt", "good.gff", "bad.gff", "group.txt")]
+        b = Branch(isoform_filename=isoform_fn, sam_filename=sam_fn,
+                   cov_threshold=2, min_aln_coverage=0.99, min_aln_identity=0.95)
+        seconds, _ret = timed(b.run, allow_extra_5exon=True, skip_5_exon_alt=True,
+                              ignored_ids_fn=out_fns[0], good_gff_fn=out_fns[1],
+                              bad_gff_fn=out_fns[2], group_fn=out_fns[3], nproc=nproc)
+        first_out_fns = first_out_fns or out_fns
+        identical = all(filecmp.cmp(fn0, fn, shallow=False)
+                        for fn0, fn in zip(first_out_fns, out_fns))
+        report("collapse_nproc_%d" % nproc, seconds, dir_size(out_dir))
+        sys.stdout.write("collapse_nproc_{n}\t{l:.1f} loci/s\tidentical={i}\n".format(
+            n=nproc, l=args.num_loci / max(seconds, 1e-6), i=identical))
+
+
+def get_parser():
+    """Get argument parser."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    subparsers = parser.add_subparsers(dest="subCommand")
+
+    p = subparsers.add_parser("classify", help=bench_classify.__doc__)
+    p.add_argument("ccs", type=str, help="Input ccs.bam or consensusreadset.xml")
+    p.add_argument("out_dir", type=str, help="Output directory")
+    p.add_argument("--cpus", type=int, default=8, help="Number of CPUs")
+    p.set_defaults(func=bench_classify)
+
+    p = subparsers.add_parser("fasta_random_reader",
+                              help=bench_fasta_random_reader.__doc__)
+    p.add_argument("fasta", type=str, help="Input FASTA file")
+    p.add_argument("--num_fetches", type=int, default=10000,
+                   help="Number of random reads to fetch")
+    p.add_argument("--seed", type=int, default=0, help="Random seed")
+    p.set_defaults(func=bench_fasta_random_reader)
+
+    p = subparsers.add_parser("trim_subreads", help=bench_trim_subreads.__doc__)
+    p.add_argument("subreads", type=str,
+                   help="Input subreads BAM/xml/fofn, or FASTA fofn")
+    p.add_argument("out_dir", type=str, help="Output directory")
+    p.add_argument("--num_zmws", type=int, default=2000,
+                   help="Number of random zmws to extract")
+    p.add_argument("--zmws_per_cluster", type=int, default=20,
+                   help="Number of zmws in each cluster file")
+    p.add_argument("--trim_len", type=int, default=50,
+                   help="Trim the first and last n bases of subreads")
+    p.add_argument("--repeats", type=int, default=3,
+                   help="Number of times to repeat each route")
+    p.add_argument("--drop_caches", default=False, action="store_true",
+                   help="Drop page cache before each route, root only")
+    p.add_argument("--seed", type=int, default=0, help="Random seed")
+    p.set_defaults(func=bench_trim_subreads)
+
+    p = subparsers.add_parser("bgzf", help=bench_bgzf.__doc__)
+    p.add_argument("fastx", type=str, help="Input plain FASTA or FASTQ file")
+    p.add_argument("out_dir", type=str, help="Output directory")
+    p.add_argument("--threads", type=int, default=4,
+                   help="Number of threads to decompress blocks")
+    p.add_argument("--num_fetches", type=int, default=10000,
+                   help="Number of random reads to fetch")
+    p.add_argument("--seed", type=int, default=0, help="Random seed")
+    p.set_defaults(func=bench_bgzf)
+
+    p = subparsers.add_parser("contigset", help=bench_contigset.__doc__)
+    p.add_argument("fasta", type=str, help="Input FASTA file")
+    p.add_argument("out_dir", type=str, help="Output directory")
+    p.add_argument("--num_files", type=int, default=500,
+                   help="Number of FASTA files in the ContigSet xml")
+    p.add_argument("--repeats", type=int, default=3,
+                   help="Number of times to repeat each step")
+    p.set_defaults(func=bench_contigset)
+
+    p = subparsers.add_parser("quiver_bin", help=bench_quiver_bin.__doc__)
+    p.add_argument("root_dir", type=str,
+                   help="Cluster root dir of a finished ICE run")
+    p.add_argument("subreads", type=str, help="Input subreads BAM or xml")
+    p.add_argument("out_dir", type=str, help="Output directory")
+    p.add_argument("--num_clusters", type=int, default=200,
+                   help="Number of clusters to align")
+    p.add_argument("--bin_size", type=int, default=100,
+                   help="Number of clusters in each bin")
+    p.add_argument("--blasr_nproc", type=int, default=8,
+                   help="Number of threads of each blasr call")
+    p.set_defaults(func=bench_quiver_bin)
+
+    p = subparsers.add_parser("collapse", help=bench_collapse.__doc__)
+    p.add_argument("out_dir", type=str, help="Output directory")
+    p.add_argument("--num_loci", type=int, default=50000,
+                   help="Number of synthetic loci")
+    p.add_argument("--loci_per_chrom", type=int, default=5000,
+                   help="Number of loci on each synthetic chromosome")
+    p.add_argument("--locus_span", type=int, default=20000,
+                   help="Number of bases between starts of adjacent loci")
+    p.add_argument("--isoforms_per_locus", type=int, default=4,
+                   help="Number of isoforms of each locus")
+    p.add_argument("--nproc", type=int, nargs="+", default=[1, 2, 4, 8],
+                   help="Numbers of processes to collapse loci")
+    p.add_argument("--seed", type=int, default=0, help="Random seed")
+    p.set_defaults(func=bench_collapse)
+    return parser
+
+
+def main(argv=sys.argv[1:]):
+    """Run a benchmark."""
+    logging.basicConfig(level=logging.INFO)
+    args = get_parser().parse_args(argv)
+    args.func(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -277,7 +277,8 @@ def args_runner(args):
     logging.info("Merging isoforms from all bins to %s.", tofu_f.combined_dir)
     c = CombineRunner(combined_dir=tofu_f.combined_dir,
                       sample_name=get_sample_name(args.sample_name),
-                      split_dirs=split_dirs, ipq_opts=ipq_opts)
+                      split_dirs=split_dirs, ipq_opts=ipq_opts,
+                      nproc=args.quiver_nproc)
     c.run()
     if args.summary_fn is not None:
         ln(tofu_f.all_cluster_summary_fn, args.summary_fn)
@@ -309,7 +310,8 @@ def args_runner(args):
         out_group=args.group_fn, out_read_stat=args.read_stat_fn,
         min_aln_coverage=args.min_aln_coverage, min_aln_identity=args.min_aln_identity,
         min_flnc_coverage=args.min_flnc_coverage, max_fuzzy_junction=args.max_fuzzy_junction,
-        allow_extra_5exon=args.allow_extra_5exon, min_count=args.min_count)
+        allow_extra_5exon=args.allow_extra_5exon, min_count=args.min_count,
+        nproc=args.gmap_nproc)
 
     return 0
 
@@ -7,7 +7,10 @@ import hashlib
 import time
 
 from pbtranscript.Utils import make_pbi
-from pbtranscript.io.PbiBamIO import BamCollection, BamHeader, BamWriter, BamZmwRead
+from pbtranscript.io.PbiBamIO import BamCollection, BamHeader, BamWriter, BamZmwRead, \
+    AnnotatedBamWriter, annotation_from_segment, carried_tags, ZmwRowIndex
+from pbtranscript.io.ReadAnnotation import ReadAnnotation
+import pysam
 from pbcore.io import BamAlignment, IndexedBamReader, readFofn, ConsensusReadSet
 from test_setpath import OUT_DIR, STD_DIR
 from pbcore.util.Process import backticks
@@ -91,6 +94,22 @@ def _verify_write_compare_ccs(testobj, inbamfns, zmws, outbamfn,
     testobj.assertTrue(set(zmws) == set(outzmws))
 
 
+def test_ZmwRowIndex():
+    """Test ZmwRowIndex."""
+    movie_ids = [3, -7, 3, 3, -7, 3]
+    hole_numbers = [10, 10, 5, 10, 2**31 + 1, 5]
+    idx = ZmwRowIndex(movie_ids, hole_numbers)
+    assert len(idx) == 6
+    assert list(idx.rows(3, 10)) == [0, 3]
+    assert list(idx.rows(3, 5)) == [2, 5]
+    assert list(idx.rows(-7, 10)) == [1]
+    assert list(idx.rows(-7, 2**31 + 1)) == [4]
+    assert list(idx.rows(3, 11)) == []
+    assert list(idx.rows(4, 10)) == []
+    assert idx.num_zmws == 4
+    assert [list(rows) for rows in idx.groups()] == [[1], [4], [2, 5], [0, 3]]
+
+
 class TestIO(unittest.TestCase):
     def setUp(self):
         """Define input bam file, out bam file."""
@@ -122,6 +141,30 @@ class TestIO(unittest.TestCase):
 
         _verify_write_compare_subreads(self, subreadsfns, zmws, outbamfn)
 
+    def test_fetch_zmws(self):
+        """Test BamCollection.fetch_zmws, zmws are fetched in batch."""
+        movie = "m131018_081703_42161_c100585152550000001823088404281404_s1_p0"
+        reader = BamCollection(op.join(self.dataDir, "%s.1.subreads.bam" % movie))
+        zmws = ["%s/%s" % (movie, hn) for hn in [888, 45, 161]]
+        d = reader.fetch_zmws(zmws + ["%s/99999999" % movie], ignore_missing=True)
+        self.assertEqual(d.keys(), zmws)
+        for zmw in zmws:
+            self.assertEqual([sr.readName for sr in d[zmw].subreads],
+                             [sr.readName for sr in reader[zmw].subreads])
+        self.assertRaises(KeyError, reader.fetch_zmws, ["%s/99999999" % movie])
+
+    def test_iterZmws(self):
+        """Test BamCollection.iterZmws with and without prefetch."""
+        movie = "m131018_081703_42161_c100585152550000001823088404281404_s1_p0"
+        reader = BamCollection(op.join(self.dataDir, "%s.1.subreads.bam" % movie))
+        zmws = [zmw.zmwName for zmw in reader]
+        self.assertEqual(len(zmws), len(reader))
+        self.assertEqual(len(set(zmws)), len(zmws))
+        self.assertEqual([int(zmw.split('/')[1]) for zmw in zmws],
+                         sorted([int(zmw.split('/')[1]) for zmw in zmws]))
+        self.assertEqual([zmw.zmwName for zmw in reader.iterZmws(prefetch=True)],
+                         zmws)
+
     def test_read_subreads_from_multiple_files_of_one_smrtcell_write_bam(self):
         """
         test_read_subreads_from_multiple_files_of_one_smrtcell_write_bam
@@ -245,3 +288,25 @@ class TestIO(unittest.TestCase):
         with ConsensusReadSet(dataset_xml) as ds:
             for read in ds:
                 self.assertEqual(bc[read.qName].readName, read.qName)
+
+    def test_AnnotatedBamWriter(self):
+        """Test AnnotatedBamWriter, annotation_from_segment and carried_tags."""
+        outbamfn = op.join(self.outDir, "test_AnnotatedBamWriter.bam")
+        header = {'HD': {'VN': '1.5', 'SO': 'unknown'},
+                  'RG': [{'ID': 'ab', 'PL': 'PACBIO', 'PU': 'movie'}]}
+        annotation = ReadAnnotation(ID="movie/10/30_80_CCS", strand="-",
+                                    fiveend=30, polyAend=50, threeend=None,
+                                    primer=0, chimera=0)
+        with AnnotatedBamWriter(outbamfn, header, make_index=False) as writer:
+            writer.writeRecord(annotation, "ACGT" * 5, [20] * 20,
+                               [('RG', 'ab'), ('zm', 10)])
+
+        reader = pysam.AlignmentFile(outbamfn, 'rb', check_sq=False)
+        records = [r for r in reader]
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].query_sequence, "ACGT" * 5)
+        self.assertEqual(list(records[0].query_qualities), [20] * 20)
+        self.assertEqual(sorted(carried_tags(records[0])),
+                         [('RG', 'ab'), ('zm', 10)])
+        other = annotation_from_segment(records[0])
+        self.assertEqual(other.toAnnotation(), annotation.toAnnotation())
@@ -0,0 +1,77 @@
+"""Test pbtranscript.io.BgzfIO"""
+
+import unittest
+import gzip
+import os
+import os.path as op
+from pbcore.io import FastaReader, FastqReader
+from pbtranscript.io import BgzfReader, BgzfTextReader, BgzfWriter, is_bgzf, \
+        FastaRandomReader, FastqRandomReader, ContigSetReaderWrapper
+from pbtranscript.io.BgzfIO import gzi_filename, read_gzi
+from test_setpath import DATA_DIR, OUT_DIR
+
+
+def _bgzip(in_fn, out_fn):
+    """Compress in_fn to out_fn in BGZF format."""
+    with open(in_fn, 'rb') as reader, BgzfWriter(out_fn) as writer:
+        writer.write(reader.read())
+    for fn in (out_fn + ".fai", gzi_filename(out_fn)):
+        if op.exists(fn):
+            os.remove(fn)
+
+
+class TestBgzfIO(unittest.TestCase):
+    """Class for testing BgzfIO."""
+
+    def setUp(self):
+        """Set up test data."""
+        self.inFa = op.join(DATA_DIR, "reads_of_insert.fasta")
+        self.inFq = op.join(DATA_DIR, "test_fastq_random_reader.fastq")
+        self.gzFa = op.join(OUT_DIR, "test_BgzfIO.fasta.gz")
+        self.gzFq = op.join(OUT_DIR, "test_BgzfIO.fastq.gz")
+        _bgzip(self.inFa, self.gzFa)
+        _bgzip(self.inFq, self.gzFq)
+
+    def test_BgzfReader(self):
+        """Test BgzfWriter, BgzfReader and BgzfTextReader."""
+        # test_fastq_random_reader.fastq is compressed into multiple blocks.
+        data = open(self.inFq, 'rb').read()
+        self.assertTrue(is_bgzf(self.gzFq))
+        self.assertFalse(is_bgzf(self.inFq))
+        self.assertEqual(gzip.open(self.gzFq).read(), data)
+
+        with BgzfReader(self.gzFq) as reader:
+            self.assertEqual(len(reader), len(data))
+            self.assertTrue(read_gzi(self.gzFq) is not None)
+            for start, end in [(0, 10), (65270, 65300), (100, 200000),
+                               (len(data) - 5, len(data) + 5)]:
+                self.assertEqual(reader[start:end], data[start:end])
+
+        for threads in [1, 4]:
+            with BgzfTextReader(self.gzFq, threads=threads) as reader:
+                self.assertEqual(list(reader), data.splitlines(True))
+
+    def test_random_readers(self):
+        """Test FastaRandomReader and FastqRandomReader reading bgzip files."""
+        reads = [r for r in FastaReader(self.inFa)]
+        frr = FastaRandomReader(self.gzFa)
+        self.assertEqual(len(frr), len(reads))
+        for r in reads:
+            self.assertEqual(frr[r.id].sequence, r.sequence)
+
+        reads = [r for r in FastqReader(self.inFq)]
+        frr = FastqRandomReader(self.gzFq)
+        for r in reads:
+            self.assertEqual(frr[r.name].sequence, r.sequence)
+            self.assertTrue((frr.quality(r.name) == r.quality).all())
+
+    def test_ContigSetReaderWrapper(self):
+        """Test ContigSetReaderWrapper reading bgzip files."""
+        names = [r.name for r in FastqReader(self.inFq)]
+        for threads in [1, 4]:
+            with ContigSetReaderWrapper(self.gzFq, threads=threads) as reader:
+                self.assertEqual([r.name for r in reader], names)
+
+
+if __name__ == "__main__":
+    unittest.main()
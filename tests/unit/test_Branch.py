@@ -236,3 +236,30 @@ class TEST_Branch(unittest.TestCase):
         self.assertTrue(filecmp.cmp(good_gff_fn, std_good_gff_fn))
         self.assertTrue(filecmp.cmp(bad_gff_fn, std_bad_gff_fn))
         self.assertTrue(filecmp.cmp(group_fn, std_group_fn))
+
+    def test_Branch_nproc(self):
+        """Test Branch.run collapsing loci using multiple processes, outputs
+        must be identical to outputs of a single process."""
+        test_name = "test_branch_nproc"
+        good_gff_fn = op.join(_OUT_DIR_, test_name + ".good.gff.unfuzzy")
+        bad_gff_fn = op.join(_OUT_DIR_, test_name + ".bad.gff.unfuzzy")
+        group_fn = op.join(_OUT_DIR_, test_name + ".group.txt.unfuzzy")
+
+        rmpath(good_gff_fn)
+        rmpath(bad_gff_fn)
+        rmpath(group_fn)
+
+        b = Branch(isoform_filename=READS_DS, sam_filename=SORTED_GMAP_SAM,
+                   cov_threshold=2, min_aln_coverage=0.99, min_aln_identity=0.95)
+
+        b.run(allow_extra_5exon=True, skip_5_exon_alt=False,
+              ignored_ids_fn=None,
+              good_gff_fn=good_gff_fn,
+              bad_gff_fn=bad_gff_fn,
+              group_fn=group_fn,
+              nproc=2)
+
+        std_prefix = op.join(SIV_STD_DIR, "test_branch", "test_branch")
+        self.assertTrue(filecmp.cmp(good_gff_fn, std_prefix + ".good.gff.unfuzzy"))
+        self.assertTrue(filecmp.cmp(bad_gff_fn, std_prefix + ".bad.gff.unfuzzy"))
+        self.assertTrue(filecmp.cmp(group_fn, std_prefix + ".group.txt.unfuzzy"))
@@ -3,7 +3,8 @@
 import unittest
 import os
 import os.path as op
-from pbtranscript.Classifier import Classifier, PBRead
+from pbtranscript.Classifier import (Classifier, PBRead, PrimerSeedIndex,
+                                     window_name, window_to_read_coordinate)
 from pbtranscript.io.DOMIO import DOMRecord
 from collections import namedtuple
 from test_setpath import DATA_DIR, OUT_DIR, STD_DIR
@@ -156,5 +157,40 @@ class Test_Classifier(unittest.TestCase):
         self.assertEqual((y.movie, y.zmw, y.isCCS),
                 ("movie", 10, True))
 
+    def test_PrimerSeedIndex(self):
+        """Test class PrimerSeedIndex."""
+        primer_fn = op.join(self.outDir, "test_PrimerSeedIndex.fasta")
+        with open(primer_fn, 'w') as writer:
+            writer.write(">F0\nAAGCAGTGGTATCAACGCAGAGTAC\n")
+        idx = PrimerSeedIndex(primer_fn, k=10)
+        self.assertEqual(len(idx.kmers), 16)
+
+        primer = "AAGCAGTGGTATCAACGCAGAGTAC"
+        seq = "C" * 300 + primer + "G" * 300
+        self.assertEqual(idx.candidate_windows(seq, 100, 50),
+                         [(250, 375)])
+        self.assertEqual(idx.seed_hits(seq, 0, len(seq)), range(300, 316))
+        self.assertEqual(idx.seed_hits(seq, 305, 310), range(305, 310))
+        # a primer with an error in every 10-mer has no seed.
+        bad_primer = "AAGCAGTGGaATCAACGCAtAGTAC".upper()
+        self.assertEqual(idx.seed_hits("C" * 300 + bad_primer + "G" * 300, 0, 625), [])
+        # primer seeds near either end are ignored.
+        seq = "C" * 50 + primer + "G" * 300
+        self.assertEqual(idx.candidate_windows(seq, 100, 50), [])
+        self.assertEqual(idx.candidate_windows("C" * 100, 100, 50), [])
+
+    def test_window_to_read_coordinate(self):
+        """Test functions window_name and window_to_read_coordinate."""
+        name = window_name("movie/10/0_1000_CCS", 250, 1000)
+        self.assertEqual(name, "movie/10/0_1000_CCS_win250_1000")
+        r = window_to_read_coordinate(
+            DOMRecord("F0", name, 30.0, 0, 25, 25, 50, 75, 125))
+        self.assertEqual((r.sid, r.sStart, r.sEnd, r.sLen),
+                         ("movie/10/0_1000_CCS", 300, 325, 1000))
+        r = window_to_read_coordinate(
+            DOMRecord("F0", "movie/10/ccs", 30.0, 0, 25, 25, 50, 75, 125))
+        self.assertEqual((r.sid, r.sStart, r.sEnd, r.sLen),
+                         ("movie/10/ccs", 50, 75, 125))
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,131 @@
+"""Test pbtranscript.io.ClusterStateIO."""
+import unittest
+import os
+import os.path as op
+import time
+import cPickle
+import threading
+from collections import defaultdict
+from pbtranscript.Utils import mkdir, rmpath
+from pbtranscript.io import ClusterState, write_cluster_state, \
+    is_cluster_state_valid, sequence_hash
+from pbtranscript.ice.IceFiles import IceFiles, CLUSTER_STATE_LOCK_TIMEOUT
+from test_setpath import OUT_DIR
+
+
+class TestClusterStateIO(unittest.TestCase):
+    """Test ClusterState."""
+
+    def setUp(self):
+        """Write consensus isoforms of clusters."""
+        self.consensus_fa = op.join(OUT_DIR, "test_ClusterStateIO.consensus.fasta")
+        with open(self.consensus_fa, 'w') as writer:
+            writer.write(">c0/2/10 isoform=c0\nACGTACGT\nAC\n")
+            writer.write(">c7/1/5 isoform=c7\nGGGCC\n")
+            writer.write(">c12/3/4 isoform=c12\nTTTT\n")
+            writer.write(">c3/1/5 isoform=c3\nGGGCC\n")
+        self.uc = {12: ["m/3/ccs", "m/4/ccs", "m/5/ccs"], 0: ["m/1/ccs", "m/2/ccs"],
+                   7: ["m/6/ccs"], 3: ["m/7/ccs"]}
+        self.partial_uc = defaultdict(lambda: [])
+        self.partial_uc.update({0: ["m/10/0_100"], 12: []})
+        self.refs = dict((cid, "tmp/0/c%d/g_consensus_ref.fasta" % cid) for cid in self.uc)
+        self.prefix = op.join(OUT_DIR, "test_ClusterStateIO")
+
+    def test_ClusterState(self):
+        """Test write_cluster_state and ClusterState."""
+        sources = [self.consensus_fa]
+        write_cluster_state(out_prefix=self.prefix, uc=self.uc,
+                            partial_uc=self.partial_uc, refs=self.refs,
+                            consensus_fa=self.consensus_fa, sources=sources)
+        self.assertTrue(is_cluster_state_valid(self.prefix, sources))
+
+        with ClusterState(self.prefix) as s:
+            self.assertEqual(s.cids, [0, 3, 7, 12])
+            self.assertEqual(s.uc[12], self.uc[12])
+            self.assertEqual(s.partial_uc[0], ["m/10/0_100"])
+            self.assertEqual(s.partial_uc[12], [])
+            self.assertEqual(s.partial_uc[100], [])
+            self.assertEqual(s.partial_uc.keys(), [0])
+            self.assertTrue(7 in s.uc and 7 not in s.partial_uc)
+            self.assertEqual(s.num_reads(0), (2, 1))
+            self.assertEqual(s.consensus_len(0), 10)
+            self.assertEqual(s.consensus(0), ("c0/2/10", "ACGTACGTAC"))
+            self.assertEqual(s.consensus(12), ("c12/3/4", "TTTT"))
+            self.assertEqual(s.refs[7], self.refs[7])
+            self.assertRaises(KeyError, s.fl_reads, 100)
+
+            self.assertEqual(s.consensus_of_clusters([12, 0, 7]),
+                             {0: ("c0/2/10", "ACGTACGTAC"), 7: ("c7/1/5", "GGGCC"),
+                              12: ("c12/3/4", "TTTT")})
+            self.assertEqual(s.consensus_hash(0), sequence_hash("ACGTACGTAC"))
+            self.assertEqual(s.consensus_hash(3), s.consensus_hash(7))
+            self.assertNotEqual(s.consensus_hash(7), s.consensus_hash(12))
+
+
+class TestLoadClusterState(unittest.TestCase):
+    """Test IceFiles.load_cluster_state."""
+
+    def setUp(self):
+        """Write pickles and consensus isoforms of an ICE project."""
+        root_dir = op.join(OUT_DIR, "test_load_cluster_state")
+        rmpath(root_dir)
+        self.files = IceFiles(prog_name="test", root_dir=root_dir, no_log_f=True)
+        mkdir(self.files.nfl_dir)
+        self.uc = {0: ["m/1/ccs", "m/2/ccs"], 7: ["m/6/ccs"]}
+        self.refs = dict((cid, "tmp/0/c%d/g_consensus_ref.fasta" % cid) for cid in self.uc)
+        with open(self.files.final_pickle_fn, 'wb') as writer:
+            cPickle.dump({'uc': self.uc, 'refs': self.refs}, writer)
+        with open(self.files.nfl_all_pickle_fn, 'wb') as writer:
+            cPickle.dump({'partial_uc': {0: ["m/10/0_100"]}, 'nohit': set()}, writer)
+        with open(self.files.final_consensus_fa, 'w') as writer:
+            writer.write(">c0/2/10 isoform=c0\nACGTACGTAC\n>c7/1/5 isoform=c7\nGGGCC\n")
+        self.sources = [self.files.final_pickle_fn, self.files.nfl_all_pickle_fn,
+                        self.files.final_consensus_fa]
+
+    def test_build(self):
+        """Test building cluster state once, and removing a stale lock."""
+        self.assertIsNone(self.files.load_cluster_state(build=False))
+
+        lock_fn = self.files.cluster_state_lock_fn
+        open(lock_fn, 'w').close()
+        stale = time.time() - CLUSTER_STATE_LOCK_TIMEOUT - 10
+        os.utime(lock_fn, (stale, stale))
+
+        with self.files.load_cluster_state() as s:
+            self.assertEqual(s.uc[0], self.uc[0])
+            self.assertEqual(s.partial_uc[0], ["m/10/0_100"])
+        self.assertFalse(op.exists(lock_fn))
+        s = self.files.load_cluster_state(build=False)
+        self.assertIsNotNone(s)
+        s.close()
+
+    def test_wait_for_builder(self):
+        """Test waiting for cluster state built by another caller."""
+        lock_fn = self.files.cluster_state_lock_fn
+        open(lock_fn, 'w').close()
+
+        def _build():
+            """Build cluster state as another chunk which holds the lock."""
+            time.sleep(0.5)
+            write_cluster_state(out_prefix=self.files.cluster_state_prefix,
+                                uc=self.uc, partial_uc={0: ["m/10/0_100"]},
+                                refs=self.refs, consensus_fa=self.files.final_consensus_fa,
+                                sources=self.sources)
+            os.remove(lock_fn)
+
+        def _fail():
+            """Pickles must not be loaded by a waiting caller."""
+            raise AssertionError("cluster state is built twice.")
+
+        self.files.load_pickles = _fail
+        builder = threading.Thread(target=_build)
+        builder.start()
+        try:
+            with self.files.load_cluster_state() as s:
+                self.assertEqual(s.uc[7], self.uc[7])
+        finally:
+            builder.join()
+
+
+if __name__ == "__main__":
+    unittest.main()
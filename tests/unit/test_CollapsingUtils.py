@@ -1,10 +1,11 @@
 """Test classes defined within pbtranscript.collapsing.CollaspingUtils."""
 import unittest
 import os.path as op
+from pbcore.io import FastqReader
 from pbtranscript.Utils import rmpath, mkdir
 from pbtranscript.io import CollapseGffReader, CollapseGffRecord
 from pbtranscript.collapsing.CollapsingUtils import copy_sam_header, map_isoforms_and_sort, \
-        concatenate_sam, can_merge, compare_fuzzy_junctions, collapse_fuzzy_junctions
+        concatenate_sam, can_merge, compare_fuzzy_junctions, collapse_fuzzy_junctions, pick_rep
 import filecmp
 from test_setpath import DATA_DIR, OUT_DIR, SIV_DATA_DIR
 
@@ -118,3 +119,30 @@ class TEST_CollapsingUtils(unittest.TestCase):
         r4, r5 = [r for r in CollapseGffReader(output_gff)]
         self.assertEqual(r1, r4)
         self.assertEqual(r3, r5)
+
+    def test_pick_rep(self):
+        """Test pick_rep picks the member with the least expected number of
+        base errors, where error probability of a base of QV q is 10**-(q/10)."""
+        test_name = "pick_rep"
+        input_fq = op.join(_OUT_DIR_, "input_%s.fastq" % test_name)
+        input_gff = op.join(_OUT_DIR_, "input_%s.gff" % test_name)
+        input_group = op.join(_OUT_DIR_, "input_%s.group.txt" % test_name)
+        output_fq = op.join(_OUT_DIR_, "output_%s.fastq" % test_name)
+
+        # Expected errors of i0 is 10 * 10**-2 = 0.1, of i1 is about
+        # 10**-1.2 = 0.063, so i1 is picked.
+        with open(input_fq, 'w') as writer:
+            writer.write("@i0\n%s\n+\n%s\n" % ("A" * 10, chr(20 + 33) * 10))
+            writer.write("@i1\n%s\n+\n%s\n" % ("A" * 10, chr(12 + 33) + chr(60 + 33) * 9))
+        with open(input_gff, 'w') as writer:
+            writer.write('chr1\tPacBio\ttranscript\t1\t10\t.\t+\t.\t' +
+                         'gene_id "PB.1"; transcript_id "PB.1.1";\n')
+            writer.write('chr1\tPacBio\texon\t1\t10\t.\t+\t.\t' +
+                         'gene_id "PB.1"; transcript_id "PB.1.1";\n')
+        with open(input_group, 'w') as writer:
+            writer.write("PB.1.1\ti0,i1\n")
+
+        pick_rep(isoform_filename=input_fq, gff_filename=input_gff,
+                 group_filename=input_group, output_filename=output_fq,
+                 pick_least_err_instead=True)
+        self.assertEqual([r.name.split('|')[-1] for r in FastqReader(output_fq)], ["i1"])
@@ -1,12 +1,13 @@
 """Test classes defined within pbtranscript.CombineUtils."""
 
 import unittest
+import os
 import os.path as op
 
 from pbcore.io import FastaReader, FastqReader
 from pbtranscript.Utils import rmpath, mkdir
 from pbtranscript.ClusterOptions import IceQuiverHQLQOptions
-from pbtranscript.CombineUtils import CombineRunner
+from pbtranscript.CombineUtils import CombineRunner, combine_isoforms_of_bins
 from test_setpath import DATA_DIR, OUT_DIR, SIV_DATA_DIR
 
 
@@ -51,3 +52,51 @@ class TEST_CombineUtils(unittest.TestCase):
         expected_consensus_isoforms_num = 79
         self.assertEqual(len([r for r in FastaReader(obj.all_consensus_isoforms_fa)]), expected_consensus_isoforms_num)
 
+
+    def test_runner_nproc(self):
+        """Test CombineRunner combining cluster bins by multiple processes."""
+        ipq_opts = IceQuiverHQLQOptions(qv_trim_5=100, qv_trim_3=30)
+        d = op.join(SIV_DATA_DIR, "test_tool_contract_chunks")
+        split_dirs = [op.join(d, b, "cluster_out") for b in
+                      ("0to1kb_part0", "1to2kb_part0", "2to3kb_part0", "3to4kb_part0", "4to5kb_part0")]
+        objs = []
+        for nproc in (1, 3):
+            out_combined_dir = op.join(OUT_DIR, "test_CombineUtils", "combined_dir_nproc%d" % nproc)
+            rmpath(out_combined_dir)
+            mkdir(out_combined_dir)
+            obj = CombineRunner(combined_dir=out_combined_dir,
+                                sample_name="mysample",
+                                split_dirs=split_dirs,
+                                ipq_opts=ipq_opts, nproc=nproc)
+            obj.run()
+            objs.append(obj)
+
+        for attr in ("all_hq_fa", "all_hq_fq", "all_lq_fa", "all_lq_fq",
+                     "all_consensus_isoforms_fa"):
+            self.assertEqual(open(getattr(objs[0], attr)).read(),
+                             open(getattr(objs[1], attr)).read())
+        self.assertFalse(any(f.endswith(".part") for f in os.listdir(objs[1].combined_dir)))
+
+    def test_combine_isoforms_of_bins(self):
+        """Test combine_isoforms_of_bins, which names isoforms by
+        combined_cid_*_name and removes fragments even if it fails."""
+        out_dir = op.join(OUT_DIR, "test_CombineUtils", "combine_isoforms_of_bins")
+        rmpath(out_dir)
+        mkdir(out_dir)
+        in_fq = op.join(out_dir, "in.fastq")
+        with open(in_fq, 'w') as writer:
+            writer.write("@c1\nACGT\n+\nIIII\n")
+        out_fa, out_fq = op.join(out_dir, "hq.fasta"), op.join(out_dir, "hq.fastq")
+
+        combine_isoforms_of_bins(jobs=[(in_fq, "HQ", out_fa, out_fq, 0),
+                                       (in_fq, "HQ", out_fa, out_fq, 1)],
+                                 sample_name="mysample")
+        self.assertEqual([r.name for r in FastqReader(out_fq)],
+                         ["i0_HQ_mysample|c1", "i1_HQ_mysample|c1"])
+
+        missing_fq = op.join(out_dir, "missing.fastq")
+        with self.assertRaises(IOError):
+            combine_isoforms_of_bins(jobs=[(in_fq, "LQ", out_fa, out_fq, 0),
+                                           (missing_fq, "LQ", out_fa, out_fq, 1)],
+                                     sample_name="mysample")
+        self.assertFalse(any(f.endswith(".part") for f in os.listdir(out_dir)))
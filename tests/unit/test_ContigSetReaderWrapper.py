@@ -1,7 +1,7 @@
 """Test classes defined within pbtranscript.io.ContigSetReaderWrapper."""
 import unittest
 import os.path as op
-from pbtranscript.io import ContigSetReaderWrapper
+from pbtranscript.io import ContigSetReaderWrapper, get_contigset_info
 from test_setpath import DATA_DIR, OUT_DIR
 
 
@@ -79,3 +79,21 @@ class TEST_ContigSetReaderWrapper(unittest.TestCase):
         d = ContigSetReaderWrapper.name_to_len_dict(self.fastqfn)
         for key in expected:
             self.assertEqual(expected[key], d[key])
+
+    def test_indexed_xml(self):
+        """Test reading ContigSet xml through cached info and .fai indices."""
+        info = get_contigset_info(self.xmlfn)
+        self.assertTrue(get_contigset_info(self.xmlfn) is info)
+        self.assertFalse(info.has_filters)
+        self.assertEqual(ContigSetReaderWrapper.indexable_files(self.xmlfn),
+                         list(info.external_files))
+
+        with ContigSetReaderWrapper(self.xmlfn) as reader:
+            expected = dict([(r.name.split()[0], len(r.sequence[:])) for r in reader])
+        self.assertEqual(ContigSetReaderWrapper.name_to_len_dict(self.xmlfn), expected)
+
+        # consolidate by copying files if no record has been read.
+        with ContigSetReaderWrapper(self.xmlfn) as reader:
+            out_fn = reader.consolidate(out_prefix=op.join(OUT_DIR, "test_ContigSetReaderWrapper_indexed_xml"))
+        self.assertTrue(out_fn.endswith(".fasta"))
+        self.assertEqual(len([r for r in ContigSetReaderWrapper(out_fn)]), 25)
@@ -1,10 +1,12 @@
 """Test FastaSplitter"""
 
 import unittest
+import os
 import os.path as op
 from pbcore.io import FastaReader, ContigSet
 from pbtranscript.io.FastaRandomReader import FastaRandomReader, \
-        MetaSubreadFastaReader
+        MetaSubreadFastaReader, build_fai, read_fai, fai_filename, \
+        read_zmw_index
 from pbtranscript.Utils import write_files_to_fofn
 from test_setpath import DATA_DIR, OUT_DIR, STD_DIR
 import hashlib
@@ -85,6 +87,51 @@ class TestFastaRandomReader(unittest.TestCase):
         for r in reads:
             self.assertEqual(frr[r.name].sequence, r.sequence[:])
 
+    def testPersistedIndex(self):
+        """Test FastaRandomReader saves, reuses and invalidates .fai."""
+        fa = op.join(self.outDir, "test_FastaRandomReader_fai.fasta")
+        with open(fa, 'w') as writer:
+            writer.write(">r1 desc\nACGTA\nCGTAC\nGT\n>r2\nAAAA\n>r3\n\n")
+        if op.exists(fai_filename(fa)):
+            os.remove(fai_filename(fa))
+
+        frr = FastaRandomReader(fa)
+        self.assertTrue(op.exists(fai_filename(fa)))
+        self.assertEqual(read_fai(fa), build_fai(fa))
+        with open(fai_filename(fa)) as reader:
+            self.assertEqual(reader.readline(), "r1\t12\t9\t5\t6\n")
+        self.assertEqual(frr["r1"].sequence, "ACGTACGTACGT")
+        self.assertEqual(frr["r3"].sequence, "")
+
+        # .fai of a FASTA file of a different size is not valid.
+        with open(fa, 'a') as writer:
+            writer.write(">r4\nCC\n")
+        self.assertTrue(read_fai(fa) is None)
+        frr = FastaRandomReader(fa)
+        self.assertEqual(frr["r4"].sequence, "CC")
+        self.assertEqual(len(read_fai(fa)), 4)
+
+        # lines of unequal width can not be described in .fai
+        with open(fa, 'w') as writer:
+            writer.write(">r1\nACGT\nAC\nACGT\n")
+        os.remove(fai_filename(fa))
+        frr = FastaRandomReader(fa)
+        self.assertEqual(frr["r1"].sequence, "ACGTACACGT")
+        self.assertFalse(op.exists(fai_filename(fa)))
+
+        # index is kept in memory if .fai can not be saved.
+        with open(fa, 'w') as writer:
+            writer.write(">r1\nACGT\n")
+        os.mkdir(fai_filename(fa))
+        try:
+            frr = FastaRandomReader(fa)
+            self.assertEqual(frr["r1"].sequence, "ACGT")
+            self.assertEqual(os.listdir(fai_filename(fa)), [])
+            self.assertEqual([fn for fn in os.listdir(self.outDir)
+                              if fn.startswith(op.basename(fa)) and fn.endswith(".tmp")], [])
+        finally:
+            os.rmdir(fai_filename(fa))
+
 
 class TestMetaSubreadFastaReader(unittest.TestCase):
     """Class for testing MetaSubreadFastaReader."""
@@ -123,3 +170,37 @@ class TestMetaSubreadFastaReader(unittest.TestCase):
         self.assertEqual(r5.name, "m130812_random_random_s1_p0/249/0_1339")
         self.assertEqual(hashlib.md5(r5.sequence).hexdigest(), "b20d3723a136aedc2f96f6f498ad3da0")
 
+    def testFetchZmws(self):
+        """Test MetaSubreadFastaReader.fetch_zmws and zmw index files."""
+        reader = MetaSubreadFastaReader([self.fa1, self.fa2])
+        for fn in [self.fa1, self.fa2]:
+            self.assertTrue(read_zmw_index(fn) is not None)
+
+        zmw_3 = "m130812_185809_42141_c100533960310000001823079711101380_s1_p0/70"
+        zmw_4 = "m130812_random_random_s1_p0/249"
+        d = reader.fetch_zmws([zmw_4, "movie/1", zmw_3], ignore_missing=True)
+        self.assertEqual(d.keys(), [zmw_4, zmw_3])
+        self.assertEqual([r.name for r in d[zmw_3]],
+                         [r.name for r in reader[zmw_3]])
+        self.assertEqual([r.sequence for r in d[zmw_4]],
+                         [r.sequence for r in reader[zmw_4]])
+        self.assertRaises(KeyError, reader.fetch_zmws, ["movie/1"])
+        self.assertTrue(zmw_3 in reader)
+        self.assertFalse("movie/1" in reader)
+
+    def testReadsNotNamedAsSubreads(self):
+        """Test MetaSubreadFastaReader indexes reads, e.g., CCS reads,
+        which are not named as subreads by names."""
+        fa = op.join(self.outDir, "test_meta_subreads_fasta_reader_ccs.fasta")
+        with open(fa, 'w') as writer:
+            writer.write(">movie/2/ccs\nGGGG\n>movie/1/ccs\nACGT\n" +
+                         ">movie/1/0_10\nTT\n")
+        reader = MetaSubreadFastaReader([fa])
+        self.assertFalse(op.exists(fa + ".zmwi"))
+        self.assertEqual(len(reader), 2)
+        self.assertEqual([r.name for r in reader["movie/1"]],
+                         ["movie/1/ccs", "movie/1/0_10"])
+        self.assertEqual(reader["movie/2/ccs"][0].sequence, "GGGG")
+        self.assertTrue("movie/1/0_10" in reader)
+        self.assertFalse("movie/3" in reader)
+        self.assertEqual(reader.fetch_zmws(["movie/2"]).keys(), ["movie/2"])
@@ -39,9 +39,32 @@ class TestFastaSplitter(unittest.TestCase):
         fs = FastaSplitter(self.input_fasta, 2, self.out_dir,
             "testFastaSplitter_rmOutFNs_")
         fs.split()
+        self.assertTrue(op.exists(fs.manifest_fn))
         fs.rmOutFNs()
         self.assertTrue(len(fs.out_fns) == 0)
+        self.assertFalse(op.exists(fs.manifest_fn))
 
 
 
 
+
+    def testSplitBalanceByBases(self):
+        """Test FastaSplitter.split(balance_by_bases=True) and manifest."""
+        fs = FastaSplitter(self.input_fasta, 5, self.out_dir,
+            "testFastaSplitter_balance_", threads=2)
+        fs.split(balance_by_bases=True)
+        self.assertTrue(0 < len(fs.out_fns) <= 5)
+        self.assertTrue(op.exists(fs.manifest_fn))
+
+        splittedReads = []
+        for of, num_reads, num_bases in zip(fs.out_fns, fs.num_reads, fs.num_bases):
+            with FastaReader(of) as reader:
+                reads = [(r.name, r.sequence) for r in reader]
+            self.assertTrue(len(reads) == num_reads)
+            self.assertTrue(sum([len(r[1]) for r in reads]) == num_bases)
+            splittedReads.extend(reads)
+        fs.rmOutFNs()
+
+        with FastaReader(self.input_fasta) as reader:
+            reads = [(r.name, r.sequence) for r in reader]
+        self.assertTrue(splittedReads == reads)
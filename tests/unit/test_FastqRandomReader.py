@@ -2,9 +2,11 @@
 
 import unittest
 import os.path as op
+import shutil
+import numpy as np
 from pbcore.io import FastqReader
 from pbtranscript.io.FastqRandomReader import FastqRandomReader
-from test_setpath import DATA_DIR
+from test_setpath import DATA_DIR, OUT_DIR
 
 
 class TestFastqRandomReader(unittest.TestCase):
@@ -33,3 +35,40 @@ class TestFastqRandomReader(unittest.TestCase):
 
         self.assertTrue(False not in
                 [frr[r.name].qualityString == r.qualityString for r in reads])
+
+    def testQualityArrays(self):
+        """Test FastqRandomReader .fai, quality, expected_errors and mean_error."""
+        in_fq = op.join(OUT_DIR, "test_fastq_random_reader.fastq")
+        shutil.copy(self.inFq, in_fq)
+        reads = [r for r in FastqReader(in_fq)]
+        names = [r.name for r in reads]
+
+        frr = FastqRandomReader(in_fq)
+        self.assertTrue(op.exists(in_fq + ".fai"))
+        frr = FastqRandomReader(in_fq) # load index from .fai
+        self.assertTrue(set(frr.keys()) == set(names))
+
+        for r in reads:
+            self.assertTrue(frr.quality(r.name).dtype == np.uint8)
+            self.assertTrue((frr.quality(r.name) == r.quality).all())
+
+        errs = frr.expected_errors(names)
+        self.assertTrue(np.allclose(errs,
+            [sum(10 ** -(q / 10.) for q in r.quality) for r in reads]))
+        self.assertTrue(np.allclose(frr.mean_error(names),
+            [err / len(r.sequence) for err, r in zip(errs, reads)]))
+        frr.close()
+
+    def testTrimmedExpectedErrors(self):
+        """Test FastqRandomReader.trimmed_expected_errors."""
+        reads = [r for r in FastqReader(self.inFq)]
+        names = [r.name for r in reads]
+        frr = FastqRandomReader(self.inFq)
+        for trim_5, trim_3 in [(0, 0), (12, 0), (0, 12), (12, 12), (10**6, 0)]:
+            errs, lens = frr.trimmed_expected_errors(names, trim_5, trim_3)
+            for err, n, r in zip(errs, lens, reads):
+                qvs = r.quality[trim_5:max(0, len(r.quality) - trim_3)]
+                self.assertEqual(n, max(0, len(r.quality) - trim_5 - trim_3))
+                self.assertTrue(np.allclose(err,
+                    sum(10 ** -(q / 10.) for q in qvs)))
+        frr.close()
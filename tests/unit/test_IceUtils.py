@@ -1,7 +1,10 @@
 import unittest
+import os
 import os.path as op
 import filecmp
+from collections import OrderedDict
 import numpy as np
+from pbcore.io import FastaReader
 from pbcore.util.Process import backticks
 from pbtranscript.ClusterOptions import SgeOptions
 from pbtranscript.Utils import make_pbi, mknewdir
@@ -92,6 +95,44 @@ class Test_ICEUtils(unittest.TestCase):
         IceUtils.ice_fa2fq(in_fa, ccs_bam_fofn, out_bam_fq)
         self.assertTrue(filecmp.cmp(out_bam_fq, stdout_fq))
 
+    def test_ice_fa2fq_parallel_with_qv_cache(self):
+        """Test ice_fa2fq extracting qvs with multiple workers and a qv cache."""
+        in_fa = op.join(self.sivDataDir, "flnc.fasta")
+        ccs_bam_fofn = op.join(self.sivDataDir, "ccsbam.fofn")
+        stdout_fq = op.join(self.sivStdoutDir, "test_ice_fa2fq.fastq")
+        qv_cache = op.join(self.outDir, "test_ice_fa2fq.qv_cache.fastq")
+        if op.exists(qv_cache):
+            os.remove(qv_cache)
+
+        # First run extracts QVs from bam and fills the cache,
+        # second run reads all QVs from the cache.
+        for i in range(2):
+            out_fq = op.join(self.outDir, "test_ice_fa2fq.parallel.%d.fastq" % i)
+            IceUtils.ice_fa2fq(in_fa, ccs_bam_fofn, out_fq, num_workers=2,
+                               qv_cache=qv_cache, chunk_size=7)
+            self.assertTrue(filecmp.cmp(out_fq, stdout_fq))
+            self.assertTrue(op.exists(qv_cache))
+
+    def test_qv_cache_key(self):
+        """Test QV cache keys change with ccs files, and QVs written to cache."""
+        fns = [op.join(self.outDir, "test_qv_cache_key.%d.ccs.bam" % i) for i in range(2)]
+        for fn in fns:
+            with open(fn, 'w') as writer:
+                writer.write("ccs")
+        key = IceUtils.qv_cache_key(fns)
+        self.assertEqual(key, IceUtils.qv_cache_key(fns[::-1]))
+        self.assertNotEqual(key, IceUtils.qv_cache_key(fns[0:1]))
+        with open(fns[1], 'a') as writer:
+            writer.write("more ccs")
+        self.assertNotEqual(key, IceUtils.qv_cache_key(fns))
+
+        qv_cache = op.join(self.outDir, "test_qv_cache_key.fastq")
+        if op.exists(qv_cache):
+            os.remove(qv_cache)
+        IceUtils._write_qv_cache([("%s/m/1/ccs" % key, "ACG", np.array([0, 10, 93]))],
+                                 qv_cache)
+        self.assertEqual(open(qv_cache).read(), "@%s/m/1/ccs\nACG\n+\n!+~\n" % key)
+
     def test_parsed_read_name(self):
         names = ['m/1234/CCS',
                  'm/1234/0_100_CCS',
@@ -147,6 +188,34 @@ class Test_ICEUtils(unittest.TestCase):
         execute(cmd=cmd)
         self.assertTrue(filecmp.cmp(out_sam, stdout_sam))
 
+    def test_write_sorted_bam_of_targets(self):
+        """Test write_sorted_bam_of_targets, filtering alignments of a bin."""
+        import pysam
+        from pbtranscript.ice.IceUtils import concat_bam, write_sorted_bam_of_targets
+        fns = [op.join(self.moreDir, "aligned.%d.bam" % i) for i in range(1, 6)]
+        in_fn = op.join(self.outDir, "test_write_sorted_bam_of_targets.in.bam")
+        concat_bam(fns, in_fn)
+
+        # Assign zmws of alignments to refs 0, 2, 4 to their refs.
+        with pysam.Samfile(in_fn, 'rb') as reader:
+            ref_names = list(reader.references)
+            zmw_to_cids = {}
+            for r in reader:
+                if r.tid % 2 == 0:
+                    zmw_to_cids['/'.join(r.qname.split('/')[0:2])] = set([r.tid])
+        ref_name_to_cid = dict((name, i) for i, name in enumerate(ref_names))
+
+        out_fn = op.join(self.outDir, "test_write_sorted_bam_of_targets.bam")
+        valid = write_sorted_bam_of_targets(in_bam=in_fn, out_bam=out_fn,
+                                            zmw_to_cids=zmw_to_cids,
+                                            ref_name_to_cid=ref_name_to_cid)
+        self.assertEqual(valid, [n for i, n in enumerate(ref_names) if i % 2 == 0])
+        with pysam.Samfile(out_fn, 'rb') as reader:
+            self.assertEqual(list(reader.references), valid)
+            positions = [(r.tid, r.pos) for r in reader]
+        self.assertTrue(len(positions) > 0)
+        self.assertEqual(positions, sorted(positions))
+
     def test_trim_subreads_and_write(self):
         """
         Test trim_subreads_and_write(reader, in_zmwids, outfile, trim_len, min_len...)
@@ -178,6 +247,37 @@ class Test_ICEUtils(unittest.TestCase):
                                  trim_len=trim_len,
                                  min_len=min_len)
 
+    def test_trim_subreads_and_write_in_batch(self):
+        """
+        Test trim_subreads_and_write_in_batch(reader, out_file_to_seqids, ...)
+        on subreads FASTA files, output is identical to zmw by zmw extraction.
+        """
+        fa1 = op.join(self.dataDir, "test_meta_subreads_fasta_reader1.fasta")
+        fa2 = op.join(self.dataDir, "test_meta_subreads_fasta_reader2.fasta")
+        reader = MetaSubreadFastaReader([fa1, fa2])
+        zmw_1 = "m130812_185809_42141_c100533960310000001823079711101380_s1_p0/70"
+        zmw_2 = "m130812_random_random_s1_p0/249"
+
+        out_file_to_seqids = OrderedDict()
+        for i, seqids in enumerate([[zmw_2 + "/0_100_CCS", zmw_1], [zmw_1, "movie/1"]]):
+            out_file_to_seqids[op.join(self.outDir, "test_trim_batch_%d.fasta" % i)] = seqids
+        movies = trim_subreads_and_write_in_batch(reader, out_file_to_seqids,
+                                                  trim_len=10, min_len=0,
+                                                  ignore_keyerror=True,
+                                                  max_files_per_batch=1)
+        self.assertEqual(movies, set([zmw_1.split('/')[0], zmw_2.split('/')[0], "movie"]))
+
+        for out_file, seqids in out_file_to_seqids.iteritems():
+            expected = [r for zmw in zmws_of_seqids(seqids) if zmw in reader
+                        for r in reader[zmw]]
+            with FastaReader(out_file) as f:
+                out_reads = [r for r in f]
+            self.assertEqual([r.sequence for r in out_reads],
+                             [r.sequence[10:-10] for r in expected])
+
+        self.assertRaises(ValueError, trim_subreads_and_write, reader, ["movie/1"],
+                          op.join(self.outDir, "test_trim_batch_2.fasta"), 10, 0)
+
     def _test_daligner_against_ref(self, test_name, use_sge, sge_opts,
                                    prob_model_from="fake"):
         """Test daligner_against_ref with and without using sge."""
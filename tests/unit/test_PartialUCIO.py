@@ -0,0 +1,82 @@
+"""Test pbtranscript.io.PartialUCIO"""
+
+import unittest
+import os.path as op
+import pickle
+import cPickle
+from pbtranscript.io import write_partial_uc, merge_partial_uc, \
+        iter_partial_uc, load_partial_uc, is_partial_uc_file, \
+        merge_partial_uc_pickles, partial_uc_text_file
+from test_setpath import OUT_DIR
+
+
+class TestPartialUCIO(unittest.TestCase):
+    """Class for testing PartialUCIO."""
+
+    def setUp(self):
+        """Set up test data."""
+        self.chunks = [{'partial_uc': {10: ["m/3/ccs", "m/1/ccs"], 2: ["m/2/ccs"]},
+                        'nohit': set(["m/9/ccs"])},
+                       {'partial_uc': {2: ["m/5/ccs", "m/2/ccs"], 7: ["m/4/ccs"]},
+                        'nohit': set(["m/8/ccs", "m/9/ccs"])}]
+        self.pickles = [op.join(OUT_DIR, "test_PartialUCIO.%d.partial_uc.pickle" % i)
+                        for i in range(len(self.chunks))]
+        for a, fn in zip(self.chunks, self.pickles):
+            with open(fn, 'wb') as writer:
+                cPickle.dump(a, writer)
+
+    def test_merge_partial_uc(self):
+        """Test write_partial_uc, merge_partial_uc, iter_partial_uc and load_partial_uc."""
+        out_fn = op.join(OUT_DIR, "test_PartialUCIO.nfl.all.partial_uc.pickle")
+        merge_partial_uc(self.pickles, out_fn)
+        self.assertTrue(is_partial_uc_file(out_fn))
+        self.assertFalse(is_partial_uc_file(self.pickles[0]))
+        self.assertEqual(list(iter_partial_uc(out_fn)),
+                         [(2, ["m/2/ccs", "m/5/ccs"]), (7, ["m/4/ccs"]),
+                          (10, ["m/1/ccs", "m/3/ccs"]), (None, ["m/8/ccs", "m/9/ccs"])])
+        self.assertEqual(load_partial_uc(out_fn),
+                         {'partial_uc': {2: ["m/2/ccs", "m/5/ccs"], 7: ["m/4/ccs"],
+                                         10: ["m/1/ccs", "m/3/ccs"]},
+                          'nohit': set(["m/8/ccs", "m/9/ccs"])})
+        self.assertEqual(load_partial_uc(self.pickles[0]), self.chunks[0])
+
+        # Merge sorted chunks and pickles.
+        sorted_fn = op.join(OUT_DIR, "test_PartialUCIO.0.sorted.txt")
+        write_partial_uc(self.chunks[0]['partial_uc'], self.chunks[0]['nohit'], sorted_fn)
+        out_fn2 = op.join(OUT_DIR, "test_PartialUCIO.nfl.all.partial_uc.2.pickle")
+        merge_partial_uc([sorted_fn, self.pickles[1]], out_fn2)
+        self.assertEqual(open(out_fn2).read(), open(out_fn).read())
+
+    def test_merge_partial_uc_pickles(self):
+        """Test merge_partial_uc_pickles, which writes a pickle and its sorted text file."""
+        out_pickle = op.join(OUT_DIR, "test_PartialUCIO.merged.partial_uc.pickle")
+        text_fn = partial_uc_text_file(out_pickle)
+        self.assertEqual(text_fn, op.join(OUT_DIR, "test_PartialUCIO.merged.partial_uc.txt"))
+        self.assertEqual(partial_uc_text_file("a/nfl.pickle"), "a/nfl.partial_uc.txt")
+
+        self.assertEqual(merge_partial_uc_pickles(self.pickles, out_pickle), text_fn)
+        expected = {'partial_uc': {2: ["m/2/ccs", "m/5/ccs"], 7: ["m/4/ccs"],
+                                   10: ["m/1/ccs", "m/3/ccs"]},
+                    'nohit': set(["m/8/ccs", "m/9/ccs"])}
+        for loads in (cPickle.loads, pickle.loads):
+            self.assertEqual(loads(open(out_pickle, 'rb').read()), expected)
+        self.assertTrue(is_partial_uc_file(text_fn))
+        self.assertEqual(load_partial_uc(text_fn), expected)
+        self.assertEqual(list(iter_partial_uc(text_fn))[-1], (None, ["m/8/ccs", "m/9/ccs"]))
+
+        # The pickle is read, not its text file, no matter which is newer.
+        with open(out_pickle, 'wb') as writer:
+            cPickle.dump(self.chunks[0], writer)
+        self.assertEqual(load_partial_uc(out_pickle), self.chunks[0])
+
+        # No cluster and no nohit reads.
+        empty_pickle = op.join(OUT_DIR, "test_PartialUCIO.empty.partial_uc.pickle")
+        with open(self.pickles[0], 'wb') as writer:
+            cPickle.dump({'partial_uc': {}, 'nohit': set()}, writer)
+        merge_partial_uc_pickles(self.pickles[0:1], empty_pickle)
+        with open(empty_pickle, 'rb') as reader:
+            self.assertEqual(cPickle.load(reader), {'partial_uc': {}, 'nohit': set()})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+"""Test pbtranscript.ice.PolishCache"""
+
+import unittest
+import os
+import os.path as op
+import shutil
+from pbtranscript.Utils import mkdir
+from pbtranscript.ice.PolishCache import PolishCache, polish_cache_key, \
+    file_signatures
+from test_setpath import OUT_DIR
+
+
+class TestPolishCache(unittest.TestCase):
+    """Class for testing PolishCache."""
+
+    def setUp(self):
+        """Set up test data."""
+        self.test_dir = op.join(OUT_DIR, "test_PolishCache")
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+        mkdir(self.test_dir)
+        self.cache = PolishCache(op.join(self.test_dir, "cache"))
+        self.files = {"raw": op.join(self.test_dir, "c1", "in.raw_with_partial.fasta"),
+                      "aln": op.join(self.test_dir, "c1", "out.sam")}
+
+    def test_polish_cache_key(self):
+        """Test polish_cache_key."""
+        key = polish_cache_key({"bam": False}, 1, ["a/1/ccs", "b/2/ccs"], [], "ACGT")
+        self.assertEqual(key, polish_cache_key({"bam": False}, 1, ["a/1/ccs", "b/2/ccs"], [], "ACGT"))
+        self.assertNotEqual(key, polish_cache_key({"bam": True}, 1, ["a/1/ccs", "b/2/ccs"], [], "ACGT"))
+        self.assertNotEqual(key, polish_cache_key({"bam": False}, 1, ["a/1/ccs"], [], "ACGT"))
+        self.assertNotEqual(key, polish_cache_key({"bam": False}, 1, ["a/1/ccs", "b/2/ccs"], [], "ACGA"))
+
+    def test_save_and_restore(self):
+        """Test PolishCache.save, restore and discard."""
+        key = polish_cache_key("c1")
+        self.assertTrue(self.cache.restore(key, self.files) is None)
+
+        mkdir(op.dirname(self.files["raw"]))
+        for name, fn in self.files.iteritems():
+            with open(fn, 'w') as writer:
+                writer.write(name)
+        self.cache.save(key, self.files, data={"valid_cids": [1]})
+        self.assertTrue(key in self.cache)
+
+        # Files created again must not modify cached files.
+        self.cache.discard(self.files)
+        self.assertFalse(op.exists(self.files["raw"]))
+        with open(self.files["aln"], 'w') as writer:
+            writer.write("modified")
+
+        self.assertEqual(self.cache.restore(key, self.files), {"valid_cids": [1]})
+        for name, fn in self.files.iteritems():
+            self.assertEqual(open(fn).read(), name)
+        self.assertTrue(self.cache.restore(polish_cache_key("c2"), self.files) is None)
+
+    def test_file_signatures(self):
+        """Test file_signatures, which changes if a file is modified."""
+        fn = op.join(self.test_dir, "subreads.bam")
+        with open(fn, 'w') as writer:
+            writer.write("ACGT")
+        signatures = file_signatures([fn, fn])
+        self.assertEqual(signatures, [[op.realpath(fn), 4, op.getmtime(fn)]])
+        with open(fn, 'a') as writer:
+            writer.write("A")
+        self.assertNotEqual(file_signatures([fn]), signatures)
+
+    def test_prune(self):
+        """Test PolishCache.prune, which removes least recently used entries."""
+        mkdir(op.dirname(self.files["raw"]))
+        for name, fn in self.files.iteritems():
+            with open(fn, 'w') as writer:
+                writer.write("A" * 100)
+        keys = [polish_cache_key("c%d" % i) for i in range(3)]
+        for i, key in enumerate(keys):
+            self.cache.save(key, self.files)
+            os.utime(self.cache.entry_dir(key), (i, i))
+        self.assertEqual([key for _mtime, key in self.cache.entries()], keys)
+
+        # Restoring an entry makes it the most recently used.
+        self.cache.restore(keys[0], self.files)
+        self.assertEqual(self.cache.prune(max_size=450), 1)
+        self.assertFalse(keys[1] in self.cache)
+        self.assertTrue(keys[0] in self.cache and keys[2] in self.cache)
+        self.assertEqual(self.cache.prune(max_size=0), 2)
+        self.assertEqual(self.cache.entries(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
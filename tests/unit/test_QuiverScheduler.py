@@ -0,0 +1,47 @@
+"""Test pbtranscript.ice.QuiverScheduler."""
+import unittest
+from collections import defaultdict
+from pbtranscript.ice.QuiverScheduler import cluster_polish_cost, \
+    cluster_polish_costs, pack_by_cost, local_job_slots
+
+
+class TestQuiverScheduler(unittest.TestCase):
+    """Test QuiverScheduler."""
+
+    def test_cluster_polish_costs(self):
+        """Test cluster_polish_cost and cluster_polish_costs."""
+        self.assertEqual(cluster_polish_cost(9, 1000), 10000)
+        self.assertEqual(cluster_polish_cost(0, 0), 1)
+
+        uc = {0: ['a', 'b'], 1: ['c']}
+        partial_uc = defaultdict(lambda: [])
+        partial_uc[1] = ['d', 'e', 'f']
+        costs = cluster_polish_costs(cids=[0, 1], uc=uc, partial_uc=partial_uc,
+                                     consensus_lens={0: 100, 1: 200})
+        self.assertEqual(costs, {0: 300, 1: 1000})
+
+    def test_pack_by_cost(self):
+        """Test pack_by_cost, a huge cluster is packed alone."""
+        costs = dict((cid, 1) for cid in range(10))
+        costs[3] = 9
+        packs = pack_by_cost(range(10), costs, 2)
+        self.assertEqual(packs, [[3], [0, 1, 2, 4, 5, 6, 7, 8, 9]])
+
+        packs = pack_by_cost(range(10), dict((cid, 1) for cid in range(10)), 3)
+        self.assertEqual(sorted(len(p) for p in packs), [3, 3, 4])
+        self.assertEqual(sorted(sum(packs, [])), range(10))
+
+        # more packs than clusters
+        packs = pack_by_cost([5, 6], {5: 1, 6: 2}, 4)
+        self.assertEqual(packs, [[6], [5], [], []])
+
+    def test_local_job_slots(self):
+        """Test local_job_slots."""
+        self.assertEqual(local_job_slots(nproc_per_job=8, cpus=32, mem_per_job=1), 4)
+        self.assertEqual(local_job_slots(nproc_per_job=8, cpus=4, mem_per_job=1), 1)
+        self.assertEqual(local_job_slots(nproc_per_job=1, cpus=32,
+                                         mem_per_job=1024**5), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+"""Test classes defined within pbtranscript.io.ReadAnnotation."""
+import unittest
+import gzip
+import os.path as op
+from pbtranscript.io.ReadAnnotation import ReadAnnotation, PrimerReportWriter
+from test_setpath import OUT_DIR
+
+
+class TEST_ReadAnnotation(unittest.TestCase):
+    """Test ReadAnnotation and PrimerReportWriter."""
+    def setUp(self):
+        """Define annotations."""
+        self.annotations = [
+            ReadAnnotation(ID="movie/1/0_100_CCS"),
+            ReadAnnotation(ID="movie/2/30_180_CCS", strand="+", fiveend=30,
+                           polyAend=150, threeend=180, primer=0, chimera=0)]
+        self.expected = ReadAnnotation.header(delimiter=",") + "\n" + \
+            "".join([a.toReportRecord(delimitor=",") + "\n"
+                     for a in self.annotations])
+
+    def test_PrimerReportWriter(self):
+        """Test PrimerReportWriter writes the same rows as toReportRecord."""
+        out_fn = op.join(OUT_DIR, "test_PrimerReportWriter.csv")
+        with PrimerReportWriter(out_fn, buffer_size=1) as writer:
+            for annotation in self.annotations:
+                writer.write(annotation)
+        self.assertEqual(open(out_fn, 'r').read(), self.expected)
+
+    def test_PrimerReportWriter_gz(self):
+        """Test PrimerReportWriter compresses *.gz outputs."""
+        out_fn = op.join(OUT_DIR, "test_PrimerReportWriter.csv.gz")
+        with PrimerReportWriter(out_fn) as writer:
+            for annotation in self.annotations:
+                writer.write(annotation)
+            self.assertEqual(len(writer), 2)
+        self.assertEqual(gzip.open(out_fn, 'rb').read(), self.expected)
+
+    def test_PrimerReportWriter_append(self):
+        """Test PrimerReportWriter appends rows of a report without header."""
+        nfl_fn = op.join(OUT_DIR, "test_PrimerReportWriter.nfl.csv")
+        with PrimerReportWriter(nfl_fn, write_header=False) as writer:
+            writer.write(self.annotations[1])
+        out_fn = op.join(OUT_DIR, "test_PrimerReportWriter.append.csv")
+        with PrimerReportWriter(out_fn) as writer:
+            writer.write(self.annotations[0])
+            writer.append(nfl_fn)
+        self.assertEqual(open(out_fn, 'r').read(), self.expected)
+
+if __name__ == "__main__":
+    unittest.main()
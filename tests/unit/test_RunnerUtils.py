@@ -3,6 +3,8 @@
 import unittest
 import os.path as op
 import filecmp
+import time
+import threading
 from pbcore.util.Process import backticks
 from pbtranscript.RunnerUtils import *
 from pbtranscript.ClusterOptions import SgeOptions
@@ -45,6 +47,32 @@ class TestRunnerUtils(unittest.TestCase):
         self.assertEqual(["unknown_cmd"],
                          local_job_runner(cmds_list, num_threads, throw_error=False))
 
+    def test_backoff_intervals(self):
+        """Test backoff_intervals."""
+        intervals = backoff_intervals(initial=1, maximum=5)
+        self.assertEqual([next(intervals) for _i in range(5)], [1, 2, 4, 5, 5])
+
+    def test_wait_for_files(self):
+        """Test wait_for_files, which returns when the last file is created."""
+        fns = [op.join(self.out_dir, "test_wait_for_files.%d.DONE" % i) for i in range(2)]
+        for fn in fns:
+            backticks('rm -f %s' % fn)
+        self.assertFalse(wait_for_files(fns, timeout=0.2))
+
+        # Files are created by timers, after wait_for_files starts waiting.
+        threads = [threading.Timer(0.2 * (i + 1), lambda fn=fn: open(fn, 'w').close())
+                   for i, fn in enumerate(fns)]
+        start = time.time()
+        for t in threads:
+            t.start()
+        self.assertFalse(any(op.exists(fn) for fn in fns))
+        self.assertTrue(wait_for_files(fns, timeout=30))
+        elapsed = time.time() - start
+        self.assertTrue(0.4 <= elapsed < 5)
+        for t in threads:
+            t.join()
+        self.assertTrue(wait_for_files(fns, timeout=0))
+
     @unittest.skipUnless(backticks('qstat')[1] == 0, "sge disabled")
     def test_get_active_sge_jobs(self):
         """Test get_active_sge_jobs"""
@@ -0,0 +1,105 @@
+"""Test pbtranscript.io.SamMergeIO"""
+
+import unittest
+import os
+import os.path as op
+from pbtranscript.io import merge_sam_header_lines, merge_sam_files, sam_header_lines
+from test_setpath import OUT_DIR
+
+
+HEADER_0 = ["@HD\tVN:1.5\tSO:coordinate",
+            "@SQ\tSN:chr1\tLN:1000\tM5:a1b2",
+            "@SQ\tSN:chr2\tLN:500\tM5:c3d4",
+            "@RG\tID:rg0\tPL:PACBIO",
+            "@PG\tID:GMAP\tCL:gmap chunk0.fasta"]
+
+HEADER_1 = ["@HD\tVN:1.5\tSO:coordinate",
+            "@SQ\tSN:chr1\tLN:1000\tM5:a1b2",
+            "@SQ\tSN:chr2\tLN:500\tM5:c3d4",
+            "@SQ\tSN:chr3\tLN:200\tM5:a1b2",
+            "@RG\tID:rg1\tPL:PACBIO",
+            "@PG\tID:GMAP\tCL:gmap chunk1.fasta",
+            "@CO\tchunk1"]
+
+
+def _record(name, ref, pos):
+    """Return a sam record line."""
+    return "\t".join([name, "0", ref, str(pos), "60", "4M", "*", "0", "0",
+                      "ACGT", "*"]) + "\n"
+
+
+def _write_sam(fn, header, records):
+    """Write header and records to a sam file."""
+    with open(fn, 'w') as writer:
+        writer.write("".join(line + "\n" for line in header))
+        writer.write("".join(records))
+
+
+class TestSamMergeIO(unittest.TestCase):
+    """Class for testing SamMergeIO."""
+
+    def setUp(self):
+        """Set up test data."""
+        self.records_0 = [_record("r0", "chr1", 10), _record("r1", "chr2", 5),
+                          _record("r2", "*", 0)]
+        self.records_1 = [_record("r3", "chr1", 20), _record("r4", "chr2", 1),
+                          _record("r5", "chr3", 7)]
+        self.in_fns = [op.join(OUT_DIR, "test_SamMergeIO.%d.sam" % i) for i in range(2)]
+        _write_sam(self.in_fns[0], HEADER_0, self.records_0)
+        _write_sam(self.in_fns[1], HEADER_1, self.records_1)
+
+    def test_merge_sam_header_lines(self):
+        """Test merge_sam_header_lines."""
+        lines = merge_sam_header_lines([HEADER_0, HEADER_1])
+        self.assertEqual(lines, HEADER_0[0:3] + [HEADER_1[3], HEADER_0[3],
+                                                 HEADER_1[4], HEADER_0[4],
+                                                 HEADER_1[6]])
+        self.assertEqual(sam_header_lines(self.in_fns[1]), HEADER_1)
+
+        lines = merge_sam_header_lines([HEADER_0, HEADER_1], unique_m5=True)
+        m5s = [line.split('\t')[-1] for line in lines if line.startswith("@SQ")]
+        self.assertEqual(len(set(m5s)), 3)
+        self.assertEqual(sorted(m5s[2][3:]), sorted("a1b2"))
+
+        lines = merge_sam_header_lines([HEADER_0, HEADER_1], first_rg_pg=True)
+        self.assertEqual(lines, HEADER_0[0:3] + [HEADER_1[3]] + HEADER_0[3:5] + [HEADER_1[6]])
+
+        bad_header = ["@SQ\tSN:chr1\tLN:999"]
+        with self.assertRaises(ValueError):
+            merge_sam_header_lines([HEADER_0, bad_header])
+
+    def test_merge_sam_files(self):
+        """Test merge_sam_files, sorted and unsorted sam files."""
+        out_fn = op.join(OUT_DIR, "test_SamMergeIO.merged.sam")
+        self.assertTrue(merge_sam_files(self.in_fns, out_fn))
+        self.assertEqual(open(out_fn).read().split("\n@CO\tchunk1\n")[1],
+                         "".join([self.records_0[0], self.records_1[0],
+                                  self.records_1[1], self.records_0[1],
+                                  self.records_1[2], self.records_0[2]]))
+
+        # Input files which are not sorted are concatenated.
+        _write_sam(self.in_fns[1], HEADER_1[1:], self.records_1)
+        self.assertFalse(merge_sam_files(self.in_fns, out_fn, header=HEADER_1[1:]))
+        self.assertEqual(open(out_fn).read(),
+                         "".join(line + "\n" for line in HEADER_1[1:]) +
+                         "".join(self.records_0 + self.records_1))
+
+        with self.assertRaises(IOError):
+            merge_sam_files(self.in_fns, self.in_fns[0])
+
+    def test_merge_sam_files_in_batches(self):
+        """Test merge_sam_files merges sorted sam files in batches."""
+        in_fns = self.in_fns + [op.join(OUT_DIR, "test_SamMergeIO.2.sam")]
+        _write_sam(in_fns[2], HEADER_0, [_record("r6", "chr1", 15)])
+        out_fn = op.join(OUT_DIR, "test_SamMergeIO.merged.sam")
+        self.assertTrue(merge_sam_files(in_fns, out_fn))
+        expected = open(out_fn).read()
+        batched_fn = op.join(OUT_DIR, "test_SamMergeIO.batched.sam")
+        self.assertTrue(merge_sam_files(in_fns, batched_fn, max_open_files=2))
+        self.assertEqual(open(batched_fn).read(), expected)
+        self.assertEqual([fn for fn in os.listdir(OUT_DIR)
+                          if fn.startswith("test_SamMergeIO.batched.sam.")], [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -7,7 +7,8 @@ from pbcore.io import FastaReader
 import pbcommand.testkit.core
 from pbtranscript.Utils import execute, mknewdir
 from pbtranscript.separate_flnc import SizeBin, SizeBins, \
-        SeparateFLNCByPrimer, SeparateFLNCBySize
+        SeparateFLNCByPrimer, SeparateFLNCBySize, \
+        fasta_chunk_offsets, scan_fasta_chunk, scan_read_lengths
 from test_setpath import DATA_DIR, OUT_DIR, STD_DIR, SIV_DATA_DIR
 
 PBI_DATA = "/pbi/dept/secondary/siv/testdata/pbtranscript-unittest/data/bam"
@@ -41,6 +42,28 @@ def test_SizeBins():
     assert bs.which_bin_contains(3900) == SizeBin(3, 6)
     assert bs.which_bin_contains(SizeBin(3,4)) == SizeBin(3, 6)
 
+def test_scan_read_lengths():
+    """Test fasta_chunk_offsets, scan_fasta_chunk and scan_read_lengths."""
+    fasta_fn = op.join(OUT_DIR, "test_scan_read_lengths.fasta")
+    with open(fasta_fn, 'w') as writer:
+        for i in range(0, 100):
+            seq = "A" * (i * 97)
+            writer.write(">movie/%d/0_%d_CCS strand=+;fiveseen=1;primer=%d\n" % (i, i * 97, i % 2))
+            writer.write("\n".join([seq[j:j+60] for j in range(0, len(seq), 60)]) + "\n")
+
+    offsets = fasta_chunk_offsets(fasta_fn, 7)
+    assert len(offsets) == 7
+    assert offsets[0][0] == 0 and offsets[-1][1] == op.getsize(fasta_fn)
+
+    hists = [scan_fasta_chunk((fasta_fn, start, end)) for start, end in offsets]
+    assert sum([len(h) for h in hists]) == 100
+
+    hist = scan_read_lengths(fasta_fn, cpus=3)
+    assert len(hist) == 100
+    assert (hist.min_len, hist.max_len) == (0, 99 * 97)
+    assert hist.primer_reads == {0: 50, 1: 50}
+    assert sum(hist.kb_bases.values()) == sum([i * 97 for i in range(0, 100)])
+
 
 class TestSeparateFLNCByPrimer(unittest.TestCase):
     """Test SeparateFLNCByPrimer"""
@@ -133,6 +156,23 @@ class TestSeparateFLNCBySize(unittest.TestCase):
         expected_bin_manual = [(SizeBin(3, 4), 0), (SizeBin(4, 8), 0)]
         self._test_bin_manual(bin_manual=bin_manual, expected_bin_manual=expected_bin_manual)
 
+    def test_manifest(self):
+        """Test number of reads and bases in manifest."""
+        out_dir = op.join(OUT_DIR, 'separate_flnc_by_size_manifest')
+        mknewdir(out_dir)
+        with SeparateFLNCBySize(flnc_filename=FLNC_FASTA, root_dir=out_dir,
+                                cpus=2) as obj:
+            obj.run()
+
+        rows = SeparateFLNCBySize.read_manifest(obj.out_manifest)
+        self.assertEqual([row[0] for row in rows], obj.separation_criterion)
+        self.assertEqual(sum([row[1] for row in rows]), len(obj.histogram))
+        self.assertEqual(sum([row[2] for row in rows]),
+                         sum(obj.histogram.kb_bases.values()))
+        for _c, num_reads, _b, fasta_fn in rows:
+            with FastaReader(fasta_fn) as reader:
+                self.assertEqual(len([r for r in reader]), num_reads)
+
 
 def test_end_to_end():
     """Call separate_flnc.py from command line, end to end must exit gracefully."""